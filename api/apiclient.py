@@ -0,0 +1,183 @@
+"""
+Cliente HTTP asíncrono compartido para las llamadas entre servicios de Sttcast
+Mantiene un pool de conexiones keep-alive, aplica timeouts y reintentos con jitter
+y firma cada petición con HMAC mediante create_auth_headers.
+run_until_disconnected cancela la llamada si el cliente que la originó se desconecta
+"""
+
+import asyncio
+import logging
+import random
+from typing import Any, Optional
+from urllib.parse import urljoin
+
+import httpx
+
+from api.apihmac import create_auth_headers, serialize_body
+from api.apisse import iter_sse_events
+
+# Códigos de estado que indican un fallo transitorio del servicio remoto
+RETRY_STATUS_CODES = {502, 503, 504}
+
+
+class ClientDisconnected(Exception):
+    """El cliente HTTP se desconectó antes de recibir la respuesta."""
+
+
+async def run_until_disconnected(request, awaitable, poll_interval: float = 0.25):
+    """
+    Espera a `awaitable` comprobando mientras tanto si el cliente de `request`
+    (petición de Starlette/FastAPI) se ha desconectado. En ese caso cancela la
+    llamada en curso (httpx cierra su conexión con el servicio remoto) y lanza
+    ClientDisconnected.
+    """
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=poll_interval)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                task.cancel()
+                raise ClientDisconnected()
+    finally:
+        if not task.done():
+            task.cancel()
+
+
+class SignedAsyncClient:
+    """
+    Envoltorio de httpx.AsyncClient con firma HMAC y reintentos.
+
+    Se crea una única instancia por servicio remoto en el lifespan de FastAPI,
+    de forma que todas las peticiones reutilizan las conexiones del pool.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        secret_key: str,
+        client_id: str,
+        timeout: float = 120.0,
+        connect_timeout: float = 10.0,
+        max_connections: int = 20,
+        max_keepalive_connections: int = 10,
+        keepalive_expiry: float = 30.0,
+        retries: int = 2,
+        backoff_base: float = 0.5,
+        backoff_max: float = 8.0,
+    ):
+        """
+        Args:
+            base_url: URL base del servicio remoto (ej: http://localhost:5500)
+            secret_key: Clave HMAC compartida con el servicio remoto
+            client_id: Identificador enviado en X-Client-ID
+            timeout: Timeout total de lectura/escritura en segundos
+            connect_timeout: Timeout de establecimiento de conexión en segundos
+            max_connections: Máximo de conexiones simultáneas en el pool
+            max_keepalive_connections: Máximo de conexiones ociosas que se mantienen abiertas
+            keepalive_expiry: Segundos que se mantiene abierta una conexión ociosa
+            retries: Número de reintentos ante errores de red o 502/503/504
+            backoff_base: Espera base (segundos) del backoff exponencial
+            backoff_max: Espera máxima (segundos) entre reintentos
+        """
+        self.base_url = base_url
+        self.secret_key = secret_key
+        self.client_id = client_id
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_connections = max_connections
+        self.stats_counters = {"in_flight": 0, "requests": 0, "errors": 0, "cancelled": 0}
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(timeout, connect=connect_timeout),
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=keepalive_expiry,
+            ),
+        )
+
+    def url_for(self, path: str) -> str:
+        """Construye la URL completa de un endpoint del servicio remoto."""
+        return urljoin(self.base_url, path)
+
+    def _backoff_delay(self, attempt: int) -> float:
+        """Backoff exponencial con jitter completo para no sincronizar reintentos."""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    async def post_json(self, path: str, payload: Any, retries: Optional[int] = None,
+                        timeout: Optional[float] = None) -> httpx.Response:
+        """
+        Envía un POST firmado con HMAC y devuelve la respuesta.
+
+        El cuerpo se serializa una sola vez con serialize_body (el mismo JSON que
+        se firma), pero la firma se regenera en cada intento porque incluye el timestamp.
+
+        Args:
+            path: Ruta del endpoint (ej: /getembeddings)
+            payload: Cuerpo de la petición (dict, list o modelo Pydantic)
+            retries: Reintentos para esta llamada (por defecto, los del cliente)
+            timeout: Timeout de lectura/escritura para esta llamada (por defecto, el del cliente)
+
+        Returns:
+            httpx.Response de la última petición realizada
+
+        Raises:
+            httpx.TransportError: Si fallan todos los intentos por errores de red o timeout
+        """
+        url = self.url_for(path)
+        body_bytes = serialize_body(payload).encode('utf-8')
+        max_retries = self.retries if retries is None else retries
+        extra = {} if timeout is None else {"timeout": httpx.Timeout(timeout, connect=self.client.timeout.connect)}
+
+        self.stats_counters["in_flight"] += 1
+        self.stats_counters["requests"] += 1
+        try:
+            for attempt in range(max_retries + 1):
+                headers = create_auth_headers(self.secret_key, "POST", url, payload, client_id=self.client_id)
+                try:
+                    response = await self.client.post(url, content=body_bytes, headers=headers, **extra)
+                except httpx.TransportError as e:
+                    if attempt >= max_retries:
+                        logging.error(f"Error de red en POST {url} tras {attempt + 1} intentos: {e}")
+                        self.stats_counters["errors"] += 1
+                        raise
+                    logging.warning(f"Error de red en POST {url} (intento {attempt + 1}): {e}")
+                else:
+                    if response.status_code not in RETRY_STATUS_CODES or attempt >= max_retries:
+                        return response
+                    logging.warning(f"POST {url} devolvió {response.status_code} (intento {attempt + 1}), reintentando")
+
+                await asyncio.sleep(self._backoff_delay(attempt))
+        except asyncio.CancelledError:
+            self.stats_counters["cancelled"] += 1
+            raise
+        finally:
+            self.stats_counters["in_flight"] -= 1
+
+    async def stream_events(self, path: str, payload: Any):
+        """
+        Envía un POST firmado a un endpoint SSE y devuelve sus eventos (evento, datos)
+        según llegan. Sin reintentos: una respuesta a medias no se puede repetir.
+
+        Raises:
+            httpx.HTTPStatusError: Si el servicio remoto responde con un error
+            httpx.TransportError: Si falla la conexión o se agota el timeout
+        """
+        url = self.url_for(path)
+        headers = create_auth_headers(self.secret_key, "POST", url, payload, client_id=self.client_id)
+        body_bytes = serialize_body(payload).encode('utf-8')
+        async with self.client.stream("POST", url, content=body_bytes, headers=headers) as response:
+            if response.status_code != 200:
+                await response.aread()
+                response.raise_for_status()
+            async for event in iter_sse_events(response.aiter_lines()):
+                yield event
+
+    def stats(self) -> dict:
+        return {"base_url": self.base_url, "max_connections": self.max_connections, **self.stats_counters}
+
+    async def aclose(self):
+        """Cierra el pool de conexiones."""
+        await self.client.aclose()
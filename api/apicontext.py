@@ -22,11 +22,24 @@ class GetContextRequest(BaseModel):
     n_fragments: int = 20
     only_embedding: bool = False
     query_embedding: Optional[List[float]] = None
+    token_budget: Optional[int] = None  # Context token budget (None: server default, 0: no packing)
 
 
 class GetContextResponse(BaseModel):
     context: List[dict]
     query_embedding: Optional[List[float]] = None
+    embedding_model: Optional[str] = None  # Model used to compute query_embedding
+    packing: Optional[dict] = None  # Context packing stats (tokens_in, tokens_out, tokens_saved...)
+    index_generation: Optional[int] = None  # Changes whenever the embedding space changes (migration)
+    corpus_generation: Optional[int] = None  # Changes whenever the indexed corpus changes (episode added or migration)
+
+
+# Models for /admin/embedding_migration/start endpoint
+class EmbeddingMigrationRequest(BaseModel):
+    model: str
+    dimensions: Optional[int] = None  # Reduced output dimension (text-embedding-3 models only)
+    token_budget: int = 50000
+    concurrency: int = 4
 
 
 # Models for /api/gen_stats endpoint
@@ -11,6 +11,8 @@ from typing import List, Optional
 class EpisodeInput(BaseModel):
     ep_id: str
     transcription: str
+    # "html": full transcript file; "text": plain text already extracted by the client
+    transcription_format: str = "html"
 
 
 class EpisodeOutput(BaseModel):
@@ -61,16 +63,27 @@ class RelSearchResponse(BaseModel):
 
 
 # Models for /getembeddings endpoint
+class GetEmbeddingsRequest(BaseModel):
+    """Object form of the /getembeddings body (the legacy body is a bare list of segments)"""
+    segments: List[EmbeddingInput]
+    model: Optional[str] = None  # Embedding model (default: the service's configured model)
+    dimensions: Optional[int] = None  # Reduced output dimension (text-embedding-3 models only)
+
+
 class GetEmbeddingsResponse(BaseModel):
     embeddings: List[List[float]]  # List of byte arrays for embeddings
     tokens_prompt: int
     tokens_total: int
+    model: Optional[str] = None
 
 
 # Models for /getoneembedding endpoint
 class GetOneEmbeddingRequest(BaseModel):
     query: str
+    model: Optional[str] = None
+    dimensions: Optional[int] = None
 
 
 class GetOneEmbeddingResponse(BaseModel):
     embedding: List[float]  # List of floats for the vector
+    model: Optional[str] = None
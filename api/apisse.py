@@ -0,0 +1,39 @@
+"""
+Utilidades de server-sent events (SSE) para los endpoints en streaming
+(/relsearch/stream del RAG server y /api/ask/stream de client_rag)
+"""
+
+import json
+from typing import Any, AsyncIterator, Tuple
+
+SSE_MEDIA_TYPE = "text/event-stream"
+
+# Cabeceras para que los proxies (nginx) no acumulen el stream
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",
+}
+
+
+def format_sse_event(event: str, data: Any) -> str:
+    """Serializa un evento; los datos se envían como una única línea JSON."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def iter_sse_events(lines: AsyncIterator[str]) -> AsyncIterator[Tuple[str, Any]]:
+    """Convierte un stream SSE (línea a línea) en tuplas (evento, datos)."""
+    event, data_lines = "message", []
+    async for line in lines:
+        line = line.rstrip("\r\n")
+        if not line:
+            if data_lines:
+                yield event, json.loads("\n".join(data_lines))
+            event, data_lines = "message", []
+        elif line.startswith(":"):
+            continue  # comentario / keep-alive
+        elif line.startswith("event:"):
+            event = line[6:].strip()
+        elif line.startswith("data:"):
+            data_lines.append(line[5:].lstrip())
+    if data_lines:
+        yield event, json.loads("\n".join(data_lines))
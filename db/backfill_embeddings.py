@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+"""
+Backfill de embeddings de las intervenciones almacenadas en SQLite.
+
+Recorre en streaming las intervenciones sin embedding (o, con --reembed-stale,
+las calculadas con otro modelo), las agrupa en lotes según un presupuesto de
+tokens, llama a /getembeddings del RAG server con concurrencia acotada y guarda
+cada lote en una única transacción junto con el checkpoint del último id
+procesado. Si el proceso se interrumpe, la siguiente ejecución continúa desde
+el checkpoint.
+
+Al terminar hay que reconstruir el índice FAISS con rebuild_faiss_index.py.
+
+Uso:
+    python backfill_embeddings.py [--token-budget 50000] [--concurrency 4] [--reembed-stale]
+    python backfill_embeddings.py --fake-dim 64     # embedder local determinista (pruebas)
+"""
+
+import sys
+import os
+
+# Add parent directory to path for imports
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import argparse
+import asyncio
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from tools.logs import logcfg
+from tools.envvars import load_env_vars_from_directory
+from sttcastdb import SttcastDB
+
+# Aproximación de tokens: ~4 caracteres por token en los modelos de OpenAI
+CHARS_PER_TOKEN = 4
+# Tokens del prefijo [Episodio ...] [Fecha ...] [Hablante ...] que añade el RAG server
+SEGMENT_OVERHEAD_TOKENS = 40
+
+
+def estimate_tokens(segment: dict) -> int:
+    """Estimación rápida (sin tokenizador) de los tokens de un segmento."""
+    return len(segment["content"] or "") // CHARS_PER_TOKEN + SEGMENT_OVERHEAD_TOKENS
+
+
+def row_to_segment(row) -> dict:
+    """Convierte una fila de iter_ints_to_embed en un EmbeddingInput serializable."""
+    epdate = row["epdate"]
+    return {
+        "tag": row["tag"],
+        "epname": row["epname"],
+        "epdate": epdate.strftime("%Y-%m-%d") if hasattr(epdate, "strftime") else str(epdate),
+        "start": row["start"] or 0.0,
+        "end": row["end"] or 0.0,
+        "content": row["content"] or "",
+    }
+
+
+def iter_batches(rows, token_budget: int, max_items: int):
+    """Agrupa filas en lotes de (ids, segmentos) sin superar el presupuesto de tokens."""
+    ids, segments, tokens = [], [], 0
+    for row in rows:
+        segment = row_to_segment(row)
+        seg_tokens = estimate_tokens(segment)
+        if segments and (tokens + seg_tokens > token_budget or len(segments) >= max_items):
+            yield ids, segments
+            ids, segments, tokens = [], [], 0
+        ids.append(row["id"])
+        segments.append(segment)
+        tokens += seg_tokens
+    if segments:
+        yield ids, segments
+
+
+class RagEmbedder:
+    """Calcula embeddings llamando a /getembeddings del RAG server."""
+
+    def __init__(self, client, model: str = None, dimensions: int = None):
+        """
+        Args:
+            client: SignedAsyncClient del RAG server
+            model: Modelo a pedir explícitamente (None = el configurado en el RAG server)
+            dimensions: Dimensión reducida a pedir (solo modelos text-embedding-3)
+        """
+        self.client = client
+        self.model = model
+        self.dimensions = dimensions
+
+    async def embed(self, segments: list):
+        """Devuelve (vectores, prompt_tokens, total_tokens) por segmento."""
+        payload = segments
+        if self.model or self.dimensions:
+            payload = {"segments": segments, "model": self.model, "dimensions": self.dimensions}
+        r = await self.client.post_json("/getembeddings", payload)
+        if r.status_code != 200:
+            raise RuntimeError(f"/getembeddings devolvió {r.status_code}: {r.text}")
+        rjson = r.json()
+        return rjson["embeddings"], rjson.get("tokens_prompt", 0), rjson.get("tokens_total", 0)
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+class FakeEmbedder:
+    """Embedder local determinista: el vector depende solo del texto del segmento."""
+
+    def __init__(self, dim: int = 64):
+        self.dim = dim
+        self.calls = 0
+
+    def vector_for(self, segment: dict) -> list:
+        text = f"{segment['epname']}|{segment['tag']}|{segment['content']}"
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        return np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32).tolist()
+
+    async def embed(self, segments: list):
+        self.calls += 1
+        await asyncio.sleep(0)
+        tokens = sum(estimate_tokens(s) for s in segments) // max(len(segments), 1)
+        return [self.vector_for(s) for s in segments], tokens, tokens
+
+    async def aclose(self):
+        pass
+
+
+async def run_backfill(db: SttcastDB, embedder, model: str,
+                       token_budget: int = 50000, max_items: int = 512, concurrency: int = 4,
+                       reembed_stale: bool = False, checkpoint_name: str = None,
+                       page_size: int = 2000, dim: int = None, on_batch=None, stage: bool = False) -> dict:
+    """
+    Ejecuta el backfill y devuelve estadísticas.
+
+    Con `dim`, también se recalculan (si reembed_stale) los embeddings de otra
+    dimensión y se rechazan lotes con vectores de dimensión distinta. `on_batch(ids,
+    vectors)` se llama con los vectores normalizados antes de escribirlos en la BD
+    (la migración de modelo lo usa para rellenar el índice FAISS nuevo).
+
+    Con `stage` (requiere `dim`), los vectores se guardan en embedding_staging y
+    los de speakerintervention no se tocan hasta que la migración termina.
+
+    El checkpoint guardado es la marca de agua: el mayor id tal que todos los
+    lotes anteriores están ya escritos. Como los lotes terminan en cualquier
+    orden, un lote solo adelanta el checkpoint cuando los previos han acabado.
+    """
+    checkpoint_name = checkpoint_name or f"embeddings:{model}"
+    after_id = db.get_checkpoint(checkpoint_name)
+    if after_id:
+        logging.info(f"Reanudando backfill '{checkpoint_name}' desde el id {after_id}")
+
+    semaphore = asyncio.Semaphore(concurrency)
+    inflight = OrderedDict()   # nº de lote -> último id del lote (en orden de lanzamiento)
+    completed = set()
+    stats = {"batches": 0, "segments": 0, "prompt_tokens": 0, "checkpoint": after_id}
+    start = time.perf_counter()
+
+    def advance_watermark() -> int:
+        while inflight and next(iter(inflight)) in completed:
+            batch_no, last_id = inflight.popitem(last=False)
+            completed.discard(batch_no)
+            stats["checkpoint"] = last_id
+        return stats["checkpoint"]
+
+    async def process(batch_no: int, ids: list, segments: list):
+        try:
+            vectors, prompt_tokens, total_tokens = await embedder.embed(segments)
+            if len(vectors) != len(ids):
+                raise RuntimeError(f"Lote {batch_no}: {len(vectors)} embeddings para {len(ids)} segmentos")
+            vectors = np.asarray(vectors, dtype=np.float32)
+            if dim and vectors.shape[1] != dim:
+                raise RuntimeError(f"Lote {batch_no}: dimensión {vectors.shape[1]}, se esperaba {dim}")
+            # Normalizar como en /addsegments (búsqueda por coseno en FAISS)
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            vectors /= np.where(norms > 0, norms, 1.0)
+
+            if on_batch is not None:
+                on_batch(ids, vectors)
+
+            completed.add(batch_no)
+            watermark = advance_watermark()
+            write = db.stage_embeddings if stage else db.update_embeddings
+            write(
+                ((_id, v.tobytes(), prompt_tokens, total_tokens) for _id, v in zip(ids, vectors)),
+                model=model,
+                checkpoint=(checkpoint_name, watermark),
+            )
+            stats["batches"] += 1
+            stats["segments"] += len(ids)
+            stats["prompt_tokens"] += prompt_tokens * len(ids)
+            logging.info(f"Lote {batch_no}: {len(ids)} segmentos (ids {ids[0]}-{ids[-1]}), checkpoint={watermark}")
+        finally:
+            semaphore.release()
+
+    rows = db.iter_ints_to_embed(model=model if reembed_stale else None, after_id=after_id,
+                                 page_size=page_size, dim=dim if reembed_stale else None, staged=stage)
+    tasks = []
+    try:
+        for batch_no, (ids, segments) in enumerate(iter_batches(rows, token_budget, max_items)):
+            await semaphore.acquire()
+            # Si algún lote ha fallado, dejar de lanzar nuevos
+            for t in tasks:
+                if t.done() and t.exception() is not None:
+                    raise t.exception()
+            inflight[batch_no] = ids[-1]
+            tasks.append(asyncio.create_task(process(batch_no, ids, segments)))
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        logging.error(f"Backfill interrumpido; checkpoint en el id {db.get_checkpoint(checkpoint_name)}")
+        raise
+
+    stats["seconds"] = round(time.perf_counter() - start, 2)
+    return stats
+
+
+def get_pars():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", help="Fichero SQLite (por defecto STTCAST_DB_FILE)")
+    parser.add_argument("--model", help="Modelo de embeddings (por defecto OPENAI_EMBEDDINGS_MODEL)")
+    parser.add_argument("--token-budget", type=int, default=50000, help="Tokens estimados por petición")
+    parser.add_argument("--max-items", type=int, default=512, help="Segmentos máximos por petición")
+    parser.add_argument("--concurrency", type=int, default=4, help="Peticiones simultáneas al RAG server")
+    parser.add_argument("--reembed-stale", action="store_true",
+                        help="Recalcular también los embeddings calculados con otro modelo")
+    parser.add_argument("--restart", action="store_true", help="Ignorar el checkpoint y empezar desde el principio")
+    parser.add_argument("--dimensions", type=int, help="Dimensión reducida a pedir (modelos text-embedding-3)")
+    parser.add_argument("--fake-dim", type=int, help="Usar un embedder local determinista de esta dimensión")
+    return parser.parse_args()
+
+
+async def amain(args):
+    env_dir = os.path.join(os.path.dirname(__file__), '../.env')
+    load_env_vars_from_directory(directory=env_dir)
+
+    db_file = args.db or os.getenv("STTCAST_DB_FILE")
+    if not db_file:
+        raise ValueError("STTCAST_DB_FILE environment variable is not set")
+    model = args.model or os.getenv("OPENAI_EMBEDDINGS_MODEL", "text-embedding-3-small")
+
+    if args.fake_dim:
+        embedder = FakeEmbedder(args.fake_dim)
+        model = f"fake-{args.fake_dim}"
+    else:
+        from api.apiclient import SignedAsyncClient
+        rag_server_api_key = os.getenv('RAG_SERVER_API_KEY')
+        if not rag_server_api_key:
+            raise ValueError("RAG_SERVER_API_KEY is required")
+        rag_url = f"http://{os.getenv('RAG_SERVER_HOST', 'localhost')}:{os.getenv('RAG_SERVER_PORT', '5500')}"
+        # Solo se pide el modelo explícitamente si difiere del configurado en el RAG server
+        request_model = model if (args.model or args.dimensions) else None
+        embedder = RagEmbedder(SignedAsyncClient(
+            rag_url, rag_server_api_key, client_id='backfill_embeddings',
+            timeout=float(os.getenv("RAG_HTTP_TIMEOUT", "300")),
+            max_connections=args.concurrency, max_keepalive_connections=args.concurrency,
+            retries=int(os.getenv("RAG_HTTP_RETRIES", "2")),
+        ), model=request_model, dimensions=args.dimensions)
+
+    db = SttcastDB(db_file, create_if_not_exists=False)
+    try:
+        checkpoint_name = f"embeddings:{model}" + (f":{args.dimensions}" if args.dimensions else "")
+        if args.restart:
+            db.reset_checkpoint(checkpoint_name)
+        logging.info(f"Backfill de embeddings con el modelo {model} sobre {db_file}")
+        stats = await run_backfill(db, embedder, model,
+                                   token_budget=args.token_budget, max_items=args.max_items,
+                                   concurrency=args.concurrency, reembed_stale=args.reembed_stale,
+                                   checkpoint_name=checkpoint_name, dim=args.dimensions)
+        logging.info(f"✅ Backfill completado: {stats}")
+        if stats["segments"]:
+            logging.info("💡 Reconstruye el índice FAISS con rebuild_faiss_index.py")
+    finally:
+        await embedder.aclose()
+        db.close()
+
+
+if __name__ == "__main__":
+    logcfg(__file__)
+    asyncio.run(amain(get_pars()))
@@ -17,7 +17,7 @@ from sttcastdb import SttcastDB
 from openai import OpenAI
 import json
 import faiss
-import requests
+import httpx
 from datetime import datetime
 from api.apirag import EmbeddingInput
 from api.apicontext import (
@@ -28,9 +28,14 @@ from api.apicontext import (
     GetGeneralStatsResponse,
     SpeakerStat,
     GetSpeakerStatsResponse,
-    SpeakerStatsRequest
+    SpeakerStatsRequest,
+    EmbeddingMigrationRequest
 )
-from api.apihmac import create_auth_headers, validate_hmac_auth, serialize_body
+from api.apihmac import validate_hmac_auth
+from api.apiclient import SignedAsyncClient
+from embeddingcache import QueryEmbeddingCache
+from embeddingindex import EmbeddingMigration, bump_corpus_generation, load_index_meta, space_key
+from contextpacker import pack_context
 from contextlib import asynccontextmanager
 import threading
 
@@ -119,6 +124,17 @@ async def lifespan(app: FastAPI):
         raise ValueError("RAG_SERVER_API_KEY is required")
     app.state.rag_server_api_key = rag_server_api_key
     logging.info("RAG server authentication configured successfully")
+
+    # Cliente HTTP asíncrono compartido (pool keep-alive) para el RAG server
+    app.state.rag_client = SignedAsyncClient(
+        app.state.rag_server_url,
+        rag_server_api_key,
+        client_id='context_server',
+        timeout=float(os.getenv("RAG_HTTP_TIMEOUT", "120")),
+        max_connections=int(os.getenv("RAG_HTTP_MAX_CONNECTIONS", "20")),
+        max_keepalive_connections=int(os.getenv("RAG_HTTP_MAX_KEEPALIVE", "10")),
+        retries=int(os.getenv("RAG_HTTP_RETRIES", "2")),
+    )
     
     # Cargar clave de autenticación para Context server
     global CONTEXT_SERVER_API_KEY
@@ -128,8 +144,55 @@ async def lifespan(app: FastAPI):
         raise ValueError("CONTEXT_SERVER_API_KEY is required")
     logging.info("Context server authentication configured successfully")
 
+    # ---------- Caché de embeddings de consultas ----------
+    # LRU en memoria por worker y, opcionalmente, un fichero SQLite compartido entre workers
+    embedding_model = os.getenv("OPENAI_EMBEDDINGS_MODEL", "text-embedding-3-small")
+    cache_file = os.getenv("QUERY_EMBEDDING_CACHE_FILE") or None
+    app.state.embedding_cache = QueryEmbeddingCache(
+        model=embedding_model,
+        max_items=int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "2048")),
+        ttl_seconds=float(os.getenv("QUERY_EMBEDDING_CACHE_TTL", str(7 * 86400))),
+        sqlite_path=cache_file,
+    )
+    logging.info(f"Caché de embeddings de consultas: modelo={embedding_model}, "
+                 f"tamaño={app.state.embedding_cache.max_items}, fichero={cache_file or '-'}")
+
+    # ---------- Espacio de embeddings del índice activo ----------
+    # El modelo/dimensión del índice se guarda junto a él (<índice>.meta.json) tras una migración;
+    # sin metadatos, se asume el modelo configurado en OPENAI_EMBEDDINGS_MODEL
+    app.state.default_embedding_model = embedding_model
+    meta = load_index_meta(index_file)
+    # Generación del índice (cambia con cada migración) y del corpus indexado (cambia
+    # además con cada episodio añadido); índices anteriores solo guardaban la primera
+    app.state.index_generation = meta.pop("generation", 0) if meta else 0
+    app.state.corpus_generation = meta.pop("corpus_generation", app.state.index_generation) if meta else 0
+    if meta:
+        app.state.embedding_space = meta
+        if app.state.index is not None and meta.get("dim") != app.state.index.d:
+            logging.warning(f"Los metadatos del índice indican dim={meta.get('dim')} pero el índice tiene d={app.state.index.d}")
+    else:
+        app.state.embedding_space = {
+            "model": embedding_model,
+            "dim": app.state.index.d if app.state.index is not None else None,
+            "dimensions": None,
+        }
+    app.state.migration = None
+    # Migración que cambió el índice pero se interrumpió antes de actualizar la BD: completarla
+    space = app.state.embedding_space
+    staged = {(m["embedding_model"], m["embedding_dim"]) for m in app.state.db.get_staged_embedding_models()}
+    if (space["model"], space.get("dim")) in staged:
+        promoted = app.state.db.promote_staged_embeddings(space["model"], space["dim"])
+        logging.info(f"{promoted} embeddings preparados de {space_key(space)} pasados a la BD")
+    logging.info(f"Espacio de embeddings activo: {space_key(app.state.embedding_space)} "
+                 f"(generación {app.state.index_generation}, corpus {app.state.corpus_generation})")
+
     # ---------- Otros parámetros ----------
     app.state.relevant_fragments = int(os.getenv("STTCAST_RELEVANT_FRAGMENTS", "100"))
+    # Empaquetado del contexto (MMR, uniones y presupuesto de tokens); 0 lo desactiva
+    app.state.context_token_budget = int(os.getenv("CONTEXT_TOKEN_BUDGET", "12000"))
+    app.state.context_mmr_lambda = float(os.getenv("CONTEXT_MMR_LAMBDA", "0.7"))
+    app.state.context_dedup_threshold = float(os.getenv("CONTEXT_DEDUP_THRESHOLD", "0.95"))
+    app.state.context_merge_gap = float(os.getenv("CONTEXT_MERGE_GAP", "1.0"))
     
     # Nota: La caché de estadísticas ya está cargada (se construye de forma sincrónica arriba)
     # No es necesario construirla en background
@@ -138,7 +201,22 @@ async def lifespan(app: FastAPI):
     yield
 
     # ---------- Cierre ordenado ----------
+
+    if app.state.migration is not None and app.state.migration.is_running():
+        app.state.migration.cancel()
+        logging.info("Migración de embeddings en curso cancelada (se reanudará al relanzarla)")
+
+    try:
+        await app.state.rag_client.aclose()
+        logging.info("Cliente HTTP del RAG server cerrado correctamente")
+    except Exception as e:
+        logging.warning(f"Error al cerrar el cliente HTTP del RAG server: {e}")
     
+    try:
+        app.state.embedding_cache.close()
+    except Exception as e:
+        logging.warning(f"Error al cerrar la caché de embeddings: {e}")
+
     try:
         app.state.db.close()
         logging.info("Conexión a DB cerrada correctamente")
@@ -169,9 +247,8 @@ async def addsegments(request: Request):
     db: SttcastDB = app.state.db
     db_lock: threading.Lock = app.state.db_write_lock
     index_lock: threading.Lock = app.state.index_lock
-    index = app.state.index
     index_file = app.state.index_file
-    rag_server_url = app.state.rag_server_url
+    space = app.state.embedding_space
 
     # 1) Borrado de episodio previo + inserción de segmentos (ESCRITURA: usar lock)
     with db_lock:
@@ -205,24 +282,92 @@ async def addsegments(request: Request):
         for intv in ints
     ]
     ids = [intv["id"] for intv in ints]
+    ids_new = np.array(ids, dtype=np.int64)
+
+    while True:
+        vectors, prompt_tokens, total_tokens = await embed_segments(app, segments, space)
+
+        # 3) Actualizar índice FAISS (ÍNDICE: usar lock)
+        with index_lock:
+            # Una migración pudo cambiar el índice activo mientras se calculaban los embeddings:
+            # esos vectores son del modelo anterior, así que se recalculan con el nuevo. El índice
+            # nuevo puede traer ya los segmentos (la migración también los procesa): se sustituyen
+            if app.state.embedding_space is not space:
+                logging.info(f"El índice activo cambió a {space_key(app.state.embedding_space)} durante "
+                             f"/addsegments de {req.epname}: se recalculan los embeddings")
+                space = app.state.embedding_space
+                ids_np = np.concatenate([ids_np, ids_new])
+                continue
+
+            if app.state.index is None:
+                dim = vectors.shape[1]
+                flat = faiss.IndexFlatL2(dim)
+                app.state.index = faiss.IndexIDMap2(flat)
+                if app.state.embedding_space.get("dim") is None:
+                    app.state.embedding_space["dim"] = dim
+                logging.info(f"Índice FAISS creado (dim={dim})")
+
+            if vectors.shape[1] != app.state.index.d:
+                raise HTTPException(
+                    status_code=500,
+                    detail=f"Dimensión de vectores incorrecta: esperando {app.state.index.d}, recibido {vectors.shape[1]}"
+                )
+
+            # Si habías borrado episodio antes, quita IDs antiguos del índice
+            # (y del índice en migración; los nuevos los recogerá su siguiente pasada)
+            if ids_np.size > 0:
+                try:
+                    app.state.index.remove_ids(ids_np)
+                    if app.state.migration is not None and app.state.migration.is_running():
+                        app.state.migration.remove_ids(ids_np)
+                except Exception as e:
+                    logging.warning(f"No se pudieron eliminar IDs previos del índice: {e}")
+
+            # Añade nuevos vectores
+            app.state.index.add_with_ids(vectors, ids_new)
+            faiss.write_index(app.state.index, index_file)
+            corpus_generation = bump_corpus_generation(app.state)
+            logging.info(f"Índice FAISS actualizado y guardado en {index_file} (corpus {corpus_generation})")
+
+            # 4) Guardar embeddings en DB (ESCRITURA: lock). Aún con index_lock: un cambio de
+            # índice posterior promueve después los embeddings de su modelo y no se pisan
+            with db_lock:
+                db.update_embeddings(
+                    ((_id, emb.tobytes(), prompt_tokens, total_tokens) for _id, emb in zip(ids, vectors)),
+                    model=space["model"],
+                )
+        break
 
-    url = f"{rag_server_url}/getembeddings"
-    
-    # Crear headers de autenticación HMAC
-    rag_api_key = app.state.rag_server_api_key
-    auth_headers = create_auth_headers(rag_api_key, "POST", url, segments, client_id='context_server')
-    
-    # ENVIAR EL JSON EXACTO QUE USAMOS PARA LA FIRMA
-    body_str = serialize_body(segments)
-    r = requests.post(url, data=body_str, headers=auth_headers)
+    # 5) Verificación ligera
+    remaining = db.get_ints(with_embeddings=False, epname=req.epname)
+    logging.info(f"Tras actualización, quedan {len(remaining)} segmentos sin embedding para {req.epname}")
+    return {"ok": True, "episode": req.epname, "segments": len(segments)}
+
+
+async def embed_segments(app, segments: list, space: dict):
+    """
+    Calcula en el RAG server los embeddings (normalizados) de los segmentos de un
+    episodio con el modelo del espacio indicado.
+
+    Returns:
+        (vectores float32, tokens de prompt, tokens totales)
+
+    Raises:
+        HTTPException: Si el RAG server no responde o devuelve embeddings inválidos
+    """
+    payload = segments
+    model_fields = embedding_request_fields(app, space)
+    if model_fields:
+        payload = {"segments": segments, **model_fields}
+    try:
+        r = await app.state.rag_client.post_json("/getembeddings", payload)
+    except httpx.TransportError as e:
+        raise HTTPException(status_code=502, detail=f"Error comunicando con el RAG server: {e}")
     if r.status_code != 200:
         raise HTTPException(status_code=r.status_code, detail=r.text)
     rjson = r.json()
 
     vectors = rjson.get("embeddings")
-    prompt_tokens = rjson.get("prompt_tokens", 0)
-    total_tokens = rjson.get("total_tokens", 0)
-
     if not isinstance(vectors, list) or not all(isinstance(v, list) for v in vectors):
         raise HTTPException(status_code=500, detail="Formato de embeddings inválido")
     if len(vectors) != len(segments):
@@ -233,70 +378,57 @@ async def addsegments(request: Request):
     faiss.normalize_L2(vectors)
     if vectors.ndim != 2 or vectors.shape[0] != len(segments):
         raise HTTPException(status_code=500, detail="Forma de embeddings inválida")
+    return vectors, rjson.get("tokens_prompt", 0), rjson.get("tokens_total", 0)
 
-    # 3) Actualizar índice FAISS (ÍNDICE: usar lock)
-    with index_lock:
-        if app.state.index is None:
-            dim = vectors.shape[1]
-            flat = faiss.IndexFlatL2(dim)
-            app.state.index = faiss.IndexIDMap2(flat)
-            logging.info(f"Índice FAISS creado (dim={dim})")
-
-        if vectors.shape[1] != app.state.index.d:
-            raise HTTPException(
-                status_code=500,
-                detail=f"Dimensión de vectores incorrecta: esperando {app.state.index.d}, recibido {vectors.shape[1]}"
-            )
-
-        # Si habías borrado episodio antes, quita IDs antiguos del índice
-        if ids_np.size > 0:
-            try:
-                app.state.index.remove_ids(ids_np)
-            except Exception as e:
-                logging.warning(f"No se pudieron eliminar IDs previos del índice: {e}")
-
-        # Añade nuevos vectores
-        app.state.index.add_with_ids(vectors, np.array(ids, dtype=np.int64))
-        faiss.write_index(app.state.index, index_file)
-        logging.info(f"Índice FAISS actualizado y guardado en {index_file}")
-
-    # 4) Guardar embeddings en DB (ESCRITURA: lock)
-    with db_lock:
-        for _id, emb in zip(ids, vectors):
-            db.update_embedding(_id, emb.tobytes(), prompt_tokens, total_tokens)
-        db.commit()
 
-    # 5) Verificación ligera
-    remaining = db.get_ints(with_embeddings=False, epname=req.epname)
-    logging.info(f"Tras actualización, quedan {len(remaining)} segmentos sin embedding para {req.epname}")
-    return {"ok": True, "episode": req.epname, "segments": len(segments)}
+def embedding_request_fields(app, space: dict) -> dict:
+    """
+    Campos model/dimensions para las peticiones de embeddings al RAG server.
+    Vacío si el espacio es el del modelo configurado por defecto (compatibilidad).
+    """
+    if space["model"] == app.state.default_embedding_model and not space.get("dimensions"):
+        return {}
+    return {"model": space["model"], "dimensions": space.get("dimensions")}
+
+
+async def fetch_query_embedding(query: str, app, space: Optional[dict] = None) -> np.ndarray:
+    """
+    Obtiene el embedding (sin normalizar) de una consulta, primero de la caché
+    y, si no está, del RAG server. El resultado se guarda en la caché.
+
+    Args:
+        space: Espacio de embeddings (modelo/dimensión); por defecto, el del índice activo
+
+    Raises:
+        httpx.TransportError: Si no se puede contactar con el RAG server
+        HTTPException: Si el RAG server responde con error
+    """
+    space = space or app.state.embedding_space
+    cache: QueryEmbeddingCache = app.state.embedding_cache
+    cached = cache.get(query, model=space_key(space))
+    if cached is not None:
+        return cached
+
+    rag_client: SignedAsyncClient = app.state.rag_client
+    r = await rag_client.post_json("/getoneembedding", {"query": query, **embedding_request_fields(app, space)})
+    if r.status_code != 200:
+        raise HTTPException(status_code=r.status_code, detail=r.text)
+    embedding = r.json().get("embedding")
+    if not isinstance(embedding, list):
+        raise HTTPException(status_code=502, detail="Respuesta del RAG server sin embedding")
+    return cache.put(query, embedding, model=space_key(space))
 
 
 async def get_query_embedding(query: str, app) -> Optional[List[float]]:
     """
-    Obtiene el embedding de una query genérica del RAG server.
+    Obtiene el embedding de una query genérica (caché o RAG server).
     Retorna una lista de floats o None si falla.
     """
     try:
-        rag_server_url = app.state.rag_server_url
-        rag_api_key = app.state.rag_server_api_key
-        
-        qurl = f"{rag_server_url}/getoneembedding"
-        query_data = {"query": query}
-        
-        auth_headers = create_auth_headers(rag_api_key, "POST", qurl, query_data, client_id='context_server')
-        body_str = serialize_body(query_data)
-        
-        r = requests.post(qurl, data=body_str, headers=auth_headers)
-        if r.status_code != 200:
-            logging.warning(f"Error obteniendo embedding: {r.status_code} - {r.text}")
-            return None
-        
-        embedding = r.json().get("embedding")
-        if isinstance(embedding, list):
-            return embedding
+        return (await fetch_query_embedding(query, app)).tolist()
+    except HTTPException as e:
+        logging.warning(f"Error obteniendo embedding: {e.status_code} - {e.detail}")
         return None
-        
     except Exception as e:
         logging.error(f"Error en get_query_embedding: {e}")
         return None
@@ -312,32 +444,32 @@ async def getcontext(request: Request):
     req = GetContextRequest(**body_dict)
     
     db: SttcastDB = app.state.db
-    index = app.state.index
-    rag_server_url = app.state.rag_server_url
+    # Índice y espacio de embeddings se leen juntos: una migración puede cambiarlos a la vez
+    with app.state.index_lock:
+        index = app.state.index
+        space = app.state.embedding_space
+        generation = app.state.index_generation
+        corpus_generation = app.state.corpus_generation
     k = req.n_fragments
 
     if index is None:
         raise HTTPException(status_code=500, detail="El índice FAISS aún no está inicializado")
 
     # 1. Obtener embedding de la query
-    if req.query_embedding:
+    if req.query_embedding and len(req.query_embedding) == index.d:
         # Si ya viene en la petición, usarlo
         qvec = np.array(req.query_embedding, dtype=np.float32).reshape(1, -1)
     else:
-        # Si no, calcularlo llamando al RAG server
-        qurl = f"{rag_server_url}/getoneembedding"
-        query_data = {"query": req.query}
-        
-        # Crear headers de autenticación HMAC
-        rag_api_key = app.state.rag_server_api_key
-        auth_headers = create_auth_headers(rag_api_key, "POST", qurl, query_data, client_id='context_server')
-        
-        # ENVIAR EL JSON EXACTO QUE USAMOS PARA LA FIRMA
-        body_str = serialize_body(query_data)
-        r = requests.post(qurl, data=body_str, headers=auth_headers)
-        if r.status_code != 200:
-            raise HTTPException(status_code=r.status_code, detail=r.text)
-        qvec = np.array(r.json().get("embedding"), dtype=np.float32).reshape(1, -1)
+        if req.query_embedding:
+            logging.info(f"query_embedding de dimensión {len(req.query_embedding)} ignorado "
+                         f"(índice activo: {space_key(space)})")
+        # Si no, buscarlo en la caché o calcularlo en el RAG server (sin bloquear el event loop)
+        try:
+            embedding = await fetch_query_embedding(req.query, app, space)
+        except httpx.TransportError as e:
+            raise HTTPException(status_code=502, detail=f"Error comunicando con el RAG server: {e}")
+        # Copia: normalize_L2 trabaja in situ y no debe alterar el vector cacheado
+        qvec = np.array(embedding, dtype=np.float32).reshape(1, -1)
     
     # Normalizar siempre
     faiss.normalize_L2(qvec)
@@ -347,7 +479,9 @@ async def getcontext(request: Request):
 
     # 2. Si solo se pide el embedding, devolverlo y salir
     if req.only_embedding:
-        return GetContextResponse(context=[], query_embedding=query_embedding_list)
+        return GetContextResponse(context=[], query_embedding=query_embedding_list,
+                                  embedding_model=space["model"], index_generation=generation,
+                                  corpus_generation=corpus_generation)
 
     # 3. Buscar en FAISS
     D, I = index.search(qvec, k=k)
@@ -355,11 +489,28 @@ async def getcontext(request: Request):
     if not ids or ids[0] == -1:
         raise HTTPException(status_code=404, detail="No se han encontrado segmentos relevantes para la consulta")
 
+    ids = [i for i in ids if i != -1]
     rows = db.get_ints(with_embeddings=True, ids=ids)
-    context = [{k: v for k, v in dict(row).items() if k != 'embedding'} for row in rows]
+    # get_ints no respeta el orden de FAISS: restaurarlo (más relevante primero)
+    by_id = {row['id']: {k: v for k, v in dict(row).items() if k != 'embedding'} for row in rows}
+    context = [by_id[i] for i in ids if i in by_id]
     logging.info(f"Contexto recuperado: {len(context)} fragmentos")
-    
-    return GetContextResponse(context=context, query_embedding=query_embedding_list)
+
+    token_budget = app.state.context_token_budget if req.token_budget is None else req.token_budget
+    packing = None
+    if token_budget > 0 and context:
+        # Los vectores se reconstruyen del propio índice (mismo espacio que qvec)
+        vectors = index.reconstruct_batch(np.array([f['id'] for f in context], dtype=np.int64))
+        context, packing = pack_context(
+            context, vectors, qvec[0], token_budget,
+            mmr_lambda=app.state.context_mmr_lambda,
+            dedup_threshold=app.state.context_dedup_threshold,
+            max_gap=app.state.context_merge_gap,
+        )
+
+    return GetContextResponse(context=context, query_embedding=query_embedding_list,
+                              embedding_model=space["model"], packing=packing,
+                              index_generation=generation, corpus_generation=corpus_generation)
 
 
 # Endpoint para obtener estadísticas generales entre dos fechas
@@ -401,6 +552,65 @@ async def get_speaker_stats(request: Request):
         raise HTTPException(status_code=500, detail=f"Error de validación en stats: {e}")
     return GetSpeakerStatsResponse(tags=req.tags, stats=stats)
 
+# Endpoint con las métricas de la caché de embeddings de consultas
+@app.post("/api/embedding_cache_stats")
+async def get_embedding_cache_stats(request: Request):
+    # Validar autenticación HMAC
+    body_bytes = await request.body()
+    client_id = validate_hmac_auth(request, CONTEXT_SERVER_API_KEY, body_bytes)
+
+    cache: QueryEmbeddingCache = app.state.embedding_cache
+    return cache.stats()
+
+# Endpoints de migración del modelo de embeddings
+@app.post("/admin/embedding_migration/start")
+async def start_embedding_migration(request: Request):
+    # Validar autenticación HMAC
+    body_bytes = await request.body()
+    client_id = validate_hmac_auth(request, CONTEXT_SERVER_API_KEY, body_bytes)
+
+    body_dict = json.loads(body_bytes.decode('utf-8'))
+    req = EmbeddingMigrationRequest(**body_dict)
+
+    migration: Optional[EmbeddingMigration] = app.state.migration
+    if migration is not None and migration.is_running():
+        raise HTTPException(status_code=409, detail="Ya hay una migración de embeddings en curso")
+    migration = EmbeddingMigration(app, req.model, dimensions=req.dimensions,
+                                   token_budget=req.token_budget, concurrency=req.concurrency)
+    app.state.migration = migration
+    migration.start()
+    logging.info(f"Migración de embeddings a {req.model} (dimensions={req.dimensions}) lanzada por {client_id}")
+    return migration.stats()
+
+
+@app.post("/admin/embedding_migration/status")
+async def get_embedding_migration_status(request: Request):
+    # Validar autenticación HMAC
+    body_bytes = await request.body()
+    client_id = validate_hmac_auth(request, CONTEXT_SERVER_API_KEY, body_bytes)
+
+    migration: Optional[EmbeddingMigration] = app.state.migration
+    db: SttcastDB = app.state.db
+    return {
+        "active": app.state.embedding_space,
+        "stored": db.get_embedding_models(),
+        "staged": db.get_staged_embedding_models(),
+        "migration": migration.stats() if migration is not None else None,
+    }
+
+
+@app.post("/admin/embedding_migration/cancel")
+async def cancel_embedding_migration(request: Request):
+    # Validar autenticación HMAC
+    body_bytes = await request.body()
+    client_id = validate_hmac_auth(request, CONTEXT_SERVER_API_KEY, body_bytes)
+
+    migration: Optional[EmbeddingMigration] = app.state.migration
+    if migration is None or not migration.is_running():
+        raise HTTPException(status_code=404, detail="No hay ninguna migración de embeddings en curso")
+    migration.cancel()
+    return {"ok": True}
+
 if __name__ == "__main__":
     env_dir = os.path.join(os.path.dirname(__file__), '../.env')
     # Cargar variables de entorno desde el directorio actual
@@ -0,0 +1,163 @@
+"""
+Empaquetado del contexto recuperado para /relsearch.
+
+/getcontext recupera hasta 100 intervenciones de FAISS y antes se enviaban
+todas tal cual al prompt. Muchas son casi duplicados (el mismo hablante
+repitiendo una idea, intervenciones solapadas), así que el prompt crecía sin
+aportar información. El empaquetador:
+
+1. Reordena los fragmentos con Maximal Marginal Relevance (MMR): relevancia
+   respecto a la pregunta penalizada por la similitud con lo ya elegido, y
+   descarta los casi duplicados (similitud >= dedup_threshold).
+2. Añade fragmentos en ese orden mientras quepan en el presupuesto de tokens.
+3. Une las intervenciones seleccionadas consecutivas del mismo episodio y
+   hablante, que así comparten una sola cabecera en el prompt.
+
+Los tokens se cuentan en local (tiktoken si está instalado, si no una
+estimación por caracteres), sin llamadas externas.
+"""
+
+import logging
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+try:
+    import tiktoken
+    _ENCODING = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    _ENCODING = None
+
+# Aproximación cuando no hay tokenizador: ~4 caracteres por token
+CHARS_PER_TOKEN = 4
+
+DEFAULT_MMR_LAMBDA = 0.7
+DEFAULT_DEDUP_THRESHOLD = 0.95
+DEFAULT_MERGE_GAP = 1.0
+
+
+def count_tokens(text: str) -> int:
+    """Tokens de un texto (tiktoken si está disponible, si no una estimación)."""
+    if _ENCODING is not None:
+        return len(_ENCODING.encode(text, disallowed_special=()))
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def fragment_header(fragment: dict) -> str:
+    """Cabecera con la que build_relsearch_prompt (RAG server) presenta cada fragmento."""
+    return f"{fragment['tag']} en {fragment['epname']}, [{fragment['epdate']}], a partir de {fragment['start']}s:\n"
+
+
+def fragment_tokens(fragment: dict) -> int:
+    """Tokens que ocupa un fragmento en el prompt (cabecera, contenido y separador)."""
+    return count_tokens(fragment_header(fragment) + (fragment.get("content") or "")) + 1
+
+
+def mmr_order(query_vec: np.ndarray, vectors: np.ndarray, mmr_lambda: float = DEFAULT_MMR_LAMBDA,
+              dedup_threshold: float = DEFAULT_DEDUP_THRESHOLD) -> Tuple[List[int], int]:
+    """
+    Ordena los fragmentos por Maximal Marginal Relevance.
+
+    Returns:
+        (índices en orden MMR, número de casi duplicados descartados)
+    """
+    n = len(vectors)
+    if n == 0:
+        return [], 0
+    vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    query_vec = query_vec / max(float(np.linalg.norm(query_vec)), 1e-12)
+    relevance = vectors @ query_vec
+    similarity = vectors @ vectors.T
+
+    remaining = np.ones(n, dtype=bool)
+    max_sim = np.full(n, -1.0, dtype=np.float32)
+    order, duplicates = [], 0
+    while remaining.any():
+        redundancy = np.where(max_sim > -1.0, max_sim, 0.0)
+        scores = mmr_lambda * relevance - (1 - mmr_lambda) * redundancy
+        scores[~remaining] = -np.inf
+        best = int(np.argmax(scores))
+        remaining[best] = False
+        if max_sim[best] >= dedup_threshold:
+            duplicates += 1
+            continue
+        order.append(best)
+        max_sim = np.maximum(max_sim, similarity[best])
+    return order, duplicates
+
+
+def merge_adjacent(fragments: List[dict], max_gap: float = DEFAULT_MERGE_GAP) -> Tuple[List[dict], int]:
+    """
+    Une fragmentos consecutivos del mismo episodio y hablante separados como
+    mucho max_gap segundos. El grupo resultante ocupa la posición de su
+    fragmento más relevante (el primero en la lista de entrada).
+
+    Returns:
+        (fragmentos unidos, número de uniones realizadas)
+    """
+    rank = {id(f): i for i, f in enumerate(fragments)}
+    ordered = sorted(fragments, key=lambda f: (f["epname"], float(f["start"])))
+    groups, merges = [], 0
+    for fragment in ordered:
+        last = groups[-1] if groups else None
+        if (last is not None and last["epname"] == fragment["epname"] and last["tag"] == fragment["tag"]
+                and float(fragment["start"]) - float(last["end"]) <= max_gap):
+            last["content"] = f"{last['content']} {fragment['content']}"
+            last["end"] = max(float(last["end"]), float(fragment["end"]))
+            last["_rank"] = min(last["_rank"], rank[id(fragment)])
+            merges += 1
+        else:
+            groups.append({**fragment, "_rank": rank[id(fragment)]})
+    groups.sort(key=lambda g: g["_rank"])
+    for group in groups:
+        del group["_rank"]
+    return groups, merges
+
+
+def pack_context(fragments: List[dict], vectors: Optional[np.ndarray], query_vec: Optional[np.ndarray],
+                 token_budget: int, mmr_lambda: float = DEFAULT_MMR_LAMBDA,
+                 dedup_threshold: float = DEFAULT_DEDUP_THRESHOLD,
+                 max_gap: float = DEFAULT_MERGE_GAP) -> Tuple[List[dict], dict]:
+    """
+    Selecciona, ordena y une los fragmentos para que quepan en token_budget.
+
+    Args:
+        fragments: Fragmentos en el orden de recuperación (dicts de intview)
+        vectors: Embeddings de los fragmentos (misma longitud); None para no aplicar MMR
+        query_vec: Embedding de la pregunta
+        token_budget: Máximo de tokens del contexto (0 o negativo: sin límite)
+
+    Returns:
+        (fragmentos empaquetados, estadísticas)
+    """
+    costs = [fragment_tokens(f) for f in fragments]
+    tokens_in = sum(costs)
+
+    if vectors is not None and query_vec is not None and len(fragments) > 0:
+        order, duplicates = mmr_order(query_vec, vectors, mmr_lambda, dedup_threshold)
+    else:
+        order, duplicates = list(range(len(fragments))), 0
+
+    selected, used = [], 0
+    for i in order:
+        if token_budget > 0 and used + costs[i] > token_budget:
+            continue
+        selected.append(fragments[i])
+        used += costs[i]
+
+    packed, merges = merge_adjacent(selected, max_gap)
+    tokens_out = sum(fragment_tokens(f) for f in packed)
+    stats = {
+        "fragments_in": len(fragments),
+        "fragments_out": len(packed),
+        "duplicates": duplicates,
+        "merged": merges,
+        "dropped": len(order) - len(selected),
+        "tokens_in": tokens_in,
+        "tokens_out": tokens_out,
+        "tokens_saved": tokens_in - tokens_out,
+    }
+    logging.info(f"Contexto empaquetado: {stats['fragments_in']} -> {stats['fragments_out']} fragmentos, "
+                 f"{tokens_in} -> {tokens_out} tokens ({stats['tokens_saved']} ahorrados; "
+                 f"{duplicates} duplicados, {merges} uniones, {stats['dropped']} fuera de presupuesto)")
+    return packed, stats
@@ -0,0 +1,171 @@
+"""
+Caché de embeddings de consultas para el context server.
+
+Dos niveles:
+- LRU en memoria, acotada en número de entradas (por proceso)
+- Fichero SQLite opcional (modo WAL), compartido por todos los workers
+
+La clave es sha256(modelo de embeddings + texto normalizado de la consulta),
+de modo que un cambio de modelo invalida automáticamente las entradas antiguas.
+"""
+
+import hashlib
+import logging
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+
+
+def normalize_query(query: str) -> str:
+    """Normaliza el texto de una consulta (Unicode NFKC, minúsculas, espacios colapsados)."""
+    text = unicodedata.normalize("NFKC", query or "")
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+class QueryEmbeddingCache:
+    """Caché LRU en memoria + SQLite opcional para embeddings de consultas."""
+
+    def __init__(self, model: str, max_items: int = 2048, ttl_seconds: float = 7 * 86400,
+                 sqlite_path: Optional[str] = None):
+        """
+        Args:
+            model: Modelo de embeddings (forma parte de la clave)
+            max_items: Máximo de entradas en la LRU en memoria
+            ttl_seconds: Antigüedad máxima de una entrada (0 = sin caducidad)
+            sqlite_path: Fichero SQLite compartido entre workers (None = solo memoria)
+        """
+        self.model = model
+        self.max_items = max_items
+        self.ttl_seconds = ttl_seconds
+        self.sqlite_path = sqlite_path
+        self._lru = OrderedDict()  # key -> (created_at, np.ndarray)
+        self._lock = threading.Lock()
+        self._conn = None
+        self.stats_counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "expired": 0}
+
+        if sqlite_path:
+            self._conn = sqlite3.connect(sqlite_path, timeout=30.0, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode = WAL;')
+            self._conn.execute('PRAGMA synchronous = NORMAL;')
+            self._conn.execute('PRAGMA busy_timeout = 30000;')
+            self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS query_embedding_cache (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                created_at REAL NOT NULL
+            );
+            """)
+            self._conn.commit()
+            self.prune_expired()
+            logging.info(f"Caché de embeddings de consultas en disco: {sqlite_path}")
+
+    def make_key(self, query: str, model: Optional[str] = None) -> str:
+        """Clave de caché: hash del modelo (por defecto, el de la caché) y del texto normalizado."""
+        return hashlib.sha256(f"{model or self.model}\n{normalize_query(query)}".encode("utf-8")).hexdigest()
+
+    def _is_expired(self, created_at: float) -> bool:
+        return self.ttl_seconds > 0 and time.time() - created_at > self.ttl_seconds
+
+    def _remember(self, key: str, created_at: float, vector: np.ndarray):
+        """Inserta en la LRU en memoria desalojando la entrada menos usada (requiere el lock)."""
+        self._lru[key] = (created_at, vector)
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_items:
+            self._lru.popitem(last=False)
+
+    def get(self, query: str, model: Optional[str] = None) -> Optional[np.ndarray]:
+        """Devuelve el embedding cacheado de la consulta o None."""
+        key = self.make_key(query, model)
+        with self._lock:
+            entry = self._lru.get(key)
+            if entry is not None:
+                created_at, vector = entry
+                if not self._is_expired(created_at):
+                    self._lru.move_to_end(key)
+                    self.stats_counters["memory_hits"] += 1
+                    return vector
+                del self._lru[key]
+                self.stats_counters["expired"] += 1
+
+            if self._conn is not None:
+                row = self._conn.execute(
+                    "SELECT embedding, created_at FROM query_embedding_cache WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    blob, created_at = row
+                    if not self._is_expired(created_at):
+                        vector = np.frombuffer(blob, dtype=np.float32)
+                        self._remember(key, created_at, vector)
+                        self.stats_counters["disk_hits"] += 1
+                        return vector
+                    self.stats_counters["expired"] += 1
+
+            self.stats_counters["misses"] += 1
+            return None
+
+    def put(self, query: str, embedding, model: Optional[str] = None) -> np.ndarray:
+        """Guarda el embedding de una consulta en memoria y, si hay fichero, en disco."""
+        key = self.make_key(query, model)
+        vector = np.asarray(embedding, dtype=np.float32).ravel()
+        created_at = time.time()
+        with self._lock:
+            self._remember(key, created_at, vector)
+            if self._conn is not None:
+                try:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO query_embedding_cache (key, model, embedding, created_at) "
+                        "VALUES (?, ?, ?, ?)",
+                        (key, model or self.model, vector.tobytes(), created_at)
+                    )
+                    self._conn.commit()
+                except sqlite3.Error as e:
+                    logging.warning(f"No se pudo guardar el embedding en la caché en disco: {e}")
+            self.stats_counters["stores"] += 1
+        return vector
+
+    def prune_expired(self) -> int:
+        """Elimina del fichero las entradas caducadas. Devuelve el número de filas borradas."""
+        if self._conn is None or self.ttl_seconds <= 0:
+            return 0
+        with self._lock:
+            cur = self._conn.execute(
+                "DELETE FROM query_embedding_cache WHERE created_at < ?", (time.time() - self.ttl_seconds,)
+            )
+            self._conn.commit()
+        if cur.rowcount:
+            logging.info(f"Caché de embeddings: {cur.rowcount} entradas caducadas eliminadas")
+        return cur.rowcount
+
+    def stats(self) -> dict:
+        """Métricas de la caché (contadores de este proceso y tamaño del fichero compartido)."""
+        with self._lock:
+            counters = dict(self.stats_counters)
+            memory_items = len(self._lru)
+            disk_items = None
+            if self._conn is not None:
+                disk_items = self._conn.execute("SELECT COUNT(*) FROM query_embedding_cache").fetchone()[0]
+        lookups = counters["memory_hits"] + counters["disk_hits"] + counters["misses"]
+        hits = counters["memory_hits"] + counters["disk_hits"]
+        return {
+            **counters,
+            "lookups": lookups,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            "memory_items": memory_items,
+            "memory_max_items": self.max_items,
+            "disk_items": disk_items,
+            "disk_file": self.sqlite_path,
+            "ttl_seconds": self.ttl_seconds,
+            "model": self.model,
+        }
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
@@ -0,0 +1,295 @@
+"""
+Versionado del índice FAISS por modelo de embeddings y migración entre modelos.
+
+Cada índice lleva un fichero de metadatos (<índice>.meta.json) con el modelo,
+la dimensión y, si se pidió, la dimensión reducida (`dimensions`) con la que se
+calcularon sus vectores. El context server lo lee al arrancar para saber con
+qué modelo tiene que calcular los embeddings de las consultas.
+
+EmbeddingMigration rellena en segundo plano un índice nuevo con otro modelo
+mientras las consultas siguen usando el actual, y al terminar los intercambia
+de forma atómica (bajo index_lock). Los vectores nuevos se guardan aparte
+(embedding_staging) y solo sustituyen a los de speakerintervention tras el
+cambio: si la migración se cancela o falla, la BD sigue siendo la fuente
+completa del índice activo.
+"""
+
+import asyncio
+import itertools
+import json
+import logging
+import os
+import time
+from typing import Optional
+
+import faiss
+import numpy as np
+
+from backfill_embeddings import RagEmbedder, run_backfill
+
+
+def index_meta_path(index_file: str) -> str:
+    return f"{index_file}.meta.json"
+
+
+def load_index_meta(index_file: str) -> Optional[dict]:
+    """Lee los metadatos (modelo, dimensión) de un índice, o None si no existen."""
+    path = index_meta_path(index_file)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logging.warning(f"No se pudieron leer los metadatos del índice {path}: {e}")
+        return None
+
+
+def save_index_meta(index_file: str, meta: dict):
+    """Escribe los metadatos del índice de forma atómica."""
+    path = index_meta_path(index_file)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp, path)
+
+
+def write_index_atomic(index, index_file: str):
+    """Escribe un índice FAISS en un temporal y lo renombra sobre el definitivo."""
+    tmp = f"{index_file}.tmp"
+    faiss.write_index(index, tmp)
+    os.replace(tmp, index_file)
+
+
+def save_generations(state):
+    """Guarda el espacio de embeddings y las generaciones en los metadatos del índice."""
+    save_index_meta(state.index_file, {**state.embedding_space, "generation": state.index_generation,
+                                       "corpus_generation": state.corpus_generation})
+
+
+def bump_index_generation(state) -> int:
+    """
+    Incrementa la generación del índice activo y la guarda en sus metadatos.
+    Cambia cuando cambia el espacio de embeddings (índice migrado): los
+    embeddings de preguntas guardados dejan de ser comparables. Un índice
+    migrado también es un corpus distinto, así que sube la generación del
+    corpus. Llamar con index_lock.
+    """
+    state.index_generation += 1
+    state.corpus_generation += 1
+    save_generations(state)
+    return state.index_generation
+
+
+def bump_corpus_generation(state) -> int:
+    """
+    Incrementa la generación del corpus indexado y la guarda en los metadatos.
+    Cambia con cada episodio añadido (y con cada migración): una respuesta
+    guardada solo se reutiliza con la generación con la que se generó.
+    Llamar con index_lock.
+    """
+    state.corpus_generation += 1
+    save_generations(state)
+    return state.corpus_generation
+
+
+def space_key(space: dict) -> str:
+    """Identificador del espacio de embeddings (modelo y dimensión)."""
+    return f"{space['model']}:{space.get('dim') or ''}"
+
+
+class EmbeddingMigration:
+    """Migración en segundo plano del índice FAISS a otro modelo de embeddings."""
+
+    def __init__(self, app, model: str, dimensions: Optional[int] = None,
+                 token_budget: int = 50000, concurrency: int = 4):
+        """
+        Args:
+            app: Aplicación FastAPI del context server (usa app.state)
+            model: Modelo de embeddings destino
+            dimensions: Dimensión reducida a pedir (solo modelos text-embedding-3)
+            token_budget: Tokens estimados por petición a /getembeddings
+            concurrency: Peticiones simultáneas al RAG server
+        """
+        self.app = app
+        self.model = model
+        self.dimensions = dimensions
+        self.token_budget = token_budget
+        self.concurrency = concurrency
+        self.dim = dimensions
+        self.index = None
+        self.status = "pending"
+        self.error = None
+        self.seeded = 0
+        self.segments = 0
+        self.passes = 0
+        self.started_at = time.time()
+        self.finished_at = None
+        self.task = None
+        # Ids borrados mientras try_switch escribe el índice a disco (se aplican después)
+        self._deferred_removals = None
+
+    @property
+    def space(self) -> dict:
+        return {"model": self.model, "dim": self.dim, "dimensions": self.dimensions}
+
+    @property
+    def checkpoint_name(self) -> str:
+        return f"migration:{space_key(self.space)}"
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    def cancel(self):
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+
+    def is_running(self) -> bool:
+        return self.status in ("pending", "running")
+
+    def stats(self) -> dict:
+        return {
+            "status": self.status,
+            "target": self.space,
+            "seeded": self.seeded,
+            "embedded": self.segments,
+            "passes": self.passes,
+            "index_size": self.index.ntotal if self.index is not None else 0,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "error": self.error,
+        }
+
+    async def probe_dimension(self) -> int:
+        """Pide un embedding de prueba para conocer la dimensión del modelo destino."""
+        payload = {"query": "dimension probe", "model": self.model, "dimensions": self.dimensions}
+        r = await self.app.state.rag_client.post_json("/getoneembedding", payload)
+        if r.status_code != 200:
+            raise RuntimeError(f"/getoneembedding devolvió {r.status_code}: {r.text}")
+        return len(r.json()["embedding"])
+
+    async def seed_from_db(self):
+        """Carga en el índice nuevo los embeddings que ya están en el modelo destino
+        y los preparados por una migración anterior interrumpida."""
+        db = self.app.state.db
+        rows = itertools.chain(db.iter_embeddings(model=self.model, dim=self.dim),
+                               db.iter_staged_embeddings(self.model, self.dim))
+        batch_ids, batch_vecs = [], []
+        for row in rows:
+            batch_ids.append(row["id"])
+            batch_vecs.append(np.frombuffer(row["embedding"], dtype=np.float32))
+            if len(batch_ids) >= 5000:
+                self.add_vectors(batch_ids, np.vstack(batch_vecs))
+                self.seeded += len(batch_ids)
+                batch_ids, batch_vecs = [], []
+                await asyncio.sleep(0)
+        if batch_ids:
+            self.add_vectors(batch_ids, np.vstack(batch_vecs))
+            self.seeded += len(batch_ids)
+
+    def add_vectors(self, ids, vectors: np.ndarray):
+        """Añade (o sustituye) vectores en el índice nuevo."""
+        ids_np = np.asarray(ids, dtype=np.int64)
+        with self.app.state.index_lock:
+            self.index.remove_ids(ids_np)
+            self.index.add_with_ids(np.ascontiguousarray(vectors, dtype=np.float32), ids_np)
+
+    def remove_ids(self, ids_np: np.ndarray):
+        """Quita ids del índice nuevo (episodios borrados). Requiere tener index_lock."""
+        if self.index is None or ids_np.size == 0:
+            return
+        if self._deferred_removals is not None:
+            self._deferred_removals.append(ids_np)
+        else:
+            self.index.remove_ids(ids_np)
+
+    async def run(self):
+        db = self.app.state.db
+        self.status = "running"
+        try:
+            if not self.dim:
+                self.dim = await self.probe_dimension()
+            logging.info(f"🔄 Migración de embeddings a {space_key(self.space)} iniciada")
+            self.index = faiss.IndexIDMap2(faiss.IndexFlatL2(self.dim))
+            await self.seed_from_db()
+            db.reset_checkpoint(self.checkpoint_name)
+
+            embedder = RagEmbedder(self.app.state.rag_client, model=self.model, dimensions=self.dimensions)
+            while True:
+                self.passes += 1
+                stats = await run_backfill(db, embedder, self.model,
+                                           token_budget=self.token_budget, concurrency=self.concurrency,
+                                           reembed_stale=True, checkpoint_name=self.checkpoint_name,
+                                           dim=self.dim, on_batch=self.add_vectors, stage=True)
+                self.segments += stats["segments"]
+                logging.info(f"Migración {space_key(self.space)}: pasada {self.passes}, "
+                             f"{stats['segments']} embeddings, índice con {self.index.ntotal} vectores")
+                if await self.try_switch():
+                    break
+        except asyncio.CancelledError:
+            self.status = "cancelled"
+            self.finished_at = time.time()
+            logging.warning(f"Migración a {space_key(self.space)} cancelada")
+            raise
+        except Exception as e:
+            self.status = "failed"
+            self.error = str(e)
+            self.finished_at = time.time()
+            logging.exception(f"❌ Error en la migración a {space_key(self.space)}")
+
+    def has_pending(self) -> bool:
+        """Quedan intervenciones sin embedding del modelo destino (p. ej. episodios nuevos)."""
+        rows = self.app.state.db.iter_ints_to_embed(model=self.model, dim=self.dim, page_size=1, staged=True)
+        return next(rows, None) is not None
+
+    async def try_switch(self) -> bool:
+        """
+        Sustituye el índice activo por el nuevo si no queda ninguna intervención
+        pendiente (las añadidas durante la pasada obligan a otra pasada).
+
+        El índice se escribe a un temporal en otro hilo; index_lock solo se toma
+        para el cambio en memoria y los renombrados. Los episodios borrados
+        mientras tanto obligan también a otra pasada (el temporal los incluye).
+        """
+        state = self.app.state
+        if self.has_pending():
+            return False
+
+        index_file = state.index_file
+        tmp = f"{index_file}.{self.model}-{self.dim}.tmp"
+        with state.index_lock:
+            self._deferred_removals = []
+        try:
+            await asyncio.to_thread(faiss.write_index, self.index, tmp)
+        finally:
+            with state.index_lock:
+                deferred, self._deferred_removals = self._deferred_removals, None
+                for ids_np in deferred:
+                    self.index.remove_ids(ids_np)
+
+        with state.index_lock:
+            if deferred or self.has_pending():
+                os.remove(tmp)
+                return False
+            old_space = state.embedding_space
+            if os.path.exists(index_file):
+                backup = f"{index_file}.{old_space['model']}-{old_space.get('dim')}.bak"
+                os.replace(index_file, backup)
+                logging.info(f"Índice anterior guardado en {backup}")
+            os.replace(tmp, index_file)
+
+            state.index = self.index
+            state.embedding_space = self.space
+            bump_index_generation(state)
+
+        # Solo ahora los vectores del modelo nuevo sustituyen a los antiguos en la BD
+        def promote() -> int:
+            with state.db_write_lock:
+                return state.db.promote_staged_embeddings(self.model, self.dim)
+
+        promoted = await asyncio.to_thread(promote)
+        self.status = "done"
+        self.finished_at = time.time()
+        logging.info(f"✅ Índice activo cambiado a {space_key(self.space)} ({self.index.ntotal} vectores, "
+                     f"{promoted} embeddings actualizados en la BD)")
+        return True
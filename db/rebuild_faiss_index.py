@@ -7,6 +7,9 @@ Uso:
     python rebuild_faiss_index.py
     
 El script lee las variables de entorno desde ../.env para obtener las rutas de los archivos.
+Solo se incluyen los embeddings del modelo y dimensión del índice (según sus
+metadatos <índice>.meta.json o, si no existen, OPENAI_EMBEDDINGS_MODEL y la
+dimensión más frecuente en la base de datos).
 """
 
 import sys
@@ -19,6 +22,7 @@ import logging
 from tools.logs import logcfg
 from tools.envvars import load_env_vars_from_directory
 from sttcastdb import SttcastDB
+from embeddingindex import load_index_meta, save_index_meta
 import numpy as np
 import faiss
 from datetime import datetime
@@ -62,50 +66,45 @@ def rebuild_faiss_index():
     logging.info("Conectando a la base de datos...")
     db = SttcastDB(db_file, create_if_not_exists=False)
     
-    # Obtener todas las intervenciones con embeddings
+    # Modelo y dimensión del índice
+    meta = load_index_meta(index_file) or {}
+    model = meta.get("model") or os.getenv("OPENAI_EMBEDDINGS_MODEL", "text-embedding-3-small")
+    stored = db.get_embedding_models()
+    logging.info(f"Embeddings almacenados por modelo/dimensión: {stored}")
+    dim = meta.get("dim")
+    if not dim:
+        # Dimensión más frecuente entre los embeddings del modelo (o sin etiquetar, anteriores al versionado)
+        candidates = [s for s in stored if s["embedding_model"] in (model, None)]
+        if not candidates:
+            logging.error(f"No se encontraron embeddings del modelo {model} en la base de datos")
+            db.close()
+            return False
+        dim = candidates[0]["embedding_dim"]
+    logging.info(f"Reconstruyendo índice para el modelo {model} (dimensión {dim})")
+    
+    # Obtener las intervenciones con embeddings de ese modelo y dimensión
     logging.info("Recuperando intervenciones con embeddings desde la base de datos...")
-    ints = db.get_ints(with_embeddings=True)
-    
-    if not ints:
-        logging.error("No se encontraron intervenciones con embeddings en la base de datos")
-        db.close()
-        return False
-    
-    logging.info(f"Se encontraron {len(ints)} intervenciones con embeddings")
-    
-    # Extraer IDs y embeddings
     ids = []
     embeddings = []
     
     logging.info("Procesando embeddings...")
-    for i, intv in enumerate(ints):
+    for i, intv in enumerate(db.iter_embeddings(model=model, dim=dim)):
         if i % 10000 == 0:
-            logging.info(f"Procesado {i}/{len(ints)} embeddings...")
+            logging.info(f"Procesado {i} embeddings...")
         
         int_id = intv['id']
-        embedding_blob = intv['embedding']
-        
-        if embedding_blob is None:
-            logging.warning(f"Intervención {int_id} no tiene embedding, saltando...")
-            continue
-        
-        # Convertir de BLOB a numpy array
-        # Los embeddings están guardados como float32, dimensión 1536
         try:
-            embedding = np.frombuffer(embedding_blob, dtype=np.float32)
-            
-            # Verificar dimensión
-            if len(embedding) != 1536:
-                logging.warning(f"Intervención {int_id} tiene dimensión incorrecta: {len(embedding)}, esperado 1536")
-                continue
-            
+            embedding = np.frombuffer(intv['embedding'], dtype=np.float32)
             ids.append(int_id)
             embeddings.append(embedding)
-            
         except Exception as e:
             logging.error(f"Error procesando embedding de intervención {int_id}: {e}")
             continue
     
+    skipped = sum(s["n"] for s in stored) - len(embeddings)
+    if skipped:
+        logging.warning(f"{skipped} embeddings de otros modelos/dimensiones no se incluyen en el índice")
+    
     logging.info(f"Se procesaron exitosamente {len(embeddings)} embeddings válidos")
     
     if not embeddings:
@@ -153,6 +152,8 @@ def rebuild_faiss_index():
     try:
         test_index = faiss.read_index(index_file)
         logging.info(f"✅ Verificación exitosa: {test_index.ntotal} vectores, dimensión {test_index.d}")
+        save_index_meta(index_file, {"model": model, "dim": test_index.d, "dimensions": meta.get("dimensions"),
+                                     "generation": meta.get("generation", 0) + 1})
     except Exception as e:
         logging.error(f"❌ Error verificando el índice guardado: {e}")
         db.close()
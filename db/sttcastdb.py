@@ -41,6 +41,8 @@ class SttcastDB:
             self.conn.execute('PRAGMA busy_timeout = 30000;')  # 30 segundos
             self.conn.execute('PRAGMA cache_size = -64000;')  # Tamaño del caché en páginas (ajustable)
         self.cursor = self.conn.cursor()
+        # Caché tag -> id de speakertag (los tags no se borran nunca)
+        self._tag_ids = {}
         # DEPRECATED: caché en memoria ya no se usa. Las estadísticas se obtienen directamente de cache_stats (tabla SQLite)
         # self._cache_speaker_episode_stats = {}
         
@@ -48,6 +50,8 @@ class SttcastDB:
         # (Si se acaba de crear, ya debería tener la vista)
         if self.exist_file:
             self.ensure_intview_exists()
+            self.ensure_speakertag_index()
+            self.ensure_embedding_schema()
 
     def build_cache_speaker_episode_stats(self):
         """⚠️  DEPRECATED: Ya no se necesita.
@@ -93,6 +97,7 @@ class SttcastDB:
             tag VARCHAR(100) NOT NULL
         );
         """)
+        temp_cursor.execute("CREATE INDEX IF NOT EXISTS idx_speakertag_tag ON speakertag(tag);")
         temp_cursor.execute("""
         CREATE TABLE IF NOT EXISTS audiofile (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -112,6 +117,8 @@ class SttcastDB:
             embedding BLOB,
             prompt_tokens INTEGER DEFAULT 0,
             total_tokens INTEGER DEFAULT 0,
+            embedding_model TEXT,
+            embedding_dim INTEGER,
             FOREIGN KEY (tagid) REFERENCES speakertag(id),
             FOREIGN KEY (episodeid) REFERENCES episode(id)
         );
@@ -130,6 +137,26 @@ class SttcastDB:
             PRIMARY KEY (tag, epname)
         );
         """)
+        temp_cursor.execute("""
+        CREATE TABLE IF NOT EXISTS backfill_checkpoint (
+            name TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """)
+        # Embeddings de una migración de modelo en curso (pasan a speakerintervention al terminar)
+        temp_cursor.execute("""
+        CREATE TABLE IF NOT EXISTS embedding_staging (
+            id INTEGER NOT NULL,
+            embedding_model TEXT NOT NULL,
+            embedding_dim INTEGER NOT NULL,
+            embedding BLOB NOT NULL,
+            prompt_tokens INTEGER DEFAULT 0,
+            total_tokens INTEGER DEFAULT 0,
+            PRIMARY KEY (id, embedding_model, embedding_dim),
+            FOREIGN KEY (id) REFERENCES speakerintervention(id) ON DELETE CASCADE
+        );
+        """)
         temp_cursor.execute("CREATE INDEX IF NOT EXISTS idx_cache_stats_tag ON cache_stats(tag);")
         temp_cursor.execute("CREATE INDEX IF NOT EXISTS idx_cache_stats_epname ON cache_stats(epname);")
         temp_cursor.execute("CREATE INDEX IF NOT EXISTS idx_cache_stats_epdate ON cache_stats(epdate);")
@@ -216,6 +243,70 @@ class SttcastDB:
             logging.error(f"Error al verificar/crear la tabla 'cache_stats': {e}")
             raise
     
+    def ensure_speakertag_index(self):
+        """Crea el índice por tag de speakertag en BDs antiguas que no lo tienen."""
+        try:
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_speakertag_tag ON speakertag(tag);")
+            self.conn.commit()
+        except sqlite3.OperationalError as e:
+            logging.warning(f"No se pudo crear el índice idx_speakertag_tag: {e}")
+
+    def ensure_embedding_schema(self):
+        """Añade a BDs antiguas las columnas embedding_model/embedding_dim y las tablas
+        backfill_checkpoint y embedding_staging."""
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(speakerintervention)")]
+        if "embedding_model" not in columns:
+            logging.info("Añadiendo columna embedding_model a speakerintervention")
+            self.conn.execute("ALTER TABLE speakerintervention ADD COLUMN embedding_model TEXT")
+        if "embedding_dim" not in columns:
+            logging.info("Añadiendo columna embedding_dim a speakerintervention")
+            self.conn.execute("ALTER TABLE speakerintervention ADD COLUMN embedding_dim INTEGER")
+            # Los embeddings existentes son float32: la dimensión sale del tamaño del blob
+            self.conn.execute(
+                "UPDATE speakerintervention SET embedding_dim = length(embedding) / 4 WHERE embedding IS NOT NULL"
+            )
+        self.conn.execute("""
+        CREATE TABLE IF NOT EXISTS backfill_checkpoint (
+            name TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """)
+        self.conn.execute("""
+        CREATE TABLE IF NOT EXISTS embedding_staging (
+            id INTEGER NOT NULL,
+            embedding_model TEXT NOT NULL,
+            embedding_dim INTEGER NOT NULL,
+            embedding BLOB NOT NULL,
+            prompt_tokens INTEGER DEFAULT 0,
+            total_tokens INTEGER DEFAULT 0,
+            PRIMARY KEY (id, embedding_model, embedding_dim),
+            FOREIGN KEY (id) REFERENCES speakerintervention(id) ON DELETE CASCADE
+        );
+        """)
+        self.conn.commit()
+
+    def resolve_tag_ids(self, tags) -> dict:
+        """Devuelve un diccionario tag -> id, creando los tags que no existan.
+
+        Los tags ya conocidos se sirven de la caché en memoria; los nuevos se
+        insertan con un único executemany (INSERT ... WHERE NOT EXISTS) y se
+        recuperan con una sola SELECT. No hace commit.
+        """
+        tags = set(tags)
+        missing = sorted(t for t in tags if t not in self._tag_ids)
+        if missing:
+            self.cursor.executemany(
+                "INSERT INTO speakertag (tag) SELECT ? WHERE NOT EXISTS (SELECT 1 FROM speakertag WHERE tag = ?)",
+                [(t, t) for t in missing]
+            )
+            placeholders = ",".join("?" * len(missing))
+            self.cursor.execute(
+                f"SELECT tag, MIN(id) FROM speakertag WHERE tag IN ({placeholders}) GROUP BY tag", missing
+            )
+            self._tag_ids.update({row[0]: row[1] for row in self.cursor.fetchall()})
+        return {t: self._tag_ids[t] for t in tags}
+
     def del_episode_data(self, epid):
         """Elimina todos los datos de un episodio dado su ID."""
         # Obtener el nombre del episodio para limpiar cache_stats
@@ -242,21 +333,14 @@ class SttcastDB:
         episode_id = self.cursor.lastrowid
 
         self.cursor.execute("INSERT INTO audiofile (fname, episodeid) VALUES (?, ?)", (epfile, episode_id))
-        invalid_cache_speakers = set()
-
-        for epi in epints:
-            self.cursor.execute("SELECT id FROM speakertag WHERE tag = ?", (epi['tag'],))
-            row = self.cursor.fetchone()
-            if row is None:
-                self.cursor.execute("INSERT INTO speakertag (tag) VALUES (?)", (epi['tag'],))
-                tag_id = self.cursor.lastrowid
-            else:
-                tag_id = row[0]
-            invalid_cache_speakers.add(epi['tag'])
-            self.cursor.execute(
-                "INSERT INTO speakerintervention (tagid, episodeid, start, end, content) VALUES (?, ?, ?, ?, ?)",
-                (tag_id, episode_id, epi.get('start', None), epi.get('end', None), epi.get('content', None))
-            )
+        tag_ids = self.resolve_tag_ids(epi['tag'] for epi in epints)
+        self.cursor.executemany(
+            "INSERT INTO speakerintervention (tagid, episodeid, start, end, content) VALUES (?, ?, ?, ?, ?)",
+            [
+                (tag_ids[epi['tag']], episode_id, epi.get('start', None), epi.get('end', None), epi.get('content', None))
+                for epi in epints
+            ]
+        )
         
         # Actualizar cache_stats para este episodio
         self.update_cache_stats_for_episode(epname, epdatestr, episode_id)
@@ -392,11 +476,211 @@ class SttcastDB:
         """
         params = (embedding, prompt_tokens, total_tokens, intervention_id)
         self.cursor.execute(query, params)
+        self.cursor.execute("UPDATE speakerintervention SET embedding_dim = ? WHERE id = ?",
+                            (len(embedding) // 4, intervention_id))
         self.conn.commit()
-        
+
+    def update_embeddings(self, rows, model=None, checkpoint=None):
+        """Actualiza los embeddings de muchas intervenciones en una sola transacción.
+
+        Args:
+            rows: Iterable de tuplas (intervention_id, embedding[, prompt_tokens, total_tokens])
+                  con el embedding ya serializado en bytes
+            model: Modelo de embeddings con el que se han calculado (se guarda en embedding_model)
+            checkpoint: Tupla opcional (nombre, last_id) que se guarda en la misma transacción
+        """
+        query = """
+        UPDATE speakerintervention
+        SET embedding = ?, prompt_tokens = ?, total_tokens = ?, embedding_model = COALESCE(?, embedding_model),
+            embedding_dim = ?
+        WHERE id = ?
+        """
+        params = []
+        for row in rows:
+            intervention_id, embedding, *tokens = row
+            prompt_tokens, total_tokens = (tokens + [0, 0])[:2]
+            params.append((embedding, prompt_tokens, total_tokens, model, len(embedding) // 4, intervention_id))
+        try:
+            self.cursor.executemany(query, params)
+            if checkpoint is not None:
+                self._save_checkpoint(*checkpoint)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return len(params)
+
+    def stage_embeddings(self, rows, model: str, checkpoint=None):
+        """Guarda embeddings de otro modelo en embedding_staging, sin tocar los de
+        speakerintervention (que siguen siendo los del índice activo).
+
+        Args:
+            rows: Iterable de tuplas (intervention_id, embedding[, prompt_tokens, total_tokens])
+            model: Modelo de embeddings con el que se han calculado
+            checkpoint: Tupla opcional (nombre, last_id) que se guarda en la misma transacción
+        """
+        query = """
+        INSERT OR REPLACE INTO embedding_staging
+            (id, embedding_model, embedding_dim, embedding, prompt_tokens, total_tokens)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """
+        params = []
+        for row in rows:
+            intervention_id, embedding, *tokens = row
+            prompt_tokens, total_tokens = (tokens + [0, 0])[:2]
+            params.append((intervention_id, model, len(embedding) // 4, embedding, prompt_tokens, total_tokens))
+        try:
+            self.cursor.executemany(query, params)
+            if checkpoint is not None:
+                self._save_checkpoint(*checkpoint)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return len(params)
+
+    def promote_staged_embeddings(self, model: str, dim: int) -> int:
+        """Pasa a speakerintervention los embeddings preparados de (model, dim) y los
+        borra de embedding_staging, en una sola transacción. Devuelve cuántos pasaron."""
+        staged = "FROM embedding_staging AS es WHERE es.id = speakerintervention.id " \
+                 "AND es.embedding_model = ? AND es.embedding_dim = ?"
+        try:
+            cursor = self.conn.execute(f"""
+            UPDATE speakerintervention
+            SET embedding = (SELECT es.embedding {staged}),
+                prompt_tokens = (SELECT es.prompt_tokens {staged}),
+                total_tokens = (SELECT es.total_tokens {staged}),
+                embedding_model = ?, embedding_dim = ?
+            WHERE EXISTS (SELECT 1 {staged})
+            """, (model, dim) * 5)
+            promoted = cursor.rowcount
+            self.conn.execute("DELETE FROM embedding_staging WHERE embedding_model = ? AND embedding_dim = ?",
+                              (model, dim))
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return promoted
+
+    def iter_staged_embeddings(self, model: str, dim: int, page_size=5000):
+        """Recorre (id, embedding) de los embeddings preparados de (model, dim), por páginas."""
+        query = """
+        SELECT id, embedding FROM embedding_staging
+        WHERE embedding_model = ? AND embedding_dim = ? AND id > ?
+        ORDER BY id LIMIT ?
+        """
+        last_id = 0
+        while True:
+            rows = self.conn.execute(query, (model, dim, last_id, page_size)).fetchall()
+            if not rows:
+                return
+            yield from rows
+            last_id = rows[-1]["id"]
+
+    def get_staged_embedding_models(self):
+        """Número de embeddings preparados (migración sin terminar) por (modelo, dimensión)."""
+        self.cursor.execute("""
+        SELECT embedding_model, embedding_dim, COUNT(*) AS n
+        FROM embedding_staging
+        GROUP BY embedding_model, embedding_dim
+        ORDER BY n DESC
+        """)
+        return [dict(row) for row in self.cursor.fetchall()]
+
+    def _save_checkpoint(self, name: str, last_id: int):
+        self.cursor.execute("""
+        INSERT INTO backfill_checkpoint (name, last_id, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT(name) DO UPDATE SET last_id = excluded.last_id, updated_at = excluded.updated_at
+        """, (name, last_id))
+
+    def get_checkpoint(self, name: str) -> int:
+        """Último id procesado por el backfill `name` (0 si no hay checkpoint)."""
+        self.cursor.execute("SELECT last_id FROM backfill_checkpoint WHERE name = ?", (name,))
+        row = self.cursor.fetchone()
+        return row[0] if row else 0
+
+    def set_checkpoint(self, name: str, last_id: int):
+        self._save_checkpoint(name, last_id)
+        self.conn.commit()
+
+    def reset_checkpoint(self, name: str):
+        self.cursor.execute("DELETE FROM backfill_checkpoint WHERE name = ?", (name,))
+        self.conn.commit()
+
+    def iter_ints_to_embed(self, model=None, after_id=0, page_size=1000, dim=None, staged=False):
+        """Recorre, por páginas de id creciente, las intervenciones sin embedding
+        o (si se indica `model` y/o `dim`) con un embedding de otro modelo o dimensión.
+        Con `staged`, se excluyen además las que ya tienen en embedding_staging un
+        embedding de ese modelo y dimensión (requiere `model` y `dim`).
+
+        Usa paginación por clave (id > último id) para no mantener un cursor
+        abierto mientras se escriben resultados en la misma conexión.
+        """
+        query = """
+        SELECT si.id, st.tag, e.epname, e.epdate, si.start, si.end, si.content
+        FROM speakerintervention AS si
+        JOIN episode AS e ON si.episodeid = e.id
+        JOIN speakertag AS st ON si.tagid = st.id
+        WHERE si.id > ? AND (si.embedding IS NULL
+        """
+        params = []
+        if model:
+            query += " OR si.embedding_model IS NULL OR si.embedding_model != ?"
+            params.append(model)
+        if dim:
+            query += " OR si.embedding_dim IS NULL OR si.embedding_dim != ?"
+            params.append(dim)
+        query += ")"
+        if staged:
+            query += """ AND NOT EXISTS (SELECT 1 FROM embedding_staging AS es
+                     WHERE es.id = si.id AND es.embedding_model = ? AND es.embedding_dim = ?)"""
+            params += [model, dim]
+        query += " ORDER BY si.id LIMIT ?"
+        last_id = after_id
+        while True:
+            rows = self.conn.execute(query, [last_id, *params, page_size]).fetchall()
+            if not rows:
+                return
+            yield from rows
+            last_id = rows[-1]["id"]
+
     def commit(self):
         self.conn.commit()
     
+    def iter_embeddings(self, model=None, dim=None, page_size=5000):
+        """Recorre (id, embedding) de las intervenciones con embedding, por páginas.
+
+        Si se indica `model`, solo las de ese modelo (las antiguas sin etiqueta
+        se consideran del modelo pedido); si se indica `dim`, solo las de esa dimensión.
+        """
+        query = "SELECT id, embedding FROM speakerintervention WHERE id > ? AND embedding IS NOT NULL"
+        params = []
+        if model:
+            query += " AND (embedding_model IS NULL OR embedding_model = ?)"
+            params.append(model)
+        if dim:
+            query += " AND embedding_dim = ?"
+            params.append(dim)
+        query += " ORDER BY id LIMIT ?"
+        last_id = 0
+        while True:
+            rows = self.conn.execute(query, [last_id, *params, page_size]).fetchall()
+            if not rows:
+                return
+            yield from rows
+            last_id = rows[-1]["id"]
+
+    def get_embedding_models(self):
+        """Número de embeddings almacenados por (modelo, dimensión)."""
+        self.cursor.execute("""
+        SELECT embedding_model, embedding_dim, COUNT(*) AS n
+        FROM speakerintervention
+        WHERE embedding IS NOT NULL
+        GROUP BY embedding_model, embedding_dim
+        ORDER BY n DESC
+        """)
+        return [dict(row) for row in self.cursor.fetchall()]
+
     def get_ints(self, 
                 fromdate=None, 
                 todate=None, 
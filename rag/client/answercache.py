@@ -0,0 +1,92 @@
+"""
+Caché semántica de respuestas para /api/ask.
+
+Las preguntas y respuestas ya se guardan en PostgreSQL con su embedding. Si la
+pregunta nueva está muy cerca de una ya respondida (similitud del coseno por
+encima de ANSWER_CACHE_SIMILARITY) y el corpus indexado no ha cambiado desde
+entonces, se devuelve la respuesta guardada en lugar de repetir getcontext y
+relsearch (decenas de segundos de LLM).
+
+El corpus se identifica por la generación del corpus que devuelve el context
+server en /getcontext: sube con cada episodio añadido y con cada migración de
+embeddings, de modo que las respuestas anteriores dejan de servirse solas.
+(La generación del índice, que solo cambia con las migraciones, es la que
+invalida los embeddings de preguntas de QuestionEmbeddingCache.)
+
+Cada consulta a la caché queda en rag_queries_access_log con cache_hit (el
+acierto apunta a la respuesta servida; el fallo no apunta a ninguna, porque
+el umbral se aplica en la propia búsqueda).
+"""
+
+import logging
+from typing import Any, Dict, List, Optional
+
+DEFAULT_SIMILARITY = 0.95
+
+
+class AnswerCache:
+    """Consulta la BD de preguntas guardadas antes de lanzar el pipeline RAG."""
+
+    def __init__(self, db, similarity_threshold: float = DEFAULT_SIMILARITY,
+                 podcast_name: Optional[str] = None):
+        """
+        Args:
+            db: RAGDatabase (o None si no hay BD)
+            similarity_threshold: Similitud mínima para reutilizar una respuesta; <= 0 desactiva la caché
+            podcast_name: Solo se reutilizan respuestas de este podcast
+        """
+        self.db = db
+        self.similarity_threshold = similarity_threshold
+        self.podcast_name = podcast_name
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.similarity_threshold > 0 and self.db is not None and self.db.is_available
+
+    async def lookup(self, query_embedding: List[float],
+                     corpus_generation: Optional[int]) -> Optional[Dict[str, Any]]:
+        """
+        Busca una respuesta reutilizable para la pregunta.
+
+        Args:
+            query_embedding: Embedding normalizado de la pregunta
+            corpus_generation: Generación del corpus del context server (None si no la informa)
+
+        Returns:
+            La consulta guardada (con response_data y similarity) si hay acierto, o None
+        """
+        if not self.enabled or not query_embedding:
+            return None
+
+        candidate = None
+        if corpus_generation is not None:
+            candidate = await self.db.find_cached_answer(query_embedding, corpus_generation, self.podcast_name,
+                                                         self.similarity_threshold)
+        similarity = float(candidate["similarity"]) if candidate else None
+        hit = similarity is not None and similarity >= self.similarity_threshold
+
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        await self.db.log_query_access(candidate["id"] if candidate else None, similarity, cache_hit=hit)
+
+        if hit:
+            logging.info(f"Caché de respuestas: acierto con '{candidate['query_text'][:50]}' "
+                         f"(similitud {similarity:.4f}, generación {corpus_generation})")
+            return candidate
+        logging.info(f"Caché de respuestas: fallo (ninguna respuesta de la generación {corpus_generation} "
+                     f"con similitud >= {self.similarity_threshold})")
+        return None
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "similarity_threshold": self.similarity_threshold,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else None,
+        }
@@ -0,0 +1,351 @@
+"""
+Piezas compartidas del pipeline de /api/ask.
+
+Una pregunta pasaba por varias peticiones de embedding: /api/check_similar lo
+pedía al context server, /api/ask lo volvía a pedir antes de buscar el
+contexto y de guardar la consulta. Ahora cada petición crea un
+QuestionEmbedding que lo obtiene una sola vez y lo reutiliza en todas las
+etapas (consultas similares, caché de respuestas, /getcontext y save_query).
+
+- QuestionEmbeddingCache: LRU entre peticiones indexado por sha256 del texto
+  normalizado. Una entrada caduca por TTL o cuando el context server informa
+  de una generación del índice posterior (nuevo modelo de embeddings). No
+  guarda la generación del corpus: cambia con cada episodio y solo vale la
+  que acaba de informar el context server.
+- StageTimer: mide la duración de cada etapa de una pregunta y la deja en el
+  log en una sola línea.
+- AskSingleFlight: las preguntas idénticas simultáneas (mismo texto
+  normalizado e idioma) comparten una sola ejecución del pipeline (una
+  llamada al LLM y una fila en rag_queries); el resultado se conserva unos
+  segundos para las que llegan justo después.
+"""
+
+import asyncio
+import hashlib
+import logging
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+_WHITESPACE = re.compile(r'\s+')
+
+# (embedding, modelo, generación del índice, generación del corpus)
+EmbeddingFetch = Callable[[str], Awaitable[Tuple[List[float], Optional[str], Optional[int], Optional[int]]]]
+# Eventos del pipeline de una pregunta: ("delta", ...), ("result", ...) o ("error", ...)
+AskEvents = AsyncIterator[Tuple[str, dict]]
+
+
+def normalize_question(question: str) -> str:
+    """Normaliza el texto de una pregunta (Unicode NFC y espacios) para indexar la caché."""
+    return _WHITESPACE.sub(' ', unicodedata.normalize('NFC', question)).strip()
+
+
+def question_key(question: str) -> str:
+    return hashlib.sha256(normalize_question(question).encode('utf-8')).hexdigest()
+
+
+class QuestionEmbeddingCache:
+    """LRU en memoria de embeddings de preguntas."""
+
+    def __init__(self, max_items: int = 1024, ttl_seconds: float = 300.0,
+                 clock: Callable[[], float] = time.monotonic):
+        """
+        Args:
+            max_items: Entradas máximas; 0 desactiva la caché
+            ttl_seconds: Vida de una entrada en segundos. Acota también el tiempo que una
+                entrada puede arrastrar una generación del índice ya superada si este
+                worker no ha hablado con el context server desde el cambio
+        """
+        self.max_items = max_items
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._items: "OrderedDict[str, tuple]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.latest_generation: Optional[int] = None
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def observe_generation(self, generation: Optional[int]):
+        """Registra la generación del índice vista en una respuesta del context server."""
+        if generation is None:
+            return
+        with self._lock:
+            if self.latest_generation is None or generation > self.latest_generation:
+                self.latest_generation = generation
+
+    def get(self, question: str) -> Optional[tuple]:
+        """Devuelve (embedding, modelo, generación) o None si no está o ha caducado."""
+        if self.max_items <= 0:
+            return None
+        key = question_key(question)
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                stored_at, value = item
+                generation = value[2]
+                stale = (self.clock() - stored_at > self.ttl_seconds
+                         or (self.latest_generation is not None
+                             and (generation is None or generation < self.latest_generation)))
+                if not stale:
+                    self._items.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._items[key]
+            self.misses += 1
+            return None
+
+    def put(self, question: str, embedding: List[float], model: Optional[str], generation: Optional[int]):
+        if self.max_items <= 0:
+            return
+        self.observe_generation(generation)
+        key = question_key(question)
+        with self._lock:
+            self._items[key] = (self.clock(), (embedding, model, generation))
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    async def fetch_once(self, question: str, fetch: EmbeddingFetch) -> tuple:
+        """
+        Obtiene el embedding con `fetch` y lo guarda. Las peticiones simultáneas
+        de la misma pregunta esperan a la misma llamada al context server.
+        """
+        key = question_key(question)
+        task = self._inflight.get(key)
+        if task is None:
+            async def fetch_and_put():
+                value = await fetch(question)
+                self.put(question, *value[:3])
+                return value
+            task = asyncio.ensure_future(fetch_and_put())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.coalesced += 1
+        # shield: si la petición que la lanzó se cancela, la llamada sigue para las demás
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._items), "hits": self.hits, "misses": self.misses,
+                    "coalesced": self.coalesced, "latest_generation": self.latest_generation}
+
+
+class QuestionEmbedding:
+    """
+    Embedding de la pregunta de una petición: se calcula (o se toma de la
+    caché) la primera vez que alguna etapa lo necesita y se reutiliza después.
+    """
+
+    def __init__(self, question: str, fetch: EmbeddingFetch, cache: Optional[QuestionEmbeddingCache] = None,
+                 timer: Optional["StageTimer"] = None):
+        self.question = question
+        self._fetch = fetch
+        self._cache = cache
+        self.timer = timer or StageTimer("embedding")
+        self._lock = asyncio.Lock()
+        self.embedding: Optional[List[float]] = None
+        self.model: Optional[str] = None
+        self.index_generation: Optional[int] = None
+        # Generación del corpus vista en la última respuesta del context server
+        # (None si el embedding salió de la caché: hay que preguntarla)
+        self.corpus_generation: Optional[int] = None
+        self.cached = False
+        self.fetches = 0
+
+    async def get(self) -> List[float]:
+        """
+        Devuelve el embedding normalizado de la pregunta.
+
+        Raises:
+            Las excepciones de la función de obtención (el siguiente get lo reintenta)
+        """
+        async with self._lock:
+            if self.embedding is not None:
+                return self.embedding
+            with self.timer.stage("embedding"):
+                value = self._cache.get(self.question) if self._cache else None
+                if value is not None:
+                    self.cached = True
+                else:
+                    self.fetches += 1
+                    if self._cache:
+                        value = await self._cache.fetch_once(self.question, self._fetch)
+                    else:
+                        value = await self._fetch(self.question)
+            self.embedding, self.model, self.index_generation = value[:3]
+            if not self.cached:
+                self.corpus_generation = value[3]
+            return self.embedding
+
+
+class StageTimer:
+    """Tiempos por etapa de una pregunta (en el orden en que se ejecutan)."""
+
+    def __init__(self, label: str, clock: Callable[[], float] = time.perf_counter):
+        self.label = label
+        self.clock = clock
+        self.started = clock()
+        self.stages: "OrderedDict[str, float]" = OrderedDict()
+
+    @contextmanager
+    def stage(self, name: str):
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + self.clock() - start
+
+    def total(self) -> float:
+        return self.clock() - self.started
+
+    def summary(self) -> str:
+        parts = [f"{name}={seconds * 1000:.0f}ms" for name, seconds in self.stages.items()]
+        parts.append(f"total={self.total() * 1000:.0f}ms")
+        return " ".join(parts)
+
+    def log(self, outcome: str):
+        logging.info(f"Tiempos de {self.label} ({outcome}): {self.summary()}")
+
+
+class AskFlight:
+    """
+    Ejecución compartida del pipeline de una pregunta. Guarda los eventos que
+    produce para que quien se una a mitad reciba también los anteriores.
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self.events: List[Tuple[str, dict]] = []
+        self.meta: dict = {}  # datos internos del pipeline (p. ej. el id de la fila guardada)
+        self.done = False
+        self.finished_at: Optional[float] = None
+        self.waiters = 0
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+
+    @property
+    def failed(self) -> bool:
+        return self.done and self.events[-1][0] != "result"
+
+    def publish(self, event: str, data: dict):
+        self.events.append((event, data))
+        self._notify()
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def follow(self) -> AskEvents:
+        """
+        Eventos de la ejecución: los ya producidos y los siguientes según llegan.
+        Si ya terminó, solo el último (result o error).
+
+        Cuando todos los que esperan se van (navegador desconectado) se cancela
+        la ejecución.
+        """
+        if self.done:
+            yield self.events[-1]
+            return
+        self.waiters += 1
+        try:
+            sent = 0
+            while True:
+                while sent < len(self.events):
+                    yield self.events[sent]
+                    sent += 1
+                if self.done:
+                    return
+                await self._changed.wait()
+        finally:
+            self.waiters -= 1
+            if self.waiters == 0 and not self.done and self.task is not None:
+                logging.info("Pregunta abandonada por todos sus clientes: se cancela el pipeline")
+                self.task.cancel()
+
+
+class AskSingleFlight:
+    """
+    Mapa de preguntas en curso indexado por texto normalizado e idioma.
+
+    La primera petición lanza el pipeline en una tarea propia (no ligada a su
+    conexión) y las idénticas que llegan mientras tanto se unen a ella. Las
+    ejecuciones que terminan con respuesta se conservan ttl_seconds para las
+    que llegan justo después; las que fallan se olvidan al terminar.
+    """
+
+    def __init__(self, ttl_seconds: float = 30.0, clock: Callable[[], float] = time.monotonic):
+        """
+        Args:
+            ttl_seconds: Segundos que se conserva una respuesta terminada; 0 solo une
+                las preguntas simultáneas
+        """
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self._flights: "OrderedDict[str, AskFlight]" = OrderedDict()
+        self.counters = {"started": 0, "joined": 0, "reused": 0, "cancelled": 0}
+
+    @staticmethod
+    def key(question: str, language: str) -> str:
+        return hashlib.sha256(f"{(language or '').lower()}\n{normalize_question(question)}".encode('utf-8')).hexdigest()
+
+    def _expire(self):
+        now = self.clock()
+        for key in [k for k, f in self._flights.items()
+                    if f.done and now - f.finished_at > self.ttl_seconds]:
+            del self._flights[key]
+
+    def join(self, question: str, language: str,
+             pipeline: Callable[[AskFlight], AskEvents]) -> Tuple[AskFlight, str]:
+        """
+        Devuelve la ejecución de la pregunta, lanzando `pipeline(flight)` si no hay
+        ninguna en curso ni reciente.
+
+        Returns:
+            (flight, papel) con papel "started", "joined" (en curso) o "reused" (terminada)
+        """
+        self._expire()
+        key = self.key(question, language)
+        flight = self._flights.get(key)
+        if flight is not None:
+            role = "reused" if flight.done else "joined"
+            self.counters[role] += 1
+            return flight, role
+
+        flight = AskFlight(key)
+        self._flights[key] = flight
+        flight.task = asyncio.ensure_future(self._run(flight, pipeline))
+        self.counters["started"] += 1
+        return flight, "started"
+
+    async def _run(self, flight: AskFlight, pipeline: Callable[[AskFlight], AskEvents]):
+        try:
+            async for event, data in pipeline(flight):
+                flight.publish(event, data)
+                if event in ("result", "error"):
+                    break
+            else:
+                flight.events.append(("error", {"status": 502, "detail": "Respuesta incompleta del servicio de búsqueda"}))
+        except asyncio.CancelledError:
+            self.counters["cancelled"] += 1
+            flight.events.append(("error", {"status": 499, "detail": "Client closed request"}))
+        except Exception as e:
+            logging.error(f"Error en el pipeline compartido de la pregunta: {e}")
+            flight.events.append(("error", {"status": 500, "detail": f"Error interno: {str(e)}"}))
+        finally:
+            flight.done = True
+            flight.finished_at = self.clock()
+            if (flight.failed or self.ttl_seconds <= 0) and self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+            flight._notify()
+
+    def stats(self) -> dict:
+        in_flight = sum(1 for f in self._flights.values() if not f.done)
+        return {"in_flight": in_flight, "completed": len(self._flights) - in_flight,
+                "ttl_seconds": self.ttl_seconds, **self.counters}
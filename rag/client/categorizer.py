@@ -0,0 +1,100 @@
+"""
+Categorización en lote de consultas por similitud vectorial.
+
+En lugar de pasar las consultas una a una por el LLM y asignarlas con un
+UPDATE/INSERT por fila, se cargan una sola vez los embeddings de todas las
+categorías (rag_categories.category_embedding) y de todas las consultas sin
+categoría (rag_queries.categorization_embedding), se calcula la similitud del
+coseno de todas contra todas con un único producto de matrices de NumPy y se
+asignan a cada consulta sus top-k categorías por encima del umbral. Las
+asignaciones se escriben de una vez (executemany).
+
+Las consultas cuya mejor categoría no llega al umbral quedan como de baja
+confianza: son las únicas que se envían al LLM (/api/admin/suggest_categories).
+"""
+
+from dataclasses import dataclass, field
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+DEFAULT_THRESHOLD = 0.5
+DEFAULT_TOP_K = 2
+# Filas de consultas por bloque del producto de matrices (acota la memoria con muchas categorías)
+BLOCK_ROWS = 4096
+
+
+@dataclass
+class CategoryMatches:
+    """Resultado de la categorización en lote."""
+    # (query_id, category_id, similitud) por encima del umbral
+    assignments: List[Tuple[int, int, float]] = field(default_factory=list)
+    # (query_id, mejor similitud) de las consultas que no llegan al umbral
+    low_confidence: List[Tuple[int, float]] = field(default_factory=list)
+
+    @property
+    def categorized(self) -> int:
+        return len({query_id for query_id, _, _ in self.assignments})
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """Normaliza cada fila a norma 1 (las filas nulas quedan a cero)."""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms > 0)
+
+
+def match_categories(
+    query_ids: Sequence[int],
+    query_vectors: np.ndarray,
+    category_ids: Sequence[int],
+    category_vectors: np.ndarray,
+    top_k: int = DEFAULT_TOP_K,
+    threshold: float = DEFAULT_THRESHOLD
+) -> CategoryMatches:
+    """
+    Asigna a cada consulta sus top_k categorías más similares por encima del umbral.
+
+    Args:
+        query_ids: IDs de las consultas (uno por fila de query_vectors)
+        query_vectors: Matriz (n_consultas, dim) de embeddings de las consultas
+        category_ids: IDs de las categorías (uno por fila de category_vectors)
+        category_vectors: Matriz (n_categorías, dim) de embeddings de las categorías
+        top_k: Máximo de categorías por consulta
+        threshold: Similitud del coseno mínima para asignar una categoría
+
+    Returns:
+        CategoryMatches con las asignaciones (ordenadas por consulta y similitud
+        descendente) y las consultas de baja confianza
+    """
+    result = CategoryMatches()
+    if len(query_ids) == 0 or len(category_ids) == 0:
+        result.low_confidence = [(int(q), 0.0) for q in query_ids]
+        return result
+
+    categories = normalize_rows(category_vectors)
+    category_ids = np.asarray(category_ids)
+    k = max(1, min(top_k, len(category_ids)))
+
+    for start in range(0, len(query_ids), BLOCK_ROWS):
+        block_ids = query_ids[start:start + BLOCK_ROWS]
+        scores = normalize_rows(query_vectors[start:start + BLOCK_ROWS]) @ categories.T
+        # Top-k sin ordenar todas las columnas; después se ordenan solo esas k
+        if k < scores.shape[1]:
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        else:
+            top = np.broadcast_to(np.arange(scores.shape[1]), (scores.shape[0], k))
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+        for query_id, cats, sims in zip(block_ids, category_ids[top], top_scores):
+            if sims[0] < threshold:
+                result.low_confidence.append((int(query_id), float(sims[0])))
+                continue
+            for category_id, similarity in zip(cats, sims):
+                if similarity < threshold:
+                    break
+                result.assignments.append((int(query_id), int(category_id), float(similarity)))
+    return result
@@ -12,21 +12,32 @@ env_dir = os.path.join(os.path.dirname(__file__), '..', '..')
 load_env_vars_from_directory(os.path.join(env_dir, '.env'))
 
 from fastapi import FastAPI, Request, HTTPException, status
-from fastapi.responses import JSONResponse, HTMLResponse, Response, RedirectResponse
+from fastapi.responses import JSONResponse, HTMLResponse, Response, RedirectResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 from starlette.middleware.sessions import SessionMiddleware
 from pydantic import BaseModel
 from typing import List, Optional
+import asyncio
+import json
 import secrets
-import requests
+import time
+import httpx
 from datetime import datetime
 from html import escape
 from urllib.parse import urljoin
-from api.apihmac import create_auth_headers, serialize_body
-from findtime import find_nearest_time_id
-from queriesdb import db  # Importar el gestor de BD (después de cargar env vars)
+from api.apiclient import ClientDisconnected, SignedAsyncClient, run_until_disconnected
+from api.apisse import SSE_HEADERS, SSE_MEDIA_TYPE, format_sse_event
+from findtime import anchor_cache, find_nearest_time_id
+from transcriptproxy import TranscriptProxy
+from transcriptcache import TranscriptDiskCache
+from queriesdb import db, decode_cursor, encode_cursor, geoip_coordinates  # Importar el gestor de BD (después de cargar env vars)
+from answercache import AnswerCache
+from askpipeline import AskFlight, AskSingleFlight, QuestionEmbedding, QuestionEmbeddingCache, StageTimer
 from cache_buster import get_static_url
+from categorizer import match_categories
+from querymap import QueryMapCache
+from listingcache import ListingCache, conditional_response
 
 
 # Configuración desde variables de entorno
@@ -35,13 +46,47 @@ WEB_SERVICE_TIMEOUT = int(os.getenv('WEB_SERVICE_TIMEOUT', '15'))
 BASE_PATH = os.getenv('RAG_CLIENT_BASE_PATH', '')
 TRANSCRIPTS_URL_EXTERNAL = os.getenv('TRANSCRIPTS_URL_EXTERNAL')  # URL base de S3 u otro storage externo
 
+# Caché en disco de las transcripciones de TRANSCRIPTS_URL_EXTERNAL (directorio vacío la desactiva)
+TRANSCRIPTS_CACHE_DIR = os.getenv('TRANSCRIPTS_CACHE_DIR', os.path.join(os.path.dirname(__file__), 'transcripts_cache'))
+TRANSCRIPTS_CACHE_MAX_MB = int(os.getenv('TRANSCRIPTS_CACHE_MAX_MB', '512'))
+TRANSCRIPTS_CACHE_REVALIDATE = float(os.getenv('TRANSCRIPTS_CACHE_REVALIDATE', '3600'))
+
+# Conexiones simultáneas por servicio remoto: cada pregunta en curso ocupa una con el RAG server
+RAG_SERVER_MAX_CONNECTIONS = int(os.getenv('RAG_SERVER_MAX_CONNECTIONS', '50'))
+CONTEXT_SERVER_MAX_CONNECTIONS = int(os.getenv('CONTEXT_SERVER_MAX_CONNECTIONS', '20'))
+
 # Thresholds de similitud para clasificación de consultas similares
 QUERIES_HIGH_SIMILARITY = float(os.getenv('QUERIES_HIGH_SIMILARITY', '0.75'))
 QUERIES_MEDIUM_SIMILARITY = float(os.getenv('QUERIES_MEDIUM_SIMILARITY', '0.65'))
 QUERIES_LOW_SIMILARITY = float(os.getenv('QUERIES_LOW_SIMILARITY', '0.60'))
 
+# Similitud mínima para devolver una respuesta guardada sin volver a consultar el RAG (<= 0 la desactiva)
+ANSWER_CACHE_SIMILARITY = float(os.getenv('ANSWER_CACHE_SIMILARITY', '0.95'))
+
+# Caché de embeddings de preguntas entre peticiones (0 entradas la desactiva)
+QUESTION_EMBEDDING_CACHE_SIZE = int(os.getenv('QUESTION_EMBEDDING_CACHE_SIZE', '1024'))
+QUESTION_EMBEDDING_CACHE_TTL = float(os.getenv('QUESTION_EMBEDDING_CACHE_TTL', '300'))
+
+# Segundos que se comparte la respuesta de una pregunta con las idénticas que llegan después
+# (las simultáneas siempre comparten la ejecución; 0 solo une las simultáneas)
+ASK_SINGLE_FLIGHT_TTL = float(os.getenv('ASK_SINGLE_FLIGHT_TTL', '30'))
+
+# Categorización automática por similitud: top-k categorías por encima del umbral;
+# solo las consultas por debajo (hasta AUTO_CATEGORY_LLM_MAX) se envían al LLM
+AUTO_CATEGORY_THRESHOLD = float(os.getenv('AUTO_CATEGORY_THRESHOLD', '0.5'))
+AUTO_CATEGORY_TOP_K = int(os.getenv('AUTO_CATEGORY_TOP_K', '2'))
+AUTO_CATEGORY_LLM_MAX = int(os.getenv('AUTO_CATEGORY_LLM_MAX', '50'))
+
 # Umbral por defecto para mostrar consultas en el mapa público
 QUERY_MAP_LIKES_THRESHOLD = int(os.getenv('QUERY_MAP_LIKES_THRESHOLD', '1'))
+# Páginas del mapa guardadas por (umbral, generación del resumen geográfico); 0 desactiva la caché
+QUERY_MAP_CACHE_SIZE = int(os.getenv('QUERY_MAP_CACHE_SIZE', '16'))
+
+# Listados de consultas: filas por página (paginación por cursor) y segundos que se sirve
+# una página ya generada (los votos y cambios de destacadas la invalidan antes; 0 desactiva)
+QUERY_LISTING_PAGE_SIZE = int(os.getenv('QUERY_LISTING_PAGE_SIZE', '100'))
+QUERY_LISTING_MAX_PAGE_SIZE = 500
+QUERY_LISTING_CACHE_TTL = float(os.getenv('QUERY_LISTING_CACHE_TTL', '30'))
 
 # Autenticación del panel de administración
 ADMIN_PASSWORD = os.getenv('ADMIN_PASSWORD')
@@ -59,9 +104,35 @@ async def lifespan(app_instance: FastAPI):
         await app_instance.db.initialize()
         # Crear tablas si no existen
         await app_instance.db.create_tables()
+    # Cliente con conexiones persistentes al RAG server (respuestas en streaming)
+    app_instance.rag_client = SignedAsyncClient(
+        app_instance.rag_server_url, app_instance.rag_server_api_key, "client_rag_service",
+        max_connections=RAG_SERVER_MAX_CONNECTIONS, max_keepalive_connections=RAG_SERVER_MAX_CONNECTIONS // 2
+    )
+    # Y al context server (embedding de la pregunta y contexto)
+    app_instance.context_client = SignedAsyncClient(
+        app_instance.context_server_url, app_instance.context_server_api_key, "client_rag_service",
+        max_connections=CONTEXT_SERVER_MAX_CONNECTIONS, max_keepalive_connections=CONTEXT_SERVER_MAX_CONNECTIONS // 2
+    )
+    # Y al storage externo de transcripciones y audios (descargas en streaming),
+    # con las transcripciones HTML en una caché en disco
+    transcripts_client = httpx.AsyncClient(timeout=httpx.Timeout(10.0))
+    transcript_cache = None
+    if app_instance.transcripts_url_external and TRANSCRIPTS_CACHE_DIR:
+        transcript_cache = TranscriptDiskCache(
+            TRANSCRIPTS_CACHE_DIR, app_instance.transcripts_url_external, transcripts_client,
+            max_bytes=TRANSCRIPTS_CACHE_MAX_MB * 2**20, revalidate_seconds=TRANSCRIPTS_CACHE_REVALIDATE
+        )
+    app_instance.transcript_proxy = TranscriptProxy(
+        app_instance.transcripts_url_external, app_instance.transcripts_local_dir,
+        transcripts_client, cache=transcript_cache
+    )
     yield
     # Shutdown
     logging.info("Deteniendo client_rag...")
+    await app_instance.rag_client.aclose()
+    await app_instance.context_client.aclose()
+    await app_instance.transcript_proxy.aclose()
     if app_instance.db and app_instance.db.is_available:
         await app_instance.db.close()
 
@@ -144,6 +215,7 @@ relsearch_path = "/relsearch"
 relsearch_url = urljoin(rag_server_url, relsearch_path)
 logging.info(f"RAG server URL: {relsearch_url}")
 app.relsearch_url = relsearch_url
+app.rag_server_url = rag_server_url
 
 # Detectar si estamos en Docker y ajustar la ruta de RAG_MP3_DIR
 # Si la variable está configurada pero no existe (estamos en Docker), usar /app/transcripts
@@ -162,6 +234,14 @@ podcast_name = os.getenv('PODCAST_NAME')
 app.podcast_name = podcast_name
 logging.info(f"Podcast Name: {podcast_name}")
 
+# Caché semántica de respuestas de /api/ask
+app.answer_cache = AnswerCache(db, ANSWER_CACHE_SIMILARITY, podcast_name)
+logging.info(f"Caché de respuestas: similitud mínima {ANSWER_CACHE_SIMILARITY}")
+app.question_embeddings = QuestionEmbeddingCache(QUESTION_EMBEDDING_CACHE_SIZE, QUESTION_EMBEDDING_CACHE_TTL)
+app.ask_flights = AskSingleFlight(ASK_SINGLE_FLIGHT_TTL)
+app.query_maps = QueryMapCache(QUERY_MAP_CACHE_SIZE)
+app.listings = ListingCache(QUERY_LISTING_CACHE_TTL)
+
 # Usar rutas relativas al archivo actual para templates y static
 current_dir = os.path.dirname(__file__)
 templates_dir = os.path.join(current_dir, "templates")
@@ -224,83 +304,6 @@ def build_time_anchor(seconds) -> str:
     secs = total_seconds % 60
     return f"time-{hours:02d}-{minutes:02d}-{secs:02d}"
 
-async def get_transcript_file(file_path: str) -> tuple:
-    """
-    Obtiene archivo de transcripción desde fuente externa o local.
-    Estrategia híbrida: intenta S3 primero, luego filesystem local.
-    
-    Retorna: (contenido, content_type, headers_dict) o (None, None, {}) si no existe
-    """
-    import mimetypes
-    
-    # Intentar S3 primero si está configurado
-    if app.transcripts_url_external:
-        try:
-            external_url = f"{app.transcripts_url_external}/{file_path}"
-            logging.info(f"Intentando obtener desde S3: {external_url}")
-            
-            response = requests.get(external_url, timeout=10)
-            if response.status_code == 200:
-                content_type = response.headers.get('content-type', 'application/octet-stream')
-                
-                # Forzar content-type correcto para archivos HTML
-                if file_path.lower().endswith('.html'):
-                    content_type = 'text/html; charset=utf-8'
-                elif content_type == 'application/octet-stream':
-                    # Intentar detectar por extensión si S3 no lo especificó
-                    guessed_type, _ = mimetypes.guess_type(file_path)
-                    if guessed_type:
-                        content_type = guessed_type
-                
-                # Devolver headers relevantes de S3 para Range support
-                s3_headers = {}
-                if 'content-length' in response.headers:
-                    s3_headers['content-length'] = response.headers['content-length']
-                if 'accept-ranges' in response.headers:
-                    s3_headers['accept-ranges'] = response.headers['accept-ranges']
-                logging.info(f"Archivo obtenido desde S3: {file_path} (Content-Type: {content_type})")
-                return response.content, content_type, s3_headers
-            elif response.status_code == 404:
-                logging.debug(f"Archivo no encontrado en S3: {file_path}")
-            else:
-                logging.warning(f"Error al obtener de S3 ({response.status_code}): {file_path}")
-        except requests.exceptions.Timeout:
-            logging.warning(f"Timeout al intentar obtener de S3: {file_path}")
-        except Exception as e:
-            logging.warning(f"Error al obtener de S3: {e}")
-    
-    # Fallback a filesystem local
-    if app.transcripts_local_dir:
-        try:
-            local_path = os.path.join(app.transcripts_local_dir, file_path)
-            # Seguridad: evitar path traversal
-            local_path = os.path.normpath(local_path)
-            if not local_path.startswith(os.path.normpath(app.transcripts_local_dir)):
-                logging.error(f"Intento de path traversal: {file_path}")
-                return None, None, {}
-            
-            if os.path.isfile(local_path):
-                logging.info(f"Archivo obtenido desde filesystem local: {file_path}")
-                content_type, _ = mimetypes.guess_type(local_path)
-                
-                # Forzar content-type correcto para archivos HTML
-                if file_path.lower().endswith('.html'):
-                    content_type = 'text/html; charset=utf-8'
-                elif content_type is None:
-                    content_type = 'application/octet-stream'
-                
-                file_size = os.path.getsize(local_path)
-                with open(local_path, 'rb') as f:
-                    return f.read(), content_type, {'content-length': str(file_size)}
-            else:
-                logging.debug(f"Archivo no encontrado en filesystem: {local_path}")
-        except Exception as e:
-            logging.error(f"Error al obtener del filesystem: {e}")
-    
-    # No encontrado en ningún lugar
-    logging.warning(f"Archivo no encontrado en ninguna fuente: {file_path}")
-    return None, None, {}
-
 # ------------------------
 #   Modelos
 # ------------------------
@@ -338,227 +341,13 @@ async def get_transcript(file_path: str, request: Request):
     """
     Endpoint proxy híbrido para archivos de transcripción.
     Intenta obtener de S3 primero, luego del filesystem local.
-    Soporta HTTP Range Requests para seek eficiente en audio/video (marcas de tiempo).
+    Soporta HTTP Range Requests para seek eficiente en audio/video (marcas de tiempo)
+    y peticiones condicionales (ETag / Last-Modified).
     
-    Para archivos grandes (3+ horas), esto es crítico: solo descarga los bytes necesarios.
+    Para archivos grandes (3+ horas), esto es crítico: los bytes se retransmiten
+    por bloques sin cargar el archivo en memoria (ver transcriptproxy.py).
     """
-    
-    # Si es un Range Request a S3, manejarlo especialmente
-    range_header = request.headers.get("Range")
-    if range_header and app.transcripts_url_external:
-        return await get_transcript_with_range(file_path, range_header)
-    
-    # Si no es Range Request, obtener archivo completo (para fallback local)
-    content, content_type, source_headers = await get_transcript_file(file_path)
-    
-    if content is None:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Archivo no encontrado: {file_path}"
-        )
-    
-    file_size = len(content)
-    
-    # Headers comunes
-    headers = {
-        "Cache-Control": "public, max-age=86400",  # Cache 24 horas
-        "Content-Disposition": f"inline; filename={os.path.basename(file_path)}",
-        "Accept-Ranges": "bytes",  # Indicar que soportamos rangos
-    }
-    headers.update(source_headers)
-    
-    # Procesar Range Request si existe
-    if range_header:
-        try:
-            if not range_header.startswith("bytes="):
-                return Response(
-                    content=content,
-                    media_type=content_type,
-                    status_code=200,
-                    headers=headers
-                )
-            
-            ranges_str = range_header[6:]
-            
-            # Soportar single range
-            if "," not in ranges_str and "-" in ranges_str:
-                start_str, end_str = ranges_str.split("-", 1)
-                
-                start = int(start_str) if start_str else 0
-                end = int(end_str) if end_str else file_size - 1
-                
-                if start < 0 or start >= file_size or end >= file_size or start > end:
-                    headers["Content-Range"] = f"bytes */{file_size}"
-                    raise HTTPException(
-                        status_code=status.HTTP_416_RANGE_NOT_SATISFIABLE,
-                        headers=headers,
-                        detail="Range no satisfiable"
-                    )
-                
-                partial_content = content[start:end + 1]
-                headers["Content-Range"] = f"bytes {start}-{end}/{file_size}"
-                
-                logging.info(f"Range Request: {file_path} bytes {start}-{end}/{file_size}")
-                
-                return Response(
-                    content=partial_content,
-                    media_type=content_type,
-                    status_code=206,
-                    headers=headers
-                )
-        except (ValueError, IndexError):
-            logging.warning(f"Error parsing Range header: {range_header}")
-            pass
-    
-    # Devolver archivo completo
-    return Response(
-        content=content,
-        media_type=content_type,
-        status_code=200,
-        headers=headers
-    )
-
-
-async def get_transcript_with_range(file_path: str, range_header: str):
-    """
-    Maneja Range Requests eficientemente para S3.
-    En lugar de descargar todo el archivo, solo descarga el rango solicitado.
-    
-    Esto es crítico para archivos de 3+ horas.
-    """
-    external_url = f"{app.transcripts_url_external}/{file_path}"
-    
-    try:
-        logging.info(f"Range Request a S3: {file_path} - {range_header}")
-        
-        # Pasar el Range header directamente a S3
-        headers = {"Range": range_header}
-        response = requests.get(external_url, headers=headers, timeout=10)
-        
-        # S3 devuelve 206 si puede satisfacer el rango
-        if response.status_code == 206:
-            logging.info(f"Rango obtenido de S3: {file_path}")
-            return Response(
-                content=response.content,
-                media_type=response.headers.get('content-type', 'application/octet-stream'),
-                status_code=206,
-                headers={
-                    "Cache-Control": "public, max-age=86400",
-                    "Content-Disposition": f"inline; filename={os.path.basename(file_path)}",
-                    "Accept-Ranges": "bytes",
-                    "Content-Range": response.headers.get('content-range', ''),
-                    "Content-Length": str(len(response.content))
-                }
-            )
-        
-        # Si S3 devuelve 200, significa que no soporta rangos (raro)
-        # Descargar todo y procesar el rango localmente
-        elif response.status_code == 200:
-            logging.warning(f"S3 no devolvió 206, procesando rango localmente: {file_path}")
-            
-            try:
-                ranges_str = range_header[6:]
-                if "," not in ranges_str and "-" in ranges_str:
-                    start_str, end_str = ranges_str.split("-", 1)
-                    start = int(start_str) if start_str else 0
-                    end = int(end_str) if end_str else len(response.content) - 1
-                    
-                    partial = response.content[start:end + 1]
-                    return Response(
-                        content=partial,
-                        media_type=response.headers.get('content-type', 'application/octet-stream'),
-                        status_code=206,
-                        headers={
-                            "Cache-Control": "public, max-age=86400",
-                            "Content-Disposition": f"inline; filename={os.path.basename(file_path)}",
-                            "Accept-Ranges": "bytes",
-                            "Content-Range": f"bytes {start}-{end}/{len(response.content)}",
-                            "Content-Length": str(len(partial))
-                        }
-                    )
-            except (ValueError, IndexError):
-                pass
-            
-            # Fallback: devolver todo
-            return Response(
-                content=response.content,
-                media_type=response.headers.get('content-type', 'application/octet-stream'),
-                status_code=200,
-                headers={
-                    "Cache-Control": "public, max-age=86400",
-                    "Content-Disposition": f"inline; filename={os.path.basename(file_path)}",
-                    "Accept-Ranges": "bytes",
-                    "Content-Length": str(len(response.content))
-                }
-            )
-        
-        elif response.status_code == 404:
-            # Intentar fallback local
-            logging.debug(f"Archivo no encontrado en S3, intentando fallback local: {file_path}")
-            content, content_type, source_headers = await get_transcript_file(file_path)
-            
-            if content is None:
-                raise HTTPException(
-                    status_code=status.HTTP_404_NOT_FOUND,
-                    detail=f"Archivo no encontrado: {file_path}"
-                )
-            
-            # Procesar el Range Request localmente
-            try:
-                ranges_str = range_header[6:]
-                if "," not in ranges_str and "-" in ranges_str:
-                    start_str, end_str = ranges_str.split("-", 1)
-                    start = int(start_str) if start_str else 0
-                    end = int(end_str) if end_str else len(content) - 1
-                    
-                    partial = content[start:end + 1]
-                    return Response(
-                        content=partial,
-                        media_type=content_type,
-                        status_code=206,
-                        headers={
-                            "Cache-Control": "public, max-age=86400",
-                            "Content-Disposition": f"inline; filename={os.path.basename(file_path)}",
-                            "Accept-Ranges": "bytes",
-                            "Content-Range": f"bytes {start}-{end}/{len(content)}",
-                            "Content-Length": str(len(partial))
-                        }
-                    )
-            except (ValueError, IndexError):
-                pass
-            
-            return Response(
-                content=content,
-                media_type=content_type,
-                status_code=200,
-                headers={
-                    "Cache-Control": "public, max-age=86400",
-                    "Content-Disposition": f"inline; filename={os.path.basename(file_path)}",
-                    "Accept-Ranges": "bytes"
-                }
-            )
-        
-        else:
-            logging.warning(f"Error al obtener de S3 ({response.status_code}): {file_path}")
-            raise HTTPException(
-                status_code=status.HTTP_502_BAD_GATEWAY,
-                detail=f"Error al obtener archivo de S3: {response.status_code}"
-            )
-    
-    except requests.exceptions.Timeout:
-        logging.error(f"Timeout en Range Request a S3: {file_path}")
-        raise HTTPException(
-            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
-            detail="Timeout al obtener de S3"
-        )
-    except HTTPException:
-        raise
-    except Exception as e:
-        logging.error(f"Error en Range Request: {e}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Error: {str(e)}"
-        )
+    return await app.transcript_proxy.serve(file_path, request)
 
 @app.post("/api/vote/{query_uuid}")
 async def vote_query(query_uuid: str, payload: VoteRequest, request: Request):
@@ -597,6 +386,8 @@ async def vote_query(query_uuid: str, payload: VoteRequest, request: Request):
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                 detail="Error al registrar el voto"
             )
+        # El voto puede cambiar los listados públicos (umbral de likes)
+        app.listings.invalidate()
 
         # Registrar en tabla de auditoría ip_likes
         client_ip = get_client_ip_from_request(request)
@@ -640,6 +431,12 @@ async def check_similar_queries(payload: CheckSimilarRequest, request: Request):
             detail="La pregunta no puede estar vacía"
         )
 
+    return await _find_similar_queries(_question_embedding(payload.question))
+
+
+async def _find_similar_queries(question_embedding: QuestionEmbedding) -> dict:
+    """Busca y clasifica por similitud las consultas guardadas parecidas a la pregunta"""
+    question = question_embedding.question.strip()
     if not app.db or not app.db.is_available:
         # Si no hay BD disponible, indicar que puede continuar
         return {
@@ -649,36 +446,11 @@ async def check_similar_queries(payload: CheckSimilarRequest, request: Request):
         }
 
     try:
-        # Paso 1: Obtener embedding de la pregunta
-        gcpayload_emb = {
-            "query": payload.question,
-            "n_fragments": 1,
-            "only_embedding": True
-        }
-        
-        auth_headers_emb = create_auth_headers(
-            app.context_server_api_key,
-            "POST",
-            "/getcontext",
-            gcpayload_emb,
-            "client_rag_service"
-        )
-        
-        body_str_emb = serialize_body(gcpayload_emb)
-        gcresp_emb = requests.post(app.get_context_url, data=body_str_emb, headers=auth_headers_emb, timeout=120)
-        
-        if gcresp_emb.status_code != 200:
-            logging.warning(f"Error al obtener embedding para verificación: {gcresp_emb.status_code}")
-            return {
-                "exact_match": False,
-                "similar_queries": {"high": [], "medium": [], "low": []},
-                "can_continue": True
-            }
-        
-        data_emb = gcresp_emb.json()
-        query_embedding = data_emb.get('query_embedding')
-        
-        if not query_embedding:
+        # Paso 1: Obtener embedding de la pregunta (se reutiliza en el resto de /api/ask)
+        try:
+            query_embedding = await question_embedding.get()
+        except HTTPException as e:
+            logging.warning(f"Error al obtener embedding para verificación: {e.detail}")
             return {
                 "exact_match": False,
                 "similar_queries": {"high": [], "medium": [], "low": []},
@@ -686,12 +458,13 @@ async def check_similar_queries(payload: CheckSimilarRequest, request: Request):
             }
 
         # Paso 2: Buscar consultas similares
-        similar_queries = await app.db.search_similar_queries(
-            query_embedding=query_embedding,
-            podcast_name=app.podcast_name,
-            limit=15,
-            similarity_threshold=0.60
-        )
+        with question_embedding.timer.stage("similares"):
+            similar_queries = await app.db.search_similar_queries(
+                query_embedding=query_embedding,
+                podcast_name=app.podcast_name,
+                limit=15,
+                similarity_threshold=0.60
+            )
         
         if not similar_queries:
             return {
@@ -757,7 +530,7 @@ async def check_similar_queries(payload: CheckSimilarRequest, request: Request):
         
         return response
 
-    except requests.exceptions.Timeout:
+    except httpx.TimeoutException:
         logging.warning("Timeout al verificar consultas similares")
         return {
             "exact_match": False,
@@ -772,24 +545,20 @@ async def check_similar_queries(payload: CheckSimilarRequest, request: Request):
             "can_continue": True
         }
 
-@app.post("/api/ask")
-async def ask_question(payload: AskRequest, request: Request):
-    """Procesa la pregunta enviada"""
+async def _ask_shortcut(payload: AskRequest, request: Request,
+                        question_embedding: QuestionEmbedding) -> Optional[dict]:
+    """
+    Respuestas de /api/ask que no necesitan al RAG server: coincidencia exacta,
+    consultas similares pendientes de confirmar y entradas del historial.
+    Devuelve None si hay que hacer la búsqueda completa.
+    """
     question = payload.question.strip() if payload.question else ""
-    language = payload.language
-
-    if not question:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="La pregunta no puede estar vacía"
-        )
 
     # Si no se solicita saltar la verificación de similitud, verificar primero
     if not payload.skip_similarity_check:
         try:
             # Verificar consultas similares primero
-            check_request = CheckSimilarRequest(question=question, language=language)
-            similar_check = await check_similar_queries(check_request, request)
+            similar_check = await _find_similar_queries(question_embedding)
             
             # Si hay match exacto, retornar inmediatamente
             if similar_check.get('exact_match'):
@@ -874,275 +643,521 @@ async def ask_question(payload: AskRequest, request: Request):
                     detail=f"No hay entrada de historial en la posición {index_back}"
                 )
 
+    return None
+
+
+async def _post_upstream(client: SignedAsyncClient, path: str, payload, request: Request,
+                         **kwargs) -> httpx.Response:
+    """
+    POST firmado por el pool del servicio remoto. Si el navegador se desconecta
+    antes de la respuesta se cancela la llamada (y con ella el trabajo del LLM).
+    """
     try:
-        # Paso 1: Obtener embedding de la pregunta
-        gcpayload_emb = {
-            "query": payload.question,
-            "n_fragments": 1, # No importa, solo queremos el embedding
-            "only_embedding": True
-        }
-        
-        auth_headers_emb = create_auth_headers(
-            app.context_server_api_key,
-            "POST",
-            "/getcontext",
-            gcpayload_emb,
-            "client_rag_service"
-        )
-        
-        body_str_emb = serialize_body(gcpayload_emb)
-        gcresp_emb = requests.post(app.get_context_url, data=body_str_emb, headers=auth_headers_emb, timeout=120)
-        
-        if gcresp_emb.status_code != 200:
-             raise HTTPException(
-                status_code=status.HTTP_502_BAD_GATEWAY,
-                detail=f"Error al obtener embedding de la pregunta: {gcresp_emb.status_code}"
-            )
-        
-        data_emb = gcresp_emb.json()
-        query_embedding = data_emb.get('query_embedding')
-        
-        if not query_embedding:
-             raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="No se pudo obtener el embedding de la pregunta"
-            )
+        return await run_until_disconnected(request, client.post_json(path, payload, **kwargs))
+    except ClientDisconnected:
+        logging.info(f"Cliente desconectado: POST {path} cancelado")
+        # 499: código de nginx para "el cliente cerró la conexión"
+        raise HTTPException(status_code=499, detail="Client closed request")
 
-        # Paso 2: Obtener contexto usando el embedding
-        gcpayload = {
-            "query": payload.question,
-            "n_fragments": 100,
-            "query_embedding": query_embedding
-        }
-        
-        # Crear headers de autenticación HMAC para context server
-        auth_headers = create_auth_headers(
-            app.context_server_api_key,
-            "POST",
-            "/getcontext",
-            gcpayload,
-            "client_rag_service"
+
+async def _post_context_server(payload: dict) -> dict:
+    """POST firmado a /getcontext por el pool del context server"""
+    response = await app.context_client.post_json("/getcontext", payload)
+    if response.status_code != 200:
+        raise HTTPException(
+            status_code=status.HTTP_502_BAD_GATEWAY,
+            detail=f"Error del context server: {response.status_code}"
         )
-        
-        # ENVIAR EL JSON EXACTO QUE USAMOS PARA LA FIRMA
-        body_str = serialize_body(gcpayload)
-        gcresp = requests.post(app.get_context_url, data=body_str, headers=auth_headers, timeout=120)
-        
-        if gcresp.status_code != 200:
-            raise HTTPException(
-                status_code=status.HTTP_502_BAD_GATEWAY,
-                detail=f"Error al obtener contexto: {gcresp.status_code}"
-            )
-        data = gcresp.json()
-        logging.info(f"Respuesta del servicio de contexto: {len(data.get('context'))} fragmentos obtenidos")
-        if 'context' in data:
-            context = data['context']
-        # Pregunta al servicio de búsqueda RAG
-        client_ip = get_client_ip_from_request(request)
-        relquery_data = {
-            "query": payload.question,
-            "embeddings": context,
-            "requester": client_ip
-        }
-        
-        # Crear headers de autenticación HMAC
-        auth_headers = create_auth_headers(
-            app.rag_server_api_key,
-            "POST",
-            "/relsearch",
-            relquery_data,
-            "client_rag_service"
+    data = response.json()
+    app.question_embeddings.observe_generation(data.get('index_generation'))
+    return data
+
+
+async def _fetch_question_embedding(question: str):
+    """
+    Obtiene del context server el embedding de la pregunta, el modelo con el que
+    se calculó y las generaciones del índice y del corpus con los que se va a responder.
+    """
+    data_emb = await _post_context_server({
+        "query": question,
+        "n_fragments": 1, # No importa, solo queremos el embedding
+        "only_embedding": True
+    })
+    query_embedding = data_emb.get('query_embedding')
+    
+    if not query_embedding:
+         raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="No se pudo obtener el embedding de la pregunta"
         )
-        
-        # ENVIAR EL JSON EXACTO QUE USAMOS PARA LA FIRMA
-        body_str = serialize_body(relquery_data)
-        relresp = requests.post(app.relsearch_url, data=body_str, headers=auth_headers, timeout=120)
-        if relresp.status_code != 200:
-            raise HTTPException(
-                status_code=status.HTTP_502_BAD_GATEWAY,
-                detail=f"Error al realizar búsqueda: {relresp.status_code}"
-            )
-        reldata = relresp.json()
-        logging.info(f"Respuesta del servicio de búsqueda: {reldata}")
-        
-        references = []
-        if "refs" in reldata and reldata["refs"]:
-            logging.info(f"Referencias encontradas: {len(reldata['refs'])}")
-            for ref in reldata["refs"]:
-                if all(k in ref for k in ['label', 'file', 'time']):
-                    logging.info(f"Procesando referencia: {ref['label']} - {ref['file']} a {ref['time']} segundos")
-                    html_file = {
-                        l: get_transcript_url(os.path.join("/transcripts", f"{ref['file']}_whisper_audio_{l}.html")) for l in ['es', 'en']
-                    }
-                    logging.info(f"Archivos HTML: {html_file}")
-                    logging.info(f"Buscando ID más cercano para {ref['time']} segundos")
-
-                    nearest_id = None
-                    if app.transcripts_local_dir or app.transcripts_url_external:
-                        # Determinar qué ruta usar: local o URL externa
-                        file_to_search = None
-                        if app.transcripts_local_dir:
-                            real_file = os.path.join(
-                                app.transcripts_local_dir,
-                                f"{ref['file']}_whisper_audio_es.html"
-                            )
-                            if os.path.exists(real_file):
-                                file_to_search = real_file
-                                logging.info(f"Usando archivo local: {file_to_search}")
-                        if not file_to_search and app.transcripts_url_external:
-                            file_to_search = f"{app.transcripts_url_external}/{ref['file']}_whisper_audio_es.html"
-                            logging.info(f"Usando URL externa: {file_to_search}")
-
-                        if file_to_search:
-                            nearest_id = find_nearest_time_id(file_to_search, ref['time'])
-                        else:
-                            logging.warning("No se encontró archivo local ni URL externa configurada")
-
-                    if not nearest_id:
-                        nearest_id = build_time_anchor(ref['time'])
-                    logging.info(f"ID más cercano encontrado: {nearest_id}")
-
-                    ref['hyperlink'] = {
-                        l: f"{html_file[l]}#{nearest_id}" if nearest_id else html_file[l]
-                        for l in ['es', 'en']
-                    }
-                    logging.info(f"Referencia con hipervínculo: {ref['hyperlink']}")
-
-                    references.append({
-                        "label": ref["label"],
-                        "tag": ref.get("tag", ""),
-                        "file": ref["file"],
-                        "time": ref["time"],
-                        "url": build_file_url(ref["file"], ref["time"]),
-                        "formatted_time": format_time(ref["time"]),
-                        "hyperlink": ref.get("hyperlink", None)
-                    })
-
-        timestamp_iso = datetime.now().isoformat()
-        
-        # Create response
-        response_data = {
+    return (query_embedding, data_emb.get('embedding_model'), data_emb.get('index_generation'),
+            data_emb.get('corpus_generation'))
+
+
+def _question_embedding(question: str, timer: Optional[StageTimer] = None) -> QuestionEmbedding:
+    """Embedding de la pregunta para una petición (se obtiene una sola vez)"""
+    return QuestionEmbedding(question, _fetch_question_embedding, app.question_embeddings, timer)
+
+
+async def _fetch_question_context(question_embedding: QuestionEmbedding) -> list:
+    """
+    Obtiene del context server los fragmentos de contexto de la pregunta usando
+    su embedding (el context server no lo vuelve a calcular). Actualiza las
+    generaciones del índice y del corpus con las de la respuesta.
+    """
+    data = await _post_context_server({
+        "query": question_embedding.question,
+        "n_fragments": 100,
+        "query_embedding": await question_embedding.get()
+    })
+    if data.get('index_generation') is not None:
+        question_embedding.index_generation = data['index_generation']
+    if data.get('corpus_generation') is not None:
+        question_embedding.corpus_generation = data['corpus_generation']
+    logging.info(f"Respuesta del servicio de contexto: {len(data.get('context'))} fragmentos obtenidos")
+    packing = data.get('packing')
+    if packing:
+        logging.info(f"Contexto empaquetado: {packing['tokens_in']} -> {packing['tokens_out']} tokens "
+                     f"({packing['tokens_saved']} ahorrados)")
+    return data.get('context', [])
+
+
+async def _cached_answer(question_embedding: QuestionEmbedding, flight: Optional[AskFlight] = None) -> Optional[dict]:
+    """
+    Respuesta guardada para una pregunta casi idéntica con el corpus actual,
+    con la misma forma que la de /api/ask, o None si hay que consultar al RAG.
+    """
+    query_embedding = await question_embedding.get()
+    try:
+        with question_embedding.timer.stage("caché"):
+            if app.answer_cache.enabled and question_embedding.corpus_generation is None:
+                # Embedding de la caché: la generación del corpus puede haber cambiado desde
+                # entonces. Se pregunta con el propio embedding (el context server no lo recalcula)
+                data = await _post_context_server({
+                    "query": question_embedding.question,
+                    "n_fragments": 1,
+                    "only_embedding": True,
+                    "query_embedding": query_embedding
+                })
+                question_embedding.corpus_generation = data.get('corpus_generation')
+            cached = await app.answer_cache.lookup(query_embedding, question_embedding.corpus_generation)
+        if cached is None:
+            return None
+        if flight is not None:
+            flight.meta["query_id"] = cached.get('id')
+        import json
+        stored_response = json.loads(cached['response_data'])
+        return {
             "success": True,
-            "response": reldata["search"],
+            "response": stored_response.get('response', cached.get('response_text', '')),
+            "references": stored_response.get('references', []),
+            "timestamp": cached['created_at'].isoformat(),
+            "query": cached['query_text'],
+            "cache_hit": True,
+            "similarity": round(float(cached['similarity']), 4),
+            "uuid": str(cached['uuid']),
+            "likes": cached.get('likes', 0),
+            "dislikes": cached.get('dislikes', 0),
+            "saved_query_url": f"{BASE_PATH}/savedquery/{cached['uuid']}"
+        }
+    except Exception as e:
+        logging.error(f"Error consultando la caché de respuestas: {e}")
+        return None
+
+
+async def _cached_transcripts(refs: list) -> dict:
+    """
+    Copias en la caché de disco de las transcripciones remotas de las referencias
+    (una descarga por episodio como mucho), para buscar en ellas las anclas de tiempo.
+
+    Returns:
+        {ref['file']: ruta local de la transcripción en español}
+    """
+    cache = app.transcript_proxy.cache
+    if cache is None:
+        return {}
+    files = {ref['file'] for ref in refs if 'file' in ref}
+    if app.transcripts_local_dir:
+        files = {f for f in files if not os.path.exists(
+            os.path.join(app.transcripts_local_dir, f"{f}_whisper_audio_es.html"))}
+
+    async def fetch(f):
+        try:
+            entry = await cache.get(f"{f}_whisper_audio_es.html")
+            return f, entry.path if entry else None
+        except httpx.HTTPError as e:
+            logging.warning(f"No se pudo obtener la transcripción de {f}: {e}")
+            return f, None
+
+    return {f: path for f, path in await asyncio.gather(*(fetch(f) for f in files)) if path}
+
+
+def _build_references(refs: list, cached_files: Optional[dict] = None) -> list:
+    """Añade a las referencias del RAG server los enlaces a la transcripción y al audio"""
+    references = []
+    if refs:
+        logging.info(f"Referencias encontradas: {len(refs)}")
+        for ref in refs:
+            if all(k in ref for k in ['label', 'file', 'time']):
+                logging.info(f"Procesando referencia: {ref['label']} - {ref['file']} a {ref['time']} segundos")
+                html_file = {
+                    l: get_transcript_url(os.path.join("/transcripts", f"{ref['file']}_whisper_audio_{l}.html")) for l in ['es', 'en']
+                }
+                logging.info(f"Archivos HTML: {html_file}")
+                logging.info(f"Buscando ID más cercano para {ref['time']} segundos")
+
+                nearest_id = None
+                if app.transcripts_local_dir or app.transcripts_url_external:
+                    # Determinar qué ruta usar: local o URL externa
+                    file_to_search = None
+                    if app.transcripts_local_dir:
+                        real_file = os.path.join(
+                            app.transcripts_local_dir,
+                            f"{ref['file']}_whisper_audio_es.html"
+                        )
+                        if os.path.exists(real_file):
+                            file_to_search = real_file
+                            logging.info(f"Usando archivo local: {file_to_search}")
+                    if not file_to_search and cached_files and ref['file'] in cached_files:
+                        file_to_search = cached_files[ref['file']]
+                        logging.info(f"Usando copia en caché: {file_to_search}")
+                    if not file_to_search and app.transcripts_url_external:
+                        file_to_search = f"{app.transcripts_url_external}/{ref['file']}_whisper_audio_es.html"
+                        logging.info(f"Usando URL externa: {file_to_search}")
+
+                    if file_to_search:
+                        nearest_id = find_nearest_time_id(file_to_search, ref['time'])
+                    else:
+                        logging.warning("No se encontró archivo local ni URL externa configurada")
+
+                if not nearest_id:
+                    nearest_id = build_time_anchor(ref['time'])
+                logging.info(f"ID más cercano encontrado: {nearest_id}")
+
+                ref['hyperlink'] = {
+                    l: f"{html_file[l]}#{nearest_id}" if nearest_id else html_file[l]
+                    for l in ['es', 'en']
+                }
+                logging.info(f"Referencia con hipervínculo: {ref['hyperlink']}")
+
+                references.append({
+                    "label": ref["label"],
+                    "tag": ref.get("tag", ""),
+                    "file": ref["file"],
+                    "time": ref["time"],
+                    "url": build_file_url(ref["file"], ref["time"]),
+                    "formatted_time": format_time(ref["time"]),
+                    "hyperlink": ref.get("hyperlink", None)
+                })
+    return references
+
+
+async def _store_answer(question: str, search: dict, references: list, query_embedding,
+                        request: Request, response_data: dict, index_generation: Optional[int] = None,
+                        corpus_generation: Optional[int] = None) -> Optional[int]:
+    """
+    Guarda la respuesta en el historial y en la BD; completa response_data con
+    la URL de la consulta guardada y las consultas similares.
+
+    Returns:
+        id de la fila de rag_queries, o None si no se guardó
+    """
+    timestamp_iso = response_data["timestamp"]
+
+    # Store this query and response in history
+    if history_key:
+        history_entry = {
+            "query": question,
+            "response": search,
             "references": references,
             "timestamp": timestamp_iso
         }
-        
-        # Store this query and response in history
-        if history_key:
-            history_entry = {
-                "query": question,
-                "response": reldata["search"],
-                "references": references,
-                "timestamp": timestamp_iso
-            }
-            app.query_history.append(history_entry)
-            logging.info(f"Stored query in history. Total entries: {len(app.query_history)}")
-
-        # ===== GUARDAR EN BASE DE DATOS (SOLO /api/ask) =====
-        # Guardar la pregunta y respuesta en BD para futuro caché semántico
-        saved_uuid = None
-        logging.info(f"[DEBUG] Verificando guardado en BD. DB disponible: {app.db and app.db.is_available}")
-        if app.db and app.db.is_available:
-            try:
-                # El embedding de la pregunta ya lo tenemos de la llamada inicial a /getcontext
-                # query_embedding ya contiene el embedding
-                logging.info(f"[DEBUG] query_embedding existe: {query_embedding is not None}, tipo: {type(query_embedding) if query_embedding else 'None'}")
+        app.query_history.append(history_entry)
+        logging.info(f"Stored query in history. Total entries: {len(app.query_history)}")
+
+    # ===== GUARDAR EN BASE DE DATOS (SOLO /api/ask) =====
+    # Guardar la pregunta y respuesta en BD para futuro caché semántico
+    saved_uuid = None
+    saved_id = None
+    logging.info(f"[DEBUG] Verificando guardado en BD. DB disponible: {app.db and app.db.is_available}")
+    if app.db and app.db.is_available:
+        try:
+            # El embedding de la pregunta ya lo tenemos de la llamada inicial a /getcontext
+            # query_embedding ya contiene el embedding
+            logging.info(f"[DEBUG] query_embedding existe: {query_embedding is not None}, tipo: {type(query_embedding) if query_embedding else 'None'}")
+            
+            if query_embedding:
+                # Preparar response_data completo para almacenar
+                response_data_to_save = {
+                    "response": search,  # Contiene {es: ..., en: ...}
+                    "references": references,
+                    "timestamp": timestamp_iso,
+                    "query": question
+                }
                 
-                if query_embedding:
-                    # Preparar response_data completo para almacenar
-                    response_data_to_save = {
-                        "response": reldata["search"],  # Contiene {es: ..., en: ...}
-                        "references": references,
-                        "timestamp": timestamp_iso,
-                        "query": question
-                    }
-                    
-                    # Guardar en BD con estructura completa
-                    client_ip = get_client_ip_from_request(request)
-                    result = await app.db.save_query(
-                        query_text=question,
-                        response_text=reldata["search"].get("es", ""),  # Español como texto plano
-                        response_data=response_data_to_save,
-                        query_embedding=query_embedding,
-                        podcast_name=app.podcast_name,
-                        ip=client_ip
-                    )
-                    if result and result.get('uuid'):
-                        saved_uuid = result['uuid']
-                        # Construir URL para recuperar la consulta (endpoint HTML)
-                        saved_query_url = f"{BASE_PATH}/savedquery/{saved_uuid}"
-                        response_data['saved_query_url'] = saved_query_url
-                        response_data['uuid'] = str(saved_uuid)
-                        response_data['likes'] = 0
-                        response_data['dislikes'] = 0
-                        logging.info(f"Pregunta guardada en BD con UUID: {saved_uuid}")
-                        logging.info(f"URL para recuperar: {saved_query_url}")
+                # Guardar en BD con estructura completa
+                client_ip = get_client_ip_from_request(request)
+                result = await app.db.save_query(
+                    query_text=question,
+                    response_text=search.get("es", ""),  # Español como texto plano
+                    response_data=response_data_to_save,
+                    query_embedding=query_embedding,
+                    podcast_name=app.podcast_name,
+                    ip=client_ip,
+                    index_generation=index_generation,
+                    corpus_generation=corpus_generation
+                )
+                if result and result.get('uuid'):
+                    saved_uuid = result['uuid']
+                    saved_id = result.get('id')
+                    app.listings.invalidate()
+                    # Construir URL para recuperar la consulta (endpoint HTML)
+                    saved_query_url = f"{BASE_PATH}/savedquery/{saved_uuid}"
+                    response_data['saved_query_url'] = saved_query_url
+                    response_data['uuid'] = str(saved_uuid)
+                    response_data['likes'] = 0
+                    response_data['dislikes'] = 0
+                    logging.info(f"Pregunta guardada en BD con UUID: {saved_uuid}")
+                    logging.info(f"URL para recuperar: {saved_query_url}")
+                
+                # Buscar consultas similares (excluyendo la actual si tiene UUID)
+                similar_queries = await app.db.search_similar_queries(
+                    query_embedding=query_embedding,
+                    podcast_name=app.podcast_name,
+                    limit=10,  # Obtener hasta 10 para clasificar por niveles
+                    similarity_threshold=0.60  # Umbral mínimo para capturar similitud baja
+                )
+                
+                # Clasificar por niveles de similitud
+                if similar_queries:
+                    # Filtrar la consulta actual si existe
+                    if saved_uuid:
+                        similar_queries = [q for q in similar_queries if str(q.get('uuid')) != saved_uuid]
                     
-                    # Buscar consultas similares (excluyendo la actual si tiene UUID)
-                    similar_queries = await app.db.search_similar_queries(
-                        query_embedding=query_embedding,
-                        podcast_name=app.podcast_name,
-                        limit=10,  # Obtener hasta 10 para clasificar por niveles
-                        similarity_threshold=0.60  # Umbral mínimo para capturar similitud baja
-                    )
+                    # Clasificar en tres niveles
+                    high_similarity = []
+                    medium_similarity = []
+                    low_similarity = []
                     
-                    # Clasificar por niveles de similitud
-                    if similar_queries:
-                        # Filtrar la consulta actual si existe
-                        if saved_uuid:
-                            similar_queries = [q for q in similar_queries if str(q.get('uuid')) != saved_uuid]
-                        
-                        # Clasificar en tres niveles
-                        high_similarity = []
-                        medium_similarity = []
-                        low_similarity = []
-                        
-                        for query in similar_queries:
-                            similarity = query.get('similarity', 0)
-                            query_info = {
-                                'uuid': str(query['uuid']),
-                                'query_text': query['query_text'],
-                                'similarity': round(similarity, 3),
-                                'likes': query.get('likes', 0),
-                                'dislikes': query.get('dislikes', 0),
-                                'url': f"{BASE_PATH}/savedquery/{query['uuid']}"
-                            }
-                            
-                            if similarity >= QUERIES_HIGH_SIMILARITY:
-                                high_similarity.append(query_info)
-                            elif similarity >= QUERIES_MEDIUM_SIMILARITY:
-                                medium_similarity.append(query_info)
-                            elif similarity >= QUERIES_LOW_SIMILARITY:
-                                low_similarity.append(query_info)
-                        
-                        response_data['similar_queries'] = {
-                            'high': high_similarity[:3],     # Máximo 3 por nivel
-                            'medium': medium_similarity[:3],
-                            'low': low_similarity[:3]
+                    for query in similar_queries:
+                        similarity = query.get('similarity', 0)
+                        query_info = {
+                            'uuid': str(query['uuid']),
+                            'query_text': query['query_text'],
+                            'similarity': round(similarity, 3),
+                            'likes': query.get('likes', 0),
+                            'dislikes': query.get('dislikes', 0),
+                            'url': f"{BASE_PATH}/savedquery/{query['uuid']}"
                         }
-                        logging.info(f"Consultas similares encontradas: {len(high_similarity)} altas, {len(medium_similarity)} medias, {len(low_similarity)} bajas")
-                        logging.info(f"[DEBUG] response_data ahora incluye similar_queries: {response_data.get('similar_queries') is not None}")
+                        
+                        if similarity >= QUERIES_HIGH_SIMILARITY:
+                            high_similarity.append(query_info)
+                        elif similarity >= QUERIES_MEDIUM_SIMILARITY:
+                            medium_similarity.append(query_info)
+                        elif similarity >= QUERIES_LOW_SIMILARITY:
+                            low_similarity.append(query_info)
                     
-                else:
-                    logging.warning("No se pudo obtener embedding para guardar en BD")
-            except Exception as e:
-                logging.error(f"Error guardando en BD: {e}")
-        
-        logging.info(f"[DEBUG] Antes de return - response_data tiene similar_queries: {response_data.get('similar_queries') is not None}")
-        if response_data.get('similar_queries'):
-            logging.info(f"[DEBUG] Contenido de similar_queries: {response_data['similar_queries']}")
-        
-        return response_data
+                    response_data['similar_queries'] = {
+                        'high': high_similarity[:3],     # Máximo 3 por nivel
+                        'medium': medium_similarity[:3],
+                        'low': low_similarity[:3]
+                    }
+                    logging.info(f"Consultas similares encontradas: {len(high_similarity)} altas, {len(medium_similarity)} medias, {len(low_similarity)} bajas")
+                    logging.info(f"[DEBUG] response_data ahora incluye similar_queries: {response_data.get('similar_queries') is not None}")
+                
+            else:
+                logging.warning("No se pudo obtener embedding para guardar en BD")
+        except Exception as e:
+            logging.error(f"Error guardando en BD: {e}")
+    return saved_id
+
+
+async def _ask_events(flight: AskFlight, payload: AskRequest, question_embedding: QuestionEmbedding,
+                      request: Request, timer: StageTimer, stream: bool):
+    """
+    Pipeline de una pregunta sin atajo (caché de respuestas, contexto, relsearch,
+    referencias y guardado) como eventos delta / result / error. Se ejecuta una
+    sola vez por pregunta en curso (AskSingleFlight) y con la petición de quien la lanzó.
+
+    Args:
+        stream: Usar /relsearch/stream y producir los deltas de la respuesta
+    """
+    question = payload.question.strip()
+    try:
+        cached = await _cached_answer(question_embedding, flight)
+        if cached is not None:
+            timer.log("caché de respuestas")
+            yield "result", cached
+            return
+        with timer.stage("contexto"):
+            context = await _fetch_question_context(question_embedding)
+    except HTTPException as e:
+        yield "error", {"status": e.status_code, "detail": e.detail}
+        return
+    except httpx.TimeoutException:
+        yield "error", {"status": 504, "detail": "Timeout: El servicio web tardó demasiado en responder"}
+        return
+    except httpx.TransportError:
+        yield "error", {"status": 503, "detail": "Error de conexión con el servicio web"}
+        return
+
+    # Pregunta al servicio de búsqueda RAG
+    relquery_data = {
+        "query": payload.question,
+        "embeddings": context,
+        "requester": get_client_ip_from_request(request)
+    }
+    reldata = None
+    relsearch_started = timer.clock()
+    try:
+        if stream:
+            async for event, data in app.rag_client.stream_events("/relsearch/stream", relquery_data):
+                if event == "delta":
+                    if "primer texto" not in timer.stages:
+                        timer.stages["primer texto"] = timer.clock() - relsearch_started
+                    yield "delta", data
+                elif event == "done":
+                    reldata = data
+                elif event == "error":
+                    yield "error", data
+                    return
+        else:
+            # Sin reintentos: cada intento es una llamada completa al LLM
+            relresp = await app.rag_client.post_json("/relsearch", relquery_data, retries=0)
+            if relresp.status_code != 200:
+                yield "error", {"status": 502, "detail": f"Error al realizar búsqueda: {relresp.status_code}"}
+                return
+            reldata = relresp.json()
+            logging.info(f"Respuesta del servicio de búsqueda: {reldata}")
+    except httpx.HTTPStatusError as e:
+        yield "error", {"status": 502, "detail": f"Error al realizar búsqueda: {e.response.status_code}"}
+        return
+    except httpx.TimeoutException:
+        yield "error", {"status": 504, "detail": "Timeout: El servicio web tardó demasiado en responder"}
+        return
+    except httpx.TransportError:
+        yield "error", {"status": 503, "detail": "Error de conexión con el servicio web"}
+        return
+
+    timer.stages["relsearch"] = timer.clock() - relsearch_started
+    if reldata is None:
+        yield "error", {"status": 502, "detail": "Respuesta incompleta del servicio de búsqueda"}
+        return
 
-    except requests.exceptions.Timeout:
-        raise HTTPException(status_code=504, detail="Timeout: El servicio web tardó demasiado en responder")
-    except requests.exceptions.ConnectionError:
-        raise HTTPException(status_code=503, detail="Error de conexión con el servicio web")
-    except requests.exceptions.RequestException as e:
-        raise HTTPException(status_code=500, detail=f"Error en la petición: {str(e)}")
+    try:
+        with timer.stage("referencias"):
+            refs = reldata.get("refs") or []
+            references = await asyncio.to_thread(_build_references, refs, await _cached_transcripts(refs))
+        response_data = {
+            "success": True,
+            "response": reldata["search"],
+            "references": references,
+            "timestamp": datetime.now().isoformat()
+        }
+        with timer.stage("guardado"):
+            flight.meta["query_id"] = await _store_answer(
+                question, reldata["search"], references, question_embedding.embedding, request,
+                response_data, question_embedding.index_generation, question_embedding.corpus_generation)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
+        logging.error(f"Error completando la respuesta: {e}")
+        yield "error", {"status": 500, "detail": f"Error interno: {str(e)}"}
+        return
+    timer.log("respuesta nueva")
+    yield "result", response_data
+
+
+async def _shared_ask_events(payload: AskRequest, request: Request, question_embedding: QuestionEmbedding,
+                             timer: StageTimer, stream: bool):
+    """
+    Eventos de la pregunta para esta petición: lanza el pipeline o se une al de
+    una pregunta idéntica en curso (o recién respondida). A las que se unen se
+    les marca la respuesta con "coalesced" y su acceso queda en el log de la
+    consulta guardada.
+    """
+    flight, role = app.ask_flights.join(
+        payload.question, payload.language,
+        lambda flight: _ask_events(flight, payload, question_embedding, request, timer, stream)
+    )
+    if role != "started":
+        logging.info(f"Pregunta idéntica {'en curso' if role == 'joined' else 'recién respondida'}: "
+                     f"se comparte su respuesta")
+    async for event, data in flight.follow():
+        if event == "result" and role != "started":
+            data = {**data, "coalesced": True}
+            query_id = flight.meta.get("query_id")
+            if query_id and app.db and app.db.is_available:
+                await app.db.log_query_access(query_id, 1.0, cache_hit=True)
+            timer.log("pregunta compartida")
+        yield event, data
+
+
+@app.post("/api/ask")
+async def ask_question(payload: AskRequest, request: Request):
+    """Procesa la pregunta enviada"""
+    question = payload.question.strip() if payload.question else ""
+
+    if not question:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="La pregunta no puede estar vacía"
+        )
+
+    timer = StageTimer("/api/ask")
+    question_embedding = _question_embedding(payload.question, timer)
+    shortcut = await _ask_shortcut(payload, request, question_embedding)
+    if shortcut is not None:
+        timer.log("atajo")
+        return shortcut
+
+    async def answer():
+        last = None
+        async for last in _shared_ask_events(payload, request, question_embedding, timer, stream=False):
+            pass
+        return last
+
+    try:
+        event, data = await run_until_disconnected(request, answer())
+    except ClientDisconnected:
+        logging.info("Cliente desconectado durante /api/ask")
+        raise HTTPException(status_code=499, detail="Client closed request")
+    if event == "error":
+        raise HTTPException(status_code=data["status"], detail=data["detail"])
+    return data
+
+
+@app.post("/api/ask/stream")
+async def ask_question_stream(payload: AskRequest, request: Request):
+    """
+    Variante de /api/ask que envía la respuesta como server-sent events según
+    la genera el modelo.
+
+    Eventos:
+        delta:  {"lang": "es"|"en", "text": ...} con el texto nuevo de la respuesta
+        result: el mismo JSON que devuelve /api/ask (con las referencias)
+        error:  {"status": ..., "detail": ...}
+    """
+    question = payload.question.strip() if payload.question else ""
+
+    if not question:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="La pregunta no puede estar vacía"
+        )
+
+    timer = StageTimer("/api/ask/stream")
+    question_embedding = _question_embedding(payload.question, timer)
+    shortcut = await _ask_shortcut(payload, request, question_embedding)
+    if shortcut is not None:
+        timer.log("atajo")
+        return StreamingResponse(iter([format_sse_event("result", shortcut)]),
+                                 media_type=SSE_MEDIA_TYPE, headers=SSE_HEADERS)
+
+    async def events():
+        async for event, data in _shared_ask_events(payload, request, question_embedding, timer, stream=True):
+            yield format_sse_event(event, data)
+
+    return StreamingResponse(events(), media_type=SSE_MEDIA_TYPE, headers=SSE_HEADERS)
+
 
 @app.get("/api/savedquery/{query_uuid}")
 async def get_saved_query(query_uuid: str, request: Request):
@@ -1201,9 +1216,9 @@ async def get_saved_query(query_uuid: str, request: Request):
             }
         
         # Buscar consultas similares usando el embedding de la consulta guardada
-        if query_data.get('query_embedding'):
+        if query_data.get('query_embedding') is not None:
             try:
-                # Convertir el string del embedding de vuelta a lista
+                # Con el códec binario llega como array; en texto, como '[x,y,z,...]'
                 embedding_str = query_data['query_embedding']
                 if isinstance(embedding_str, str):
                     # Parsear el string a lista de floats
@@ -1349,10 +1364,9 @@ async def get_saved_query_html(query_uuid: str, request: Request):
             }
         
         # Buscar consultas similares usando el embedding de la consulta guardada
-        if query_data.get('query_embedding'):
+        if query_data.get('query_embedding') is not None:
             try:
-                # Convertir el string del embedding de vuelta a lista
-                # El embedding está almacenado como string '[x,y,z,...]'
+                # Con el códec binario llega como array; en texto, como '[x,y,z,...]'
                 embedding_str = query_data['query_embedding']
                 if isinstance(embedding_str, str):
                     # Parsear el string a lista de floats
@@ -1431,11 +1445,42 @@ async def get_saved_query_html(query_uuid: str, request: Request):
                                          "error": f"Error al cargar la consulta: {str(e)}"
                                         })
 
+
+def _listing_page(cursor: Optional[str], limit: int):
+    """Valida cursor y tamaño de página de un listado. Devuelve (before, limit)."""
+    try:
+        before = decode_cursor(cursor) if cursor else None
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Cursor no válido")
+    return before, max(1, min(limit, QUERY_LISTING_MAX_PAGE_SIZE))
+
+
+def _next_page(rows: list, limit: int):
+    """
+    Recorta las filas a la página (se piden limit + 1) y devuelve (filas, cursor siguiente),
+    con el cursor a None si es la última página.
+    """
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(rows[-1]['created_at'], rows[-1]['id'])
+
+
+def _next_page_link(request: Request, next_cursor: Optional[str]) -> str:
+    if not next_cursor:
+        return ""
+    # Enlace relativo: conserva el resto de parámetros y funciona detrás de BASE_PATH
+    query = request.url.include_query_params(cursor=next_cursor).query
+    return f'<p><a href="?{escape(query)}">Consultas anteriores →</a></p>'
+
+
 @app.get("/pgv/{clave}", response_class=HTMLResponse)
-async def list_all_queries(clave: str, request: Request):
+async def list_all_queries(clave: str, request: Request, cursor: Optional[str] = None,
+                           limit: int = QUERY_LISTING_PAGE_SIZE):
     """
     Lista todas las consultas guardadas en la base de datos en formato HTML
     Requiere autenticación mediante PGV_KEY
+    Paginada por cursor (?cursor=...), de la más reciente a la más antigua
     """
     # Verificar la clave
     if not app.pgv_key or clave != app.pgv_key:
@@ -1450,14 +1495,16 @@ async def list_all_queries(clave: str, request: Request):
             detail="Base de datos no disponible"
         )
     
-    try:
-        # Obtener todas las consultas de la base de datos
-        # Podemos usar limit alto para obtener todas, o implementar paginación si es necesario
+    before, limit = _listing_page(cursor, limit)
+
+    async def build() -> bytes:
+        # Una página más una fila para saber si hay siguiente
         all_queries = await app.db.get_all_queries(
             podcast_name=app.podcast_name,
-            limit=1000,  # Ajustar según necesidades
-            offset=0
+            limit=limit + 1,
+            before=before
         )
+        all_queries, next_cursor = _next_page(all_queries, limit)
         
         # Construir la tabla HTML
         html_content = f"""
@@ -1519,7 +1566,7 @@ async def list_all_queries(clave: str, request: Request):
 </head>
 <body>
     <h1>Consultas Guardadas - {app.podcast_name}</h1>
-    <div class="total-count">Total de consultas: {len(all_queries)}</div>
+    <div class="total-count">Consultas en esta página: {len(all_queries)}</div>
     <table>
         <thead>
             <tr>
@@ -1565,15 +1612,20 @@ async def list_all_queries(clave: str, request: Request):
             </tr>
 """
         
-        html_content += """
+        html_content += f"""
         </tbody>
     </table>
+    {_next_page_link(request, next_cursor)}
 </body>
 </html>
 """
         
-        return HTMLResponse(content=html_content)
-        
+        return html_content.encode()
+
+    try:
+        page = await app.listings.get(("pgv", cursor, limit), build)
+        return conditional_response(request, page.body, page.media_type, page.etag,
+                                    cache_control="private, no-cache")
     except Exception as e:
         logging.error(f"Error al listar consultas: {e}")
         raise HTTPException(
@@ -1584,7 +1636,8 @@ async def list_all_queries(clave: str, request: Request):
 
 @app.get("/queries/city/{city}", response_class=HTMLResponse)
 async def list_queries_by_city(city: str, request: Request,
-                                likes_threshold: int = QUERY_MAP_LIKES_THRESHOLD):
+                                likes_threshold: int = QUERY_MAP_LIKES_THRESHOLD,
+                                cursor: Optional[str] = None, limit: int = QUERY_LISTING_PAGE_SIZE):
     """
     Endpoint público: lista las consultas mejor valoradas desde una ciudad.
     No muestra IPs ni requiere autenticación.
@@ -1593,14 +1646,19 @@ async def list_queries_by_city(city: str, request: Request,
         raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
                             detail="Base de datos no disponible")
 
-    try:
-        from urllib.parse import unquote
-        decoded_city = unquote(city)
+    from urllib.parse import unquote
+    decoded_city = unquote(city)
+    before, limit = _listing_page(cursor, limit)
+
+    async def build() -> bytes:
         queries = await app.db.get_queries_by_city(
             city=decoded_city,
             podcast_name=app.podcast_name,
             likes_threshold=likes_threshold,
+            limit=limit + 1,
+            before=before,
         )
+        queries, next_cursor = _next_page(queries, limit)
 
         html_content = f"""
 <!DOCTYPE html>
@@ -1625,7 +1683,7 @@ async def list_queries_by_city(city: str, request: Request,
 </head>
 <body>
     <h1>Consultas desde {escape(decoded_city)} - {escape(app.podcast_name)}</h1>
-    <div class="total-count">Total de consultas: {len(queries)}</div>
+    <div class="total-count">Consultas en esta página: {len(queries)}</div>
     <table>
         <thead>
             <tr>
@@ -1665,14 +1723,19 @@ async def list_queries_by_city(city: str, request: Request,
                 <td><a href="{query_url}" target="_blank">Ver consulta</a></td>
             </tr>
 """
-        html_content += """
+        html_content += f"""
         </tbody>
     </table>
+    {_next_page_link(request, next_cursor)}
 </body>
 </html>
 """
-        return HTMLResponse(content=html_content)
+        return html_content.encode()
 
+    try:
+        page = await app.listings.get(("city", decoded_city, likes_threshold, cursor, limit), build)
+        return conditional_response(request, page.body, page.media_type, page.etag,
+                                    cache_control=f"public, max-age={int(QUERY_LISTING_CACHE_TTL)}")
     except Exception as e:
         logging.error(f"Error al listar consultas por ciudad: {e}")
         raise HTTPException(
@@ -1683,20 +1746,26 @@ async def list_queries_by_city(city: str, request: Request,
 
 @app.get("/queries/country/{country}", response_class=HTMLResponse)
 async def list_queries_by_country(country: str, request: Request,
-                                  likes_threshold: int = QUERY_MAP_LIKES_THRESHOLD):
+                                  likes_threshold: int = QUERY_MAP_LIKES_THRESHOLD,
+                                  cursor: Optional[str] = None, limit: int = QUERY_LISTING_PAGE_SIZE):
     """Endpoint público: lista las consultas mejor valoradas desde un país."""
     if not app.db or not app.db.is_available:
         raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
                             detail="Base de datos no disponible")
 
-    try:
-        from urllib.parse import unquote
-        decoded_country = unquote(country)
+    from urllib.parse import unquote
+    decoded_country = unquote(country)
+    before, limit = _listing_page(cursor, limit)
+
+    async def build() -> bytes:
         queries = await app.db.get_queries_by_country(
             country=decoded_country,
             podcast_name=app.podcast_name,
             likes_threshold=likes_threshold,
+            limit=limit + 1,
+            before=before,
         )
+        queries, next_cursor = _next_page(queries, limit)
 
         html_content = f"""
 <!DOCTYPE html>
@@ -1721,7 +1790,7 @@ async def list_queries_by_country(country: str, request: Request,
 </head>
 <body>
     <h1>Consultas desde {escape(decoded_country)} - {escape(app.podcast_name)}</h1>
-    <div class="total-count">Total de consultas: {len(queries)}</div>
+    <div class="total-count">Consultas en esta página: {len(queries)}</div>
     <table>
         <thead>
             <tr>
@@ -1761,14 +1830,19 @@ async def list_queries_by_country(country: str, request: Request,
                 <td><a href="{query_url}" target="_blank">Ver consulta</a></td>
             </tr>
 """
-        html_content += """
+        html_content += f"""
         </tbody>
     </table>
+    {_next_page_link(request, next_cursor)}
 </body>
 </html>
 """
-        return HTMLResponse(content=html_content)
+        return html_content.encode()
 
+    try:
+        page = await app.listings.get(("country", decoded_country, likes_threshold, cursor, limit), build)
+        return conditional_response(request, page.body, page.media_type, page.etag,
+                                    cache_control=f"public, max-age={int(QUERY_LISTING_CACHE_TTL)}")
     except Exception as e:
         logging.error(f"Error al listar consultas por país: {e}")
         raise HTTPException(
@@ -1800,40 +1874,22 @@ async def _resolve_geo_summary_points(likes_threshold: int = QUERY_MAP_LIKES_THR
     if not geo_data:
         return []
 
-    try:
-        import geoip2.database
-    except ImportError:
-        logging.error("geoip2 no disponible para resolver coordenadas del mapa")
-        return []
-
-    geoip_db_path = os.getenv("GEOIP_DB_PATH", "/var/lib/GeoIP/GeoLite2-City.mmdb")
-    if not os.path.exists(geoip_db_path):
-        logging.error(f"Base de datos GeoIP no encontrada en {geoip_db_path}")
-        return []
-
+    # Lector GeoIP singleton de queriesdb con LRU de IPs (no se abre la base en cada visita)
     resolved = []
-    reader = geoip2.database.Reader(geoip_db_path)
-    try:
-        for item in geo_data:
-            sample_ip = item.get("sample_ip")
-            if not sample_ip:
-                continue
-            try:
-                resp = reader.city(sample_ip)
-                lat = resp.location.latitude
-                lon = resp.location.longitude
-                if lat is None or lon is None:
-                    continue
-                resolved.append({
-                    **item,
-                    "latitude": lat,
-                    "longitude": lon,
-                    "location_name": item.get("city") or item.get("country") or "Desconocida",
-                })
-            except Exception:
-                logging.debug(f"No se pudieron resolver coordenadas para {item.get('country')} / {item.get('city')}")
-    finally:
-        reader.close()
+    for item in geo_data:
+        sample_ip = item.get("sample_ip")
+        if not sample_ip:
+            continue
+        coordinates = geoip_coordinates(sample_ip)
+        if coordinates is None:
+            logging.debug(f"No se pudieron resolver coordenadas para {item.get('country')} / {item.get('city')}")
+            continue
+        resolved.append({
+            **item,
+            "latitude": coordinates[0],
+            "longitude": coordinates[1],
+            "location_name": item.get("city") or item.get("country") or "Desconocida",
+        })
 
     return resolved
 
@@ -1851,61 +1907,81 @@ async def public_queries_map(request: Request, likes_threshold: int = QUERY_MAP_
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                             detail="folium no está instalado")
 
-    try:
+    async def build() -> str:
         points = await _resolve_geo_summary_points(likes_threshold=likes_threshold)
-        if not points:
-            return HTMLResponse(content="""
+        # folium genera cientos de KB de HTML: fuera del bucle de eventos
+        return await asyncio.to_thread(_render_queries_map, points, likes_threshold)
+
+    try:
+        generation = await app.db.get_geo_summary_generation()
+        page_html = await app.query_maps.get(likes_threshold, generation, build)
+        return HTMLResponse(content=page_html)
+
+    except Exception as e:
+        logging.error(f"Error generando el mapa público de consultas: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error al generar el mapa: {str(e)}"
+        )
+
+
+def _render_queries_map(points: list, likes_threshold: int) -> str:
+    """Genera la página HTML del mapa con folium a partir de los puntos resueltos."""
+    import folium
+
+    if not points:
+        return """
 <!DOCTYPE html>
 <html lang="es"><head><meta charset="UTF-8"><title>Mapa de consultas</title></head>
 <body style="font-family: Arial, sans-serif; margin: 2rem; background: #f8fafc; color: #1f2937;">
 <h1>Mapa de consultas</h1>
 <p>No hay datos geográficos disponibles para mostrar.</p>
 </body></html>
-""")
-
-        total = sum(int(p.get("query_count", 0)) for p in points)
-        avg_lat = sum(float(p["latitude"]) * int(p.get("query_count", 0)) for p in points) / total
-        avg_lon = sum(float(p["longitude"]) * int(p.get("query_count", 0)) for p in points) / total
-        m = folium.Map(location=[avg_lat, avg_lon], zoom_start=3,
-                       tiles="CartoDB positron", control_scale=True)
-
-        max_count = max(int(p.get("query_count", 0)) for p in points) or 1
-        bounds = []
-        for point in points:
-            lat = float(point["latitude"])
-            lon = float(point["longitude"])
-            bounds.append([lat, lon])
-            location_name = escape(str(point.get("location_name") or point.get("city") or point.get("country") or "Desconocida"))
-            country = escape(str(point.get("country") or ""))
-            count = int(point.get("query_count", 0))
-            radius = max(5, 25 * (count / max_count))
-            location_url = _public_query_location_url(
-                country=str(point.get("country") or ""),
-                city=str(point.get("city") or ""),
-                likes_threshold=likes_threshold,
-            )
-            popup_html = (
-                f"<b>{location_name}</b>"
-                f"{'<br>' + country if country and country != location_name else ''}"
-                f"<br>Consultas: {count}"
-                + (f'<br><a href="{location_url}" target="_blank">Ver consultas</a>' if location_url else '')
-            )
-            folium.CircleMarker(
-                location=[lat, lon],
-                radius=radius,
-                popup=folium.Popup(popup_html, max_width=260),
-                tooltip=f"{location_name} ({count})",
-                color="#e94560",
-                fill=True,
-                fill_color="#e94560",
-                fill_opacity=0.65,
-            ).add_to(m)
-
-        if len(bounds) > 1:
-            m.fit_bounds(bounds, padding=(20, 20))
-
-        map_html = m._repr_html_()
-        page_html = f"""
+"""
+
+    total = sum(int(p.get("query_count", 0)) for p in points)
+    avg_lat = sum(float(p["latitude"]) * int(p.get("query_count", 0)) for p in points) / total
+    avg_lon = sum(float(p["longitude"]) * int(p.get("query_count", 0)) for p in points) / total
+    m = folium.Map(location=[avg_lat, avg_lon], zoom_start=3,
+                   tiles="CartoDB positron", control_scale=True)
+
+    max_count = max(int(p.get("query_count", 0)) for p in points) or 1
+    bounds = []
+    for point in points:
+        lat = float(point["latitude"])
+        lon = float(point["longitude"])
+        bounds.append([lat, lon])
+        location_name = escape(str(point.get("location_name") or point.get("city") or point.get("country") or "Desconocida"))
+        country = escape(str(point.get("country") or ""))
+        count = int(point.get("query_count", 0))
+        radius = max(5, 25 * (count / max_count))
+        location_url = _public_query_location_url(
+            country=str(point.get("country") or ""),
+            city=str(point.get("city") or ""),
+            likes_threshold=likes_threshold,
+        )
+        popup_html = (
+            f"<b>{location_name}</b>"
+            f"{'<br>' + country if country and country != location_name else ''}"
+            f"<br>Consultas: {count}"
+            + (f'<br><a href="{location_url}" target="_blank">Ver consultas</a>' if location_url else '')
+        )
+        folium.CircleMarker(
+            location=[lat, lon],
+            radius=radius,
+            popup=folium.Popup(popup_html, max_width=260),
+            tooltip=f"{location_name} ({count})",
+            color="#e94560",
+            fill=True,
+            fill_color="#e94560",
+            fill_opacity=0.65,
+        ).add_to(m)
+
+    if len(bounds) > 1:
+        m.fit_bounds(bounds, padding=(20, 20))
+
+    map_html = m._repr_html_()
+    page_html = f"""
 <!DOCTYPE html>
 <html lang="es">
 <head>
@@ -1923,14 +1999,7 @@ async def public_queries_map(request: Request, likes_threshold: int = QUERY_MAP_
 </body>
 </html>
 """
-        return HTMLResponse(content=page_html)
-
-    except Exception as e:
-        logging.error(f"Error generando el mapa público de consultas: {e}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Error al generar el mapa: {str(e)}"
-        )
+    return page_html
 
 
 # Función que pregunta al endpoint de context server gen_stats para obtener estadísticas generales
@@ -1939,30 +2008,19 @@ class GenStatsRequest(BaseModel):
     fromdate: str = None
     todate: str = None
 @app.post("/api/gen_stats")
-async def get_gen_stats(request: GenStatsRequest):
-    logging.info(f"/api/gen_stats called with fromdate={request.fromdate}, todate={request.todate}")
-    logging.info(f"Llamando a {app.context_server_url}/api/gen_stats con {request.dict()}")
+async def get_gen_stats(stats_request: GenStatsRequest, request: Request):
+    logging.info(f"/api/gen_stats called with fromdate={stats_request.fromdate}, todate={stats_request.todate}")
+    logging.info(f"Llamando a {app.context_server_url}/api/gen_stats con {stats_request.dict()}")
     try:
-        payload = request.dict()
-        
-        # Crear headers de autenticación HMAC para context server
-        auth_headers = create_auth_headers(
-            app.context_server_api_key,
-            "POST",
-            "/api/gen_stats",
-            payload,
-            "client_rag_service"
-        )
-        
-        # ENVIAR EL JSON EXACTO QUE USAMOS PARA LA FIRMA
-        body_str = serialize_body(payload)
-        response = requests.post(f"{app.context_server_url}/api/gen_stats", data=body_str, headers=auth_headers, timeout=120)
+        response = await _post_upstream(app.context_client, "/api/gen_stats", stats_request.dict(), request)
         if response.status_code != 200:
             raise HTTPException(status_code=response.status_code, detail=response.text)
         
         result = response.json()
         return result
-    except requests.exceptions.Timeout:
+    except HTTPException:
+        raise
+    except httpx.TimeoutException:
         logging.error("Timeout al consultar estadísticas generales")
         raise HTTPException(status_code=504, detail="Timeout: La consulta está tardando demasiado.")
     except Exception as e:
@@ -1975,32 +2033,21 @@ class SpeakerStatsRequest(BaseModel):
     fromdate: str = None
     todate: str = None
 @app.post("/api/speaker_stats")
-async def get_speaker_stats(request: SpeakerStatsRequest):
-    logging.info(f"/api/speaker_stats called with {request}")
-    logging.info(f"Llamando a {app.context_server_url}/api/speaker_stats con {request.dict()}")
+async def get_speaker_stats(stats_request: SpeakerStatsRequest, request: Request):
+    logging.info(f"/api/speaker_stats called with {stats_request}")
+    logging.info(f"Llamando a {app.context_server_url}/api/speaker_stats con {stats_request.dict()}")
     try:
-        payload = request.dict()
-        
-        # Crear headers de autenticación HMAC para context server
-        auth_headers = create_auth_headers(
-            app.context_server_api_key,
-            "POST",
-            "/api/speaker_stats",
-            payload,
-            "client_rag_service"
-        )
-        
-        # ENVIAR EL JSON EXACTO QUE USAMOS PARA LA FIRMA
-        body_str = serialize_body(payload)
-        response = requests.post(f"{app.context_server_url}/api/speaker_stats", data=body_str, headers=auth_headers, timeout=120)
+        response = await _post_upstream(app.context_client, "/api/speaker_stats", stats_request.dict(), request)
         logging.info(f"Respuesta del context server recibida: {response.status_code}")
         if response.status_code != 200:
             raise HTTPException(status_code=response.status_code, detail=response.text)
         
         result = response.json()
-        logging.info(f"Datos procesados exitosamente para {len(request.tags)} intervinientes")
+        logging.info(f"Datos procesados exitosamente para {len(stats_request.tags)} intervinientes")
         return result
-    except requests.exceptions.Timeout:
+    except HTTPException:
+        raise
+    except httpx.TimeoutException:
         logging.error("Timeout al consultar estadísticas de intervinientes")
         raise HTTPException(status_code=504, detail="Timeout: La consulta está tardando demasiado. Intenta con un período de fechas más pequeño o menos intervinientes.")
     except Exception as e:
@@ -2077,20 +2124,28 @@ async def admin_panel(request: Request):
 # =============================================
 
 @app.get("/api/admin/queries")
-async def admin_get_queries(request: Request, limit: int = 500, offset: int = 0):
-    """Obtiene todas las consultas con info de featured y categorías"""
+async def admin_get_queries(request: Request, limit: int = 500, cursor: Optional[str] = None):
+    """
+    Obtiene las consultas con info de featured y categorías, por páginas.
+    next_cursor es el cursor de la página siguiente (None en la última).
+    """
     require_admin(request)
     if not app.db or not app.db.is_available:
         raise HTTPException(status_code=503, detail="Base de datos no disponible")
+    before, limit = _listing_page(cursor, limit)
     queries = await app.db.get_all_queries_admin(
-        podcast_name=app.podcast_name, limit=limit, offset=offset
+        podcast_name=app.podcast_name, limit=limit + 1, before=before
     )
+    queries, next_cursor = _next_page(queries, limit)
     # Serializar datetimes
     for q in queries:
         if hasattr(q.get('created_at'), 'isoformat'):
             q['created_at'] = q['created_at'].isoformat()
         q['uuid'] = str(q.get('uuid', ''))
-    return {"queries": queries, "total": len(queries)}
+    body = json.dumps({"queries": queries, "total": len(queries), "next_cursor": next_cursor},
+                      ensure_ascii=False, default=str).encode()
+    # Sin caché en el servidor (el admin ve siempre lo último), pero con ETag para el 304
+    return conditional_response(request, body, "application/json", cache_control="private, no-cache")
 
 @app.post("/api/admin/toggle_featured/{query_uuid}")
 async def admin_toggle_featured(query_uuid: str, request: Request):
@@ -2105,6 +2160,7 @@ async def admin_toggle_featured(query_uuid: str, request: Request):
     success = await app.db.update_featured(query_uuid, new_featured)
     if not success:
         raise HTTPException(status_code=500, detail="Error al actualizar")
+    app.listings.invalidate()
     return {"uuid": query_uuid, "featured": new_featured}
 
 @app.post("/api/admin/set_votes/{query_uuid}")
@@ -2124,6 +2180,7 @@ async def admin_set_votes(query_uuid: str, request: Request):
     success = await app.db.set_votes(query_uuid, likes, dislikes)
     if not success:
         raise HTTPException(status_code=500, detail="Error al actualizar votos")
+    app.listings.invalidate()
 
     # Registrar cambios en tabla de auditoría ip_likes
     old_likes = query.get('likes', 0) or 0
@@ -2145,6 +2202,16 @@ async def admin_vote_history(query_id: int, request: Request):
     history = await app.db.get_vote_history(query_id)
     return {"query_id": query_id, "votes": history}
 
+@app.post("/api/admin/queries/map/rebuild")
+async def admin_rebuild_query_map(request: Request):
+    """Recalcula el resumen geográfico del mapa desde rag_queries (tras cambios hechos sin el trigger)"""
+    require_admin(request)
+    if not app.db or not app.db.is_available:
+        raise HTTPException(status_code=503, detail="Base de datos no disponible")
+    if not await app.db.rebuild_geo_summary():
+        raise HTTPException(status_code=500, detail="Error al recalcular el resumen geográfico")
+    return {"generation": await app.db.get_geo_summary_generation()}
+
 @app.get("/api/admin/categories")
 async def admin_get_categories(request: Request):
     """Obtiene el árbol de categorías"""
@@ -2178,12 +2245,7 @@ async def admin_create_category(request: Request):
             "n_fragments": 1,
             "only_embedding": True
         }
-        auth_headers = create_auth_headers(
-            app.context_server_api_key, "POST", "/getcontext",
-            emb_payload, "client_rag_service"
-        )
-        body_str = serialize_body(emb_payload)
-        emb_resp = requests.post(app.get_context_url, data=body_str, headers=auth_headers, timeout=30)
+        emb_resp = await app.context_client.post_json("/getcontext", emb_payload, timeout=30)
         if emb_resp.status_code == 200:
             category_embedding = emb_resp.json().get('query_embedding')
     except Exception as e:
@@ -2262,15 +2324,19 @@ async def admin_suggest_categories(request: Request):
     
     body = await request.json()
     selected_model = body.get('model')  # Modelo elegido por el admin
+    query_ids = body.get('query_ids')  # Solo estas (p. ej. las de baja confianza de auto_categorize)
     
     # Obtener consultas destacadas con sus respuestas para enviar al LLM
-    featured = await app.db.get_featured_queries(podcast_name=app.podcast_name)
+    if query_ids:
+        featured = await app.db.get_queries_for_categorization(query_ids[:AUTO_CATEGORY_LLM_MAX])
+    else:
+        featured = await app.db.get_featured_queries(podcast_name=app.podcast_name)
     queries_for_llm = []
     for q in featured:
         queries_for_llm.append({
             "id": q['id'],
             "question": q['query_text'],
-            "answer": q.get('response_text', '')[:500]  # Limitar respuesta
+            "answer": (q.get('response_text') or '')[:500]  # Limitar respuesta
         })
     
     existing_categories = await app.db.get_all_categories_flat()
@@ -2288,26 +2354,66 @@ async def admin_suggest_categories(request: Request):
         suggest_payload['model'] = selected_model
     
     try:
-        rag_base_url = app.relsearch_url.rsplit('/', 1)[0]
-        auth_headers = create_auth_headers(
-            app.rag_server_api_key, "POST", "/suggest_categories",
-            suggest_payload, "client_rag_service"
-        )
-        body_str = serialize_body(suggest_payload)
-        resp = requests.post(
-            f"{rag_base_url}/suggest_categories",
-            data=body_str, headers=auth_headers, timeout=300
-        )
+        resp = await _post_upstream(app.rag_client, "/suggest_categories", suggest_payload, request,
+                                    retries=0, timeout=300)
         if resp.status_code != 200:
             raise HTTPException(status_code=resp.status_code, detail=f"Error del servicio RAG: {resp.text}")
         return resp.json()
-    except requests.exceptions.Timeout:
+    except httpx.TimeoutException:
         raise HTTPException(status_code=504, detail="Timeout al solicitar categorización")
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
+@app.post("/api/admin/auto_categorize")
+async def admin_auto_categorize(request: Request):
+    """
+    Categoriza en lote las consultas sin categoría por similitud con los
+    embeddings de las categorías. Devuelve las de baja confianza para que el
+    admin pueda enviarlas al LLM (suggest_categories con query_ids).
+    """
+    require_admin(request)
+    if not app.db or not app.db.is_available:
+        raise HTTPException(status_code=503, detail="Base de datos no disponible")
+    body = await request.json()
+    threshold = float(body.get('threshold', AUTO_CATEGORY_THRESHOLD))
+    top_k = int(body.get('top_k', AUTO_CATEGORY_TOP_K))
+    
+    start = time.perf_counter()
+    category_ids, category_vectors = await app.db.get_category_vectors()
+    if not category_ids:
+        raise HTTPException(status_code=400, detail="No hay categorías con embedding")
+    query_ids, query_vectors = await app.db.get_uncategorized_vectors(podcast_name=app.podcast_name)
+    loaded = time.perf_counter()
+    
+    matches = await asyncio.to_thread(match_categories, query_ids, query_vectors,
+                                      category_ids, category_vectors, top_k, threshold)
+    matched = time.perf_counter()
+    
+    applied = 0
+    if not body.get('dry_run'):
+        applied = await app.db.assign_queries_to_categories(matches.assignments, assigned_by='auto')
+    written = time.perf_counter()
+    
+    low_confidence = sorted(matches.low_confidence, key=lambda item: item[1])
+    logging.info(f"Categorización automática: {matches.categorized}/{len(query_ids)} consultas, "
+                 f"{applied} asignaciones, {len(low_confidence)} de baja confianza "
+                 f"(carga {loaded - start:.2f}s, similitud {matched - loaded:.2f}s, escritura {written - matched:.2f}s)")
+    return {
+        "uncategorized": len(query_ids),
+        "categories": len(category_ids),
+        "categorized": matches.categorized,
+        "applied_assignments": applied,
+        "low_confidence": len(low_confidence),
+        # Las de menor similitud primero: son las que más necesitan al LLM
+        "low_confidence_ids": [query_id for query_id, _ in low_confidence[:AUTO_CATEGORY_LLM_MAX]],
+        "threshold": threshold,
+        "top_k": top_k,
+        "timings": {"load": round(loaded - start, 3), "match": round(matched - loaded, 3),
+                    "write": round(written - matched, 3)}
+    }
+
 @app.post("/api/admin/apply_categories")
 async def admin_apply_categories(request: Request):
     """Aplica un esquema de categorías propuesto por el LLM"""
@@ -2367,20 +2473,15 @@ async def admin_apply_categories(request: Request):
         except Exception as e:
             errors.append(f"Error creando categoría {cat.get('name')}: {e}")
     
-    # Aplicar asignaciones
-    applied_count = 0
+    # Aplicar asignaciones (en lote)
+    rows = []
     for assignment in assignments:
         query_id = assignment.get('query_id')
         for slug in assignment.get('category_slugs', []):
             cat_id = created_categories.get(slug)
             if cat_id and query_id:
-                success = await app.db.assign_query_to_category(
-                    query_id, cat_id,
-                    assigned_by='llm',
-                    confidence=assignment.get('confidence', 0.8)
-                )
-                if success:
-                    applied_count += 1
+                rows.append((query_id, cat_id, assignment.get('confidence', 0.8)))
+    applied_count = await app.db.assign_queries_to_categories(rows, assigned_by='llm')
     
     # Aplicar reasignaciones de padres
     reparents = body.get('reparents', [])
@@ -2438,7 +2539,15 @@ async def health_check():
             "api_url": context_server_url,
             "files_base_url": FILES_BASE_URL,
             "timeout": WEB_SERVICE_TIMEOUT
-        }
+        },
+        "answer_cache": app.answer_cache.stats(),
+        "question_embeddings": app.question_embeddings.stats(),
+        "ask_single_flight": app.ask_flights.stats(),
+        "query_map": app.query_maps.stats(),
+        "query_listings": app.listings.stats(),
+        "transcript_anchors": anchor_cache.stats(),
+        "transcripts": app.transcript_proxy.stats(),
+        "upstreams": {"rag_server": app.rag_client.stats(), "context_server": app.context_client.stats()}
     }
 
 if __name__ == "__main__":
@@ -1,66 +1,162 @@
-from bs4 import BeautifulSoup
-import os
+"""
+Búsqueda del ancla de tiempo (id 'time-HH-MM-SS') de una referencia en su transcripción.
+
+Antes cada referencia descargaba (o leía) la transcripción completa y la
+parseaba con BeautifulSoup. Ahora cada transcripción se reduce a un
+TimeAnchorIndex (tools/timeanchors.py) que se guarda en memoria y la búsqueda
+es un bisect:
+
+- Rutas locales: el índice se valida con el mtime y el tamaño del HTML. Si no
+  está en memoria se lee el sidecar <html>.anchors.json (generado al publicar
+  o la primera vez que se consulta) y, si falta o está desactualizado, se
+  parsea el HTML y se reescribe.
+- URLs: el índice se guarda con el ETag / Last-Modified de la respuesta y,
+  pasados TRANSCRIPT_ANCHORS_REVALIDATE segundos, se revalida con una petición
+  condicional (un 304 reutiliza el índice sin descargar el HTML).
+"""
+
 import logging
-import requests
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
 
-def find_nearest_time_id(html_path, target_seconds):
-    """Busca el id 'time-HH-MM-SS' más cercano anterior a target_seconds en un HTML.
-    Acepta tanto rutas locales como URLs.
-    """
-    logging.debug(f"Buscando el id más cercano a {target_seconds} segundos en {html_path}")
-    
-    html_content = None
-    
-    # Si es una URL (comienza con http:// o https://)
-    if html_path.startswith(('http://', 'https://')):
+import httpx
+
+from tools.timeanchors import TimeAnchorIndex, file_validators, load_sidecar, write_sidecar
+
+# Transcripciones con el índice en memoria y segundos entre revalidaciones de las remotas
+TRANSCRIPT_ANCHORS_CACHE_SIZE = int(os.getenv('TRANSCRIPT_ANCHORS_CACHE_SIZE', '512'))
+TRANSCRIPT_ANCHORS_REVALIDATE = float(os.getenv('TRANSCRIPT_ANCHORS_REVALIDATE', '60'))
+DOWNLOAD_TIMEOUT = 10
+
+
+class TimeAnchorCache:
+    """LRU de índices de anclas por ruta o URL de transcripción (compartida entre hilos)."""
+
+    def __init__(self, max_items: int = TRANSCRIPT_ANCHORS_CACHE_SIZE,
+                 revalidate_seconds: float = TRANSCRIPT_ANCHORS_REVALIDATE,
+                 client: Optional[httpx.Client] = None, clock=time.monotonic):
+        self.max_items = max_items
+        self.revalidate_seconds = revalidate_seconds
+        # Cliente con keep-alive: las revalidaciones reutilizan la conexión al storage
+        self.client = client or httpx.Client(timeout=DOWNLOAD_TIMEOUT)
+        self.clock = clock
+        self._lock = threading.Lock()
+        # clave -> (validadores, índice, momento de la última validación)
+        self._items: "OrderedDict[str, tuple]" = OrderedDict()
+        self.stats_counters = {"memory": 0, "sidecar": 0, "parsed": 0, "downloaded": 0, "revalidated": 0}
+
+    def _get(self, key: str) -> Optional[tuple]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                self._items.move_to_end(key)
+            return item
+
+    def _put(self, key: str, validators: dict, index: TimeAnchorIndex):
+        with self._lock:
+            self._items[key] = (validators, index, self.clock())
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def _count(self, name: str):
+        with self._lock:
+            self.stats_counters[name] += 1
+
+    def local_index(self, html_path: str) -> Optional[TimeAnchorIndex]:
         try:
-            response = requests.get(html_path, timeout=10)
-            if response.status_code == 200:
-                html_content = response.text
-                logging.debug(f"HTML descargado desde URL: {html_path}")
-            else:
-                logging.warning(f"Error al descargar URL {html_path}: {response.status_code}")
-                return None
-        except requests.exceptions.Timeout:
-            logging.error(f"Timeout descargando {html_path}")
+            validators = file_validators(html_path)
+        except OSError:
+            logging.warning(f"No se encontró archivo o URL: {html_path}")
             return None
-        except Exception as e:
-            logging.error(f"Error descargando URL {html_path}: {e}")
-            return None
-    # Si es una ruta local
-    elif os.path.exists(html_path):
+        item = self._get(html_path)
+        if item is not None and item[0] == validators:
+            self._count("memory")
+            return item[1]
+
+        index = load_sidecar(html_path, validators)
+        if index is not None:
+            self._count("sidecar")
+            logging.debug(f"Índice de anclas leído del sidecar de {html_path}")
+        else:
+            try:
+                with open(html_path, encoding="utf-8") as f:
+                    index = TimeAnchorIndex.from_html(f.read())
+            except Exception as e:
+                logging.error(f"Error al leer archivo local {html_path}: {e}")
+                return None
+            self._count("parsed")
+            logging.debug(f"Índice de anclas construido desde {html_path} ({len(index)} anclas)")
+            write_sidecar(html_path, index, validators)
+        self._put(html_path, validators, index)
+        return index
+
+    def remote_index(self, url: str) -> Optional[TimeAnchorIndex]:
+        item = self._get(url)
+        if item is not None and self.clock() - item[2] < self.revalidate_seconds:
+            self._count("memory")
+            return item[1]
+
+        headers = {}
+        if item is not None:
+            if item[0].get("etag"):
+                headers["If-None-Match"] = item[0]["etag"]
+            if item[0].get("last_modified"):
+                headers["If-Modified-Since"] = item[0]["last_modified"]
         try:
-            with open(html_path, encoding="utf-8") as f:
-                html_content = f.read()
-            logging.debug(f"HTML cargado desde filesystem: {html_path}")
+            response = self.client.get(url, headers=headers)
+        except httpx.TimeoutException:
+            logging.error(f"Timeout descargando {url}")
+            return item[1] if item else None
         except Exception as e:
-            logging.error(f"Error al leer archivo local {html_path}: {e}")
+            logging.error(f"Error descargando URL {url}: {e}")
+            return item[1] if item else None
+
+        if response.status_code == 304 and item is not None:
+            self._count("revalidated")
+            self._put(url, item[0], item[1])
+            return item[1]
+        if response.status_code != 200:
+            logging.warning(f"Error al descargar URL {url}: {response.status_code}")
             return None
-    else:
-        logging.warning(f"No se encontró archivo o URL: {html_path}")
+
+        index = TimeAnchorIndex.from_html(response.text)
+        self._count("downloaded")
+        logging.debug(f"Índice de anclas construido desde {url} ({len(index)} anclas)")
+        self._put(url, {"etag": response.headers.get("ETag"),
+                        "last_modified": response.headers.get("Last-Modified")}, index)
+        return index
+
+    def index_for(self, html_path: str) -> Optional[TimeAnchorIndex]:
+        if html_path.startswith(('http://', 'https://')):
+            return self.remote_index(html_path)
+        return self.local_index(html_path)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._items), **self.stats_counters}
+
+
+anchor_cache = TimeAnchorCache()
+
+
+def find_nearest_time_id(html_path, target_seconds):
+    """Busca el id 'time-HH-MM-SS' más cercano anterior a target_seconds en un HTML.
+    Acepta tanto rutas locales como URLs.
+    """
+    logging.debug(f"Buscando el id más cercano a {target_seconds} segundos en {html_path}")
+    try:
+        target_seconds = float(target_seconds)
+    except (TypeError, ValueError):
+        logging.error(f"Segundos no válidos para buscar en {html_path}: {target_seconds}")
         return None
-    
-    # Procesar el HTML
-    if not html_content:
+    index = anchor_cache.index_for(html_path)
+    if index is None:
         return None
-    
-    soup = BeautifulSoup(html_content, "html.parser")
-    time_spans = soup.find_all("span", class_="time")
-    if not time_spans:
+    if not len(index):
         logging.warning(f"No se encontraron spans de tiempo en {html_path}")
         return None
-    logging.debug(f"Se encontraron {len(time_spans)} spans de tiempo en {html_path}")
-    best_id = None
-    best_secs = -1
-    for span in time_spans:
-        sid = span.get("id", "")
-        try:
-            hh, mm, ss = map(int, sid.replace("time-", "").split("-"))
-            secs = hh*3600 + mm*60 + ss
-            if secs <= target_seconds and secs > best_secs:
-                best_secs = secs
-                best_id = sid
-        except Exception:
-            logging.error(f"Error al procesar el id {sid} en {html_path}: {str(Exception)}")
-            continue
-    return best_id
+    return index.nearest(target_seconds)
@@ -0,0 +1,148 @@
+"""
+Caché de respuestas de los listados de consultas y respuestas condicionales (ETag / 304).
+
+Los listados (/pgv/{clave}, /queries/city/{city}, /queries/country/{country})
+se generan a partir de la BD en cada visita y los bots los recorren una y
+otra vez. Cada página generada se guarda unos segundos (QUERY_LISTING_CACHE_TTL)
+con su ETag:
+
+- Mientras no caduque, la página se sirve de memoria sin tocar la BD.
+- Los votos, los cambios de destacadas y las consultas nuevas vacían la caché
+  (invalidate()), así que en este proceso no se sirve un listado anterior a
+  ellos; los cambios hechos por otros workers o por manageqdb se ven como
+  mucho al caducar el TTL.
+- Si el cliente envía If-None-Match con el ETag de la página, se responde 304
+  sin cuerpo.
+"""
+
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Hashable, Optional
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+DEFAULT_TTL_SECONDS = 30.0
+DEFAULT_MAX_ITEMS = 256
+
+
+class _LeaderCancelled(Exception):
+    """La petición que generaba la página se canceló; las que la esperaban la generan ellas."""
+
+
+@dataclass
+class CachedPage:
+    body: bytes
+    media_type: str
+    etag: str
+    stored_at: float
+
+
+def make_etag(body: bytes) -> str:
+    return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Comprueba If-None-Match (lista de ETags, débiles incluidos, o '*')."""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    candidates = [tag.strip() for tag in header.split(",")]
+    return "*" in candidates or any(tag.removeprefix("W/") == etag.removeprefix("W/") for tag in candidates)
+
+
+def conditional_response(request: Request, body: bytes, media_type: str, etag: Optional[str] = None,
+                         cache_control: str = "no-cache") -> Response:
+    """Respuesta con ETag y Cache-Control; 304 sin cuerpo si el cliente ya tiene esa versión."""
+    etag = etag or make_etag(body)
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type=media_type, headers=headers)
+
+
+class ListingCache:
+    """Páginas de listados generadas, con TTL corto e invalidación explícita."""
+
+    def __init__(self, ttl_seconds: float = DEFAULT_TTL_SECONDS, max_items: int = DEFAULT_MAX_ITEMS,
+                 clock: Callable[[], float] = time.monotonic):
+        """
+        Args:
+            ttl_seconds: Segundos que se sirve una página generada; <= 0 desactiva la caché
+            max_items: Páginas máximas en memoria (LRU)
+        """
+        self.ttl_seconds = ttl_seconds
+        self.max_items = max_items
+        self.clock = clock
+        self._items: "OrderedDict[Hashable, CachedPage]" = OrderedDict()
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def invalidate(self):
+        """Descarta todas las páginas (un voto o una destacada puede cambiar cualquier listado)."""
+        self._items.clear()
+        # Las generaciones en curso empezaron antes del cambio: no se guardan
+        self._version += 1
+        self.invalidations += 1
+
+    async def get(self, key: Hashable, build: Callable[[], Awaitable[bytes]],
+                  media_type: str = "text/html; charset=utf-8") -> CachedPage:
+        """Devuelve la página de la clave, generándola con build() si no está o ha caducado."""
+        while self.ttl_seconds > 0:
+            page = self._items.get(key)
+            if page is not None and self.clock() - page.stored_at <= self.ttl_seconds:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return page
+            inflight = self._inflight.get(key)
+            if inflight is None:
+                break
+            try:
+                page = await asyncio.shield(inflight)
+            except _LeaderCancelled:
+                # Se canceló la petición que la generaba, no esta: se vuelve a intentar
+                continue
+            self.hits += 1
+            return page
+
+        self.misses += 1
+        version = self._version
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            body = await build()
+        except asyncio.CancelledError:
+            # No se cancela el future: las que esperaban no deben cancelarse con ella
+            future.set_exception(_LeaderCancelled())
+            future.exception()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # Evita el aviso si nadie más esperaba
+            raise
+        finally:
+            self._inflight.pop(key, None)
+        page = CachedPage(body, media_type, make_etag(body), self.clock())
+        future.set_result(page)
+
+        if self.ttl_seconds > 0 and version == self._version:
+            self._items[key] = page
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+        return page
+
+    def stats(self) -> dict:
+        return {
+            "items": len(self._items),
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+        }
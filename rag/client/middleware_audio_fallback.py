@@ -6,96 +6,166 @@ Este módulo permite que archivos HTML existentes (incluso de 10+ años)
 funcionen automáticamente con el sistema de fallback de audios locales,
 sin necesidad de modificarlos.
 
+Es un middleware ASGI puro que reescribe la respuesta a medida que pasa:
+no acumula el HTML (las transcripciones ocupan varios MB), solo retiene los
+últimos bytes de cada bloque por si '</body>' queda partido entre dos.
+
 Uso en client_rag.py:
     from middleware_audio_fallback import AudioFallbackMiddleware
-    
+
     app = FastAPI(...)
     app.add_middleware(AudioFallbackMiddleware)
 """
 
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.responses import StreamingResponse
-import re
 import logging
 
+import anyio
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
 logger = logging.getLogger(__name__)
 
+# Script a inyectar
+FALLBACK_SCRIPT = (
+    b'\n    <script src="/static/js/audio_fallback_standalone.js" '
+    b'defer async="false"></script>\n'
+)
 
-class AudioFallbackMiddleware(BaseHTTPMiddleware):
+BODY_CLOSE = b"</body>"
+HTML_CLOSE = b"</html>"
+# Bytes que se retienen entre bloques: una etiqueta de cierre menos un carácter
+CARRY_OVER = len(BODY_CLOSE) - 1
+PATHSEND_CHUNK_SIZE = 64 * 1024
+
+
+class ScriptInjector:
+    """
+    Inserta el script en un HTML que llega por bloques, en el mismo sitio que
+    antes con el HTML completo: delante de </body>; si no hay </body>, delante
+    de </html>; si tampoco, al final. Las etiquetas se buscan sin distinguir
+    mayúsculas y el script se inserta una sola vez.
+    """
+
+    def __init__(self, script: bytes = FALLBACK_SCRIPT):
+        self.script = script
+        self.done = False
+        self._carry = b""
+        # Desde un </html> sin </body> previo: se retiene por si </body> viene después
+        self._held = None
+
+    def feed(self, chunk: bytes) -> bytes:
+        """Devuelve los bytes que ya pueden enviarse."""
+        if self.done:
+            return chunk
+        if self._held is not None:
+            self._held += chunk
+            return self._inject_in_held()
+
+        data = self._carry + chunk
+        lowered = data.lower()
+        body_pos = lowered.find(BODY_CLOSE)
+        html_pos = lowered.find(HTML_CLOSE)
+        if body_pos >= 0 and (html_pos < 0 or body_pos < html_pos):
+            self.done = True
+            self._carry = b""
+            return data[:body_pos] + self.script + data[body_pos:]
+        if html_pos >= 0:
+            self._carry = b""
+            self._held = data[html_pos:]
+            return data[:html_pos] + self._inject_in_held()
+
+        cut = max(0, len(data) - CARRY_OVER)
+        self._carry = data[cut:]
+        return data[:cut]
+
+    def _inject_in_held(self) -> bytes:
+        body_pos = self._held.lower().find(BODY_CLOSE)
+        if body_pos < 0:
+            return b""
+        held, self._held = self._held, None
+        self.done = True
+        return held[:body_pos] + self.script + held[body_pos:]
+
+    def finish(self) -> bytes:
+        """Bytes pendientes al terminar la respuesta (con el script si aún no se insertó)."""
+        if self.done:
+            return b""
+        self.done = True
+        if self._held is not None:
+            held, self._held = self._held, None
+            return self.script + held
+        carry, self._carry = self._carry, b""
+        return carry + self.script
+
+
+class AudioFallbackMiddleware:
     """
     Middleware que inyecta automáticamente el script de fallback de audios
     en todos los HTML servidos desde el servidor.
-    
+
     Características:
-    - Solo modifica respuestas HTML
+    - Solo modifica respuestas HTML completas (no las de Range, 206, 304 ni comprimidas)
     - No afecta otros tipos de archivos
     - Compatible con iframes
     - Preserva estructura HTML original
+    - Mantiene el streaming y corrige Content-Length si la respuesta lo lleva
     """
 
-    async def dispatch(self, request, call_next):
-        response = await call_next(request)
-        
-        # Solo procesar respuestas HTML
-        if self._is_html_response(response):
-            try:
-                # Capturar el body de la respuesta
-                body = b""
-                async for chunk in response.body_iterator:
-                    body += chunk
-                
-                # Inyectar el script
-                modified_body = self._inject_fallback_script(body)
-                
-                # Preparar headers (copiar y remover Content-Length)
-                headers = dict(response.headers)
-                if 'content-length' in headers:
-                    del headers['content-length']
-                
-                # Retornar respuesta modificada con nuevo tamaño
-                return StreamingResponse(
-                    iter([modified_body]),
-                    status_code=response.status_code,
-                    headers=headers,
-                    media_type=response.media_type
-                )
-            except Exception as e:
-                logger.warning(f"Error al inyectar script de fallback: {e}")
-                # Si hay error, retornar respuesta original
-                return response
-        
-        return response
-
-    def _is_html_response(self, response):
-        """Verifica si la respuesta es HTML"""
-        content_type = response.headers.get('content-type', '').lower()
-        return 'text/html' in content_type
-
-    def _inject_fallback_script(self, html_bytes):
-        """Inyecta el script de fallback en el HTML"""
-        try:
-            html_str = html_bytes.decode('utf-8')
-            
-            # Script a inyectar
-            fallback_script = (
-                '\n    <script src="/static/js/audio_fallback_standalone.js" '
-                'defer async="false"></script>\n'
-            )
-            
-            # Buscar </body> y colocar el script antes
-            # Esto asegura que todos los elementos HTML estén cargados
-            if '</body>' in html_str:
-                html_str = html_str.replace('</body>', fallback_script + '</body>')
-            elif '</html>' in html_str:
-                # Fallback si no hay </body>
-                html_str = html_str.replace('</html>', fallback_script + '</html>')
+    def __init__(self, app: ASGIApp, script: bytes = FALLBACK_SCRIPT):
+        self.app = app
+        self.script = script
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        # Un rango de bytes de un HTML no admite inserciones: se sirve tal cual
+        if scope["type"] != "http" or "range" in Headers(scope=scope):
+            await self.app(scope, receive, send)
+            return
+
+        head_only = scope["method"] == "HEAD"
+        injector = None
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal injector
+            message_type = message["type"]
+            if message_type == "http.response.start":
+                headers = MutableHeaders(raw=list(message.get("headers", [])))
+                if self._should_inject(message["status"], headers):
+                    injector = ScriptInjector(self.script)
+                    if "content-length" in headers:
+                        headers["content-length"] = str(int(headers["content-length"]) + len(self.script))
+                    message = {**message, "headers": headers.raw}
+                await send(message)
+            elif injector is None or head_only:
+                await send(message)
+            elif message_type == "http.response.body":
+                more_body = message.get("more_body", False)
+                data = injector.feed(message.get("body", b""))
+                if not more_body:
+                    data += injector.finish()
+                if data or not more_body:
+                    await send({"type": "http.response.body", "body": data, "more_body": more_body})
+            elif message_type == "http.response.pathsend":
+                # El servidor enviaría el archivo directamente: hay que leerlo para insertar el script
+                async with await anyio.open_file(message["path"], "rb") as f:
+                    while chunk := await f.read(PATHSEND_CHUNK_SIZE):
+                        data = injector.feed(chunk)
+                        if data:
+                            await send({"type": "http.response.body", "body": data, "more_body": True})
+                await send({"type": "http.response.body", "body": injector.finish(), "more_body": False})
             else:
-                # Último recurso: agregar al final
-                html_str += fallback_script
-            
-            logger.debug("Script de fallback inyectado correctamente")
-            return html_str.encode('utf-8')
-            
-        except Exception as e:
-            logger.warning(f"Error decodificando HTML: {e}")
-            return html_bytes
+                await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+    def _should_inject(self, status_code: int, headers: MutableHeaders) -> bool:
+        """Verifica si la respuesta es un HTML completo y sin comprimir"""
+        if 'text/html' not in headers.get('content-type', '').lower():
+            return False
+        if status_code in (204, 206, 304):
+            return False
+        if headers.get('content-encoding', 'identity').lower() != 'identity':
+            logger.debug("Respuesta HTML comprimida: no se inyecta el script de fallback")
+            return False
+        if "content-length" in headers and not headers["content-length"].isdigit():
+            return False
+        return True
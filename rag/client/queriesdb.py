@@ -10,15 +10,25 @@ Este módulo soporta múltiples clientes:
   * Otorgar permisos al usuario sobre su base de datos
 
 Este módulo es OPCIONAL y solo se activa si QUERIESDB_AVAILABLE=true en queriesdb.env
+
+Los embeddings viajan en el formato binario de pgvector (códec registrado en
+cada conexión del pool) en lugar de como texto '[x, y, ...]', y las consultas
+más frecuentes usan SQL constante para que asyncpg reutilice sus sentencias
+preparadas en cada conexión.
 """
 
 import asyncio
+import base64
 import os
+import struct
 import uuid
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Tuple
 import logging
 from datetime import datetime
 from contextlib import asynccontextmanager
+from functools import lru_cache
+
+import numpy as np
 
 try:
     import asyncpg
@@ -36,6 +46,8 @@ logger = logging.getLogger(__name__)
 
 # Ruta por defecto de la base de datos GeoLite2-City
 GEOIP_DB_PATH = os.getenv("GEOIP_DB_PATH", "/var/lib/GeoIP/GeoLite2-City.mmdb")
+# IPs resueltas que se recuerdan en memoria (la base GeoLite2 no cambia mientras corre el proceso)
+GEOIP_CACHE_SIZE = int(os.getenv("GEOIP_CACHE_SIZE", "4096"))
 _geoip_reader = None
 
 
@@ -58,24 +70,242 @@ def _get_geoip_reader():
         return None
 
 
+@lru_cache(maxsize=GEOIP_CACHE_SIZE)
+def _geoip_city(ip: str) -> Optional[tuple]:
+    """(país, ciudad, latitud, longitud) de una IP con el lector singleton, o None si no está en la base."""
+    try:
+        response = _geoip_reader.city(ip)
+    except Exception:
+        return None  # IP no encontrada en la base de datos GeoIP
+    return (response.country.name, response.city.name,
+            response.location.latitude, response.location.longitude)
+
+
+def _geoip_resolve(ip: str) -> Optional[tuple]:
+    if not ip or ip in ('unknown', '127.0.0.1', '::1'):
+        return None
+    if not _get_geoip_reader():
+        return None
+    return _geoip_city(ip)
+
+
 def geoip_lookup(ip: str) -> dict:
     """
     Busca país y ciudad a partir de una IP usando GeoLite2.
     Retorna {'country': ..., 'city': ...} o valores None si no se puede resolver.
     """
-    result = {"country": None, "city": None}
-    if not ip or ip in ('unknown', '127.0.0.1', '::1'):
-        return result
-    reader = _get_geoip_reader()
-    if not reader:
-        return result
+    hit = _geoip_resolve(ip)
+    if hit is None:
+        return {"country": None, "city": None}
+    return {"country": hit[0], "city": hit[1]}
+
+
+def geoip_coordinates(ip: str) -> Optional[tuple]:
+    """Devuelve (latitud, longitud) de una IP, o None si no se puede resolver."""
+    hit = _geoip_resolve(ip)
+    if hit is None or hit[2] is None or hit[3] is None:
+        return None
+    return hit[2], hit[3]
+
+
+# Formato binario de pgvector: dimensión (int16), campo reservado (int16) y float4 big-endian
+_VECTOR_HEADER = struct.Struct('!HH')
+
+
+def encode_vector(value) -> bytes:
+    """Codifica un embedding (lista o array NumPy) en el formato binario del tipo vector."""
+    array = np.asarray(value, dtype='>f4')
+    return _VECTOR_HEADER.pack(array.shape[0], 0) + array.tobytes()
+
+
+def decode_vector(data: bytes) -> np.ndarray:
+    """Decodifica un vector binario de pgvector en un array float32."""
+    dim, _ = _VECTOR_HEADER.unpack_from(data)
+    return np.frombuffer(data, dtype='>f4', count=dim, offset=_VECTOR_HEADER.size).astype(np.float32)
+
+
+async def register_vector_codec(conn, schema: str = 'public'):
+    """Registra en una conexión asyncpg el códec binario del tipo vector."""
+    await conn.set_type_codec('vector', schema=schema, encoder=encode_vector,
+                              decoder=decode_vector, format='binary')
+
+
+def encode_cursor(created_at: datetime, query_id: int) -> str:
+    """Cursor opaco de paginación por clave: (created_at, id) de la última fila de la página."""
+    raw = f"{created_at.isoformat()}|{query_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """Decodifica un cursor de encode_cursor. Lanza ValueError si no es válido."""
     try:
-        response = reader.city(ip)
-        result["country"] = response.country.name
-        result["city"] = response.city.name
-    except Exception:
-        pass  # IP no encontrada en la base de datos GeoIP
-    return result
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created_at, query_id = raw.split('|')
+        return datetime.fromisoformat(created_at), int(query_id)
+    except Exception as e:
+        raise ValueError(f"Cursor no válido: {cursor}") from e
+
+
+def _keyset_filter(clauses: List[str], params: list, before: Optional[Tuple[datetime, int]], alias: str = ''):
+    """Añade la condición de la página siguiente: filas anteriores a (created_at, id) del cursor."""
+    if before is not None:
+        params.extend(before)
+        clauses.append(f"({alias}created_at, {alias}id) < (${len(params) - 1}::TIMESTAMP, ${len(params)}::INTEGER)")
+
+
+# Consultas frecuentes (SQL constante: asyncpg las prepara una vez por conexión)
+SAVE_QUERY_SQL = """
+    INSERT INTO rag_queries (query_text, response_text, query_embedding, podcast_name, response_data, created_at, ip, country, city, index_generation, corpus_generation)
+    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11)
+    RETURNING id, uuid;
+"""
+
+SEARCH_SIMILAR_SQL = """
+    SELECT 
+        id,
+        uuid,
+        query_text,
+        response_text,
+        1 - (query_embedding <=> $1::vector) AS similarity,
+        created_at,
+        podcast_name,
+        likes,
+        dislikes
+    FROM rag_queries
+    WHERE ($2::VARCHAR IS NULL OR podcast_name = $2) AND (query_embedding <=> $1::vector) < $3
+    ORDER BY query_embedding <=> $1::vector
+    LIMIT $4;
+"""
+
+FIND_CACHED_ANSWER_SQL = """
+    SELECT 
+        id,
+        uuid,
+        query_text,
+        response_text,
+        response_data,
+        1 - (query_embedding <=> $1::vector) AS similarity,
+        created_at,
+        likes,
+        dislikes
+    FROM rag_queries
+    WHERE corpus_generation = $2
+    AND ($3::VARCHAR IS NULL OR podcast_name = $3)
+    AND allowed IS NOT FALSE
+    AND response_data IS NOT NULL
+    AND COALESCE(dislikes, 0) <= COALESCE(likes, 0)
+    AND (query_embedding <=> $1::vector) < $4
+    ORDER BY query_embedding <=> $1::vector
+    LIMIT 1;
+"""
+
+# El índice HNSW devuelve hnsw.ef_search candidatos (40 por defecto) y los filtros de
+# FIND_CACHED_ANSWER_SQL se aplican después: justo tras un cambio de generación todos
+# pueden ser de la anterior y la búsqueda falla sin motivo. Se amplían los candidatos
+# y, con pgvector >= 0.8, el recorrido iterativo sigue hasta encontrar filas que pasen
+# los filtros o salir del umbral de distancia.
+CACHED_ANSWER_EF_SEARCH = 400
+
+LOG_QUERY_ACCESS_SQL = """
+    INSERT INTO rag_queries_access_log (query_id, access_time, similarity_score, cache_hit)
+    VALUES ($1, $2, $3, $4)
+"""
+
+# Resumen geográfico materializado (mapa de consultas): un contador por podcast, país, ciudad
+# y puntuación (likes - dislikes) de las consultas destacadas y permitidas con IP y país.
+# Lo mantiene un trigger en rag_queries. Cada cambio incrementa la versión de la fila que toca
+# (no hay un contador global que serialice todas las altas) y las filas que se quedan a cero no
+# se borran: así la suma de las versiones solo crece y sirve de generación del resumen (clave
+# de la caché del mapa). La ciudad desconocida se guarda como ''.
+# Subir GEO_SUMMARY_SCHEMA_VERSION al cambiar el trigger: el siguiente arranque lo reinstala
+# y recalcula el resumen.
+GEO_SUMMARY_SCHEMA_VERSION = 2
+
+GEO_SUMMARY_TRIGGER_SQL = """
+    CREATE OR REPLACE FUNCTION rag_geo_summary_refresh() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'UPDATE'
+           AND (OLD.featured, OLD.allowed, OLD.country, OLD.city, OLD.ip, OLD.podcast_name,
+                OLD.likes - OLD.dislikes)
+               IS NOT DISTINCT FROM
+               (NEW.featured, NEW.allowed, NEW.country, NEW.city, NEW.ip, NEW.podcast_name,
+                NEW.likes - NEW.dislikes) THEN
+            RETURN NULL;
+        END IF;
+        IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.featured AND OLD.allowed AND OLD.country IS NOT NULL
+           AND OLD.ip IS NOT NULL AND OLD.likes - OLD.dislikes IS NOT NULL THEN
+            UPDATE rag_geo_summary SET query_count = query_count - 1, version = version + 1
+            WHERE podcast_name = COALESCE(OLD.podcast_name, '') AND country = OLD.country
+              AND city = COALESCE(OLD.city, '') AND score = OLD.likes - OLD.dislikes;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.featured AND NEW.allowed AND NEW.country IS NOT NULL
+           AND NEW.ip IS NOT NULL AND NEW.likes - NEW.dislikes IS NOT NULL THEN
+            -- sample_ip: una IP de la localización para resolver sus coordenadas
+            INSERT INTO rag_geo_summary (podcast_name, country, city, score, query_count, sample_ip, version)
+            VALUES (COALESCE(NEW.podcast_name, ''), NEW.country, COALESCE(NEW.city, ''),
+                    NEW.likes - NEW.dislikes, 1, NEW.ip, 1)
+            ON CONFLICT (podcast_name, country, city, score) DO UPDATE SET
+                query_count = rag_geo_summary.query_count + 1,
+                sample_ip = LEAST(rag_geo_summary.sample_ip, EXCLUDED.sample_ip),
+                version = rag_geo_summary.version + 1;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS trg_rag_geo_summary ON rag_queries;
+    CREATE TRIGGER trg_rag_geo_summary
+    AFTER INSERT OR DELETE OR UPDATE OF featured, allowed, country, city, ip, podcast_name, likes, dislikes
+    ON rag_queries FOR EACH ROW EXECUTE FUNCTION rag_geo_summary_refresh();
+"""
+
+# Recalcula el resumen desde rag_queries sin bajar la generación: solo se tocan (version + 1)
+# las filas que cambian. Bloquea las altas mientras dura, no las lecturas del mapa.
+GEO_SUMMARY_REBUILD_SQL = """
+    LOCK TABLE rag_queries IN SHARE MODE;
+    CREATE TEMP TABLE rag_geo_summary_fresh ON COMMIT DROP AS
+    SELECT COALESCE(podcast_name, '') AS podcast_name, country, COALESCE(city, '') AS city,
+           likes - dislikes AS score, COUNT(*)::INTEGER AS query_count, MIN(ip) AS sample_ip
+    FROM rag_queries
+    WHERE featured = TRUE AND allowed = TRUE AND country IS NOT NULL AND ip IS NOT NULL
+      AND likes - dislikes IS NOT NULL
+    GROUP BY 1, 2, 3, 4;
+    UPDATE rag_geo_summary g SET query_count = 0, version = g.version + 1
+    WHERE g.query_count <> 0 AND NOT EXISTS (
+        SELECT 1 FROM rag_geo_summary_fresh f
+        WHERE (f.podcast_name, f.country, f.city, f.score) = (g.podcast_name, g.country, g.city, g.score));
+    INSERT INTO rag_geo_summary (podcast_name, country, city, score, query_count, sample_ip, version)
+    SELECT podcast_name, country, city, score, query_count, sample_ip, 1 FROM rag_geo_summary_fresh
+    ON CONFLICT (podcast_name, country, city, score) DO UPDATE SET
+        query_count = EXCLUDED.query_count,
+        sample_ip = EXCLUDED.sample_ip,
+        version = rag_geo_summary.version + 1
+    WHERE (rag_geo_summary.query_count, rag_geo_summary.sample_ip)
+          IS DISTINCT FROM (EXCLUDED.query_count, EXCLUDED.sample_ip);
+"""
+
+GEO_SUMMARY_CURRENT_SQL = """
+    SELECT (SELECT schema_version FROM rag_geo_summary_state) IS NOT DISTINCT FROM $1::INTEGER
+       AND EXISTS (SELECT 1 FROM pg_trigger
+                   WHERE tgname = 'trg_rag_geo_summary' AND tgrelid = 'rag_queries'::regclass)
+"""
+
+# Las asignaciones del admin no se sobrescriben con las automáticas
+ASSIGN_CATEGORY_SQL = """
+    INSERT INTO rag_query_categories (query_id, category_id, assigned_by, confidence)
+    VALUES ($1, $2, $3, $4)
+    ON CONFLICT (query_id, category_id) DO UPDATE SET
+        assigned_by = CASE 
+            WHEN rag_query_categories.assigned_by = 'admin' 
+            THEN rag_query_categories.assigned_by 
+            ELSE EXCLUDED.assigned_by 
+        END,
+        confidence = CASE 
+            WHEN rag_query_categories.assigned_by = 'admin' 
+            THEN rag_query_categories.confidence 
+            ELSE EXCLUDED.confidence 
+        END
+"""
 
 
 class RAGDatabase:
@@ -101,6 +331,13 @@ class RAGDatabase:
         self.pool_min_size = int(os.getenv("QUERIESDB_POOL_MIN_SIZE", "2"))
         self.pool_max_size = int(os.getenv("QUERIESDB_POOL_MAX_SIZE", "10"))
         self.query_timeout = int(os.getenv("QUERIESDB_QUERY_TIMEOUT", "30"))
+        # Sentencias preparadas que asyncpg conserva por conexión
+        self.statement_cache_size = int(os.getenv("QUERIESDB_STATEMENT_CACHE_SIZE", "100"))
+        
+        # Dimensión de las columnas vector (debe coincidir con el modelo de embeddings activo)
+        self.embedding_dim = int(os.getenv("QUERIESDB_EMBEDDING_DIM", "1536"))
+        # Ajustes del índice HNSW para find_cached_answer (según la versión de pgvector)
+        self._cached_answer_scan_sql: Optional[str] = None
         
         # Flag de disponibilidad
         self.is_available = self._check_configuration()
@@ -167,12 +404,26 @@ class RAGDatabase:
                 max_size=self.pool_max_size,
                 timeout=self.query_timeout,
                 command_timeout=self.query_timeout,
+                statement_cache_size=self.statement_cache_size,
+                init=self._init_connection,
             )
             logger.info(f"✅ Conectado a PostgreSQL: {self.user}@{self.host}:{self.port}/{self.database}")
         except Exception as e:
             logger.error(f"❌ Error al conectar a PostgreSQL: {e}")
             self.is_available = False
 
+    async def _init_connection(self, conn):
+        """Prepara cada conexión nueva del pool: códec binario del tipo vector."""
+        type_schema_sql = """
+            SELECT n.nspname FROM pg_type t JOIN pg_namespace n ON n.oid = t.typnamespace
+            WHERE t.typname = 'vector'
+        """
+        schema = await conn.fetchval(type_schema_sql)
+        if schema is None:
+            await conn.execute("CREATE EXTENSION IF NOT EXISTS vector;")
+            schema = await conn.fetchval(type_schema_sql)
+        await register_vector_codec(conn, schema)
+
     async def _ensure_database_and_user_exist(self):
         """
         Conecta como administrador y crea la base de datos y usuario si no existen.
@@ -277,13 +528,13 @@ class RAGDatabase:
                 logger.info("✅ Extensión pgvector verificada/creada")
                 
                 # Crear tabla principal rag_queries
-                await conn.execute("""
+                await conn.execute(f"""
                     CREATE TABLE IF NOT EXISTS rag_queries (
                         id SERIAL PRIMARY KEY,
                         uuid UUID DEFAULT gen_random_uuid() UNIQUE NOT NULL,
                         query_text TEXT NOT NULL,
                         response_text TEXT NOT NULL,
-                        query_embedding vector(1536),
+                        query_embedding vector({self.embedding_dim}),
                         created_at TIMESTAMP DEFAULT NOW(),
                         podcast_name VARCHAR(255),
                         likes INTEGER DEFAULT 0,
@@ -374,7 +625,7 @@ class RAGDatabase:
                 logger.info("✅ Columna featured verificada/creada")
                 
                 # Columna categorization_embedding (embedding combinado pregunta+respuesta)
-                await conn.execute("""
+                await conn.execute(f"""
                     DO $$ 
                     BEGIN
                         IF NOT EXISTS (
@@ -382,7 +633,7 @@ class RAGDatabase:
                             WHERE table_name = 'rag_queries' 
                             AND column_name = 'categorization_embedding'
                         ) THEN
-                            ALTER TABLE rag_queries ADD COLUMN categorization_embedding vector(1536);
+                            ALTER TABLE rag_queries ADD COLUMN categorization_embedding vector({self.embedding_dim});
                         END IF;
                     END $$;
                 """)
@@ -393,7 +644,7 @@ class RAGDatabase:
                 logger.info("✅ Columna categorization_embedding verificada/creada")
                 
                 # Tabla de categorías jerárquicas
-                await conn.execute("""
+                await conn.execute(f"""
                     CREATE TABLE IF NOT EXISTS rag_categories (
                         id SERIAL PRIMARY KEY,
                         name VARCHAR(255) NOT NULL,
@@ -403,7 +654,7 @@ class RAGDatabase:
                         is_primary BOOLEAN DEFAULT FALSE,
                         display_order INTEGER DEFAULT 0,
                         created_at TIMESTAMP DEFAULT NOW(),
-                        category_embedding vector(1536)
+                        category_embedding vector({self.embedding_dim})
                     );
                 """)
                 await conn.execute("""
@@ -479,12 +730,103 @@ class RAGDatabase:
                     """)
                 logger.info("✅ Columnas country/city en ip_likes verificadas/creadas")
                 
+                # ===== Caché de respuestas: generaciones del índice y del corpus y aciertos en el log =====
+                # Las filas anteriores a corpus_generation quedan a NULL: no se reutilizan porque
+                # pueden ser de un corpus con menos episodios
+                await conn.execute("""
+                    ALTER TABLE rag_queries ADD COLUMN IF NOT EXISTS index_generation INTEGER;
+                """)
+                await conn.execute("""
+                    ALTER TABLE rag_queries ADD COLUMN IF NOT EXISTS corpus_generation INTEGER;
+                """)
+                await conn.execute("""
+                    ALTER TABLE rag_queries_access_log ADD COLUMN IF NOT EXISTS cache_hit BOOLEAN;
+                """)
+                logger.info("✅ Columnas index_generation, corpus_generation y cache_hit verificadas/creadas")
+                
+                # ===== Paginación por clave (created_at, id) de los listados =====
+                await conn.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_rag_queries_podcast_created_id
+                    ON rag_queries (podcast_name, created_at DESC, id DESC);
+                    CREATE INDEX IF NOT EXISTS idx_rag_queries_created_id
+                    ON rag_queries (created_at DESC, id DESC);
+                """)
+                # Listados públicos: solo destacadas y permitidas, con las columnas del filtro de votos
+                # (los textos no caben en una entrada de índice B-tree)
+                for column in ('city', 'country'):
+                    await conn.execute(f"""
+                        CREATE INDEX IF NOT EXISTS idx_rag_queries_{column}_featured_created_id
+                        ON rag_queries ({column}, created_at DESC, id DESC)
+                        INCLUDE (podcast_name, likes, dislikes)
+                        WHERE featured = TRUE AND allowed = TRUE;
+                    """)
+                logger.info("✅ Índices de paginación por (created_at, id) verificados/creados")
+                
+                # ===== Resumen geográfico materializado para el mapa de consultas =====
+                await conn.execute("""
+                    CREATE TABLE IF NOT EXISTS rag_geo_summary (
+                        podcast_name VARCHAR(255) NOT NULL,
+                        country VARCHAR(100) NOT NULL,
+                        city VARCHAR(100) NOT NULL,
+                        score INTEGER NOT NULL,
+                        query_count INTEGER NOT NULL,
+                        sample_ip VARCHAR(45),
+                        version BIGINT NOT NULL DEFAULT 1,
+                        PRIMARY KEY (podcast_name, country, city, score)
+                    );
+                    ALTER TABLE rag_geo_summary ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 1;
+                    CREATE TABLE IF NOT EXISTS rag_geo_summary_state (
+                        id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id)
+                    );
+                    ALTER TABLE rag_geo_summary_state ADD COLUMN IF NOT EXISTS schema_version INTEGER;
+                """)
+                # Con el trigger instalado el resumen ya está al día: solo se comprueba. Se
+                # recalcula si falta el trigger o es de otra versión (primer arranque, restauración)
+                if await conn.fetchval(GEO_SUMMARY_CURRENT_SQL, GEO_SUMMARY_SCHEMA_VERSION):
+                    logger.info("✅ Resumen geográfico rag_geo_summary verificado")
+                else:
+                    await self._install_geo_summary(conn)
+                
+                await self._check_embedding_dimensions(conn)
+                
                 return True
                 
         except Exception as e:
             logger.error(f"❌ Error al crear tablas: {e}")
             return False
 
+    async def _check_embedding_dimensions(self, conn):
+        """Avisa si las columnas vector existentes no tienen la dimensión configurada.
+        
+        En pgvector, atttypmod guarda la dimensión declarada de la columna.
+        Cambiar de modelo de embeddings exige migrar estas columnas (o vaciarlas).
+        """
+        rows = await conn.fetch("""
+            SELECT c.relname AS table_name, a.attname AS column_name, a.atttypmod AS dim
+            FROM pg_attribute a
+            JOIN pg_class c ON a.attrelid = c.oid
+            WHERE c.relname IN ('rag_queries', 'rag_categories')
+            AND a.attname IN ('query_embedding', 'categorization_embedding', 'category_embedding')
+            AND NOT a.attisdropped
+        """)
+        for row in rows:
+            if row['dim'] > 0 and row['dim'] != self.embedding_dim:
+                logger.warning(
+                    f"⚠️  {row['table_name']}.{row['column_name']} es vector({row['dim']}) pero "
+                    f"QUERIESDB_EMBEDDING_DIM={self.embedding_dim}; los embeddings de otra dimensión no se guardarán. "
+                    f"Migración: ALTER TABLE {row['table_name']} ALTER COLUMN {row['column_name']} "
+                    f"TYPE vector({self.embedding_dim}) USING NULL;"
+                )
+
+    def _vector_param(self, embedding) -> Optional[np.ndarray]:
+        """Convierte un embedding en un array float32 para el códec de pgvector, o None si falta o no tiene la dimensión configurada."""
+        if embedding is None or len(embedding) == 0:
+            return None
+        if len(embedding) != self.embedding_dim:
+            logger.warning(f"⚠️  Embedding de dimensión {len(embedding)} ignorado (se esperaba {self.embedding_dim})")
+            return None
+        return np.asarray(embedding, dtype=np.float32)
+
     @asynccontextmanager
     async def get_connection(self):
         """Context manager para obtener una conexión del pool"""
@@ -505,7 +847,9 @@ class RAGDatabase:
         response_data: Optional[Dict[str, Any]] = None,
         query_embedding: Optional[List[float]] = None,
         podcast_name: Optional[str] = None,
-        ip: Optional[str] = None
+        ip: Optional[str] = None,
+        index_generation: Optional[int] = None,
+        corpus_generation: Optional[int] = None
     ) -> Optional[Dict[str, Any]]:
         """
         Guarda una query, respuesta y embedding en la BD
@@ -517,6 +861,8 @@ class RAGDatabase:
             query_embedding: Vector embedding de la pregunta (lista de floats)
             podcast_name: Nombre del podcast
             ip: Dirección IP del cliente
+            index_generation: Generación del índice (espacio de embeddings) del context server
+            corpus_generation: Generación del corpus indexado con la que se respondió
             
         Returns:
             Dict con id y uuid de la fila insertada o None si error
@@ -529,12 +875,8 @@ class RAGDatabase:
                 if conn is None:
                     return None
                 
-                # Preparar el embedding como vector para PostgreSQL
-                # Para pgvector con asyncpg, convertir la lista a string formato '[x,y,z,...]'
-                embedding_value = None
-                if query_embedding:
-                    # Convertir lista de floats a string con formato de vector de PostgreSQL
-                    embedding_value = str(query_embedding)
+                # El códec del pool envía el embedding en binario
+                embedding_value = self._vector_param(query_embedding)
                 
                 # Convertir response_data a JSON para PostgreSQL
                 import json
@@ -543,24 +885,20 @@ class RAGDatabase:
                 # Resolver GeoIP
                 geo = geoip_lookup(ip) if ip else {"country": None, "city": None}
                 
-                # SQL para insertar - El orden debe coincidir con el de VALUES
-                query = """
-                    INSERT INTO rag_queries (query_text, response_text, query_embedding, podcast_name, response_data, created_at, ip, country, city)
-                    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
-                    RETURNING id, uuid;
-                """
-                
+                # El orden debe coincidir con el de VALUES en SAVE_QUERY_SQL
                 result = await conn.fetchrow(
-                    query,
+                    SAVE_QUERY_SQL,
                     query_text,          # $1 -> query_text (TEXT)
                     response_text,       # $2 -> response_text (TEXT)
-                    embedding_value,     # $3 -> query_embedding (vector(1536))
+                    embedding_value,     # $3 -> query_embedding (vector(embedding_dim))
                     podcast_name,        # $4 -> podcast_name (VARCHAR)
                     response_data_json,  # $5 -> response_data (JSONB)
                     datetime.now(),      # $6 -> created_at (TIMESTAMP)
                     ip,                  # $7 -> ip (VARCHAR)
                     geo["country"],      # $8 -> country (VARCHAR)
-                    geo["city"]          # $9 -> city (VARCHAR)
+                    geo["city"],         # $9 -> city (VARCHAR)
+                    index_generation,    # $10 -> index_generation (INTEGER)
+                    corpus_generation    # $11 -> corpus_generation (INTEGER)
                 )
                 
                 if result:
@@ -594,60 +932,23 @@ class RAGDatabase:
         """
         if not self.is_available:
             return []
+        embedding_value = self._vector_param(query_embedding)
+        if embedding_value is None:
+            return []
         
         try:
             async with self.get_connection() as conn:
                 if conn is None:
                     return []
                 
-                # Calcular similitud del coseno entre embeddings
-                if podcast_name:
-                    query = """
-                        SELECT 
-                            id,
-                            uuid,
-                            query_text,
-                            response_text,
-                            1 - (query_embedding <=> $1::vector) AS similarity,
-                            created_at,
-                            podcast_name,
-                            likes,
-                            dislikes
-                        FROM rag_queries
-                        WHERE podcast_name = $2 AND (query_embedding <=> $1::vector) < $3
-                        ORDER BY query_embedding <=> $1::vector
-                        LIMIT $4;
-                    """
-                    results = await conn.fetch(
-                        query,
-                        str(query_embedding),
-                        podcast_name,
-                        1 - similarity_threshold,
-                        limit
-                    )
-                else:
-                    query = """
-                        SELECT 
-                            id,
-                            uuid,
-                            query_text,
-                            response_text,
-                            1 - (query_embedding <=> $1::vector) AS similarity,
-                            created_at,
-                            podcast_name,
-                            likes,
-                            dislikes
-                        FROM rag_queries
-                        WHERE (query_embedding <=> $1::vector) < $2
-                        ORDER BY query_embedding <=> $1::vector
-                        LIMIT $3;
-                    """
-                    results = await conn.fetch(
-                        query,
-                        str(query_embedding),
-                        1 - similarity_threshold,
-                        limit
-                    )
+                # Calcular similitud del coseno entre embeddings (sin podcast_name, todos)
+                results = await conn.fetch(
+                    SEARCH_SIMILAR_SQL,
+                    embedding_value,
+                    podcast_name or None,
+                    1 - similarity_threshold,
+                    limit
+                )
                 
                 # Convertir a lista de dicts
                 return [dict(record) for record in results]
@@ -656,6 +957,68 @@ class RAGDatabase:
             logger.error(f"❌ Error al buscar queries similares: {e}")
             return []
 
+    async def _cached_answer_scan(self, conn) -> str:
+        """SET LOCAL del recorrido HNSW de find_cached_answer (se calcula una vez)."""
+        if self._cached_answer_scan_sql is None:
+            version = await conn.fetchval("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+            try:
+                iterative = tuple(int(part) for part in version.split(".")[:2]) >= (0, 8)
+            except (AttributeError, ValueError):
+                iterative = False
+            sql = f"SET LOCAL hnsw.ef_search = {CACHED_ANSWER_EF_SEARCH};"
+            if iterative:
+                sql += " SET LOCAL hnsw.iterative_scan = strict_order;"
+            self._cached_answer_scan_sql = sql
+        return self._cached_answer_scan_sql
+
+    async def find_cached_answer(
+        self,
+        query_embedding: List[float],
+        corpus_generation: int,
+        podcast_name: Optional[str] = None,
+        similarity_threshold: float = 0.0
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Busca la respuesta guardada más cercana a una pregunta que pueda
+        reutilizarse: generada con la misma generación del corpus, visible,
+        sin más votos negativos que positivos y con similitud mayor que
+        `similarity_threshold`.
+        
+        Args:
+            query_embedding: Vector embedding de la pregunta
+            corpus_generation: Generación actual del corpus del context server
+            podcast_name: Filtrar por nombre de podcast
+            similarity_threshold: Similitud mínima (0-1)
+            
+        Returns:
+            Dict con la consulta (incluida response_data y similarity) o None
+        """
+        if not self.is_available:
+            return None
+        embedding_value = self._vector_param(query_embedding)
+        if embedding_value is None:
+            return None
+        
+        try:
+            async with self.get_connection() as conn:
+                if conn is None:
+                    return None
+                
+                async with conn.transaction():
+                    await conn.execute(await self._cached_answer_scan(conn))
+                    record = await conn.fetchrow(
+                        FIND_CACHED_ANSWER_SQL,
+                        embedding_value,
+                        corpus_generation,
+                        podcast_name,
+                        1 - similarity_threshold
+                    )
+                return dict(record) if record else None
+                
+        except Exception as e:
+            logger.error(f"❌ Error al buscar respuesta en caché: {e}")
+            return None
+
     async def get_query_by_id(self, query_id: int) -> Optional[Dict[str, Any]]:
         """Obtiene una query por ID"""
         if not self.is_available:
@@ -702,9 +1065,14 @@ class RAGDatabase:
         self,
         podcast_name: Optional[str] = None,
         limit: int = 100,
-        offset: int = 0
+        offset: int = 0,
+        before: Optional[Tuple[datetime, int]] = None
     ) -> List[Dict[str, Any]]:
-        """Obtiene todas las queries (con paginación)"""
+        """Obtiene todas las queries (con paginación).
+
+        Para paginar por clave se pasa en before el (created_at, id) de la última
+        fila de la página anterior (ver encode_cursor/decode_cursor) en lugar de offset.
+        """
         if not self.is_available:
             return []
         
@@ -713,32 +1081,21 @@ class RAGDatabase:
                 if conn is None:
                     return []
                 
+                clauses, params = [], []
                 if podcast_name:
-                    records = await conn.fetch(
-                        """
-                        SELECT id, uuid, query_text, response_text, created_at, podcast_name,
-                               ip, country, city
-                        FROM rag_queries
-                        WHERE podcast_name = $1
-                        ORDER BY created_at DESC
-                        LIMIT $2 OFFSET $3
-                        """,
-                        podcast_name,
-                        limit,
-                        offset
-                    )
-                else:
-                    records = await conn.fetch(
-                        """
-                        SELECT id, uuid, query_text, response_text, created_at, podcast_name,
-                               ip, country, city
-                        FROM rag_queries
-                        ORDER BY created_at DESC
-                        LIMIT $1 OFFSET $2
-                        """,
-                        limit,
-                        offset
-                    )
+                    params.append(podcast_name)
+                    clauses.append(f"podcast_name = ${len(params)}")
+                _keyset_filter(clauses, params, before)
+                where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+                params += [limit, offset]
+                records = await conn.fetch(f"""
+                    SELECT id, uuid, query_text, created_at, podcast_name,
+                           ip, country, city
+                    FROM rag_queries
+                    {where}
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT ${len(params) - 1} OFFSET ${len(params)}
+                """, *params)
                 
                 return [dict(record) for record in records]
                 
@@ -748,10 +1105,17 @@ class RAGDatabase:
 
     async def log_query_access(
         self,
-        query_id: int,
-        similarity_score: Optional[float] = None
+        query_id: Optional[int],
+        similarity_score: Optional[float] = None,
+        cache_hit: Optional[bool] = None
     ) -> bool:
-        """Registra el acceso a una query en el log de auditoría"""
+        """
+        Registra el acceso a una query en el log de auditoría.
+        
+        Con cache_hit se registran las consultas a la caché de respuestas: un
+        acierto apunta a la respuesta servida y un fallo no apunta a ninguna
+        (query_id None: el umbral de similitud se aplica en la propia búsqueda).
+        """
         if not self.is_available:
             return False
         
@@ -761,13 +1125,11 @@ class RAGDatabase:
                     return False
                 
                 await conn.execute(
-                    """
-                    INSERT INTO rag_queries_access_log (query_id, access_time, similarity_score)
-                    VALUES ($1, $2, $3)
-                    """,
+                    LOG_QUERY_ACCESS_SQL,
                     query_id,
                     datetime.now(),
-                    similarity_score
+                    similarity_score,
+                    cache_hit
                 )
                 
                 return True
@@ -1297,6 +1659,7 @@ class RAGDatabase:
         Retorna una lista de dicts con country, city, query_count y sample_ip
         (una IP representativa para resolver coordenadas localmente vía GeoIP).
         Si falta la ciudad, la entrada se mantiene usando el país.
+        Se lee de rag_geo_summary (mantenido por trigger), sin recorrer rag_queries.
         """
         if not self.is_available:
             return []
@@ -1304,180 +1667,183 @@ class RAGDatabase:
             async with self.get_connection() as conn:
                 if conn is None:
                     return []
-                if podcast_name:
-                    records = await conn.fetch("""
-                        SELECT country, city, COUNT(*) AS query_count,
-                               MIN(ip) AS sample_ip
-                        FROM rag_queries
-                        WHERE podcast_name = $1
-                          AND featured = TRUE
-                          AND allowed = TRUE
-                          AND country IS NOT NULL
-                          AND ip IS NOT NULL
-                          AND (likes - dislikes) >= $2
-                        GROUP BY country, city
-                        ORDER BY query_count DESC
-                    """, podcast_name, likes_threshold)
-                else:
-                    records = await conn.fetch("""
-                        SELECT country, city, COUNT(*) AS query_count,
-                               MIN(ip) AS sample_ip
-                        FROM rag_queries
-                        WHERE featured = TRUE
-                          AND allowed = TRUE
-                          AND country IS NOT NULL
-                          AND ip IS NOT NULL
-                          AND (likes - dislikes) >= $1
-                        GROUP BY country, city
-                        ORDER BY query_count DESC
-                    """, likes_threshold)
+                records = await conn.fetch("""
+                    SELECT country, NULLIF(city, '') AS city, SUM(query_count)::INTEGER AS query_count,
+                           MIN(sample_ip) AS sample_ip
+                    FROM rag_geo_summary
+                    WHERE ($1::VARCHAR IS NULL OR podcast_name = $1)
+                      AND score >= $2 AND query_count > 0
+                    GROUP BY country, city
+                    ORDER BY query_count DESC
+                """, podcast_name or None, likes_threshold)
                 return [dict(r) for r in records]
         except Exception as e:
             logger.error(f"❌ Error al obtener resumen geográfico: {e}")
             return []
 
+    async def _install_geo_summary(self, conn, force: bool = False) -> bool:
+        """
+        Instala el trigger del resumen geográfico y lo recalcula desde rag_queries.
+        Sin force no hace nada si otro worker ya lo ha dejado al día.
+        Devuelve si se recalculó.
+        """
+        async with conn.transaction():
+            # Varios workers pueden arrancar a la vez: el primero lo instala y los demás lo ven hecho
+            await conn.execute("SELECT pg_advisory_xact_lock(hashtext('rag_geo_summary'))")
+            if not force and await conn.fetchval(GEO_SUMMARY_CURRENT_SQL, GEO_SUMMARY_SCHEMA_VERSION):
+                return False
+            await conn.execute(GEO_SUMMARY_TRIGGER_SQL)
+            # El trigger anterior incrementaba este contador: se quita una vez reemplazado
+            await conn.execute("ALTER TABLE rag_geo_summary_state DROP COLUMN IF EXISTS generation")
+            await conn.execute(GEO_SUMMARY_REBUILD_SQL)
+            await conn.execute("""
+                INSERT INTO rag_geo_summary_state (id, schema_version) VALUES (TRUE, $1)
+                ON CONFLICT (id) DO UPDATE SET schema_version = EXCLUDED.schema_version
+            """, GEO_SUMMARY_SCHEMA_VERSION)
+        logger.info("✅ Resumen geográfico rag_geo_summary instalado y recalculado")
+        return True
+
+    async def rebuild_geo_summary(self) -> bool:
+        """
+        Recalcula el resumen geográfico desde rag_queries (tras cambios hechos sin el
+        trigger: restauraciones parciales, SQL manual). Devuelve si se pudo.
+        """
+        if not self.is_available:
+            return False
+        try:
+            async with self.get_connection() as conn:
+                if conn is None:
+                    return False
+                return await self._install_geo_summary(conn, force=True)
+        except Exception as e:
+            logger.error(f"❌ Error al recalcular el resumen geográfico: {e}")
+            return False
+
+    async def get_geo_summary_generation(self) -> Optional[int]:
+        """
+        Generación del resumen geográfico: la suma de las versiones de sus filas, que
+        crece con cada alta, baja o cambio que lo afecta.
+        """
+        if not self.is_available:
+            return None
+        try:
+            async with self.get_connection() as conn:
+                if conn is None:
+                    return None
+                return await conn.fetchval("SELECT COALESCE(SUM(version), 0)::BIGINT FROM rag_geo_summary")
+        except Exception as e:
+            logger.error(f"❌ Error al obtener la generación del resumen geográfico: {e}")
+            return None
+
     async def get_queries_by_city(
         self,
         city: str,
         podcast_name: Optional[str] = None,
         likes_threshold: int = 0,
-        limit: int = 500
+        limit: int = 500,
+        before: Optional[Tuple[datetime, int]] = None
     ) -> List[Dict[str, Any]]:
         """Obtiene consultas realizadas desde una ciudad específica.
 
         Filtra consultas cuyo (likes - dislikes) >= likes_threshold.
         No devuelve la IP (privacidad).
         """
-        if not self.is_available:
-            return []
-        try:
-            async with self.get_connection() as conn:
-                if conn is None:
-                    return []
-                if podcast_name:
-                    records = await conn.fetch("""
-                        SELECT id, uuid, query_text, response_text, created_at,
-                               podcast_name, country, city, likes, dislikes
-                        FROM rag_queries
-                        WHERE city = $1 AND podcast_name = $2
-                          AND featured = TRUE AND allowed = TRUE
-                          AND (likes - dislikes) >= $3
-                        ORDER BY created_at DESC
-                        LIMIT $4
-                    """, city, podcast_name, likes_threshold, limit)
-                else:
-                    records = await conn.fetch("""
-                        SELECT id, uuid, query_text, response_text, created_at,
-                               podcast_name, country, city, likes, dislikes
-                        FROM rag_queries
-                        WHERE city = $1
-                          AND featured = TRUE AND allowed = TRUE
-                          AND (likes - dislikes) >= $2
-                        ORDER BY created_at DESC
-                        LIMIT $3
-                    """, city, likes_threshold, limit)
-                return [dict(r) for r in records]
-        except Exception as e:
-            logger.error(f"❌ Error al obtener consultas por ciudad: {e}")
-            return []
+        return await self._get_featured_queries_at('city', city, podcast_name, likes_threshold, limit, before)
 
     async def get_queries_by_country(
         self,
         country: str,
         podcast_name: Optional[str] = None,
         likes_threshold: int = 0,
-        limit: int = 500
+        limit: int = 500,
+        before: Optional[Tuple[datetime, int]] = None
     ) -> List[Dict[str, Any]]:
         """Obtiene consultas realizadas desde un país específico."""
+        return await self._get_featured_queries_at('country', country, podcast_name, likes_threshold, limit, before)
+
+    async def _get_featured_queries_at(
+        self,
+        column: str,
+        value: str,
+        podcast_name: Optional[str],
+        likes_threshold: int,
+        limit: int,
+        before: Optional[Tuple[datetime, int]]
+    ) -> List[Dict[str, Any]]:
+        """Consultas destacadas de una ciudad o un país, de la más reciente a la más antigua."""
         if not self.is_available:
             return []
+        label = 'ciudad' if column == 'city' else 'país'
         try:
             async with self.get_connection() as conn:
                 if conn is None:
                     return []
+                params = [value]
+                clauses = [f"{column} = $1", "featured = TRUE", "allowed = TRUE"]
                 if podcast_name:
-                    records = await conn.fetch("""
-                        SELECT id, uuid, query_text, response_text, created_at,
-                               podcast_name, country, city, likes, dislikes
-                        FROM rag_queries
-                        WHERE country = $1 AND podcast_name = $2
-                          AND featured = TRUE AND allowed = TRUE
-                          AND (likes - dislikes) >= $3
-                        ORDER BY created_at DESC
-                        LIMIT $4
-                    """, country, podcast_name, likes_threshold, limit)
-                else:
-                    records = await conn.fetch("""
-                        SELECT id, uuid, query_text, response_text, created_at,
-                               podcast_name, country, city, likes, dislikes
-                        FROM rag_queries
-                        WHERE country = $1
-                          AND featured = TRUE AND allowed = TRUE
-                          AND (likes - dislikes) >= $2
-                        ORDER BY created_at DESC
-                        LIMIT $3
-                    """, country, likes_threshold, limit)
+                    params.append(podcast_name)
+                    clauses.append(f"podcast_name = ${len(params)}")
+                params.append(likes_threshold)
+                clauses.append(f"(likes - dislikes) >= ${len(params)}")
+                _keyset_filter(clauses, params, before)
+                params.append(limit)
+                records = await conn.fetch(f"""
+                    SELECT id, uuid, query_text, created_at,
+                           podcast_name, country, city, likes, dislikes
+                    FROM rag_queries
+                    WHERE {' AND '.join(clauses)}
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT ${len(params)}
+                """, *params)
                 return [dict(r) for r in records]
         except Exception as e:
-            logger.error(f"❌ Error al obtener consultas por país: {e}")
+            logger.error(f"❌ Error al obtener consultas por {label}: {e}")
             return []
 
     async def get_all_queries_admin(
         self,
         podcast_name: Optional[str] = None,
         limit: int = 500,
-        offset: int = 0
+        before: Optional[Tuple[datetime, int]] = None
     ) -> List[Dict[str, Any]]:
-        """Obtiene todas las consultas con info de featured y categorías (para admin)"""
+        """Obtiene todas las consultas con info de featured y categorías (para admin).
+
+        Paginación solo por cursor (before = (created_at, id) de la última fila
+        de la página anterior). Las categorías se agregan solo para las filas de
+        la página (subconsulta correlacionada), no para toda la tabla antes del LIMIT.
+        """
         if not self.is_available:
             return []
         try:
             async with self.get_connection() as conn:
                 if conn is None:
                     return []
+                clauses, params = [], []
                 if podcast_name:
-                    records = await conn.fetch("""
-                        SELECT q.id, q.uuid, q.query_text, q.response_text,
-                               q.created_at, q.likes, q.dislikes,
-                               q.featured, q.allowed, q.podcast_name,
-                               q.ip, q.country, q.city,
-                               COALESCE(
-                                   array_agg(DISTINCT jsonb_build_object(
-                                       'id', c.id, 'name', c.name, 'slug', c.slug,
-                                       'assigned_by', qc.assigned_by
-                                   ))
-                                   FILTER (WHERE c.id IS NOT NULL),
-                                   ARRAY[]::JSONB[]
-                               ) as categories
-                        FROM rag_queries q
-                        LEFT JOIN rag_query_categories qc ON q.id = qc.query_id
-                        LEFT JOIN rag_categories c ON qc.category_id = c.id
-                        WHERE q.podcast_name = $1
-                        GROUP BY q.id
-                        ORDER BY q.created_at DESC
-                        LIMIT $2 OFFSET $3
-                    """, podcast_name, limit, offset)
-                else:
-                    records = await conn.fetch("""
-                        SELECT q.id, q.uuid, q.query_text, q.response_text,
-                               q.created_at, q.likes, q.dislikes,
-                               q.featured, q.allowed, q.podcast_name,
-                               q.ip, q.country, q.city,
-                               COALESCE(
-                                   array_agg(DISTINCT jsonb_build_object(
-                                       'id', c.id, 'name', c.name, 'slug', c.slug,
-                                       'assigned_by', qc.assigned_by
-                                   ))
-                                   FILTER (WHERE c.id IS NOT NULL),
-                                   ARRAY[]::JSONB[]
-                               ) as categories
-                        FROM rag_queries q
-                        LEFT JOIN rag_query_categories qc ON q.id = qc.query_id
-                        LEFT JOIN rag_categories c ON qc.category_id = c.id
-                        GROUP BY q.id
-                        ORDER BY q.created_at DESC
-                        LIMIT $1 OFFSET $2
-                    """, limit, offset)
+                    params.append(podcast_name)
+                    clauses.append(f"q.podcast_name = ${len(params)}")
+                _keyset_filter(clauses, params, before, alias='q.')
+                where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+                params.append(limit)
+                records = await conn.fetch(f"""
+                    SELECT q.id, q.uuid, q.query_text, q.response_text,
+                           q.created_at, q.likes, q.dislikes,
+                           q.featured, q.allowed, q.podcast_name,
+                           q.ip, q.country, q.city,
+                           COALESCE((
+                               SELECT array_agg(jsonb_build_object(
+                                   'id', c.id, 'name', c.name, 'slug', c.slug,
+                                   'assigned_by', qc.assigned_by
+                               ) ORDER BY c.id)
+                               FROM rag_query_categories qc
+                               JOIN rag_categories c ON qc.category_id = c.id
+                               WHERE qc.query_id = q.id
+                           ), ARRAY[]::JSONB[]) as categories
+                    FROM rag_queries q
+                    {where}
+                    ORDER BY q.created_at DESC, q.id DESC
+                    LIMIT ${len(params)}
+                """, *params)
                 result = []
                 for r in records:
                     d = dict(r)
@@ -1509,9 +1875,12 @@ class RAGDatabase:
             async with self.get_connection() as conn:
                 if conn is None:
                     return False
+                embedding_value = self._vector_param(embedding)
+                if embedding_value is None:
+                    return False
                 await conn.execute(
                     "UPDATE rag_queries SET categorization_embedding = $1 WHERE id = $2",
-                    str(embedding), query_id
+                    embedding_value, query_id
                 )
                 return True
         except Exception as e:
@@ -1564,7 +1933,7 @@ class RAGDatabase:
             async with self.get_connection() as conn:
                 if conn is None:
                     return None
-                embedding_value = str(category_embedding) if category_embedding else None
+                embedding_value = self._vector_param(category_embedding)
                 result = await conn.fetchrow("""
                     INSERT INTO rag_categories (name, slug, description, parent_id, is_primary, display_order, category_embedding, created_by)
                     VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
@@ -1734,26 +2103,114 @@ class RAGDatabase:
             async with self.get_connection() as conn:
                 if conn is None:
                     return False
-                await conn.execute("""
-                    INSERT INTO rag_query_categories (query_id, category_id, assigned_by, confidence)
-                    VALUES ($1, $2, $3, $4)
-                    ON CONFLICT (query_id, category_id) DO UPDATE SET
-                        assigned_by = CASE 
-                            WHEN rag_query_categories.assigned_by = 'admin' 
-                            THEN rag_query_categories.assigned_by 
-                            ELSE EXCLUDED.assigned_by 
-                        END,
-                        confidence = CASE 
-                            WHEN rag_query_categories.assigned_by = 'admin' 
-                            THEN rag_query_categories.confidence 
-                            ELSE EXCLUDED.confidence 
-                        END
-                """, query_id, category_id, assigned_by, confidence)
+                await conn.execute(ASSIGN_CATEGORY_SQL, query_id, category_id, assigned_by, confidence)
                 return True
         except Exception as e:
             logger.error(f"❌ Error al asignar consulta a categoría: {e}")
             return False
 
+    async def assign_queries_to_categories(
+        self,
+        assignments: List[Tuple[int, int, float]],
+        assigned_by: str = 'auto'
+    ) -> int:
+        """
+        Asigna en lote consultas a categorías con un solo executemany.
+
+        Args:
+            assignments: Lista de (query_id, category_id, confianza)
+            assigned_by: Origen de las asignaciones ('auto', 'llm', 'admin')
+
+        Returns:
+            Número de asignaciones escritas (0 si falla)
+        """
+        if not self.is_available or not assignments:
+            return 0
+        try:
+            async with self.get_connection() as conn:
+                if conn is None:
+                    return 0
+                async with conn.transaction():
+                    await conn.executemany(ASSIGN_CATEGORY_SQL, [
+                        (query_id, category_id, assigned_by, confidence)
+                        for query_id, category_id, confidence in assignments
+                    ])
+                return len(assignments)
+        except Exception as e:
+            logger.error(f"❌ Error al asignar consultas a categorías en lote: {e}")
+            return 0
+
+    async def get_category_vectors(self) -> Tuple[List[int], np.ndarray]:
+        """Devuelve los IDs y la matriz de embeddings de las categorías que lo tienen"""
+        if not self.is_available:
+            return [], np.empty((0, self.embedding_dim), dtype=np.float32)
+        try:
+            async with self.get_connection() as conn:
+                if conn is None:
+                    return [], np.empty((0, self.embedding_dim), dtype=np.float32)
+                records = await conn.fetch("""
+                    SELECT id, category_embedding FROM rag_categories
+                    WHERE category_embedding IS NOT NULL
+                    ORDER BY id
+                """)
+                return self._vector_matrix(records, 'category_embedding')
+        except Exception as e:
+            logger.error(f"❌ Error al obtener embeddings de categorías: {e}")
+            return [], np.empty((0, self.embedding_dim), dtype=np.float32)
+
+    async def get_uncategorized_vectors(
+        self,
+        podcast_name: Optional[str] = None
+    ) -> Tuple[List[int], np.ndarray]:
+        """
+        Devuelve los IDs y la matriz de embeddings de las consultas sin ninguna categoría.
+        Se usa categorization_embedding (pregunta+respuesta) o, si aún no se ha
+        calculado, el embedding de la pregunta.
+        """
+        if not self.is_available:
+            return [], np.empty((0, self.embedding_dim), dtype=np.float32)
+        try:
+            async with self.get_connection() as conn:
+                if conn is None:
+                    return [], np.empty((0, self.embedding_dim), dtype=np.float32)
+                records = await conn.fetch("""
+                    SELECT q.id, COALESCE(q.categorization_embedding, q.query_embedding) AS embedding
+                    FROM rag_queries q
+                    WHERE q.allowed IS NOT FALSE
+                    AND ($1::VARCHAR IS NULL OR q.podcast_name = $1)
+                    AND COALESCE(q.categorization_embedding, q.query_embedding) IS NOT NULL
+                    AND NOT EXISTS (SELECT 1 FROM rag_query_categories qc WHERE qc.query_id = q.id)
+                    ORDER BY q.id
+                """, podcast_name)
+                return self._vector_matrix(records, 'embedding')
+        except Exception as e:
+            logger.error(f"❌ Error al obtener consultas sin categoría: {e}")
+            return [], np.empty((0, self.embedding_dim), dtype=np.float32)
+
+    def _vector_matrix(self, records, column: str) -> Tuple[List[int], np.ndarray]:
+        """Apila en una matriz float32 los vectores (ya decodificados por el códec) de las filas."""
+        if not records:
+            return [], np.empty((0, self.embedding_dim), dtype=np.float32)
+        return [r['id'] for r in records], np.stack([r[column] for r in records])
+
+    async def get_queries_for_categorization(self, query_ids: List[int]) -> List[Dict[str, Any]]:
+        """Obtiene pregunta y respuesta de las consultas indicadas (para enviarlas al LLM)"""
+        if not self.is_available or not query_ids:
+            return []
+        try:
+            async with self.get_connection() as conn:
+                if conn is None:
+                    return []
+                records = await conn.fetch("""
+                    SELECT id, query_text, response_text FROM rag_queries
+                    WHERE id = ANY($1::INTEGER[])
+                    ORDER BY id
+                """, query_ids)
+                return [dict(r) for r in records]
+        except Exception as e:
+            logger.error(f"❌ Error al obtener consultas para categorizar: {e}")
+            return []
+
     async def remove_query_from_category(
         self,
         query_id: int,
@@ -1783,6 +2240,9 @@ class RAGDatabase:
         """Sugiere categorías para una consulta usando similitud vectorial"""
         if not self.is_available:
             return []
+        embedding_value = self._vector_param(embedding)
+        if embedding_value is None:
+            return []
         try:
             async with self.get_connection() as conn:
                 if conn is None:
@@ -1794,7 +2254,7 @@ class RAGDatabase:
                     WHERE category_embedding IS NOT NULL
                     ORDER BY category_embedding <=> $1::vector
                     LIMIT $2
-                """, str(embedding), limit)
+                """, embedding_value, limit)
                 return [dict(r) for r in records]
         except Exception as e:
             logger.error(f"❌ Error al sugerir categorías: {e}")
@@ -0,0 +1,107 @@
+"""
+Caché del mapa público de consultas (/queries/map).
+
+Generar el mapa exige el resumen geográfico, las coordenadas de cada
+localización y el HTML de folium (cientos de KB). El resumen se mantiene
+materializado en PostgreSQL (rag_geo_summary) con una generación (la suma de
+las versiones de sus filas) que crece con cada alta, baja o voto que lo
+afecta, así que la página se guarda ya generada con la clave
+(likes_threshold, generación): mientras la generación no cambie, cada visita
+solo cuesta leer ese número.
+
+Si llegan varias visitas a la vez con una clave que no está, el mapa se
+genera una sola vez y todas reciben el mismo.
+"""
+
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+QUERY_MAP_CACHE_SIZE = 16
+
+MapKey = Tuple[int, Optional[int]]
+
+
+class _LeaderCancelled(Exception):
+    """La visita que generaba el mapa se canceló; las que lo esperaban lo generan ellas."""
+
+
+class QueryMapCache:
+    """LRU de páginas del mapa por (likes_threshold, generación del resumen geográfico)."""
+
+    def __init__(self, max_items: int = QUERY_MAP_CACHE_SIZE):
+        """
+        Args:
+            max_items: Páginas máximas en memoria; 0 desactiva la caché
+        """
+        self.max_items = max_items
+        self._items: "OrderedDict[MapKey, str]" = OrderedDict()
+        self._inflight: Dict[MapKey, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def get(self, likes_threshold: int, generation: Optional[int],
+                  build: Callable[[], Awaitable[str]]) -> str:
+        """
+        Devuelve la página de la clave o la genera con build().
+
+        Sin generación (BD sin resumen) no se guarda: se genera en cada visita.
+        """
+        key = (likes_threshold, generation)
+        if self.max_items <= 0 or generation is None:
+            self.misses += 1
+            return await build()
+
+        while True:
+            page = self._items.get(key)
+            if page is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return page
+            inflight = self._inflight.get(key)
+            if inflight is None:
+                break
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(inflight)
+            except _LeaderCancelled:
+                # Se canceló la visita que lo generaba, no esta: se vuelve a intentar
+                continue
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            page = await build()
+        except asyncio.CancelledError:
+            # No se cancela el future: las que esperaban no deben cancelarse con ella
+            future.set_exception(_LeaderCancelled())
+            future.exception()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # Evita el aviso si nadie más esperaba
+            raise
+        finally:
+            self._inflight.pop(key, None)
+        future.set_result(page)
+
+        # Las páginas de generaciones anteriores ya no se volverán a pedir
+        for old in [k for k in self._items if k[1] is not None and k[1] < generation]:
+            del self._items[old]
+        self._items[key] = page
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+        logging.debug(f"Mapa de consultas generado para umbral {likes_threshold}, generación {generation}")
+        return page
+
+    def stats(self) -> dict:
+        return {
+            "items": len(self._items),
+            "max_items": self.max_items,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+        }
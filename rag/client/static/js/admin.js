@@ -5,7 +5,7 @@
  * - Listado y filtrado de consultas
  * - Toggle de consultas destacadas (featured)
  * - CRUD de categorías jerárquicas
- * - Categorización automática con LLM
+ * - Categorización automática por similitud y con LLM
  * - Asignación de consultas a categorías
  */
 
@@ -18,6 +18,7 @@ let allQueries = [];
 let allCategories = [];  // flat
 let categoriesTree = [];
 let llmProposal = null;
+let llmQueryIds = null;  // Consultas de baja confianza pendientes de enviar al LLM
 
 // =============================================
 //  Inicialización
@@ -78,6 +79,7 @@ function initEventListeners() {
     });
     
     // LLM
+    document.getElementById('autoCategorizeBtn').addEventListener('click', requestAutoCategorize);
     document.getElementById('suggestCategoriesBtn').addEventListener('click', requestLlmSuggestion);
     document.getElementById('applyLlmBtn')?.addEventListener('click', applyLlmProposal);
     document.getElementById('discardLlmBtn')?.addEventListener('click', () => {
@@ -95,13 +97,23 @@ function initEventListeners() {
 // =============================================
 async function loadQueries() {
     try {
-        const resp = await fetch(`${BASE_PATH}/api/admin/queries`);
-        if (!resp.ok) {
-            if (resp.status === 401) { window.location.href = `${BASE_PATH}/admin/login`; return; }
-            throw new Error(`Error ${resp.status}`);
-        }
-        const data = await resp.json();
-        allQueries = data.queries || [];
+        // Páginas por cursor (created_at, id) hasta que no quede next_cursor
+        const queries = [];
+        let cursor = null;
+        do {
+            const url = cursor
+                ? `${BASE_PATH}/api/admin/queries?cursor=${encodeURIComponent(cursor)}`
+                : `${BASE_PATH}/api/admin/queries`;
+            const resp = await fetch(url);
+            if (!resp.ok) {
+                if (resp.status === 401) { window.location.href = `${BASE_PATH}/admin/login`; return; }
+                throw new Error(`Error ${resp.status}`);
+            }
+            const data = await resp.json();
+            queries.push(...(data.queries || []));
+            cursor = data.next_cursor;
+        } while (cursor);
+        allQueries = queries;
         renderQueries(allQueries);
         document.getElementById('queriesLoading').classList.add('hidden');
         document.getElementById('queriesTable').classList.remove('hidden');
@@ -661,6 +673,49 @@ function checkLlmPrerequisites() {
     }
 }
 
+async function requestAutoCategorize() {
+    const btn = document.getElementById('autoCategorizeBtn');
+    const spinner = document.getElementById('llmSpinner');
+    const statusEl = document.getElementById('llmStatus');
+    
+    btn.disabled = true;
+    spinner.classList.remove('hidden');
+    statusEl.textContent = 'Categorizando por similitud...';
+    
+    try {
+        const resp = await fetch(`${BASE_PATH}/api/admin/auto_categorize`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({})
+        });
+        
+        if (!resp.ok) {
+            if (resp.status === 401) { window.location.href = `${BASE_PATH}/admin/login`; return; }
+            const err = await resp.json();
+            throw new Error(err.detail || `Error ${resp.status}`);
+        }
+        
+        const result = await resp.json();
+        showToast(`${result.categorized} de ${result.uncategorized} consultas categorizadas ` +
+                  `(${result.applied_assignments} asignaciones)`, 'success');
+        llmQueryIds = result.low_confidence_ids.length > 0 ? result.low_confidence_ids : null;
+        statusEl.textContent = llmQueryIds
+            ? `${result.low_confidence} consultas con baja confianza: la propuesta del LLM se pedirá ` +
+              `solo para ${llmQueryIds.length} de ellas.`
+            : 'Todas las consultas sin categoría se han asignado por similitud.';
+        
+        await loadCategories();
+        await loadQueries();
+    } catch (e) {
+        console.error('Error en categorización automática:', e);
+        showToast(`Error: ${e.message}`, 'error');
+        statusEl.textContent = `Error: ${e.message}`;
+    } finally {
+        btn.disabled = false;
+        spinner.classList.add('hidden');
+    }
+}
+
 async function requestLlmSuggestion() {
     const btn = document.getElementById('suggestCategoriesBtn');
     const spinner = document.getElementById('llmSpinner');
@@ -675,7 +730,7 @@ async function requestLlmSuggestion() {
         const resp = await fetch(`${BASE_PATH}/api/admin/suggest_categories`, {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ model: selectedModel })
+            body: JSON.stringify({ model: selectedModel, query_ids: llmQueryIds })
         });
         
         if (!resp.ok) {
@@ -684,6 +739,7 @@ async function requestLlmSuggestion() {
             throw new Error(err.detail || `Error ${resp.status}`);
         }
         
+        llmQueryIds = null;
         llmProposal = await resp.json();
         renderLlmProposal(llmProposal);
         statusEl.textContent = 'Propuesta recibida. Revísala antes de aplicar.';
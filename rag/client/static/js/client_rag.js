@@ -363,25 +363,13 @@
                 const controller = new AbortController();
                 const timeoutId = setTimeout(() => controller.abort(), 120000);
                 
-                const response = await fetch(getApiPath("/api/ask"), {
-                    method: "POST",
-                    headers: {"Content-Type": "application/json"},
-                    body: JSON.stringify({
-                        question, 
-                        language,
-                        skip_similarity_check: true  // Saltar verificación de similares
-                    }),
-                    signal: controller.signal
-                });
+                const data = await fetchAsk({
+                    question, 
+                    language,
+                    skip_similarity_check: true  // Saltar verificación de similares
+                }, controller.signal, language);
                 
                 clearTimeout(timeoutId);
-                
-                if (!response.ok) {
-                    const errorData = await response.json().catch(()=>{});
-                    throw new Error(errorData?.detail || errorData?.error || "Error en la consulta");
-                }
-                
-                const data = await response.json();
                 lastData = data;
                 
                 // Actualizar estado: ahora la pregunta actual es la "inicial"
@@ -945,22 +933,9 @@ askForm.addEventListener('submit', async (e) => {
         const timeoutId = setTimeout(() => controller.abort(), 120000);
         
         // Primer intento: consulta normal (que verificará similares)
-        const response = await fetch(getApiPath("/api/ask"), {
-            method: "POST",
-            headers: {"Content-Type": "application/json"},
-            body: JSON.stringify({question, language}),
-            signal: controller.signal
-        });
+        const data = await fetchAsk({question, language}, controller.signal, language);
         
         clearTimeout(timeoutId);
-        console.log('RESPONSE STATUS:', response.status);
-        
-        if (!response.ok) {
-            const errorData = await response.json().catch(()=>{});
-            throw new Error(errorData?.detail || errorData?.error || "Error en la consulta");
-        }
-        
-        const data = await response.json();
         console.log('DATA RECEIVED:', data);
         
         // Verificar si se requiere confirmación (hay consultas similares)
@@ -1100,6 +1075,68 @@ if ('webkitSpeechRecognition' in window || 'SpeechRecognition' in window) {
         errorMsg.focus();
     }
 
+    // Envía la pregunta a /api/ask/stream y va mostrando la respuesta según llega.
+    // Devuelve el JSON final (mismo formato que /api/ask) del evento "result".
+    async function fetchAsk(body, signal, language) {
+        const response = await fetch(getApiPath("/api/ask/stream"), {
+            method: "POST",
+            headers: {"Content-Type": "application/json", "Accept": "text/event-stream"},
+            body: JSON.stringify(body),
+            signal: signal
+        });
+        console.log('RESPONSE STATUS:', response.status);
+
+        if (!response.ok) {
+            const errorData = await response.json().catch(()=>{});
+            throw new Error(errorData?.detail || errorData?.error || "Error en la consulta");
+        }
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let partial = '';
+        let result = null;
+
+        const handleEvent = (event, data) => {
+            if (event === 'delta') {
+                if (data.lang !== language) return;
+                partial += data.text;
+                searchResult.innerHTML = partial;
+                resultsSection.classList.remove('hidden');
+            } else if (event === 'result') {
+                result = data;
+            } else if (event === 'error') {
+                // El texto ya mostrado no es válido (p. ej. un rechazo detectado al final)
+                partial = '';
+                searchResult.innerHTML = '';
+                throw new Error(data.detail || "Error en la consulta");
+            }
+        };
+
+        while (result === null) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            let sep;
+            while ((sep = buffer.indexOf('\n\n')) !== -1) {
+                const block = buffer.slice(0, sep);
+                buffer = buffer.slice(sep + 2);
+                let event = 'message';
+                const dataLines = [];
+                for (const line of block.split('\n')) {
+                    if (line.startsWith('event:')) event = line.slice(6).trim();
+                    else if (line.startsWith('data:')) dataLines.push(line.slice(5).trimStart());
+                }
+                if (dataLines.length) handleEvent(event, JSON.parse(dataLines.join('\n')));
+            }
+        }
+
+        if (result === null) {
+            throw new Error("Respuesta incompleta del servidor");
+        }
+        return result;
+    }
+
     function formatTime(seconds) {
         const mins = Math.floor(seconds / 60);
         const secs = Math.round(seconds % 60);
@@ -0,0 +1,352 @@
+"""
+Caché en disco de las transcripciones del storage externo (S3).
+
+Cada visita a una transcripción y cada enlace de referencia de una respuesta
+volvían a descargar el HTML de TRANSCRIPTS_URL_EXTERNAL. Las transcripciones
+no cambian una vez publicadas, así que se guardan en un directorio local:
+
+- LRU acotada por bytes (TRANSCRIPTS_CACHE_MAX_MB): al superarla se borran las
+  entradas usadas hace más tiempo. El orden sobrevive a los reinicios (atime
+  del archivo).
+- Revalidación: pasados TRANSCRIPTS_CACHE_REVALIDATE segundos una entrada se
+  sirve igualmente (stale-while-revalidate) y se lanza en segundo plano una
+  petición condicional con su ETag / Last-Modified. Un 304 la renueva; si S3
+  no responde, se sigue sirviendo la copia local.
+- Single-flight: las peticiones simultáneas de un archivo que no está en la
+  caché esperan a una única descarga.
+- Fijado: mientras una respuesta sirve el archivo de una entrada (get con
+  pin=True hasta release), ni la expulsión ni una descarga nueva lo borran;
+  el borrado se aplaza hasta soltarlo. Cada descarga va a un archivo con
+  nombre propio, así que una renovación nunca sobrescribe uno que se está
+  enviando.
+
+Cada entrada son dos archivos: <sha256>.<aleatorio>.<extensión> con el
+contenido y <sha256>.meta.json con las cabeceras de S3 y el momento de la
+última validación. Las operaciones con archivos fuera del arranque van en
+hilos (asyncio.to_thread) para no bloquear el bucle de eventos.
+"""
+
+import asyncio
+import glob
+import hashlib
+import json
+import logging
+import os
+import secrets
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from typing import Callable, Dict, List, Optional
+
+import httpx
+
+from tools.timeanchors import SIDECAR_SUFFIX
+
+META_SUFFIX = ".meta.json"
+
+
+@dataclass
+class CachedTranscript:
+    """Entrada de la caché: archivo local y cabeceras del storage."""
+    file_path: str
+    path: str
+    size: int
+    etag: Optional[str]
+    last_modified: Optional[str]
+    content_type: Optional[str]
+    validated_at: float
+
+
+class TranscriptDiskCache:
+    """LRU en disco delante del storage externo de transcripciones."""
+
+    def __init__(self, cache_dir: str, external_url: str, client: httpx.AsyncClient,
+                 max_bytes: int = 512 * 2**20, revalidate_seconds: float = 3600.0,
+                 clock: Callable[[], float] = time.time):
+        """
+        Args:
+            cache_dir: Directorio de la caché (se crea si no existe)
+            external_url: URL base del storage externo
+            client: Cliente httpx compartido con el proxy de /transcripts
+            max_bytes: Tamaño máximo del contenido guardado
+            revalidate_seconds: Segundos tras los que una entrada se revalida con S3
+        """
+        self.cache_dir = cache_dir
+        self.external_url = external_url.rstrip('/')
+        self.client = client
+        self.max_bytes = max_bytes
+        self.revalidate_seconds = revalidate_seconds
+        self.clock = clock
+        self._entries: "OrderedDict[str, CachedTranscript]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Task] = {}
+        # Archivos de contenido que se están sirviendo (ruta -> respuestas en curso) y los
+        # que se borrarán al soltarlos
+        self._pins: Dict[str, int] = {}
+        self._doomed: set = set()
+        self.total_bytes = 0
+        self.counters = {"hits": 0, "stale": 0, "misses": 0, "coalesced": 0, "downloads": 0,
+                         "revalidated": 0, "refreshed": 0, "errors": 0, "evictions": 0}
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load()
+
+    # ------------------------------------------------------------------
+    # Índice en memoria
+    # ------------------------------------------------------------------
+
+    def _key(self, file_path: str) -> str:
+        return hashlib.sha256(file_path.encode('utf-8')).hexdigest()
+
+    def _meta_path(self, file_path: str) -> str:
+        return os.path.join(self.cache_dir, self._key(file_path) + META_SUFFIX)
+
+    def _new_body_path(self, file_path: str) -> str:
+        """Ruta nueva para el contenido: nunca coincide con la de una descarga anterior."""
+        extension = os.path.splitext(file_path)[1] or ".bin"
+        return os.path.join(self.cache_dir, f"{self._key(file_path)}.{secrets.token_hex(4)}{extension}")
+
+    def _load(self):
+        """Reconstruye el índice desde el directorio, del uso más antiguo al más reciente."""
+        entries = []
+        for meta_path in glob.glob(os.path.join(self.cache_dir, "*" + META_SUFFIX)):
+            try:
+                with open(meta_path, encoding="utf-8") as f:
+                    entry = CachedTranscript(**json.load(f))
+                entries.append((os.stat(entry.path).st_atime, entry))
+            except (OSError, ValueError, TypeError) as e:
+                logging.warning(f"Entrada de la caché de transcripciones descartada ({meta_path}): {e}")
+                self._remove_files(*glob.glob(meta_path[:-len(META_SUFFIX)] + ".*"))
+        for _, entry in sorted(entries, key=lambda e: e[0]):
+            self._entries[entry.file_path] = entry
+            self.total_bytes += entry.size
+        if entries:
+            logging.info(f"Caché de transcripciones: {len(entries)} entradas, {self.total_bytes / 2**20:.1f} MB")
+        self._remove_files(*self._evict())
+
+    @staticmethod
+    def _remove_files(*paths: str):
+        for path in paths:
+            for candidate in (path, path + SIDECAR_SUFFIX):
+                try:
+                    os.remove(candidate)
+                except OSError:
+                    pass
+
+    def _discard(self, body_path: str) -> List[str]:
+        """Archivos de contenido que ya se pueden borrar: si se está sirviendo, se aplaza."""
+        if self._pins.get(body_path):
+            self._doomed.add(body_path)
+            return []
+        return [body_path]
+
+    def _drop(self, file_path: str) -> List[str]:
+        """Quita la entrada del índice y devuelve los archivos que hay que borrar."""
+        entry = self._entries.pop(file_path, None)
+        if entry is None:
+            return []
+        self.total_bytes -= entry.size
+        return self._discard(entry.path) + [self._meta_path(file_path)]
+
+    async def _store(self, entry: CachedTranscript):
+        """Registra una entrada nueva (o renovada), guarda su meta y aplica el límite de tamaño."""
+        garbage = []
+        previous = self._entries.pop(entry.file_path, None)
+        if previous is not None:
+            self.total_bytes -= previous.size
+            if previous.path != entry.path:
+                garbage += self._discard(previous.path)
+        self._entries[entry.file_path] = entry
+        self.total_bytes += entry.size
+        garbage += self._evict(keep=entry.file_path)
+        await asyncio.to_thread(self._write_meta, entry)
+        if garbage:
+            await asyncio.to_thread(self._remove_files, *garbage)
+
+    def _write_meta(self, entry: CachedTranscript):
+        meta_path = self._meta_path(entry.file_path)
+        tmp = f"{meta_path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(asdict(entry), f)
+        os.replace(tmp, meta_path)
+
+    def _evict(self, keep: Optional[str] = None) -> List[str]:
+        """Expulsa las entradas menos usadas hasta caber en max_bytes; devuelve los archivos a borrar."""
+        garbage = []
+        while self.total_bytes > self.max_bytes and self._entries:
+            oldest = next(iter(self._entries))
+            if oldest == keep:
+                if len(self._entries) == 1:
+                    break
+                self._entries.move_to_end(oldest)
+                continue
+            logging.debug(f"Caché de transcripciones: expulsada {oldest}")
+            garbage += self._drop(oldest)
+            self.counters["evictions"] += 1
+        return garbage
+
+    @staticmethod
+    def _touch_file(path: str) -> bool:
+        """Actualiza el atime (orden LRU del próximo arranque) sin tocar el mtime; False si no existe."""
+        try:
+            st = os.stat(path)
+            os.utime(path, ns=(time.time_ns(), st.st_mtime_ns))
+        except FileNotFoundError:
+            return False
+        except OSError:
+            pass
+        return True
+
+    def _pin(self, entry: CachedTranscript):
+        self._pins[entry.path] = self._pins.get(entry.path, 0) + 1
+
+    async def release(self, entry: CachedTranscript):
+        """Suelta una entrada obtenida con get(pin=True); borra su archivo si se expulsó entretanto."""
+        remaining = self._pins.get(entry.path, 0) - 1
+        if remaining > 0:
+            self._pins[entry.path] = remaining
+            return
+        self._pins.pop(entry.path, None)
+        if entry.path in self._doomed:
+            self._doomed.discard(entry.path)
+            await asyncio.to_thread(self._remove_files, entry.path)
+
+    # ------------------------------------------------------------------
+    # Descarga y revalidación
+    # ------------------------------------------------------------------
+
+    async def _download(self, file_path: str, previous: Optional[CachedTranscript]) -> Optional[CachedTranscript]:
+        """
+        Descarga el archivo (condicional si hay una copia previa) y actualiza la caché.
+
+        Returns:
+            La entrada vigente, o None si S3 no tiene el archivo
+
+        Raises:
+            httpx.HTTPError: Si S3 no responde o responde con un error distinto de 404
+        """
+        headers = {"accept-encoding": "identity"}
+        if previous is not None:
+            if previous.etag:
+                headers["if-none-match"] = previous.etag
+            if previous.last_modified:
+                headers["if-modified-since"] = previous.last_modified
+        async with self.client.stream("GET", f"{self.external_url}/{file_path}", headers=headers) as response:
+            if response.status_code == 304 and previous is not None:
+                previous.validated_at = self.clock()
+                if self._entries.get(file_path) is previous:
+                    await asyncio.to_thread(self._write_meta, previous)
+                self.counters["revalidated"] += 1
+                return previous
+            if response.status_code == 404:
+                logging.debug(f"Archivo no encontrado en S3: {file_path}")
+                await asyncio.to_thread(self._remove_files, *self._drop(file_path))
+                return None
+            response.raise_for_status()
+
+            # Archivo nuevo (no se reemplaza el de la copia anterior, que puede estar sirviéndose)
+            body_path = self._new_body_path(file_path)
+            size = 0
+            f = await asyncio.to_thread(open, body_path, "wb")
+            try:
+                async for chunk in response.aiter_raw(64 * 1024):
+                    await asyncio.to_thread(f.write, chunk)
+                    size += len(chunk)
+                await asyncio.to_thread(f.close)
+            except BaseException:
+                # Limpieza en el acto: la tarea puede estar cancelándose
+                f.close()
+                self._remove_files(body_path)
+                raise
+        entry = CachedTranscript(file_path=file_path, path=body_path, size=size,
+                                 etag=response.headers.get("etag"),
+                                 last_modified=response.headers.get("last-modified"),
+                                 content_type=response.headers.get("content-type"),
+                                 validated_at=self.clock())
+        await self._store(entry)
+        self.counters["downloads"] += 1
+        if previous is not None:
+            self.counters["refreshed"] += 1
+        logging.info(f"Caché de transcripciones: {file_path} descargado ({size} bytes)")
+        return entry
+
+    def _single_flight(self, file_path: str, previous: Optional[CachedTranscript]) -> asyncio.Task:
+        task = self._inflight.get(file_path)
+        if task is None:
+            task = asyncio.ensure_future(self._download(file_path, previous))
+            self._inflight[file_path] = task
+            task.add_done_callback(lambda _: self._inflight.pop(file_path, None))
+        else:
+            self.counters["coalesced"] += 1
+        return task
+
+    def _revalidate_in_background(self, entry: CachedTranscript):
+        task = self._single_flight(entry.file_path, entry)
+
+        def report(done: asyncio.Task):
+            if not done.cancelled() and done.exception() is not None:
+                self.counters["errors"] += 1
+                logging.warning(f"Caché de transcripciones: no se pudo revalidar {entry.file_path} "
+                                f"({done.exception()!r}); se sigue sirviendo la copia local")
+        task.add_done_callback(report)
+
+    async def get(self, file_path: str, pin: bool = False) -> Optional[CachedTranscript]:
+        """
+        Devuelve la entrada del archivo, descargándolo si no está en la caché.
+
+        Args:
+            file_path: Ruta del archivo en el storage
+            pin: Fija la entrada: su archivo no se borra hasta llamar a release(entry)
+
+        Returns:
+            La entrada, o None si S3 no tiene el archivo
+
+        Raises:
+            httpx.HTTPError: Si no está en la caché y S3 no responde
+        """
+        while True:
+            entry = self._entries.get(file_path)
+            if entry is not None:
+                # Se fija antes de esperar al disco: mientras tanto otra petición puede expulsarla
+                if pin:
+                    self._pin(entry)
+                if await asyncio.to_thread(self._touch_file, entry.path):
+                    if self._entries.get(file_path) is entry:
+                        self._entries.move_to_end(file_path)
+                    if self.clock() - entry.validated_at < self.revalidate_seconds:
+                        self.counters["hits"] += 1
+                    else:
+                        self.counters["stale"] += 1
+                        self._revalidate_in_background(entry)
+                    return entry
+                if pin:
+                    await self.release(entry)
+                if self._entries.get(file_path) is entry:
+                    # Borrada por fuera (limpieza manual del directorio)
+                    await asyncio.to_thread(self._remove_files, *self._drop(file_path))
+
+            self.counters["misses"] += 1
+            task = self._single_flight(file_path, None)
+            try:
+                # shield: si el cliente que la lanzó se desconecta, la descarga sigue para los demás
+                entry = await asyncio.shield(task)
+            except httpx.HTTPError:
+                self.counters["errors"] += 1
+                raise
+            if entry is None or not pin:
+                return entry
+            if self._entries.get(file_path) is entry:
+                self._pin(entry)
+                return entry
+            # Expulsada o renovada antes de que esta petición la recogiera: se vuelve a buscar
+
+    def stats(self) -> dict:
+        lookups = self.counters["hits"] + self.counters["stale"] + self.counters["misses"]
+        served = self.counters["hits"] + self.counters["stale"]
+        return {
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "in_flight": len(self._inflight),
+            "pinned": len(self._pins),
+            **self.counters,
+            "hit_ratio": round(served / lookups, 4) if lookups else None,
+        }
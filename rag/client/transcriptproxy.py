@@ -0,0 +1,262 @@
+"""
+Proxy de /transcripts: transcripciones HTML y audios desde S3 o el filesystem local.
+
+Antes cada petición descargaba el archivo completo con requests.get (también
+las peticiones Range de un reproductor que salta por un mp3 de 150 MB) y lo
+devolvía desde memoria. Ahora:
+
+- Storage externo: la petición se reenvía con Range, If-Range, If-None-Match e
+  If-Modified-Since y la respuesta (200, 206, 304 o 416) se retransmite por
+  bloques de CHUNK_SIZE a medida que llega. La memoria por descarga queda
+  acotada por el tamaño de bloque y el control de flujo del servidor ASGI; si
+  el cliente se desconecta se cierra la conexión con el storage.
+- Filesystem local: FileResponse (Range y, si el servidor lo admite,
+  http.response.pathsend / sendfile) con ETag y Last-Modified, y 304 para las
+  peticiones condicionales.
+
+La estrategia híbrida no cambia: primero el storage externo y, si no tiene el
+archivo (o no responde), el directorio local. Con una TranscriptDiskCache
+(transcriptcache.py) las transcripciones HTML del storage externo se sirven
+desde su copia en disco, fijada mientras dura el envío para que la caché no
+la borre ni la reemplace a medias.
+"""
+
+import asyncio
+import logging
+import mimetypes
+import os
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, Optional
+
+import httpx
+from fastapi import HTTPException, Request, status
+from starlette.background import BackgroundTask
+from starlette.responses import FileResponse, Response, StreamingResponse
+
+from transcriptcache import TranscriptDiskCache
+
+CHUNK_SIZE = 64 * 1024
+CACHE_CONTROL = "public, max-age=86400"  # Cache 24 horas
+
+# Cabeceras de la petición que se reenvían al storage externo
+FORWARDED_REQUEST_HEADERS = ("range", "if-range", "if-none-match", "if-modified-since")
+# Cabeceras del storage que se devuelven al navegador
+RELAYED_RESPONSE_HEADERS = ("content-length", "content-range", "etag", "last-modified", "accept-ranges")
+
+
+def guess_content_type(file_path: str, upstream_type: Optional[str] = None) -> str:
+    """Content-Type del archivo: HTML siempre en UTF-8; si el storage no lo indica, por la extensión."""
+    if file_path.lower().endswith('.html'):
+        return 'text/html; charset=utf-8'
+    if upstream_type and upstream_type != 'application/octet-stream':
+        return upstream_type
+    guessed_type, _ = mimetypes.guess_type(file_path)
+    return guessed_type or 'application/octet-stream'
+
+
+def is_not_modified(request_headers, etag: Optional[str], last_modified: Optional[str]) -> bool:
+    """Evalúa If-None-Match / If-Modified-Since (RFC 9110: If-None-Match tiene prioridad)."""
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match is not None:
+        if not etag:
+            return False
+        tags = [t.strip() for t in if_none_match.split(",")]
+        weak = etag[2:] if etag.startswith("W/") else etag
+        return "*" in tags or any((t[2:] if t.startswith("W/") else t) == weak for t in tags)
+    if_modified_since = request_headers.get("if-modified-since")
+    if if_modified_since and last_modified:
+        try:
+            return parsedate_to_datetime(last_modified) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+class ReleasingFileResponse(FileResponse):
+    """FileResponse que llama a on_close al acabar el envío, también si el cliente se desconecta."""
+
+    def __init__(self, *args, on_close: Callable[[], Awaitable[None]], **kwargs):
+        super().__init__(*args, **kwargs)
+        self.on_close = on_close
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.on_close()
+
+
+class TranscriptProxy:
+    """Sirve /transcripts/{file_path} desde el storage externo o el directorio local."""
+
+    def __init__(self, external_url: Optional[str], local_dir: Optional[str],
+                 client: Optional[httpx.AsyncClient] = None, chunk_size: int = CHUNK_SIZE,
+                 cache: Optional[TranscriptDiskCache] = None):
+        """
+        Args:
+            external_url: URL base del storage externo (S3) o None
+            local_dir: Directorio local de transcripciones o None
+            client: Cliente httpx con conexiones persistentes (se crea uno si no se pasa)
+            chunk_size: Tamaño de los bloques que se retransmiten
+            cache: Caché en disco de las transcripciones HTML del storage externo
+        """
+        self.external_url = external_url.rstrip('/') if external_url else None
+        self.local_dir = os.path.normpath(local_dir) if local_dir else None
+        self.client = client or httpx.AsyncClient(timeout=httpx.Timeout(10.0))
+        self.chunk_size = chunk_size
+        self.cache = cache
+        self.active_streams = 0
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    def _base_headers(self, file_path: str) -> dict:
+        return {
+            "Cache-Control": CACHE_CONTROL,
+            "Content-Disposition": f"inline; filename={os.path.basename(file_path)}",
+        }
+
+    def local_path(self, file_path: str) -> Optional[str]:
+        """Ruta local del archivo, o None si no existe o sale del directorio (path traversal)."""
+        if not self.local_dir:
+            return None
+        path = os.path.normpath(os.path.join(self.local_dir, file_path))
+        if os.path.commonpath([self.local_dir, path]) != self.local_dir:
+            logging.error(f"Intento de path traversal: {file_path}")
+            return None
+        return path if os.path.isfile(path) else None
+
+    async def serve(self, file_path: str, request: Request) -> Response:
+        """
+        Raises:
+            HTTPException: 404 si el archivo no está en ninguna fuente; 502/504 si el storage
+                externo falla y no hay copia local
+        """
+        upstream_error = None
+        if self.external_url:
+            try:
+                if self.cache is not None and file_path.lower().endswith('.html'):
+                    response = await self._from_cache(file_path, request)
+                else:
+                    response = await self._from_external(file_path, request)
+                if response is not None:
+                    return response
+            except httpx.TimeoutException:
+                logging.warning(f"Timeout al intentar obtener de S3: {file_path}")
+                upstream_error = status.HTTP_504_GATEWAY_TIMEOUT
+            except httpx.HTTPError as e:
+                logging.warning(f"Error al obtener de S3: {e}")
+                upstream_error = status.HTTP_502_BAD_GATEWAY
+
+        response = await self._from_local(file_path, request)
+        if response is not None:
+            return response
+
+        if upstream_error:
+            raise HTTPException(status_code=upstream_error,
+                                detail=f"Error al obtener archivo de S3: {file_path}")
+        logging.warning(f"Archivo no encontrado en ninguna fuente: {file_path}")
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"Archivo no encontrado: {file_path}")
+
+    async def _from_external(self, file_path: str, request: Request) -> Optional[Response]:
+        """Retransmite la respuesta del storage; None si no tiene el archivo o responde con error."""
+        external_url = f"{self.external_url}/{file_path}"
+        headers = {name: request.headers[name] for name in FORWARDED_REQUEST_HEADERS if name in request.headers}
+        # Sin compresión: los bytes (y Content-Length / Content-Range) se retransmiten tal cual
+        headers["accept-encoding"] = "identity"
+        logging.info(f"Intentando obtener desde S3: {external_url} {headers.get('range', '')}")
+
+        upstream = await self.client.send(self.client.build_request("GET", external_url, headers=headers),
+                                          stream=True)
+        if upstream.status_code not in (200, 206, 304, 416):
+            await upstream.aclose()
+            if upstream.status_code == 404:
+                logging.debug(f"Archivo no encontrado en S3: {file_path}")
+            else:
+                logging.warning(f"Error al obtener de S3 ({upstream.status_code}): {file_path}")
+            return None
+
+        response_headers = self._base_headers(file_path)
+        for name in RELAYED_RESPONSE_HEADERS:
+            if name in upstream.headers:
+                response_headers[name] = upstream.headers[name]
+        response_headers.setdefault("accept-ranges", "bytes")
+
+        if upstream.status_code in (304, 416):
+            await upstream.aclose()
+            logging.info(f"S3 respondió {upstream.status_code}: {file_path}")
+            response_headers.pop("content-length", None)
+            return Response(status_code=upstream.status_code, headers=response_headers)
+
+        # Un 206 multirango lleva su propio multipart/byteranges
+        if upstream.status_code == 206 and upstream.headers.get("content-type", "").startswith("multipart/"):
+            media_type = upstream.headers["content-type"]
+        else:
+            media_type = guess_content_type(file_path, upstream.headers.get("content-type"))
+        logging.info(f"Archivo obtenido desde S3: {file_path} ({upstream.status_code}, "
+                     f"{upstream.headers.get('content-length', '?')} bytes)")
+        return StreamingResponse(self._relay(upstream), status_code=upstream.status_code,
+                                 headers=response_headers, media_type=media_type,
+                                 background=BackgroundTask(upstream.aclose))
+
+    async def _relay(self, upstream: httpx.Response):
+        self.active_streams += 1
+        try:
+            async for chunk in upstream.aiter_raw(self.chunk_size):
+                yield chunk
+        finally:
+            self.active_streams -= 1
+            await upstream.aclose()
+
+    async def _from_cache(self, file_path: str, request: Request) -> Optional[Response]:
+        """Sirve la copia en disco (descargándola si hace falta); None si S3 no tiene el archivo."""
+        entry = await self.cache.get(file_path, pin=True)
+        if entry is None:
+            return None
+        logging.debug(f"Archivo servido desde la caché de transcripciones: {file_path}")
+        # Mismos validadores que S3: el navegador revalida igual venga de donde venga
+        validators = {k: v for k, v in (("etag", entry.etag), ("last-modified", entry.last_modified)) if v}
+        try:
+            return await self._file_response(entry.path, file_path, request, validators,
+                                             on_close=lambda: self.cache.release(entry))
+        except BaseException:
+            await self.cache.release(entry)
+            raise
+
+    async def _from_local(self, file_path: str, request: Request) -> Optional[Response]:
+        path = await asyncio.to_thread(self.local_path, file_path)
+        if path is None:
+            logging.debug(f"Archivo no encontrado en filesystem: {file_path}")
+            return None
+        logging.info(f"Archivo obtenido desde filesystem local: {file_path}")
+        return await self._file_response(path, file_path, request)
+
+    async def _file_response(self, path: str, file_path: str, request: Request,
+                             validators: Optional[dict] = None,
+                             on_close: Optional[Callable[[], Awaitable[None]]] = None) -> Response:
+        """
+        FileResponse del archivo, o 304 si la petición condicional coincide con su ETag / Last-Modified.
+        on_close se llama cuando la respuesta ya no necesita el archivo.
+        """
+        stat_result = await asyncio.to_thread(os.stat, path)
+        headers = {**self._base_headers(file_path), **(validators or {})}
+        media_type = guess_content_type(file_path)
+        if on_close is None:
+            response = FileResponse(path, headers=headers, media_type=media_type, stat_result=stat_result)
+        else:
+            response = ReleasingFileResponse(path, headers=headers, media_type=media_type,
+                                             stat_result=stat_result, on_close=on_close)
+        if is_not_modified(request.headers, response.headers.get("etag"), response.headers.get("last-modified")):
+            logging.debug(f"Archivo no modificado: {file_path}")
+            if on_close is not None:
+                await on_close()
+            not_modified = {k: v for k, v in response.headers.items()
+                            if k in ("etag", "last-modified", "cache-control")}
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=not_modified)
+        return response
+
+    def stats(self) -> dict:
+        return {"external_url": self.external_url, "local_dir": self.local_dir,
+                "active_streams": self.active_streams,
+                "cache": self.cache.stats() if self.cache is not None else None}
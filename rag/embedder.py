@@ -0,0 +1,254 @@
+"""
+Generación de embeddings por lotes para el servicio RAG.
+
+- Divide las entradas en lotes según un presupuesto de tokens y de elementos
+- Lanza los lotes de forma concurrente (semáforo) con reintentos y backoff
+- Caché persistente en SQLite indexada por sha256(modelo, dimensiones, texto),
+  de modo que los segmentos que no cambian no se vuelven a pagar
+- Cliente de embeddings intercambiable (un LLMBackend o un embedder local determinista)
+"""
+
+import asyncio
+import hashlib
+import logging
+import random
+import sqlite3
+import threading
+import time
+from typing import List, Optional
+
+import numpy as np
+
+try:
+    import tiktoken
+    _ENCODING = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    _ENCODING = None
+
+# Límites de la API de embeddings de OpenAI
+MAX_INPUT_TOKENS = 8191
+MAX_REQUEST_ITEMS = 2048
+# Aproximación cuando no hay tokenizador: ~4 caracteres por token
+CHARS_PER_TOKEN = 4
+
+
+def count_tokens(text: str) -> int:
+    """Tokens de un texto (tiktoken si está disponible, si no una estimación)."""
+    if _ENCODING is not None:
+        return len(_ENCODING.encode(text, disallowed_special=()))
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Recorta un texto para que no supere max_tokens."""
+    if _ENCODING is not None:
+        tokens = _ENCODING.encode(text, disallowed_special=())
+        return _ENCODING.decode(tokens[:max_tokens]) if len(tokens) > max_tokens else text
+    return text[:max_tokens * CHARS_PER_TOKEN]
+
+
+class FakeEmbeddingClient:
+    """Embedder local determinista para pruebas: el vector depende solo del texto."""
+
+    def __init__(self, dim: int = 64, latency: float = 0.0):
+        self.dim = dim
+        self.latency = latency
+        self.calls = 0
+        self.texts_embedded = 0
+
+    async def embed(self, texts: List[str], model: str, dimensions: Optional[int] = None):
+        self.calls += 1
+        self.texts_embedded += len(texts)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        dim = dimensions or self.dim
+        vectors = []
+        for text in texts:
+            seed = int.from_bytes(hashlib.sha256(f"{model}|{text}".encode("utf-8")).digest()[:8], "little")
+            vectors.append(np.random.default_rng(seed).standard_normal(dim).astype(np.float32).tolist())
+        tokens = sum(count_tokens(t) for t in texts)
+        return vectors, tokens, tokens
+
+
+class EmbeddingCache:
+    """Caché persistente de embeddings en SQLite (modo WAL)."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30.0, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode = WAL;')
+        self._conn.execute('PRAGMA synchronous = NORMAL;')
+        self._conn.execute('PRAGMA busy_timeout = 30000;')
+        self._conn.execute("""
+        CREATE TABLE IF NOT EXISTS embedding_cache (
+            key TEXT PRIMARY KEY,
+            model TEXT NOT NULL,
+            dim INTEGER NOT NULL,
+            embedding BLOB NOT NULL,
+            created_at REAL NOT NULL
+        );
+        """)
+        self._conn.commit()
+        logging.info(f"Caché de embeddings en {path}")
+
+    @staticmethod
+    def make_key(model: str, dimensions: Optional[int], text: str) -> str:
+        return hashlib.sha256(f"{model}\n{dimensions or ''}\n{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, keys: List[str]) -> dict:
+        """Devuelve {clave: vector} para las claves presentes en la caché."""
+        found = {}
+        with self._lock:
+            # SQLite limita el número de parámetros por sentencia
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT key, embedding FROM embedding_cache WHERE key IN ({placeholders})", chunk
+                ).fetchall()
+                found.update({k: np.frombuffer(blob, dtype=np.float32) for k, blob in rows})
+        return found
+
+    def put_many(self, model: str, items: List[tuple]):
+        """Guarda [(clave, vector)] en una sola transacción."""
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embedding_cache (key, model, dim, embedding, created_at) VALUES (?, ?, ?, ?, ?)",
+                [(k, model, len(v), np.asarray(v, dtype=np.float32).tobytes(), now) for k, v in items]
+            )
+            self._conn.commit()
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM embedding_cache").fetchone()[0]
+
+    def close(self):
+        self._conn.close()
+
+
+class EmbeddingResult:
+    """Resultado de BatchEmbedder.embed: vectores en el orden de entrada y uso de tokens."""
+
+    def __init__(self, vectors: List[np.ndarray], prompt_tokens: int, total_tokens: int,
+                 cached: int, batches: int):
+        self.vectors = vectors
+        self.prompt_tokens = prompt_tokens
+        self.total_tokens = total_tokens
+        self.cached = cached
+        self.batches = batches
+
+
+class BatchEmbedder:
+    """Capa de lotes, concurrencia, reintentos y caché sobre un cliente de embeddings."""
+
+    def __init__(self, client, cache: Optional[EmbeddingCache] = None,
+                 max_batch_tokens: int = 100000, max_batch_items: int = MAX_REQUEST_ITEMS,
+                 concurrency: int = 4, retries: int = 3,
+                 backoff_base: float = 1.0, backoff_max: float = 20.0):
+        """
+        Args:
+            client: Objeto con `async embed(texts, model, dimensions)` (LLMBackend, FakeEmbeddingClient)
+            cache: Caché persistente (None = sin caché)
+            max_batch_tokens: Tokens máximos por petición
+            max_batch_items: Textos máximos por petición
+            concurrency: Peticiones simultáneas al proveedor
+            retries: Reintentos por lote ante errores transitorios
+            backoff_base: Espera base (segundos) del backoff exponencial
+            backoff_max: Espera máxima (segundos) entre reintentos
+        """
+        self.client = client
+        self.cache = cache
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_items = max_batch_items
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self.stats = {"requests": 0, "texts": 0, "cache_hits": 0, "batches": 0, "retries": 0}
+
+    def make_batches(self, texts: List[str]) -> List[List[int]]:
+        """Agrupa los índices de `texts` en lotes según los límites de tokens y elementos."""
+        batches, current, tokens = [], [], 0
+        for i, text in enumerate(texts):
+            n = count_tokens(text)
+            if current and (tokens + n > self.max_batch_tokens or len(current) >= self.max_batch_items):
+                batches.append(current)
+                current, tokens = [], 0
+            current.append(i)
+            tokens += n
+        if current:
+            batches.append(current)
+        return batches
+
+    @staticmethod
+    def _is_retryable(exc: Exception) -> bool:
+        """Los errores 4xx (salvo 429) no se reintentan: repetir la petición no los arregla."""
+        status = getattr(exc, "status_code", None)
+        return not (status and 400 <= status < 500 and status != 429)
+
+    async def _embed_batch(self, texts: List[str], model: str, dimensions: Optional[int]):
+        async with self._semaphore:
+            for attempt in range(self.retries + 1):
+                try:
+                    return await self.client.embed(texts, model, dimensions)
+                except Exception as e:
+                    if attempt >= self.retries or not self._is_retryable(e):
+                        raise
+                    delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+                    self.stats["retries"] += 1
+                    logging.warning(f"Error en lote de {len(texts)} embeddings (intento {attempt + 1}): {e}; "
+                                    f"reintento en {delay:.1f}s")
+                    await asyncio.sleep(delay)
+
+    def _prepare(self, texts: List[str], model: str, dimensions: Optional[int]):
+        """
+        Parte síncrona de embed(): tokeniza y recorta los textos, consulta la caché
+        y agrupa en lotes los que faltan. Se ejecuta en un hilo (tiktoken y SQLite).
+        """
+        texts = [truncate_to_tokens(t, MAX_INPUT_TOKENS) for t in texts]
+        keys = [EmbeddingCache.make_key(model, dimensions, t) for t in texts]
+        found = self.cache.get_many(list(set(keys))) if self.cache else {}
+
+        # Textos únicos que hay que calcular
+        pending = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in pending:
+                pending[key] = text
+        pending_keys = list(pending)
+        pending_texts = [pending[k] for k in pending_keys]
+        return keys, found, pending_keys, pending_texts, self.make_batches(pending_texts)
+
+    async def embed(self, texts: List[str], model: str, dimensions: Optional[int] = None) -> EmbeddingResult:
+        """Calcula los embeddings de `texts`, reutilizando la caché y sin repetir textos idénticos."""
+        self.stats["requests"] += 1
+        self.stats["texts"] += len(texts)
+        keys, found, pending_keys, pending_texts, batches = await asyncio.to_thread(
+            self._prepare, texts, model, dimensions)
+        cached = sum(1 for k in keys if k in found)
+        self.stats["cache_hits"] += cached
+
+        prompt_tokens = total_tokens = 0
+        if batches:
+            results = await asyncio.gather(*(
+                self._embed_batch([pending_texts[i] for i in batch], model, dimensions) for batch in batches
+            ))
+            new_items = []
+            for batch, (vectors, p_tokens, t_tokens) in zip(batches, results):
+                if len(vectors) != len(batch):
+                    raise RuntimeError(f"El proveedor devolvió {len(vectors)} embeddings para {len(batch)} textos")
+                prompt_tokens += p_tokens
+                total_tokens += t_tokens
+                for i, vector in zip(batch, vectors):
+                    vec = np.asarray(vector, dtype=np.float32)
+                    found[pending_keys[i]] = vec
+                    new_items.append((pending_keys[i], vec))
+            if self.cache:
+                await asyncio.to_thread(self.cache.put_many, model, new_items)
+            self.stats["batches"] += len(batches)
+
+        if cached or batches:
+            logging.info(f"Embeddings: {len(texts)} textos, {cached} de caché, "
+                         f"{len(pending_texts)} calculados en {len(batches)} lotes")
+        return EmbeddingResult([found[k] for k in keys], prompt_tokens, total_tokens, cached, len(batches))
@@ -0,0 +1,265 @@
+"""
+Parser JSON incremental para respuestas del LLM en streaming.
+
+Se alimenta con fragmentos de texto a medida que llegan y va construyendo el
+objeto en su sitio, de modo que en cualquier momento se puede consultar el
+valor parcial (cadenas a medio recibir incluidas). Para las cadenas devuelve
+los trozos nuevos junto con su ruta, p. ej. (("search", "es"), "<p>Los "), lo
+que permite reenviar el texto de la respuesta según se genera.
+
+Tolera lo habitual en salidas de LLM: texto o ```json antes del objeto, comas
+colgantes antes de } o ], y salida truncada (close() cierra lo que quede abierto).
+"""
+
+from typing import Any, List, Optional, Tuple
+
+_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+_LITERALS = {"true": True, "false": False, "null": None}
+_NUMBER_CHARS = set("0123456789+-.eE")
+
+
+class JSONStreamError(ValueError):
+    """El texto recibido no es JSON válido (ni siquiera como prefijo)."""
+
+
+class _Frame:
+    """Contenedor abierto (objeto o lista) y el estado de lectura dentro de él."""
+
+    __slots__ = ("container", "path", "state", "key")
+
+    def __init__(self, container, path: tuple):
+        self.container = container
+        self.path = path
+        # object: key_or_end -> colon -> value -> comma_or_end
+        # array:  value_or_end -> comma_or_end
+        self.state = "key_or_end" if isinstance(container, dict) else "value_or_end"
+        self.key = None
+
+
+class IncrementalJSONParser:
+    """Parser JSON incremental tolerante a salida parcial."""
+
+    def __init__(self):
+        self.root: Any = None
+        self.complete = False
+        self.text = ""
+        self._stack: List[_Frame] = []
+        self._started = False
+        # Cadena en curso: ruta, destino y contenido
+        self._string: Optional[list] = None
+        self._string_is_key = False
+        self._string_slot = None
+        self._string_path: tuple = ()
+        self._escape: Optional[str] = None
+        self._high_surrogate: Optional[int] = None
+        self._flushed = 0
+        # Número o literal en curso
+        self._scalar: Optional[str] = None
+        self._deltas: List[Tuple[tuple, str]] = []
+
+    @property
+    def value(self) -> Any:
+        """Valor construido hasta ahora (los contenedores abiertos se consideran cerrados)."""
+        return self.root
+
+    def feed(self, chunk: str) -> List[Tuple[tuple, str]]:
+        """
+        Procesa un fragmento y devuelve los trozos nuevos de cadenas-valor como
+        [(ruta, texto)], agrupando los consecutivos de la misma ruta.
+        """
+        self.text += chunk
+        self._deltas = []
+        for ch in chunk:
+            if self.complete:
+                break
+            self._consume(ch)
+        if self._string is not None and not self._string_is_key:
+            self._flush_string()
+        return self._deltas
+
+    def close(self) -> Any:
+        """Termina el análisis: cierra cadenas, números y contenedores pendientes."""
+        if self._scalar is not None:
+            self._finish_scalar(partial=True)
+        if self._string is not None and not self._string_is_key:
+            self._flush_string()
+            self._string = None
+        self._stack.clear()
+        return self.root
+
+    # ------------------------------------------------------------------
+    # Máquina de estados
+    # ------------------------------------------------------------------
+
+    def _consume(self, ch: str):
+        if self._string is not None:
+            self._consume_string(ch)
+            return
+        if self._scalar is not None:
+            if ch in _NUMBER_CHARS or ch.isalpha():
+                self._scalar += ch
+                if self._scalar in _LITERALS:
+                    self._finish_scalar()
+                return
+            self._finish_scalar()
+
+        if not self._started:
+            # Ignorar lo que haya antes del primer objeto o lista (```json, texto...)
+            if ch in "{[":
+                self._started = True
+                self._open(ch)
+            return
+
+        if ch.isspace():
+            return
+        frame = self._stack[-1]
+
+        if frame.state == "key_or_end":
+            if ch == '"':
+                self._start_string(is_key=True)
+            elif ch == "}":
+                self._close()
+            else:
+                raise JSONStreamError(f"Se esperaba una clave y llegó {ch!r}")
+        elif frame.state == "colon":
+            if ch != ":":
+                raise JSONStreamError(f"Se esperaba ':' y llegó {ch!r}")
+            frame.state = "value"
+        elif frame.state in ("value", "value_or_end"):
+            if ch == "]" and isinstance(frame.container, list):
+                self._close()   # lista vacía o coma colgante
+            elif ch == "}" and isinstance(frame.container, dict):
+                self._close()   # clave sin valor en una salida defectuosa
+            else:
+                self._start_value(ch)
+        elif frame.state == "comma_or_end":
+            if ch == ",":
+                frame.state = "key_or_end" if isinstance(frame.container, dict) else "value"
+            elif ch in "}]":
+                self._close()
+            else:
+                raise JSONStreamError(f"Se esperaba ',' o cierre y llegó {ch!r}")
+
+    def _start_value(self, ch: str):
+        if ch in "{[":
+            self._open(ch)
+        elif ch == '"':
+            self._start_string(is_key=False)
+        elif ch in _NUMBER_CHARS or ch in "tfn":
+            self._scalar = ch
+        else:
+            raise JSONStreamError(f"Valor no válido: {ch!r}")
+
+    def _slot_for_value(self):
+        """Devuelve (contenedor, clave/índice, ruta) donde colocar el siguiente valor."""
+        frame = self._stack[-1]
+        if isinstance(frame.container, dict):
+            key = frame.key
+        else:
+            frame.container.append(None)
+            key = len(frame.container) - 1
+        frame.state = "comma_or_end"
+        return frame.container, key, frame.path + (key,)
+
+    def _open(self, ch: str):
+        container = {} if ch == "{" else []
+        if not self._stack:
+            self.root = container
+            path = ()
+        else:
+            parent, key, path = self._slot_for_value()
+            parent[key] = container
+        self._stack.append(_Frame(container, path))
+
+    def _close(self):
+        self._stack.pop()
+        if not self._stack:
+            self.complete = True
+
+    def _set_value(self, value):
+        container, key, _ = self._slot_for_value()
+        container[key] = value
+
+    def _finish_scalar(self, partial: bool = False):
+        token, self._scalar = self._scalar, None
+        if token in _LITERALS:
+            self._set_value(_LITERALS[token])
+            return
+        try:
+            value = float(token) if any(c in token for c in ".eE") else int(token)
+        except ValueError:
+            if partial:
+                return
+            raise JSONStreamError(f"Número no válido: {token!r}")
+        self._set_value(value)
+
+    # ------------------------------------------------------------------
+    # Cadenas
+    # ------------------------------------------------------------------
+
+    def _start_string(self, is_key: bool):
+        self._string = []
+        self._string_is_key = is_key
+        self._escape = None
+        if is_key:
+            self._string_slot = None
+        else:
+            container, key, path = self._slot_for_value()
+            container[key] = ""
+            self._string_slot = (container, key)
+            self._string_path = path
+            self._flushed = 0
+
+    def _consume_string(self, ch: str):
+        if self._escape is not None:
+            self._escape += ch
+            if self._escape[0] == "u":
+                if len(self._escape) < 5:
+                    return
+                self._append_code_point(int(self._escape[1:], 16))
+            else:
+                self._string.append(_ESCAPES.get(ch, ch))
+            self._escape = None
+        elif ch == "\\":
+            self._escape = ""
+        elif ch == '"':
+            self._end_string()
+        else:
+            self._string.append(ch)
+
+    def _append_code_point(self, cp: int):
+        if 0xD800 <= cp < 0xDC00:
+            self._high_surrogate = cp
+            return
+        if 0xDC00 <= cp < 0xE000 and self._high_surrogate is not None:
+            cp = 0x10000 + ((self._high_surrogate - 0xD800) << 10) + (cp - 0xDC00)
+        self._high_surrogate = None
+        self._string.append(chr(cp))
+
+    def _flush_string(self):
+        text = "".join(self._string)
+        container, key = self._string_slot
+        container[key] = text
+        if len(text) > self._flushed:
+            delta = text[self._flushed:]
+            self._flushed = len(text)
+            if self._deltas and self._deltas[-1][0] == self._string_path:
+                self._deltas[-1] = (self._string_path, self._deltas[-1][1] + delta)
+            else:
+                self._deltas.append((self._string_path, delta))
+
+    def _end_string(self):
+        if self._string_is_key:
+            frame = self._stack[-1]
+            frame.key = "".join(self._string)
+            frame.state = "colon"
+        else:
+            self._flush_string()
+        self._string = None
+
+
+def parse_partial_json(text: str) -> Any:
+    """Analiza de una vez un JSON posiblemente truncado; None si no hay objeto."""
+    parser = IncrementalJSONParser()
+    parser.feed(text)
+    return parser.close()
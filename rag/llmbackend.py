@@ -0,0 +1,406 @@
+"""
+Backends de LLM del servicio RAG.
+
+El servicio no llama al SDK de OpenAI directamente, sino a un LLMBackend:
+
+- OpenAIBackend: cliente asíncrono de OpenAI (no bloquea el bucle de eventos)
+- MockLLMBackend: backend local determinista para pruebas y desarrollo
+
+EndpointLimits acota las llamadas simultáneas al LLM por endpoint y fija su
+tiempo máximo; run_llm_call ejecuta una llamada con ese límite y la cancela si
+el cliente HTTP se desconecta antes de que termine.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, List, Optional
+
+from embedder import FakeEmbeddingClient, count_tokens
+
+
+class LLMResponse:
+    """Respuesta de una llamada de chat: contenido y uso de tokens."""
+
+    def __init__(self, content: str, prompt_tokens: int = 0, completion_tokens: int = 0,
+                 finish_reason: Optional[str] = None, model: Optional[str] = None):
+        self.content = content
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.total_tokens = prompt_tokens + completion_tokens
+        self.finish_reason = finish_reason
+        self.model = model
+
+
+class LLMStream:
+    """
+    Respuesta de chat en streaming: se itera por los trozos de texto y, al
+    terminar, `response` contiene el contenido completo y el uso de tokens.
+    """
+
+    def __init__(self, chunks: AsyncIterator[str]):
+        self._chunks = chunks
+        self._parts: List[str] = []
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.finish_reason: Optional[str] = None
+        self.model: Optional[str] = None
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        async for text in self._chunks:
+            self._parts.append(text)
+            yield text
+
+    @property
+    def response(self) -> LLMResponse:
+        return LLMResponse("".join(self._parts), self.prompt_tokens, self.completion_tokens,
+                           self.finish_reason, self.model)
+
+
+class LLMBackend:
+    """Interfaz de los backends de LLM (chat y embeddings)."""
+
+    name = "base"
+
+    @property
+    def is_configured(self) -> bool:
+        return True
+
+    async def chat(self, messages: List[dict], model: str, json_mode: bool = False,
+                   timeout: Optional[float] = None) -> LLMResponse:
+        raise NotImplementedError
+
+    def chat_stream(self, messages: List[dict], model: str, json_mode: bool = False,
+                    timeout: Optional[float] = None) -> LLMStream:
+        """Chat en streaming. Por defecto, una sola llamada devuelta como un único trozo."""
+        stream = None
+
+        async def chunks():
+            response = await self.chat(messages, model, json_mode=json_mode, timeout=timeout)
+            stream.prompt_tokens, stream.completion_tokens = response.prompt_tokens, response.completion_tokens
+            stream.finish_reason, stream.model = response.finish_reason, response.model
+            yield response.content
+
+        stream = LLMStream(chunks())
+        return stream
+
+    async def embed(self, texts: List[str], model: str, dimensions: Optional[int] = None):
+        """Devuelve (vectores, prompt_tokens, total_tokens); es el cliente que usa BatchEmbedder."""
+        raise NotImplementedError
+
+    async def aclose(self):
+        pass
+
+
+class OpenAIBackend(LLMBackend):
+    """Backend sobre el cliente asíncrono de OpenAI."""
+
+    name = "openai"
+
+    def __init__(self, api_key: str, timeout: float = 300.0, max_retries: int = 2):
+        from openai import AsyncOpenAI
+        self.client = AsyncOpenAI(api_key=api_key, timeout=timeout, max_retries=max_retries)
+
+    @property
+    def is_configured(self) -> bool:
+        return bool(self.client.api_key)
+
+    async def chat(self, messages: List[dict], model: str, json_mode: bool = False,
+                   timeout: Optional[float] = None) -> LLMResponse:
+        kwargs = {"model": model, "messages": messages}
+        if json_mode:
+            kwargs["response_format"] = {"type": "json_object"}
+        if timeout:
+            kwargs["timeout"] = timeout
+        response = await self.client.chat.completions.create(**kwargs)
+        usage = response.usage
+        choice = response.choices[0] if response.choices else None
+        return LLMResponse(
+            content=(choice.message.content or "") if choice else "",
+            prompt_tokens=usage.prompt_tokens if usage else 0,
+            completion_tokens=usage.completion_tokens if usage else 0,
+            finish_reason=choice.finish_reason if choice else None,
+            model=response.model,
+        )
+
+    def chat_stream(self, messages: List[dict], model: str, json_mode: bool = False,
+                    timeout: Optional[float] = None) -> LLMStream:
+        stream = None
+
+        async def chunks():
+            kwargs = {"model": model, "messages": messages, "stream": True,
+                      "stream_options": {"include_usage": True}}
+            if json_mode:
+                kwargs["response_format"] = {"type": "json_object"}
+            if timeout:
+                kwargs["timeout"] = timeout
+            response = await self.client.chat.completions.create(**kwargs)
+            try:
+                async for chunk in response:
+                    stream.model = chunk.model
+                    if chunk.usage:
+                        stream.prompt_tokens = chunk.usage.prompt_tokens
+                        stream.completion_tokens = chunk.usage.completion_tokens
+                    if not chunk.choices:
+                        continue
+                    choice = chunk.choices[0]
+                    if choice.finish_reason:
+                        stream.finish_reason = choice.finish_reason
+                    if choice.delta and choice.delta.content:
+                        yield choice.delta.content
+            finally:
+                # Cierra la conexión con OpenAI también si se cancela (cliente desconectado)
+                await response.close()
+
+        stream = LLMStream(chunks())
+        return stream
+
+    async def embed(self, texts: List[str], model: str, dimensions: Optional[int] = None):
+        kwargs = {"model": model, "input": texts}
+        if dimensions:
+            kwargs["dimensions"] = dimensions
+        resp = await self.client.embeddings.create(**kwargs)
+        vectors = [data.embedding for data in sorted(resp.data, key=lambda d: d.index)]
+        return vectors, resp.usage.prompt_tokens, resp.usage.total_tokens
+
+    async def aclose(self):
+        await self.client.close()
+
+
+class MockLLMBackend(LLMBackend):
+    """
+    Backend local determinista: no hace llamadas externas.
+
+    La respuesta de chat es un JSON que sirve a todos los endpoints (búsqueda,
+    resúmenes y categorización) y depende solo del prompt. `latency` simula el
+    tiempo de respuesta del modelo sin bloquear el bucle de eventos.
+    """
+
+    name = "mock"
+
+    def __init__(self, latency: float = 0.0, dim: int = 64):
+        self.latency = latency
+        self.embedder = FakeEmbeddingClient(dim=dim)
+        self.calls = 0
+        self.cancelled = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def chat(self, messages: List[dict], model: str, json_mode: bool = False,
+                   timeout: Optional[float] = None) -> LLMResponse:
+        self.calls += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        finally:
+            self.in_flight -= 1
+        return self.respond(messages, model)
+
+    def chat_stream(self, messages: List[dict], model: str, json_mode: bool = False,
+                    timeout: Optional[float] = None, chunk_size: int = 24) -> LLMStream:
+        """
+        Streaming simulado: el primer trozo llega tras un 20% de `latency` y el
+        resto del tiempo se reparte entre los demás trozos.
+        """
+        stream = None
+
+        async def chunks():
+            self.calls += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            try:
+                response = self.respond(messages, model)
+                content = response.content
+                pieces = [content[i:i + chunk_size] for i in range(0, len(content), chunk_size)]
+                if self.latency:
+                    await asyncio.sleep(self.latency * 0.2)
+                for i, piece in enumerate(pieces):
+                    if i and self.latency:
+                        await asyncio.sleep(self.latency * 0.8 / len(pieces))
+                    yield piece
+                stream.prompt_tokens, stream.completion_tokens = response.prompt_tokens, response.completion_tokens
+                stream.finish_reason, stream.model = response.finish_reason, response.model
+            except (asyncio.CancelledError, GeneratorExit):
+                self.cancelled += 1
+                raise
+            finally:
+                self.in_flight -= 1
+
+        stream = LLMStream(chunks())
+        return stream
+
+    def respond(self, messages: List[dict], model: str) -> LLMResponse:
+        """Respuesta determinista para un prompt."""
+        prompt = "\n".join(m.get("content", "") for m in messages)
+        digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:12]
+        text_es = f"<p>Respuesta simulada {digest}. " + "Los contertulios comentan el tema. " * 4 + "</p>"
+        text_en = f"<p>Mock answer {digest}. " + "The participants discuss the topic. " * 4 + "</p>"
+        content = json.dumps({
+            "search": {"es": text_es, "en": text_en},
+            "refs": [],
+            "es": text_es,
+            "en": text_en,
+            "categories": [],
+            "assignments": [],
+            "reparents": [],
+        }, ensure_ascii=False)
+        return LLMResponse(content, prompt_tokens=count_tokens(prompt),
+                           completion_tokens=count_tokens(content), finish_reason="stop", model=model)
+
+    async def embed(self, texts: List[str], model: str, dimensions: Optional[int] = None):
+        return await self.embedder.embed(texts, model, dimensions)
+
+
+def create_backend(kind: str, api_key: Optional[str] = None, timeout: float = 300.0) -> LLMBackend:
+    """Crea el backend indicado en RAG_LLM_BACKEND ('openai' o 'mock')."""
+    if kind == "mock":
+        return MockLLMBackend()
+    if kind == "openai":
+        return OpenAIBackend(api_key=api_key, timeout=timeout)
+    raise ValueError(f"Backend de LLM desconocido: {kind}")
+
+
+class LLMCallTimeout(Exception):
+    """La llamada al LLM superó el tiempo máximo del endpoint."""
+
+
+class ClientDisconnected(Exception):
+    """El cliente HTTP se desconectó antes de recibir la respuesta."""
+
+
+class EndpointLimits:
+    """Concurrencia máxima y tiempo máximo de las llamadas al LLM por endpoint."""
+
+    def __init__(self, concurrency: dict, timeouts: dict,
+                 default_concurrency: int = 8, default_timeout: float = 120.0):
+        self.concurrency = dict(concurrency)
+        self.timeouts = dict(timeouts)
+        self.default_concurrency = default_concurrency
+        self.default_timeout = default_timeout
+        self._semaphores = {}
+        self._stats = {}
+
+    def timeout(self, endpoint: str) -> float:
+        return self.timeouts.get(endpoint, self.default_timeout)
+
+    def _semaphore(self, endpoint: str) -> asyncio.Semaphore:
+        if endpoint not in self._semaphores:
+            self._semaphores[endpoint] = asyncio.Semaphore(self.concurrency.get(endpoint, self.default_concurrency))
+            self._stats[endpoint] = {"active": 0, "waiting": 0, "completed": 0,
+                                     "timeouts": 0, "cancelled": 0, "errors": 0}
+        return self._semaphores[endpoint]
+
+    async def acquire(self, endpoint: str, timeout: Optional[float] = None) -> Callable[[], None]:
+        """
+        Ocupa un hueco libre para `endpoint`, esperando como mucho `timeout`
+        segundos (LLMCallTimeout si no llega). Devuelve la función que lo libera,
+        que se puede llamar más de una vez.
+        """
+        semaphore = self._semaphore(endpoint)
+        stats = self._stats[endpoint]
+        stats["waiting"] += 1
+        waiter = asyncio.ensure_future(semaphore.acquire())
+        done = set()
+        try:
+            done, _ = await asyncio.wait({waiter}, timeout=timeout)
+        finally:
+            stats["waiting"] -= 1
+            if not done:
+                waiter.cancel()
+                # Si el hueco llegó justo al cancelar, se devuelve
+                waiter.add_done_callback(
+                    lambda w: semaphore.release() if not w.cancelled() and w.exception() is None else None)
+        if not done:
+            stats["timeouts"] += 1
+            raise LLMCallTimeout(endpoint)
+        stats["active"] += 1
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                stats["active"] -= 1
+                semaphore.release()
+
+        return release
+
+    @asynccontextmanager
+    async def slot(self, endpoint: str):
+        """Espera un hueco libre para `endpoint` y lo ocupa durante el bloque."""
+        release = await self.acquire(endpoint)
+        try:
+            yield self._stats[endpoint]
+        finally:
+            release()
+
+    def record(self, endpoint: str, event: str):
+        self._semaphore(endpoint)
+        self._stats[endpoint][event] += 1
+
+    def stats(self) -> dict:
+        return {
+            endpoint: {"limit": self.concurrency.get(endpoint, self.default_concurrency),
+                       "timeout": self.timeout(endpoint), **stats}
+            for endpoint, stats in self._stats.items()
+        }
+
+
+async def run_llm_call(limits: EndpointLimits, endpoint: str, request, coro_factory,
+                       poll_interval: float = 0.25):
+    """
+    Ejecuta `coro_factory()` con el límite de concurrencia y el tiempo máximo de
+    `endpoint`. El tiempo de espera en cola cuenta dentro del tiempo máximo.
+
+    Mientras la llamada está en curso se comprueba si el cliente se ha
+    desconectado; en ese caso se cancela y se lanza ClientDisconnected.
+    Si se supera el tiempo máximo se cancela y se lanza LLMCallTimeout.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + limits.timeout(endpoint)
+    start = time.perf_counter()
+
+    async def guarded():
+        async with limits.slot(endpoint) as stats:
+            try:
+                result = await coro_factory()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                stats["errors"] += 1
+                raise
+            stats["completed"] += 1
+            return result
+
+    task = asyncio.ensure_future(guarded())
+    try:
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                task.cancel()
+                limits.record(endpoint, "timeouts")
+                logging.warning(f"⏱️ Llamada al LLM en {endpoint} cancelada tras {limits.timeout(endpoint)}s")
+                raise LLMCallTimeout(endpoint)
+            done, _ = await asyncio.wait({task}, timeout=min(poll_interval, remaining))
+            if done:
+                return task.result()
+            if request is not None and await request.is_disconnected():
+                task.cancel()
+                limits.record(endpoint, "cancelled")
+                logging.info(f"🔌 Cliente desconectado: llamada al LLM en {endpoint} cancelada "
+                             f"tras {time.perf_counter() - start:.1f}s")
+                raise ClientDisconnected(endpoint)
+    finally:
+        if not task.done():
+            task.cancel()
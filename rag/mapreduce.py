@@ -0,0 +1,212 @@
+"""
+Resúmenes map-reduce de transcripciones largas para el servicio RAG.
+
+Una transcripción de tres horas no cabe con holgura en un solo prompt: la
+llamada es lenta, cara y el modelo puede recortarla sin avisar. En modo
+map-reduce la transcripción se divide en ventanas acotadas por tokens, que
+siempre empiezan en un cambio de intervención; cada ventana se resume por
+separado (en paralelo) y los resúmenes parciales se combinan al final.
+
+- normalize_transcript compacta el texto extraído del HTML (get_text deja
+  cada etiqueta en su línea) en líneas "[hablante]: texto" y marcas de tiempo
+- build_windows agrupa intervenciones completas hasta el presupuesto de tokens
+- SummaryCache guarda los resúmenes parciales en SQLite indexados por
+  sha256(modelo, prompt), de modo que cambiar solo el paso de reducción no
+  vuelve a pagar las ventanas
+"""
+
+import hashlib
+import logging
+import re
+import sqlite3
+import threading
+import time
+from typing import List, Optional
+
+from embedder import count_tokens
+
+DEFAULT_WINDOW_TOKENS = 6000
+
+_WHITESPACE = re.compile(r'\s+')
+_TIME_MARK = re.compile(r'\[\s*(\d{1,2}:\d{2}:\d{2}(?:\.\d+)?)\s*-\s*(\d{1,2}:\d{2}:\d{2}(?:\.\d+)?)\s*\]')
+_SPEAKER_MARK = re.compile(r'\[\s*([^\[\]\n]{1,80}?)\s*\]:\s*')
+_TIME_LINE = re.compile(r'^\[(\d{1,2}:\d{2}:\d{2}(?:\.\d+)?) - (\d{1,2}:\d{2}:\d{2}(?:\.\d+)?)\]$')
+_SENTENCE_END = re.compile(r'(?<=[.!?…])\s+')
+
+
+def normalize_transcript(text: str) -> str:
+    """
+    Compacta el texto de una transcripción: una línea por marca de tiempo
+    ("[hh:mm:ss - hh:mm:ss]") y otra por intervención ("[hablante]: texto").
+    """
+    text = _WHITESPACE.sub(' ', text)
+    text = _TIME_MARK.sub(lambda m: f"\n[{m[1]} - {m[2]}]\n", text)
+    text = _SPEAKER_MARK.sub(lambda m: f"\n[{m[1]}]: ", text)
+    return "\n".join(line.strip() for line in text.split("\n") if line.strip())
+
+
+def split_turns(text: str) -> List[dict]:
+    """
+    Divide una transcripción normalizada en intervenciones.
+
+    Las marcas de tiempo se quedan con la intervención que las sigue. El texto
+    sin hablante (transcripciones sin diarización) continúa la intervención
+    anterior.
+
+    Returns:
+        Lista de {"text", "start", "end"} (start/end: última marca de tiempo vista)
+    """
+    turns = []
+    pending_marks = []
+    start = end = None
+    for line in text.split("\n"):
+        mark = _TIME_LINE.match(line)
+        if mark:
+            start, end = mark[1], mark[2]
+            pending_marks.append(line)
+            continue
+        if line.startswith("[") and "]: " in line or not turns:
+            turns.append({"text": "\n".join(pending_marks + [line]), "start": start, "end": end})
+        else:
+            turns[-1]["text"] += "\n" + "\n".join(pending_marks + [line])
+            turns[-1]["end"] = end
+        pending_marks = []
+    if pending_marks and turns:
+        turns[-1]["text"] += "\n" + "\n".join(pending_marks)
+        turns[-1]["end"] = end
+    return turns
+
+
+def _split_long_turn(turn: dict, max_tokens: int) -> List[dict]:
+    """Parte una intervención que no cabe en una ventana por finales de frase (o por caracteres)."""
+    pieces, current = [], ""
+    sentences = _SENTENCE_END.split(turn["text"])
+    for sentence in sentences:
+        while count_tokens(sentence) > max_tokens:
+            # Frase sin puntuación más larga que la ventana: corte por caracteres
+            cut = max(1, len(sentence) * max_tokens // count_tokens(sentence))
+            if current:
+                pieces.append(current)
+                current = ""
+            pieces.append(sentence[:cut])
+            sentence = sentence[cut:]
+        candidate = f"{current} {sentence}" if current else sentence
+        if current and count_tokens(candidate) > max_tokens:
+            pieces.append(current)
+            candidate = sentence
+        current = candidate
+    if current:
+        pieces.append(current)
+    return [{"text": piece, "start": turn["start"], "end": turn["end"]} for piece in pieces]
+
+
+def build_windows(text: str, max_tokens: int = DEFAULT_WINDOW_TOKENS) -> List[dict]:
+    """
+    Agrupa las intervenciones de una transcripción en ventanas de como mucho
+    max_tokens. Las ventanas solo se cortan entre intervenciones, salvo que
+    una intervención por sí sola supere el presupuesto.
+
+    Args:
+        text: Texto de la transcripción (se normaliza con normalize_transcript)
+        max_tokens: Presupuesto de tokens por ventana
+
+    Returns:
+        Lista de {"text", "start", "end", "tokens"} en el orden de la transcripción
+    """
+    windows = []
+    current, current_tokens = [], 0
+
+    def flush():
+        if current:
+            windows.append({
+                "text": "\n".join(t["text"] for t in current),
+                "start": next((t["start"] for t in current if t["start"]), None),
+                "end": current[-1]["end"],
+                "tokens": current_tokens,
+            })
+
+    for turn in split_turns(normalize_transcript(text)):
+        tokens = count_tokens(turn["text"]) + 1
+        parts = [turn] if tokens <= max_tokens else _split_long_turn(turn, max_tokens - 1)
+        for part in parts:
+            part_tokens = tokens if len(parts) == 1 else count_tokens(part["text"]) + 1
+            if current and current_tokens + part_tokens > max_tokens:
+                flush()
+                current, current_tokens = [], 0
+            current.append(part)
+            current_tokens += part_tokens
+    flush()
+    return windows
+
+
+def group_by_tokens(texts: List[str], max_tokens: int) -> List[List[int]]:
+    """
+    Agrupa textos consecutivos hasta max_tokens por grupo, con al menos dos
+    textos por grupo para que cada nivel de reducción avance.
+
+    Returns:
+        Lista de grupos de índices
+    """
+    groups, current, used = [], [], 0
+    for i, text in enumerate(texts):
+        tokens = count_tokens(text) + 1
+        if len(current) >= 2 and used + tokens > max_tokens:
+            groups.append(current)
+            current, used = [], 0
+        current.append(i)
+        used += tokens
+    if current:
+        if len(current) == 1 and groups:
+            groups[-1].extend(current)
+        else:
+            groups.append(current)
+    return groups
+
+
+class SummaryCache:
+    """Caché persistente de resúmenes parciales en SQLite (modo WAL)."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30.0, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode = WAL;')
+        self._conn.execute('PRAGMA synchronous = NORMAL;')
+        self._conn.execute('PRAGMA busy_timeout = 30000;')
+        self._conn.execute("""
+        CREATE TABLE IF NOT EXISTS summary_cache (
+            key TEXT PRIMARY KEY,
+            model TEXT NOT NULL,
+            summary TEXT NOT NULL,
+            prompt_tokens INTEGER NOT NULL,
+            completion_tokens INTEGER NOT NULL,
+            created_at REAL NOT NULL
+        );
+        """)
+        self._conn.commit()
+        logging.info(f"Caché de resúmenes parciales en {path}")
+
+    @staticmethod
+    def make_key(model: str, prompt: str) -> str:
+        return hashlib.sha256(f"{model}\n{prompt}".encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT summary FROM summary_cache WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, key: str, model: str, summary: str, prompt_tokens: int, completion_tokens: int):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO summary_cache "
+                "(key, model, summary, prompt_tokens, completion_tokens, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, summary, prompt_tokens, completion_tokens, time.time())
+            )
+            self._conn.commit()
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM summary_cache").fetchone()[0]
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,276 @@
+"""
+Detección de prompt injection y del idioma de las consultas de /relsearch.
+
+Las reglas se compilan una sola vez al importar el módulo. Cada regla declara
+los literales (en minúsculas) sin los que no puede coincidir; todos esos
+literales, junto con las palabras clave de idioma y de contexto de podcast,
+forman un único autómata (una expresión regular en forma de trie) que recorre
+la consulta en minúsculas una sola vez. Solo las reglas cuyos literales
+aparecen se evalúan con su expresión completa, de modo que una consulta
+normal cuesta un recorrido en lugar de ~50 búsquedas.
+"""
+
+import re
+from typing import Dict, FrozenSet, Iterable, List, NamedTuple, Tuple
+
+# (id de regla, literales que deben aparecer, patrón). Los patrones con (?i)
+# no distinguen mayúsculas; los literales se buscan siempre en minúsculas.
+RULES: List[Tuple[str, Tuple[str, ...], str]] = [
+    # INGLÉS - Intentos de cambiar el rol del sistema
+    ("role_override_en", ("ignore", "forget", "disregard"),
+     r'(?i)(ignore|forget|disregard).*(previous|above|system|instruction)'),
+    ("role_play_en", ("you are", "act as", "pretend to be", "role"),
+     r'(?i)(you are|act as|pretend to be|role.play)'),
+    ("system_prompt_en", ("system prompt", "system message", "system instruction"),
+     r'(?i)(system prompt|system message|system instruction)'),
+
+    # ESPAÑOL - Intentos de cambiar el rol del sistema
+    ("role_override_es", ("ignora", "olvida", "descarta"),
+     r'(?i)(ignora|olvida|descarta).*(anterior|arriba|sistema|instrucción|instrucciones)'),
+    ("role_play_es", ("eres", "actúa como", "finge ser", "simula ser", "hazte pasar por"),
+     r'(?i)(eres|actúa como|finge ser|simula ser|hazte pasar por)'),
+    ("system_prompt_es", ("prompt del sistema", "mensaje del sistema", "instrucciones del sistema"),
+     r'(?i)(prompt del sistema|mensaje del sistema|instrucciones del sistema)'),
+    ("role_change_es", ("cambia tu rol", "modifica tu comportamiento", "ahora eres"),
+     r'(?i)(cambia tu rol|modifica tu comportamiento|ahora eres)'),
+
+    # FRANCÉS - Intentos de cambiar el rol del sistema
+    ("role_override_fr", ("ignore", "oublie", "néglige"),
+     r'(?i)(ignore|oublie|néglige).*(précédent|dessus|système|instruction)'),
+    ("role_play_fr", ("tu es", "agis comme", "prétends être", "fais semblant"),
+     r'(?i)(tu es|agis comme|prétends être|fais semblant)'),
+    ("system_prompt_fr", ("prompt système", "message système", "instruction système"),
+     r'(?i)(prompt système|message système|instruction système)'),
+    ("role_change_fr", ("change ton rôle", "modifie ton comportement", "maintenant tu es"),
+     r'(?i)(change ton rôle|modifie ton comportement|maintenant tu es)'),
+
+    # INGLÉS - Intentos de ejecutar código o comandos
+    ("exec_en", ("execute", "run", "eval"),
+     r'(?i)\b(execute|run|eval)\b'),
+    ("import_en", ("import",),
+     r'(?i)\bimport\b|\bfrom\s+\w+\s+import\b'),
+    ("dunder_eval", ("__", "eval(", "exec("),
+     r'(?i)(__.*__|eval\(|exec\()'),
+
+    # ESPAÑOL - Intentos de ejecutar código o comandos
+    ("exec_es", ("ejecuta", "corre", "evalúa"),
+     r'(?i)\b(ejecuta|corre|evalúa|ejecutar)\b'),
+    # Evitar "importa mucho", "importa que", etc.
+    ("import_es", ("importa",),
+     r'(?i)\bimporta\b(?!\s+(mucho|poco|nada|que|de|la|el))'),
+    # Evitar falsos positivos cuando se habla "sobre código"
+    ("code_es", ("código", "comando", "script"),
+     r'(?i)(código|comando|script)(?!\s+(de|del|en|sobre|para)\s)'),
+    # Solo "programa" seguido de verbos de ejecución
+    ("exec_program_es", ("programa",),
+     r'(?i)\b(programa)\s+(ejecut|corr|lanc)'),
+
+    # FRANCÉS - Intentos de ejecutar código o comandos
+    ("exec_fr", ("exécute", "lance", "évalue", "importe"),
+     r'(?i)(exécute|lance|évalue|importe|exécuter)'),
+    ("code_fr", ("code", "commande", "script"),
+     r'(?i)(code|commande|script)(?!\s+(de|du|sur|pour)\s)'),
+    ("exec_program_fr", ("programme",),
+     r'(?i)\b(programme)\s+(exécut|lanc)'),
+
+    # INGLÉS - Intentos de modificar el formato de salida
+    ("output_format_en", ("respond in", "answer in", "format", "output"),
+     r'(?i)(respond in|answer in|format.*as|output.*as)'),
+    ("markup_format_en", ("json", "xml", "html"),
+     r'(?i)(json.*format|xml.*format|html.*format)'),
+
+    # ESPAÑOL - Intentos de modificar el formato de salida
+    ("output_format_es", ("responde en", "contesta en", "formato", "salida"),
+     r'(?i)(responde en|contesta en|formato.*como|salida.*como)'),
+    ("markup_format_es", ("formato",),
+     r'(?i)(formato.*json|formato.*xml|formato.*html)'),
+    ("change_format_es", ("devuelve", "cambia"),
+     r'(?i)(devuelve.*formato|cambia.*formato)'),
+
+    # FRANCÉS - Intentos de modificar el formato de salida
+    ("output_format_fr", ("réponds en", "répond en", "format", "sortie"),
+     r'(?i)(réponds en|répond en|format.*comme|sortie.*comme)'),
+    ("markup_format_fr", ("format",),
+     r'(?i)(format.*json|format.*xml|format.*html)'),
+    ("change_format_fr", ("retourne", "change"),
+     r'(?i)(retourne.*format|change.*format)'),
+
+    # INGLÉS - Intentos de obtener información del sistema
+    ("secrets_en", ("api", "secret", "password", "token", "credential"),
+     r'(?i)(api.*key|secret|password|token|credential)'),
+    ("reveal_prompt_en", ("show", "reveal", "print"),
+     r'(?i)(show.*prompt|reveal.*prompt|print.*prompt)'),
+
+    # ESPAÑOL - Intentos de obtener información del sistema
+    ("secrets_es", ("clave", "secreto", "contraseña", "token", "credencial"),
+     r'(?i)(clave.*api|secreto|contraseña|token|credencial)'),
+    ("reveal_prompt_es", ("muestra", "revela", "imprime"),
+     r'(?i)(muestra.*prompt|revela.*prompt|imprime.*prompt)'),
+    ("reveal_instructions_es", ("enseña", "muestra"),
+     r'(?i)(enseña.*instrucciones|muestra.*instrucciones)'),
+
+    # FRANCÉS - Intentos de obtener información del sistema
+    ("secrets_fr", ("clé", "secret", "mot de passe", "jeton", "credential"),
+     r'(?i)(clé.*api|secret|mot de passe|jeton|credential)'),
+    ("reveal_prompt_fr", ("montre", "révèle", "imprime"),
+     r'(?i)(montre.*prompt|révèle.*prompt|imprime.*prompt)'),
+    ("reveal_instructions_fr", ("montre", "révèle"),
+     r'(?i)(montre.*instructions|révèle.*instructions)'),
+
+    # Patrones universales independientes del idioma
+    ("delimiter_end", ("###", "---", "```"),
+     r'###.*END.*###|---.*END.*---|```.*```'),
+    ("chat_role_marker", ("usuario:", "user:", "system:", "assistant:", "utilisateur:", "système:"),
+     r'USUARIO:|USER:|SYSTEM:|ASSISTANT:|UTILISATEUR:|SYSTÈME:'),
+    ("repeated_delimiters", ("<", ">", '"""', "```", "===", "---"),
+     r'[<>]{3,}|"{3,}|`{3,}|={3,}|-{3,}'),
+
+    # Términos técnicos que pueden aparecer en cualquier idioma
+    ("jailbreak", ("prompt", "jailbreak", "bypass"),
+     r'(?i)(prompt.injection|jailbreak|bypass)'),
+    ("privileged_terms", ("root", "admin", "sudo", "shell", "terminal"),
+     r'(?i)(root|admin|sudo|shell|terminal)'),
+
+    # Patrones de manipulación psicológica multiidioma
+    ("polite_ignore", ("please", "por favor", "s'il vous plaît"),
+     r'(?i)(please|por favor|s\'il vous plaît).*(ignore|ignora|ignore)'),
+    ("urgent_override", ("urgent",),
+     r'(?i)(urgent|urgente|urgent).*(override|anula|outrepasse)'),
+    ("emergency_mode", ("emergency", "emergencia", "urgence"),
+     r'(?i)(emergency|emergencia|urgence).*(mode|modo|mode)'),
+
+    # Intentos de confusión con idiomas mezclados
+    ("mixed_languages", ("español", "english", "français"),
+     r'(?i)(español.*english|english.*español|français.*english)'),
+    ("translate_ignore", ("translate", "traduce", "traduis"),
+     r'(?i)(translate.*ignore|traduce.*ignora|traduis.*ignore)'),
+]
+
+# Palabras clave por idioma (coincidencia como subcadena, en minúsculas)
+LANGUAGE_KEYWORDS: Dict[str, Tuple[str, ...]] = {
+    'es': ('qué', 'cómo', 'cuándo', 'dónde', 'por qué', 'cuál', 'episodio', 'podcast', 'habla', 'dice'),
+    'en': ('what', 'how', 'when', 'where', 'why', 'which', 'episode', 'podcast', 'talk', 'say', 'tell'),
+    'fr': ('que', 'comment', 'quand', 'où', 'pourquoi', 'quel', 'épisode', 'podcast', 'parle', 'dit'),
+}
+
+# Con contexto de podcast se toleran las reglas sobre "programa"/"programme"
+PODCAST_CONTEXT_KEYWORDS = (
+    'episodio', 'programa', 'podcast', 'capítulo', 'emisión', 'transmisión',
+    'episode', 'program', 'show', 'broadcast', 'transmission',
+    'épisode', 'programme', 'émission', 'diffusion',
+)
+PODCAST_EXEMPT_RULES = frozenset({"exec_program_es", "exec_program_fr"})
+
+ERROR_MESSAGES = {
+    'es': "Consulta no válida. Por favor, reformule su pregunta sobre el contenido de los podcasts.",
+    'en': "Invalid query. Please rephrase your question about the podcast content.",
+    'fr': "Requête non valide. Veuillez reformuler votre question sur le contenu des podcasts.",
+    'mixed': "Invalid query / Consulta no válida / Requête non valide. Please ask about podcast content only.",
+    'unknown': "Invalid query. Please ask about podcast content only.",
+}
+
+
+def _trie_regex(words: Iterable[str]) -> str:
+    """Expresión regular en forma de trie que, en cada posición, captura el literal más largo."""
+    trie: dict = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[""] = {}
+
+    def emit(node: dict) -> str:
+        terminal = "" in node
+        branches = [re.escape(ch) + emit(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        if terminal:
+            # Opcional y voraz: primero intenta el literal más largo
+            return "(?:" + body + ")?" if len(branches) == 1 else body + "?"
+        return body
+
+    return emit(trie)
+
+
+class _Literals:
+    """Autómata único con todos los literales y lo que depende de cada uno."""
+
+    def __init__(self):
+        literals = set(PODCAST_CONTEXT_KEYWORDS)
+        for _, triggers, _ in RULES:
+            literals.update(triggers)
+        for keywords in LANGUAGE_KEYWORDS.values():
+            literals.update(keywords)
+        assert all(lit == lit.lower() for lit in literals), "Los literales deben ir en minúsculas"
+        self.literals = frozenset(literals)
+        self.regex = re.compile("(?=(" + _trie_regex(sorted(literals)) + "))")
+        # En cada posición se captura el literal más largo; los literales contenidos
+        # en él también están en la consulta
+        self.contained: Dict[str, FrozenSet[str]] = {
+            lit: frozenset(other for other in literals if other in lit) for lit in literals
+        }
+
+    def find(self, text_lower: str) -> FrozenSet[str]:
+        """Literales presentes en el texto (en minúsculas), en una sola pasada."""
+        found = set()
+        for match in self.regex.finditer(text_lower):
+            found |= self.contained[match.group(1)]
+        return frozenset(found)
+
+
+# (?i) en re usa la minúscula simple de cada carácter y además equipara unos
+# pocos caracteres que str.lower() no convierte; se normalizan antes de buscar
+# los literales para que ninguna regla quede sin evaluar
+_CASE_FIXES = str.maketrans({'İ': 'i', 'ı': 'i', 'ſ': 's'})
+
+_LITERALS = _Literals()
+_RULES_BY_LITERAL: Dict[str, Tuple[Tuple[str, "re.Pattern"], ...]] = {}
+for _rule_id, _triggers, _pattern in RULES:
+    _compiled = re.compile(_pattern)
+    for _trigger in _triggers:
+        _RULES_BY_LITERAL[_trigger] = _RULES_BY_LITERAL.get(_trigger, ()) + ((_rule_id, _compiled),)
+RULE_IDS = tuple(rule_id for rule_id, _, _ in RULES)
+_RULE_ORDER = {rule_id: i for i, rule_id in enumerate(RULE_IDS)}
+_PODCAST_CONTEXT = frozenset(PODCAST_CONTEXT_KEYWORDS)
+_LANGUAGE_KEYWORDS = {lang: frozenset(keywords) for lang, keywords in LANGUAGE_KEYWORDS.items()}
+
+
+class QueryScan(NamedTuple):
+    """Resultado del análisis de una consulta."""
+    rule_ids: Tuple[str, ...]   # Reglas de prompt injection que coinciden (en el orden de RULES)
+    language: str               # 'es', 'en', 'fr', 'mixed' o 'unknown'
+
+
+def _language_from_literals(found: FrozenSet[str]) -> str:
+    counts = {lang: len(found & keywords) for lang, keywords in _LANGUAGE_KEYWORDS.items()}
+    if not any(counts.values()):
+        return 'unknown'
+    # Si hay coincidencias en múltiples idiomas
+    if sum(1 for c in counts.values() if c > 0) >= 2:
+        return 'mixed'
+    return max(counts, key=counts.get)
+
+
+def scan_query(query: str) -> QueryScan:
+    """Evalúa todas las reglas y el idioma de la consulta con una sola pasada por el texto."""
+    found = _LITERALS.find(query.translate(_CASE_FIXES).lower())
+    candidates = {}
+    for literal in found:
+        for rule_id, compiled in _RULES_BY_LITERAL.get(literal, ()):
+            candidates[rule_id] = compiled
+    exempt = PODCAST_EXEMPT_RULES if found & _PODCAST_CONTEXT else frozenset()
+    matched = [rule_id for rule_id, compiled in candidates.items()
+               if rule_id not in exempt and compiled.search(query)]
+    matched.sort(key=_RULE_ORDER.__getitem__)
+    return QueryScan(tuple(matched), _language_from_literals(found))
+
+
+def detect_query_language(query: str) -> str:
+    """
+    Detecta el idioma principal de la consulta para análisis de seguridad.
+
+    Returns:
+        Código del idioma detectado ('es', 'en', 'fr', 'mixed', 'unknown')
+    """
+    return _language_from_literals(_LITERALS.find(query.translate(_CASE_FIXES).lower()))
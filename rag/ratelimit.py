@@ -0,0 +1,311 @@
+"""
+Límite de peticiones y contadores de seguridad del servicio RAG.
+
+Antes el estado vivía en el diccionario `security_monitor` de cada proceso:
+con varios workers de uvicorn cada uno tenía sus contadores (el límite real
+era N veces el configurado) y los diccionarios crecían sin límite.
+
+Dos backends intercambiables con la misma interfaz:
+
+- MemoryRateLimiter: estado en el proceso, con ventana deslizante (registro
+  de marcas de tiempo) o token bucket, y expulsión periódica de las claves
+  inactivas. Adecuado para un único worker.
+- SQLiteRateLimiter: estado compartido en un fichero SQLite (modo WAL) para
+  despliegues con varios workers. Cada comprobación es una transacción
+  BEGIN IMMEDIATE, así que el límite se aplica sumando todos los procesos,
+  y los contadores de eventos se guardan por worker y se agregan al leerlos.
+  Con contención, una comprobación puede esperar al bloqueo del fichero
+  (busy_timeout): sus operaciones se marcan `blocking` para que el servicio
+  las ejecute fuera del event loop.
+"""
+
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Callable, Dict, List, Optional
+
+ALGORITHMS = ("sliding", "token_bucket")
+DEFAULT_EVICT_INTERVAL = 60.0
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class RateLimiter:
+    """Interfaz común de los backends."""
+
+    name = "base"
+    # Las operaciones pueden esperar a otros procesos: llamarlas con asyncio.to_thread
+    blocking = False
+
+    def __init__(self, algorithm: str = "sliding", evict_interval: float = DEFAULT_EVICT_INTERVAL,
+                 clock: Callable[[], float] = time.time):
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f"Algoritmo de rate limiting no soportado: {algorithm} (usa {', '.join(ALGORITHMS)})")
+        self.algorithm = algorithm
+        self.evict_interval = evict_interval
+        self.clock = clock
+
+    def hit(self, key: str, limit: int, window_seconds: float) -> bool:
+        """
+        Registra una petición de `key` y devuelve si está dentro del límite
+        (`limit` peticiones cada `window_seconds`). Si no lo está, la clave queda
+        bloqueada durante `window_seconds`: mientras dure el bloqueo se rechazan
+        sus peticiones sin contarlas.
+        """
+        raise NotImplementedError
+
+    def count_events(self, names: List[str]):
+        """Incrementa en uno cada contador de `names`."""
+        raise NotImplementedError
+
+    def status(self) -> dict:
+        """
+        Estado agregado: {"counters", "blocked", "active_clients", "workers"}.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class MemoryRateLimiter(RateLimiter):
+    """Estado en memoria del proceso."""
+
+    name = "memory"
+
+    def __init__(self, algorithm: str = "sliding", evict_interval: float = DEFAULT_EVICT_INTERVAL,
+                 clock: Callable[[], float] = time.time):
+        super().__init__(algorithm, evict_interval, clock)
+        self._lock = threading.Lock()
+        # sliding: clave -> (deque de marcas de tiempo, ventana)
+        self._logs: Dict[str, tuple] = {}
+        # token_bucket: clave -> [tokens, última actualización, instante en que vuelve a estar lleno]
+        self._buckets: Dict[str, list] = {}
+        self._blocked: Dict[str, float] = {}
+        self._counters = defaultdict(int)
+        self._last_evict = clock()
+
+    def hit(self, key: str, limit: int, window_seconds: float) -> bool:
+        now = self.clock()
+        with self._lock:
+            if now - self._last_evict >= self.evict_interval:
+                self._evict(now)
+            if self._blocked.get(key, 0.0) > now:
+                return False
+            if self.algorithm == "sliding":
+                entry = self._logs.get(key)
+                if entry is None:
+                    entry = self._logs[key] = (deque(), window_seconds)
+                log = entry[0]
+                cutoff = now - window_seconds
+                while log and log[0] <= cutoff:
+                    log.popleft()
+                allowed = len(log) < limit
+                if allowed:
+                    log.append(now)
+            else:
+                rate = limit / window_seconds
+                bucket = self._buckets.get(key)
+                tokens = limit if bucket is None else min(limit, bucket[0] + (now - bucket[1]) * rate)
+                allowed = tokens >= 1
+                if allowed:
+                    tokens -= 1
+                self._buckets[key] = [tokens, now, now + (limit - tokens) / rate]
+            if not allowed:
+                self._blocked[key] = now + window_seconds
+            return allowed
+
+    def _evict(self, now: float):
+        """Descarta las claves sin peticiones en su ventana y los bloqueos vencidos."""
+        self._logs = {k: (log, w) for k, (log, w) in self._logs.items() if log and log[-1] > now - w}
+        self._buckets = {k: b for k, b in self._buckets.items() if b[2] > now}
+        self._blocked = {k: until for k, until in self._blocked.items() if until > now}
+        self._last_evict = now
+
+    def count_events(self, names: List[str]):
+        with self._lock:
+            for name in names:
+                self._counters[name] += 1
+
+    def status(self) -> dict:
+        now = self.clock()
+        with self._lock:
+            self._evict(now)
+            return {
+                "counters": dict(self._counters),
+                "blocked": len(self._blocked),
+                "active_clients": len(self._logs) + len(self._buckets),
+                "workers": 1,
+            }
+
+    def tracked_keys(self) -> int:
+        """Claves con estado en memoria (para comprobar la expulsión)."""
+        with self._lock:
+            return len(self._logs) + len(self._buckets) + len(self._blocked)
+
+
+class SQLiteRateLimiter(RateLimiter):
+    """Estado compartido entre procesos en un fichero SQLite (modo WAL)."""
+
+    name = "sqlite"
+    blocking = True
+
+    def __init__(self, path: str, algorithm: str = "sliding", evict_interval: float = DEFAULT_EVICT_INTERVAL,
+                 clock: Callable[[], float] = time.time, worker_id: Optional[str] = None):
+        super().__init__(algorithm, evict_interval, clock)
+        self.path = path
+        self.worker_id = worker_id
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._last_evict = 0.0
+        conn = self._connection()
+        conn.executescript("""
+        CREATE TABLE IF NOT EXISTS rl_hits (
+            key TEXT NOT NULL,
+            ts REAL NOT NULL,
+            expires REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_rl_hits_key_ts ON rl_hits(key, ts);
+        CREATE TABLE IF NOT EXISTS rl_buckets (
+            key TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated REAL NOT NULL,
+            expires REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS rl_blocked (
+            key TEXT PRIMARY KEY,
+            until REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS security_counters (
+            worker TEXT NOT NULL,
+            name TEXT NOT NULL,
+            value INTEGER NOT NULL,
+            PRIMARY KEY (worker, name)
+        );
+        CREATE TABLE IF NOT EXISTS rl_workers (
+            worker TEXT PRIMARY KEY,
+            last_seen REAL NOT NULL
+        );
+        """)
+        self._heartbeat(conn, self.clock())
+        logging.info(f"Rate limiting compartido ({algorithm}) en {path}")
+
+    def _connection(self) -> sqlite3.Connection:
+        """Conexión del proceso actual (se reabre tras un fork)."""
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=30.0, check_same_thread=False,
+                                         isolation_level=None)
+            self._conn.execute('PRAGMA journal_mode = WAL;')
+            self._conn.execute('PRAGMA synchronous = NORMAL;')
+            self._conn.execute('PRAGMA busy_timeout = 30000;')
+            self._pid = os.getpid()
+        return self._conn
+
+    def _worker(self) -> str:
+        return self.worker_id or default_worker_id()
+
+    def _heartbeat(self, conn: sqlite3.Connection, now: float):
+        conn.execute("INSERT INTO rl_workers (worker, last_seen) VALUES (?, ?) "
+                     "ON CONFLICT(worker) DO UPDATE SET last_seen = excluded.last_seen", (self._worker(), now))
+
+    def hit(self, key: str, limit: int, window_seconds: float) -> bool:
+        now = self.clock()
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # El latido va en cada petición: con la expulsión solo se
+                # renovaba cada evict_interval y un worker podía darse por caído
+                self._heartbeat(conn, now)
+                if now - self._last_evict >= self.evict_interval:
+                    self._evict(conn, now)
+                blocked = conn.execute("SELECT 1 FROM rl_blocked WHERE key = ? AND until > ?",
+                                       (key, now)).fetchone()
+                if blocked:
+                    conn.execute("COMMIT")
+                    return False
+                if self.algorithm == "sliding":
+                    count = conn.execute("SELECT COUNT(*) FROM rl_hits WHERE key = ? AND ts > ?",
+                                         (key, now - window_seconds)).fetchone()[0]
+                    allowed = count < limit
+                    if allowed:
+                        conn.execute("INSERT INTO rl_hits (key, ts, expires) VALUES (?, ?, ?)",
+                                     (key, now, now + window_seconds))
+                else:
+                    rate = limit / window_seconds
+                    row = conn.execute("SELECT tokens, updated FROM rl_buckets WHERE key = ?", (key,)).fetchone()
+                    tokens = limit if row is None else min(limit, row[0] + (now - row[1]) * rate)
+                    allowed = tokens >= 1
+                    if allowed:
+                        tokens -= 1
+                    conn.execute("INSERT OR REPLACE INTO rl_buckets (key, tokens, updated, expires) "
+                                 "VALUES (?, ?, ?, ?)", (key, tokens, now, now + (limit - tokens) / rate))
+                if not allowed:
+                    conn.execute("INSERT OR REPLACE INTO rl_blocked (key, until) VALUES (?, ?)",
+                                 (key, now + window_seconds))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return allowed
+
+    def _evict(self, conn: sqlite3.Connection, now: float):
+        """Borra las peticiones fuera de ventana, los buckets llenos y los bloqueos vencidos."""
+        conn.execute("DELETE FROM rl_hits WHERE expires <= ?", (now,))
+        conn.execute("DELETE FROM rl_buckets WHERE expires <= ?", (now,))
+        conn.execute("DELETE FROM rl_blocked WHERE until <= ?", (now,))
+        self._last_evict = now
+
+    def count_events(self, names: List[str]):
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._heartbeat(conn, self.clock())
+                conn.executemany(
+                    "INSERT INTO security_counters (worker, name, value) VALUES (?, ?, 1) "
+                    "ON CONFLICT(worker, name) DO UPDATE SET value = value + 1",
+                    [(self._worker(), name) for name in names]
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    def status(self) -> dict:
+        now = self.clock()
+        with self._lock:
+            conn = self._connection()
+            counters = dict(conn.execute("SELECT name, SUM(value) FROM security_counters GROUP BY name").fetchall())
+            blocked = conn.execute("SELECT COUNT(*) FROM rl_blocked WHERE until > ?", (now,)).fetchone()[0]
+            active = conn.execute(
+                "SELECT (SELECT COUNT(DISTINCT key) FROM rl_hits WHERE expires > ?) + "
+                "(SELECT COUNT(*) FROM rl_buckets WHERE expires > ?)", (now, now)
+            ).fetchone()[0]
+            workers = conn.execute("SELECT COUNT(*) FROM rl_workers WHERE last_seen > ?",
+                                   (now - 3 * self.evict_interval,)).fetchone()[0]
+        return {"counters": counters, "blocked": blocked, "active_clients": active, "workers": workers}
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def create_rate_limiter(kind: str, algorithm: str = "sliding", path: Optional[str] = None,
+                        evict_interval: float = DEFAULT_EVICT_INTERVAL) -> RateLimiter:
+    """Crea el backend de rate limiting configurado (RAG_RATE_LIMIT_BACKEND)."""
+    if kind == "memory":
+        return MemoryRateLimiter(algorithm, evict_interval)
+    if kind == "sqlite":
+        if not path:
+            raise ValueError("El backend sqlite de rate limiting necesita la ruta del fichero")
+        return SQLiteRateLimiter(path, algorithm, evict_interval)
+    raise ValueError(f"Backend de rate limiting no soportado: {kind}")
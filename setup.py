@@ -38,6 +38,7 @@ setup(
         'faiss-cpu>=1.7.4',
         'tqdm>=4.66.0',
         'asyncpg>=0.29.0',
+        'httpx>=0.25.0',
     ],
     extras_require={
         'audio': ['pyannote-audio>=3.1.1'],
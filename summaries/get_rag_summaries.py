@@ -6,39 +6,132 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')
 
 from tools.logs import logcfg
 from tools.envvars import load_env_vars_from_directory
-from api.apihmac import create_auth_headers, serialize_body
+from api.apiclient import SignedAsyncClient
+from bs4 import BeautifulSoup
+import asyncio
+import hashlib
 import logging
 import json
 import argparse
-import requests
+import random
+import time
+import httpx
 import csv
 from datetime import datetime
 
-def load_transcriptions(input_dir, max_per_block):
-    """Prepara los archivos de transcripción en bloques para enviar al servicio de resúmenes.
-    Esta función busca archivos con el sufijo "_whisper_audio_es.html" en el directorio de entrada,
-    los carga y los agrupa en bloques de tamaño máximo especificado. Cada bloque se envía al servicio
-    de resúmenes para su procesamiento.
+TRANSCRIPTION_SUFFIX = "_whisper_audio_es.html"
+MANIFEST_FILE = "summaries_manifest.json"
+# Resumen que save_summaries escribe cuando la respuesta del servicio no es JSON válido
+ERROR_SUMMARY_ES = "Error al procesar el resumen"
+# Códigos tras los que merece la pena reintentar un episodio
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def extract_transcript_text(html_content):
+    """Extrae el texto plano de una transcripción HTML.
+    Aplica la misma extracción que extract_text_from_html en el servicio RAG (se descarta el
+    bloque speaker-summary), de forma que se envía solo el texto en lugar del fichero completo.
+
+    Args:
+        html_content (string): Contenido HTML de la transcripción
+
+    Returns:
+        string: Texto plano de la transcripción
+    """
+    soup = BeautifulSoup(html_content, "html.parser")
+    speaker_summary = soup.find("span", {"id": "speaker-summary"})
+    if speaker_summary:
+        speaker_summary.decompose()
+    return soup.get_text(separator="\n")
+
+
+def text_hash(text):
+    """Hash SHA-256 del texto que se envía a resumir."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def load_manifest(output_dir):
+    """Carga el manifiesto de resúmenes ({ep_id: {"sha256", "summarized"}}) del directorio de salida."""
+    path = os.path.join(output_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        logging.warning(f"No se pudo leer el manifiesto {path}, se ignora: {e}")
+        return {}
+
+
+def save_manifest(output_dir, manifest):
+    """Escribe el manifiesto de forma atómica (fichero temporal y os.replace)."""
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, MANIFEST_FILE)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def summary_is_valid(output_dir, ep_id):
+    """Indica si existe un resumen del episodio que no sea el de error por defecto."""
+    summary_file = os.path.join(output_dir, f"{ep_id}_summary.json")
+    try:
+        with open(summary_file, "r", encoding="utf-8") as f:
+            summary = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return False
+    return summary.get("es") != ERROR_SUMMARY_ES
+
+
+def load_transcriptions(input_dir):
+    """Carga las transcripciones del directorio de entrada como texto plano.
+    Esta función busca archivos con el sufijo "_whisper_audio_es.html" en el directorio de entrada
+    y extrae su texto.
 
     Args:
         input_dir (string): Directorio de entrada con archivos de transcripción
-        max_per_block (string): Número máximo de archivos a enviar en un bloque
-    
+
     Yields:
-        list: Lista de diccionarios con el ID del episodio y la transcripción HTML
+        dict: ID del episodio, texto plano de la transcripción y su hash
     """
-    buffer = []
-    for file in os.listdir(input_dir):
-        if file.endswith("_whisper_audio_es.html"):
-            ep_id = file.replace("_whisper_audio_es.html", "")
+    for file in sorted(os.listdir(input_dir)):
+        if file.endswith(TRANSCRIPTION_SUFFIX):
+            ep_id = file.replace(TRANSCRIPTION_SUFFIX, "")
             with open(os.path.join(input_dir, file), "r", encoding="utf-8") as f:
-                html = f.read()
-                buffer.append({"ep_id": ep_id, "transcription": html})
-                if len(buffer) == max_per_block:
-                    yield buffer
-                    buffer = []
-    if buffer:
-        yield buffer
+                text = extract_transcript_text(f.read())
+            yield {"ep_id": ep_id, "transcription": text, "sha256": text_hash(text)}
+
+
+def pending_episodes(input_dir, output_dir, manifest, force=False):
+    """Selecciona los episodios que hay que resumir.
+    Se omiten los episodios cuyo hash coincide con el del manifiesto y tienen un resumen válido.
+    Los resúmenes anteriores al manifiesto se adoptan (se registra su hash) en lugar de repetirse.
+
+    Args:
+        input_dir (string): Directorio de entrada con archivos de transcripción
+        output_dir (string): Directorio de salida de los resúmenes
+        manifest (dict): Manifiesto cargado con load_manifest (se actualiza con los adoptados)
+        force (bool): Resumir todos los episodios aunque no hayan cambiado
+
+    Returns:
+        tuple: (episodios pendientes, número de episodios omitidos)
+    """
+    pending, skipped = [], 0
+    for episode in load_transcriptions(input_dir):
+        ep_id = episode["ep_id"]
+        entry = manifest.get(ep_id)
+        if not force and summary_is_valid(output_dir, ep_id):
+            if entry is None:
+                logging.info(f"Resumen previo sin manifiesto para {ep_id}: se registra su hash")
+                manifest[ep_id] = {"sha256": episode["sha256"], "summarized": None}
+                entry = manifest[ep_id]
+            if entry["sha256"] == episode["sha256"]:
+                skipped += 1
+                continue
+            logging.info(f"La transcripción de {ep_id} ha cambiado: se vuelve a resumir")
+        pending.append(episode)
+    return pending, skipped
 
 
 def save_summaries(output_dir, summaries):
@@ -111,6 +204,102 @@ def save_summaries(output_dir, summaries):
                 fecha_procesado
             ])
 
+async def summarize_one(client, url, episode, retries, backoff_base=2.0):
+    """Envía un episodio al servicio de resúmenes con reintentos propios del episodio.
+
+    Args:
+        client (SignedAsyncClient): Cliente firmado compartido
+        url (string): URL del endpoint /summarize
+        episode (dict): Episodio devuelto por load_transcriptions
+        retries (int): Reintentos ante errores de red, 429 o 5xx
+        backoff_base (float): Espera base (segundos) del backoff exponencial
+
+    Returns:
+        dict: Respuesta del servicio para el episodio
+
+    Raises:
+        httpx.HTTPError: Si el episodio falla tras todos los intentos
+    """
+    payload = [{"ep_id": episode["ep_id"], "transcription": episode["transcription"],
+                "transcription_format": "text"}]
+    for attempt in range(retries + 1):
+        try:
+            response = await client.post_json(url, payload, retries=0)
+            if response.status_code not in RETRY_STATUS_CODES:
+                response.raise_for_status()
+                return response.json()[0]
+            if attempt >= retries:
+                response.raise_for_status()
+            logging.warning(f"⚠️ {episode['ep_id']}: el servicio devolvió {response.status_code} "
+                            f"(intento {attempt + 1}), reintentando")
+        except httpx.TransportError as e:
+            if attempt >= retries:
+                raise
+            logging.warning(f"⚠️ {episode['ep_id']}: error de red (intento {attempt + 1}): {e}")
+        await asyncio.sleep(random.uniform(0, backoff_base * (2 ** attempt)))
+
+
+async def summarize_directory(input_dir, output_dir, url, api_key, concurrency=4, retries=3,
+                              force=False, backoff_base=2.0):
+    """Resume las transcripciones pendientes de un directorio con un pool asíncrono acotado.
+    Cada resumen se guarda y se registra en el manifiesto en cuanto llega, de forma que una
+    ejecución interrumpida continúa donde lo dejó.
+
+    Args:
+        input_dir (string): Directorio de entrada con transcripciones HTML
+        output_dir (string): Directorio de salida para resúmenes
+        url (string): URL del servicio de resúmenes
+        api_key (string): Clave HMAC del servicio RAG
+        concurrency (int): Episodios en curso a la vez
+        retries (int): Reintentos por episodio
+        force (bool): Resumir también los episodios que no han cambiado
+        backoff_base (float): Espera base (segundos) entre reintentos
+
+    Returns:
+        dict: Recuento de episodios resumidos, omitidos y fallidos
+    """
+    manifest = load_manifest(output_dir)
+    pending, skipped = pending_episodes(input_dir, output_dir, manifest, force)
+    logging.info(f"📝 {len(pending)} episodios pendientes, {skipped} sin cambios")
+    if skipped:
+        save_manifest(output_dir, manifest)
+
+    semaphore = asyncio.Semaphore(concurrency)
+    results = {"summarized": 0, "skipped": skipped, "failed": []}
+    client = SignedAsyncClient(url, api_key, "get_rag_summaries", timeout=900.0,
+                               max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async def worker(episode):
+        async with semaphore:
+            ep_id = episode["ep_id"]
+            start = time.perf_counter()
+            # Un episodio que falla (red, respuesta mal formada o error al guardar) se
+            # anota como fallido sin interrumpir a los demás
+            try:
+                item = await summarize_one(client, url, episode, retries, backoff_base)
+                save_summaries(output_dir, [item])
+                if summary_is_valid(output_dir, ep_id):
+                    manifest[ep_id] = {"sha256": episode["sha256"],
+                                       "summarized": datetime.now().isoformat(timespec="seconds")}
+                    save_manifest(output_dir, manifest)
+            except httpx.HTTPError as e:
+                logging.error(f"❌ Error al resumir {ep_id}: {e}")
+                results["failed"].append(ep_id)
+                return
+            except (ValueError, LookupError, TypeError, OSError) as e:
+                logging.error(f"❌ Respuesta no válida o error al guardar el resumen de {ep_id}: {e!r}")
+                results["failed"].append(ep_id)
+                return
+            results["summarized"] += 1
+            logging.info(f"✅ {ep_id} resumido en {time.perf_counter() - start:.1f}s")
+
+    try:
+        await asyncio.gather(*(worker(episode) for episode in pending))
+    finally:
+        await client.aclose()
+    return results
+
+
 def main():
     """Función principal que configura el registro, carga las transcripciones y envía solicitudes al servicio de resúmenes.
     """
@@ -123,32 +312,26 @@ def main():
         logging.error("RAG_SERVER_API_KEY not found in environment variables")
         raise ValueError("RAG_SERVER_API_KEY is required")
     
-    DEFAULT_MAX_FILES = 6
+    DEFAULT_CONCURRENCY = 4
+    DEFAULT_RETRIES = 3
     parser = argparse.ArgumentParser(description="Obtener resúmenes RAG de transcripciones de podcast")
     parser.add_argument("-t", "--transcriptions", required=True, help="Directorio de entrada con transcripciones HTML")
     parser.add_argument("-s", "--summaries", required=True, help="Directorio de salida para resúmenes HTML")
     parser.add_argument("--url", default="http://localhost:5500/summarize", help="URL del servicio de resúmenes")
-    parser.add_argument("--max-files", type=int, default=DEFAULT_MAX_FILES, help="Número máximo de archivos a enviar en un bloque")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="Número de episodios que se resumen a la vez")
+    parser.add_argument("--retries", type=int, default=DEFAULT_RETRIES, help="Reintentos por episodio ante errores de red o 5xx")
+    parser.add_argument("--force", action="store_true", help="Resumir también los episodios que no han cambiado")
     args = parser.parse_args()
 
     logging.info(f"📝 Cargando transcripciones desde {args.transcriptions}")
 
     logging.info("📡 Enviando transcripciones al servicio de resúmenes...")
-    for block in load_transcriptions(args.transcriptions, args.max_files):
-        logging.info(f"📦 Enviando bloque de {len(block)} episodios...: {[b['ep_id'] for b in block]}")
-        try:
-            # Crear headers de autenticación HMAC
-            auth_headers = create_auth_headers(rag_server_api_key, "POST", args.url, block, client_id='get_rag_summaries')
-            
-            # ENVIAR EL JSON EXACTO QUE USAMOS PARA LA FIRMA
-            body_str = serialize_body(block)
-            response = requests.post(args.url, data=body_str, headers=auth_headers)
-            response.raise_for_status()
-            summaries = response.json()
-            save_summaries(args.summaries, summaries)
-        except requests.RequestException as e:
-            logging.error("❌ Error al enviar bloque: %s", e)
-        logging.info("✅ Proceso completado")
+    results = asyncio.run(summarize_directory(args.transcriptions, args.summaries, args.url, rag_server_api_key,
+                                              concurrency=args.concurrency, retries=args.retries, force=args.force))
+    logging.info(f"✅ Proceso completado: {results['summarized']} resumidos, {results['skipped']} sin cambios, "
+                 f"{len(results['failed'])} fallidos {results['failed'] or ''}")
+    if results["failed"]:
+        sys.exit(1)
 
 if __name__ == "__main__":
     logcfg(__file__)
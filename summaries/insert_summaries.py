@@ -7,6 +7,7 @@ import sys
 import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),"..", "tools")))
 from logs import logcfg
+from timeanchors import build_sidecar
 import logging
 import re
 import argparse
@@ -185,6 +186,8 @@ def update_transcript_file(transcript_file, summary_content):
         # Guardar el archivo actualizado
         with open(transcript_file, 'w', encoding='utf-8') as file:
             file.write(str(soup))
+        # Índice de anclas de tiempo para enlazar las referencias del RAG sin parsear el HTML
+        build_sidecar(transcript_file)
         
         return True
     except Exception as e:
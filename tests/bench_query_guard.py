@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Benchmark de la validación de consultas del RAG server
+Compara, por consulta del corpus de validate_query_guard.py, la ruta anterior
+(~50 re.search sobre los patrones en texto y el recuento de palabras clave de
+idioma en cada llamada) con la pasada única de queryguard.scan_query.
+
+Uso:
+    python tests/bench_query_guard.py [--repeat 2000]
+"""
+
+import argparse
+import os
+import re
+import statistics
+import sys
+import time
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(project_root, 'rag'))
+
+from queryguard import RULES, scan_query
+from validate_query_guard import CORPUS, reference_language, reference_rules
+
+PATTERNS = [pattern for _, _, pattern in RULES]
+
+
+def legacy_validate(query: str):
+    """Ruta anterior: cada patrón se busca por su texto (caché interna de re) en cada llamada."""
+    podcast_context_keywords = [
+        'episodio', 'programa', 'podcast', 'capítulo', 'emisión', 'transmisión',
+        'episode', 'program', 'show', 'broadcast', 'transmission',
+        'épisode', 'programme', 'émission', 'diffusion'
+    ]
+    query_lower = query.lower()
+    has_podcast_context = any(keyword in query_lower for keyword in podcast_context_keywords)
+    for pattern in PATTERNS:
+        if re.search(pattern, query):
+            if has_podcast_context and any(word in pattern.lower() for word in ['programa', 'programme', 'program']):
+                continue
+            return reference_language(query)
+    return None
+
+
+def time_per_query(func, queries: list, repeat: int) -> list:
+    """Microsegundos por llamada para cada consulta (mejor de 3 rondas)."""
+    results = []
+    for query in queries:
+        best = float("inf")
+        for _ in range(3):
+            start = time.perf_counter()
+            for _ in range(repeat):
+                func(query)
+            best = min(best, (time.perf_counter() - start) / repeat)
+        results.append(best * 1e6)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=2000, help="Llamadas por consulta y ronda")
+    args = parser.parse_args()
+
+    legit = [q for q, expected in CORPUS if not expected]
+    attacks = [q for q, expected in CORPUS if expected]
+    assert all(scan_query(q).rule_ids == reference_rules(q) for q in legit + attacks)
+
+    print("=" * 60)
+    print(f"Validación de consultas: µs por consulta ({args.repeat} llamadas x 3 rondas)")
+    print("=" * 60)
+    for label, queries in (("Legítimas", legit), ("Ataques", attacks)):
+        old = time_per_query(legacy_validate, queries, args.repeat)
+        new = time_per_query(scan_query, queries, args.repeat)
+        print(f"  {label:<10} anterior: p50 {statistics.median(old):6.1f} µs  máx {max(old):6.1f} µs | "
+              f"pasada única: p50 {statistics.median(new):5.1f} µs  máx {max(new):5.1f} µs  "
+              f"(x{statistics.median(old) / statistics.median(new):.1f})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Benchmark del coste por petición del rate limiting del RAG server
+Mide check_rate_limit (rag/ratelimit.py) con cada backend y algoritmo para un
+conjunto de IPs, y el caso SQLite con varios procesos compitiendo por el
+mismo fichero (despliegue con varios workers).
+
+Uso:
+    python tests/bench_rate_limiter.py [--requests 20000] [--ips 1000] [--workers 4]
+"""
+
+import argparse
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(project_root, 'rag'))
+
+from ratelimit import MemoryRateLimiter, SQLiteRateLimiter
+
+LIMIT = 1000
+WINDOW = 60.0
+
+
+def time_hits(limiter, requests: int, ips: int) -> list:
+    """Microsegundos de cada llamada a hit()."""
+    samples = []
+    for i in range(requests):
+        start = time.perf_counter()
+        limiter.hit(f"10.0.{(i % ips) // 256}.{i % 256}", LIMIT, WINDOW)
+        samples.append((time.perf_counter() - start) * 1e6)
+    return samples
+
+
+def report(label: str, samples: list):
+    samples = sorted(samples)
+    p99 = samples[int(len(samples) * 0.99) - 1]
+    print(f"  {label:<32} p50 {statistics.median(samples):7.1f} µs  p99 {p99:8.1f} µs  "
+          f"media {statistics.mean(samples):7.1f} µs")
+
+
+def _worker(path: str, algorithm: str, requests: int, ips: int, queue):
+    limiter = SQLiteRateLimiter(path, algorithm)
+    queue.put(time_hits(limiter, requests, ips))
+    limiter.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--ips", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print(f"Rate limiting: coste de check_rate_limit ({args.requests} peticiones, {args.ips} IPs)")
+    print("=" * 60)
+    with tempfile.TemporaryDirectory() as workdir:
+        for algorithm in ("sliding", "token_bucket"):
+            report(f"memory/{algorithm}", time_hits(MemoryRateLimiter(algorithm), args.requests, args.ips))
+            limiter = SQLiteRateLimiter(os.path.join(workdir, f"{algorithm}.db"), algorithm)
+            report(f"sqlite/{algorithm}", time_hits(limiter, args.requests, args.ips))
+            limiter.close()
+
+        for algorithm in ("sliding", "token_bucket"):
+            path = os.path.join(workdir, f"mp_{algorithm}.db")
+            queue = multiprocessing.Queue()
+            per_worker = args.requests // args.workers
+            procs = [multiprocessing.Process(target=_worker, args=(path, algorithm, per_worker, args.ips, queue))
+                     for _ in range(args.workers)]
+            start = time.perf_counter()
+            for p in procs:
+                p.start()
+            samples = [s for _ in procs for s in queue.get()]
+            for p in procs:
+                p.join()
+            elapsed = time.perf_counter() - start
+            report(f"sqlite/{algorithm} x{args.workers} procesos", samples)
+            print(f"  {'':<32} {len(samples) / elapsed:,.0f} peticiones/s en total")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
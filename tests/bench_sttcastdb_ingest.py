@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Benchmark de ingesta en SttcastDB
+Compara la ruta antigua (SELECT/INSERT de tags por fila y un commit por
+embedding) con la ruta en bloque (executemany + resolve_tag_ids +
+update_embeddings) ingiriendo N episodios sintéticos.
+
+Con --no-wal cada commit implica un fsync y la diferencia es máxima: solo en
+ese modo se exige la mejora mínima (--target). En modo WAL (synchronous=NORMAL,
+el del context server y el de por defecto) domina la escritura de los blobs de
+embeddings y la mejora, menor, se informa sin exigirla.
+
+Uso:
+    python tests/bench_sttcastdb_ingest.py [--episodes 100] [--interventions 1500] [--dim 1536] [--no-wal]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+# Añadir db/ al path para importar sttcastdb
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(project_root, 'db'))
+
+import numpy as np
+
+from sttcastdb import SttcastDB
+
+TAGS = [f"Speaker {i}" for i in range(8)] + ["Unknown"]
+
+
+def make_episodes(n_episodes: int, n_interventions: int) -> list:
+    """Genera episodios sintéticos con intervenciones de varios hablantes."""
+    rng = np.random.default_rng(0)
+    base = datetime(2020, 1, 1)
+    episodes = []
+    for e in range(n_episodes):
+        t = 0.0
+        ints = []
+        for _ in range(n_interventions):
+            d = float(rng.uniform(1, 20))
+            ints.append({"tag": TAGS[int(rng.integers(len(TAGS)))], "start": t, "end": t + d,
+                         "content": "texto de prueba " * 10})
+            t += d
+        episodes.append((f"ep{e:04d}", base + timedelta(days=7 * e), f"ep{e:04d}.mp3", ints))
+    return episodes
+
+
+def legacy_add_episode(db: SttcastDB, epname, epdate, epfile, epints):
+    """Ruta de ingesta anterior: una SELECT/INSERT de tag y un INSERT por intervención."""
+    cur = db.cursor
+    epdatestr = epdate.strftime("%Y-%m-%d")
+    cur.execute("INSERT INTO episode (epname, epdate) VALUES (?, ?)", (epname, epdatestr))
+    episode_id = cur.lastrowid
+    cur.execute("INSERT INTO audiofile (fname, episodeid) VALUES (?, ?)", (epfile, episode_id))
+    for epi in epints:
+        cur.execute("SELECT id FROM speakertag WHERE tag = ?", (epi['tag'],))
+        row = cur.fetchone()
+        if row is None:
+            cur.execute("INSERT INTO speakertag (tag) VALUES (?)", (epi['tag'],))
+            tag_id = cur.lastrowid
+        else:
+            tag_id = row[0]
+        cur.execute(
+            "INSERT INTO speakerintervention (tagid, episodeid, start, end, content) VALUES (?, ?, ?, ?, ?)",
+            (tag_id, episode_id, epi['start'], epi['end'], epi['content'])
+        )
+    db.update_cache_stats_for_episode(epname, epdatestr, episode_id)
+    db.conn.commit()
+
+
+def ingest(db_path: str, episodes: list, vectors: np.ndarray, bulk: bool, wal: bool) -> float:
+    """Ingiere los episodios (alta + embeddings) y devuelve el tiempo empleado."""
+    db = SttcastDB(db_path, create_if_not_exists=True, wal=wal)
+    start = time.perf_counter()
+    for epname, epdate, epfile, epints in episodes:
+        if bulk:
+            db.add_episode(epname, epdate, epfile, epints)
+        else:
+            legacy_add_episode(db, epname, epdate, epfile, epints)
+        ids = [row["id"] for row in db.get_ints(with_embeddings=False, epname=epname)]
+        if bulk:
+            db.update_embeddings((_id, v.tobytes(), 10, 10) for _id, v in zip(ids, vectors))
+        else:
+            for _id, v in zip(ids, vectors):
+                db.update_embedding(_id, v.tobytes(), 10, 10)
+    elapsed = time.perf_counter() - start
+    db.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--episodes", type=int, default=100)
+    parser.add_argument("--interventions", type=int, default=1500, help="Intervenciones por episodio")
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--no-wal", action="store_true", help="Usar el journal por defecto (un fsync por commit)")
+    parser.add_argument("--target", type=float, default=10.0, help="Mejora mínima esperada (solo con --no-wal)")
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print(f"Ingesta de {args.episodes} episodios x {args.interventions} intervenciones "
+          f"(dim={args.dim}, {'sin WAL' if args.no_wal else 'WAL'})")
+    print("=" * 60)
+
+    episodes = make_episodes(args.episodes, args.interventions)
+    # Los mismos vectores para todos los episodios: solo se mide la escritura
+    vectors = np.random.default_rng(1).standard_normal((args.interventions, args.dim)).astype(np.float32)
+    with tempfile.TemporaryDirectory() as workdir:
+        legacy = ingest(os.path.join(workdir, "legacy.db"), episodes, vectors, bulk=False, wal=not args.no_wal)
+        print(f"  Ruta por fila:  {legacy:.2f} s")
+        bulk = ingest(os.path.join(workdir, "bulk.db"), episodes, vectors, bulk=True, wal=not args.no_wal)
+        print(f"  Ruta en bloque: {bulk:.2f} s")
+
+    speedup = legacy / bulk
+    print(f"  Mejora: {speedup:.1f}x")
+    if not args.no_wal:
+        print(f"ℹ️  En modo WAL la mejora solo se informa; el objetivo de {args.target:.0f}x se comprueba con --no-wal")
+        return 0
+    if speedup >= args.target:
+        print(f"✅ Ingesta al menos {args.target:.0f}x más rápida")
+        return 0
+    print(f"❌ Mejora inferior a {args.target:.0f}x")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Prueba de carga de client_rag con un RAG server simulado
+Lanza N preguntas simultáneas (cada /relsearch tarda `latency` segundos en el
+RAG simulado) y mide mientras tanto la latencia de / y de un estático. Con las
+llamadas por el pool asíncrono (SignedAsyncClient) las páginas deben seguir
+respondiendo al momento y las preguntas resolverse en paralelo; con
+--blocking se simula el comportamiento anterior (requests.post síncrono
+dentro del endpoint async) para comparar.
+También comprueba que la firma HMAC llega al RAG server y que, si el navegador
+abandona la pregunta, la llamada al RAG server se cancela.
+
+client_rag necesita .env y la base de datos para importarse, así que la prueba
+monta una app con el mismo camino de /api/ask (run_until_disconnected +
+post_json), la página principal, los estáticos de rag/client/static y el
+middleware de fallback de audios.
+
+Uso:
+    python tests/load_client_rag.py [--concurrency 30] [--latency 2.0] [--blocking]
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import sys
+import time
+
+# Añadir el directorio raíz del proyecto y rag/client/ al path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+sys.path.insert(0, os.path.join(project_root, 'rag', 'client'))
+
+import httpx
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import HTMLResponse
+from fastapi.staticfiles import StaticFiles
+
+from api.apiclient import ClientDisconnected, SignedAsyncClient, run_until_disconnected
+from api.apihmac import create_auth_headers, serialize_body, validate_hmac_auth
+from load_context_server import free_port, percentile, start_server
+from middleware_audio_fallback import AudioFallbackMiddleware
+
+RAG_KEY = "load-test-rag-key"
+STATIC_FILE = "/static/js/audio_fallback_standalone.js"
+
+
+class StubRag:
+    """RAG server simulado: valida HMAC, tarda `latency` y cuenta las llamadas cortadas."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.completed = 0
+        self.cancelled = 0
+        self.app = FastAPI()
+
+        @self.app.post("/relsearch")
+        async def relsearch(request: Request):
+            validate_hmac_auth(request, RAG_KEY, await request.body())
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            try:
+                end = time.perf_counter() + self.latency
+                while time.perf_counter() < end:
+                    await asyncio.sleep(0.05)
+                    if await request.is_disconnected():
+                        self.cancelled += 1
+                        return
+                self.completed += 1
+                query = (await request.json())["query"]
+                return {"search": {"es": f"Respuesta a {query}", "en": ""}, "refs": []}
+            finally:
+                self.in_flight -= 1
+
+
+def build_client_app(rag_url: str, blocking: bool):
+    """App con el camino de /api/ask de client_rag, su página principal y sus estáticos."""
+    app = FastAPI()
+    app.add_middleware(AudioFallbackMiddleware)
+    app.mount("/static", StaticFiles(directory=os.path.join(project_root, "rag", "client", "static")),
+              name="static")
+    rag_client = SignedAsyncClient(rag_url, RAG_KEY, "client_rag_service", max_connections=50)
+    blocking_client = httpx.Client(timeout=120)
+
+    @app.get("/", response_class=HTMLResponse)
+    async def index():
+        return "<html><body><h1>Sttcast RAG</h1></body></html>"
+
+    @app.post("/api/ask")
+    async def ask(request: Request):
+        payload = {"query": (await request.json())["question"], "embeddings": [], "requester": "127.0.0.1"}
+        if blocking:
+            # Comportamiento anterior: requests.post dentro del endpoint async
+            headers = create_auth_headers(RAG_KEY, "POST", "/relsearch", payload, "client_rag_service")
+            response = blocking_client.post(f"{rag_url}/relsearch", content=serialize_body(payload).encode('utf-8'),
+                                            headers=headers)
+        else:
+            try:
+                response = await run_until_disconnected(request,
+                                                        rag_client.post_json("/relsearch", payload, retries=0))
+            except ClientDisconnected:
+                raise HTTPException(status_code=499, detail="Client closed request")
+        if response.status_code != 200:
+            raise HTTPException(status_code=502, detail=f"Error al realizar búsqueda: {response.status_code}")
+        return {"success": True, "response": response.json()["search"]}
+
+    app.rag_client = rag_client
+    return app
+
+
+async def sample_pages(client: httpx.AsyncClient, base: str, seconds: float, interval: float = 0.05) -> list:
+    latencies = []
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        for path in ("/", STATIC_FILE):
+            t0 = time.perf_counter()
+            r = await client.get(f"{base}{path}")
+            r.raise_for_status()
+            latencies.append(time.perf_counter() - t0)
+        await asyncio.sleep(interval)
+    return latencies
+
+
+async def ask(client: httpx.AsyncClient, base: str, i: int, timeout=None) -> httpx.Response:
+    return await client.post(f"{base}/api/ask", json={"question": f"¿Qué se dijo del telescopio {i}?"},
+                             timeout=timeout)
+
+
+async def run_load(base: str, concurrency: int, latency: float):
+    async with httpx.AsyncClient(timeout=300, limits=httpx.Limits(max_connections=concurrency + 10)) as client:
+        baseline = await sample_pages(client, base, 1.0)
+        started = time.perf_counter()
+        asks = [asyncio.create_task(ask(client, base, i)) for i in range(concurrency)]
+        await asyncio.sleep(0.2)
+        under_load = await sample_pages(client, base, max(latency - 0.4, 0.5))
+        responses = await asyncio.gather(*asks)
+        elapsed = time.perf_counter() - started
+    return baseline, under_load, responses, elapsed
+
+
+async def check_disconnect(base: str, stub: StubRag, app) -> bool:
+    async with httpx.AsyncClient() as client:
+        cancelled_before = stub.cancelled
+        try:
+            await ask(client, base, 999, timeout=stub.latency / 4)
+        except httpx.TimeoutException:
+            pass
+    await asyncio.sleep(1.0)
+    cancelled = stub.cancelled - cancelled_before
+    ok = cancelled == 1 and stub.in_flight == 0 and app.rag_client.stats()["cancelled"] == 1
+    print(f"  {'✅' if ok else '❌'} Navegador desconectado -> llamada al RAG server cancelada "
+          f"({cancelled} cancelada, {stub.in_flight} en curso)")
+    return ok
+
+
+def summary(label: str, values: list) -> str:
+    ms = [v * 1000 for v in values]
+    return (f"{label}: n={len(ms)} p50={statistics.median(ms):.1f}ms "
+            f"p95={percentile(ms, 95):.1f}ms max={max(ms):.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=30, help="Preguntas simultáneas")
+    parser.add_argument("--latency", type=float, default=2.0, help="Latencia simulada de /relsearch (s)")
+    parser.add_argument("--blocking", action="store_true", help="Simular requests.post síncrono (comportamiento anterior)")
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    stub = StubRag(args.latency)
+    rag_port, client_port = free_port(), free_port()
+    rag_server = start_server(stub.app, rag_port)
+    app = build_client_app(f"http://127.0.0.1:{rag_port}", args.blocking)
+    client_server = start_server(app, client_port)
+    base = f"http://127.0.0.1:{client_port}"
+    print("=" * 60)
+    print(f"/ y estáticos con {args.concurrency} preguntas en curso "
+          f"({'requests.post bloqueante' if args.blocking else 'pool asíncrono'}, RAG a {args.latency}s)")
+    print("=" * 60)
+    try:
+        baseline, under_load, responses, elapsed = asyncio.run(run_load(base, args.concurrency, args.latency))
+        print("  " + summary("Sin carga  ", baseline))
+        print("  " + summary("Con carga  ", under_load))
+        failed = [r.status_code for r in responses if r.status_code != 200]
+        print(f"  {len(responses) - len(failed)}/{len(responses)} preguntas correctas (firma HMAC válida) "
+              f"en {elapsed:.2f}s (máx. {stub.max_in_flight} simultáneas en el RAG server)")
+
+        flat = percentile(under_load, 95) <= percentile(baseline, 95) + 0.05
+        parallel = elapsed < 2 * args.latency
+        print(f"  {'✅' if flat else '❌'} Latencia de las páginas {'estable' if flat else 'degradada'} durante la carga")
+        print(f"  {'✅' if parallel else '❌'} Preguntas resueltas en paralelo "
+              f"({elapsed:.2f}s frente a {args.concurrency * args.latency:.0f}s en serie)")
+        ok = not failed
+        if not args.blocking:
+            ok &= flat and parallel and asyncio.run(check_disconnect(base, stub, app))
+    finally:
+        client_server.should_exit = True
+        rag_server.should_exit = True
+    print("=" * 60)
+    print("✅ Prueba superada" if ok else "❌ Prueba fallida")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Prueba de carga de /getcontext contra un RAG server simulado
+Lanza un stub local de /getoneembedding con latencia fija y mide p50/p99
+de N consultas concurrentes al context server (sin query_embedding, de modo
+que cada consulta provoca una llamada al RAG server). Una segunda ronda con
+las mismas consultas mide el efecto de la caché de embeddings.
+
+Uso:
+    python tests/load_context_server.py [--concurrency 50] [--latency 0.2]
+"""
+
+import argparse
+import asyncio
+import hashlib
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+# Añadir el directorio raíz del proyecto (y db/ para sttcastdb) al path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+sys.path.insert(0, os.path.join(project_root, 'db'))
+
+import faiss
+import httpx
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, Request
+
+from api.apiclient import SignedAsyncClient
+from api.apihmac import create_auth_headers, serialize_body, validate_hmac_auth
+
+RAG_KEY = "load-test-rag-key"
+CONTEXT_KEY = "load-test-context-key"
+DIM = 64
+
+
+def fake_embedding(text: str) -> list:
+    """Embedding determinista a partir del hash del texto."""
+    seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:4], 'little')
+    return np.random.default_rng(seed).standard_normal(DIM).astype(np.float32).tolist()
+
+
+def build_stub_rag(latency: float) -> FastAPI:
+    """RAG server simulado: valida HMAC y responde tras una latencia fija."""
+    stub = FastAPI()
+
+    @stub.post("/getoneembedding")
+    async def getoneembedding(request: Request):
+        body_bytes = await request.body()
+        validate_hmac_auth(request, RAG_KEY, body_bytes)
+        await asyncio.sleep(latency)
+        query = (await request.json())["query"]
+        return {"embedding": fake_embedding(query)}
+
+    return stub
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(asgi_app, port: int) -> uvicorn.Server:
+    """Arranca uvicorn en un hilo aparte (con su propio event loop) y sin lifespan."""
+    server = uvicorn.Server(uvicorn.Config(asgi_app, host="127.0.0.1", port=port,
+                                           log_level="warning", lifespan="off"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def setup_context_app(workdir: str, rag_url: str):
+    """Prepara app.state del context server sin pasar por el lifespan (.env, logs)."""
+    import context_server
+    from sttcastdb import SttcastDB
+    from embeddingcache import QueryEmbeddingCache
+
+    index = faiss.IndexIDMap2(faiss.IndexFlatL2(DIM))
+    vectors = np.random.default_rng(0).standard_normal((1000, DIM)).astype(np.float32)
+    faiss.normalize_L2(vectors)
+    index.add_with_ids(vectors, np.arange(1, 1001, dtype=np.int64))
+
+    app = context_server.app
+    app.state.db = SttcastDB(os.path.join(workdir, "load.db"), create_if_not_exists=True)
+    app.state.index = index
+    app.state.index_lock = threading.Lock()
+    app.state.db_write_lock = threading.Lock()
+    app.state.rag_client = SignedAsyncClient(rag_url, RAG_KEY, client_id='context_server',
+                                             max_connections=100, max_keepalive_connections=100)
+    app.state.embedding_cache = QueryEmbeddingCache(model="stub", sqlite_path=os.path.join(workdir, "qcache.db"))
+    app.state.default_embedding_model = "stub"
+    app.state.embedding_space = {"model": "stub", "dim": DIM, "dimensions": None}
+    app.state.migration = None
+    app.state.index_generation = 0
+    app.state.corpus_generation = 0
+    context_server.CONTEXT_SERVER_API_KEY = CONTEXT_KEY
+    return app
+
+
+async def run_load(context_url: str, concurrency: int, prefix: str = "pregunta") -> list:
+    """Lanza `concurrency` consultas simultáneas y devuelve sus latencias."""
+    async with httpx.AsyncClient(timeout=300,
+                                 limits=httpx.Limits(max_connections=concurrency)) as client:
+        async def one(i: int) -> float:
+            payload = {"query": f"{prefix} {i}", "n_fragments": 10, "only_embedding": True}
+            headers = create_auth_headers(CONTEXT_KEY, "POST", "/getcontext", payload, "load_test")
+            start = time.perf_counter()
+            r = await client.post(f"{context_url}/getcontext",
+                                  content=serialize_body(payload).encode('utf-8'), headers=headers)
+            elapsed = time.perf_counter() - start
+            if r.status_code != 200:
+                raise RuntimeError(f"/getcontext devolvió {r.status_code}: {r.text}")
+            return elapsed
+
+        return await asyncio.gather(*(one(i) for i in range(concurrency)))
+
+
+def percentile(values: list, p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.2, help="Latencia del RAG simulado (s)")
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print(f"Carga de /getcontext: {args.concurrency} consultas concurrentes, RAG a {args.latency}s")
+    print("=" * 60)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        rag_port, ctx_port = free_port(), free_port()
+        rag_server = start_server(build_stub_rag(args.latency), rag_port)
+        app = setup_context_app(workdir, f"http://127.0.0.1:{rag_port}")
+        ctx_server = start_server(app, ctx_port)
+        try:
+            # Calentamiento: abre conexiones del pool
+            asyncio.run(run_load(f"http://127.0.0.1:{ctx_port}", 5, prefix="calentamiento"))
+            t0 = time.perf_counter()
+            latencies = asyncio.run(run_load(f"http://127.0.0.1:{ctx_port}", args.concurrency))
+            wall = time.perf_counter() - t0
+            # Misma ronda otra vez: ahora todos los embeddings deberían salir de la caché
+            cached_latencies = asyncio.run(run_load(f"http://127.0.0.1:{ctx_port}", args.concurrency))
+            cache_stats = app.state.embedding_cache.stats()
+        finally:
+            ctx_server.should_exit = True
+            rag_server.should_exit = True
+
+    p50 = percentile(latencies, 50)
+    p99 = percentile(latencies, 99)
+    print(f"  p50: {p50 * 1000:.1f} ms")
+    print(f"  p99: {p99 * 1000:.1f} ms")
+    print(f"  media: {statistics.mean(latencies) * 1000:.1f} ms, total: {wall:.2f} s")
+    print(f"  con caché: p50 {percentile(cached_latencies, 50) * 1000:.1f} ms, "
+          f"p99 {percentile(cached_latencies, 99) * 1000:.1f} ms "
+          f"(hit rate {cache_stats['hit_rate']:.0%})")
+    # Con llamadas bloqueantes el p99 crece como concurrency * latency;
+    # con el cliente asíncrono debe quedar del orden de la latencia del RAG
+    serialized = args.concurrency * args.latency
+    if p99 < serialized / 4:
+        print(f"✅ El event loop no se bloquea (p99 muy por debajo de {serialized:.1f} s en serie)")
+        return 0
+    print(f"❌ p99 cercano a la ejecución en serie ({serialized:.1f} s)")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
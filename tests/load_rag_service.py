@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Prueba de carga del RAG server con un backend de LLM simulado
+Mide la latencia de /health sin carga y con N llamadas a /relsearch en curso
+(cada una tarda `latency` segundos en el LLM). Con el backend asíncrono
+/health debe mantenerse plana; con --blocking se simula el comportamiento
+anterior (SDK síncrono dentro de un endpoint async) para comparar.
+También comprueba el tiempo máximo por endpoint (504) y la cancelación de la
+llamada al LLM cuando el cliente se desconecta.
+
+Uso:
+    python tests/load_rag_service.py [--concurrency 20] [--latency 2.0] [--blocking]
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import sys
+import time
+
+# Añadir el directorio raíz del proyecto y rag/ al path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+sys.path.insert(0, os.path.join(project_root, 'rag'))
+
+import httpx
+
+from api.apihmac import create_auth_headers, serialize_body
+from llmbackend import EndpointLimits, MockLLMBackend
+from load_context_server import free_port, percentile, start_server
+
+RAG_KEY = "load-test-rag-key"
+
+
+class BlockingMockBackend(MockLLMBackend):
+    """Simula el SDK síncrono: la latencia bloquea el bucle de eventos."""
+
+    async def chat(self, messages, model, json_mode=False, timeout=None):
+        self.calls += 1
+        self.max_in_flight = 1
+        time.sleep(self.latency)
+        return self.respond(messages, model)
+
+
+def setup_service(latency: float, blocking: bool):
+    """Configura los globales que el servicio fija en __main__."""
+    import sttcast_rag_service as svc
+    svc.RAG_SERVER_API_KEY = RAG_KEY
+    svc.OPENAI_GPT_MODEL = "mock-model"
+    svc.OPENAI_SUMMARIES_MODEL = "mock-model"
+    svc.OPENAI_EMBEDDING_MODEL = "mock-embedding"
+    svc.llm = (BlockingMockBackend if blocking else MockLLMBackend)(latency=latency)
+    svc.llm_limits = EndpointLimits(concurrency={"relsearch": 16}, timeouts={"relsearch": 60})
+    return svc
+
+
+def relsearch_payload(i: int) -> dict:
+    return {
+        "query": f"¿Qué se dijo sobre el telescopio número {i}?",
+        "embeddings": [{"tag": "Speaker 0", "epname": f"ep{i:03d}", "epdate": "2024-01-01",
+                        "start": 10.0, "end": 20.0, "content": f"Fragmento de contexto {i}"}],
+        "requester": f"10.0.0.{i % 250}",
+    }
+
+
+async def post_relsearch(client: httpx.AsyncClient, base: str, payload: dict, timeout=None) -> httpx.Response:
+    headers = create_auth_headers(RAG_KEY, "POST", "/relsearch", payload, "load_test")
+    return await client.post(f"{base}/relsearch", content=serialize_body(payload).encode('utf-8'),
+                             headers=headers, timeout=timeout)
+
+
+async def sample_health(client: httpx.AsyncClient, base: str, seconds: float, interval: float = 0.05) -> list:
+    latencies = []
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        t0 = time.perf_counter()
+        r = await client.get(f"{base}/health")
+        r.raise_for_status()
+        latencies.append(time.perf_counter() - t0)
+        await asyncio.sleep(interval)
+    return latencies
+
+
+async def run_load(base: str, concurrency: int, latency: float):
+    async with httpx.AsyncClient(timeout=120) as client:
+        baseline = await sample_health(client, base, 1.0)
+        started = time.perf_counter()
+        searches = [asyncio.create_task(post_relsearch(client, base, relsearch_payload(i)))
+                    for i in range(concurrency)]
+        await asyncio.sleep(0.2)
+        under_load = await sample_health(client, base, max(latency - 0.4, 0.5))
+        responses = await asyncio.gather(*searches)
+        elapsed = time.perf_counter() - started
+    return baseline, under_load, responses, elapsed
+
+
+async def check_timeout_and_disconnect(base: str, svc, latency: float) -> bool:
+    ok = True
+    async with httpx.AsyncClient(timeout=120) as client:
+        # Tiempo máximo del endpoint por debajo de la latencia del LLM -> 504
+        svc.llm_limits.timeouts["relsearch"] = latency / 4
+        r = await post_relsearch(client, base, relsearch_payload(900))
+        svc.llm_limits.timeouts["relsearch"] = 60
+        print(f"  {'✅' if r.status_code == 504 else '❌'} Tiempo máximo superado -> {r.status_code}")
+        ok &= r.status_code == 504
+
+        # El cliente abandona: la llamada al LLM debe cancelarse
+        cancelled_before = svc.llm.cancelled
+        try:
+            await post_relsearch(client, base, relsearch_payload(901), timeout=latency / 4)
+        except httpx.TimeoutException:
+            pass
+        await asyncio.sleep(1.0)
+        cancelled = svc.llm.cancelled - cancelled_before
+        print(f"  {'✅' if cancelled == 1 else '❌'} Cliente desconectado -> llamada al LLM cancelada "
+              f"({cancelled} cancelada, {svc.llm.in_flight} en curso)")
+        ok &= cancelled == 1 and svc.llm.in_flight == 0
+    return ok
+
+
+def summary(label: str, values: list) -> str:
+    ms = [v * 1000 for v in values]
+    return (f"{label}: n={len(ms)} p50={statistics.median(ms):.1f}ms "
+            f"p95={percentile(ms, 95):.1f}ms max={max(ms):.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=20, help="Llamadas a /relsearch simultáneas")
+    parser.add_argument("--latency", type=float, default=2.0, help="Latencia simulada del LLM (s)")
+    parser.add_argument("--blocking", action="store_true", help="Simular el SDK síncrono (comportamiento anterior)")
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    svc = setup_service(args.latency, args.blocking)
+    port = free_port()
+    server = start_server(svc.app, port)
+    base = f"http://127.0.0.1:{port}"
+    print("=" * 60)
+    print(f"/health con {args.concurrency} /relsearch en curso "
+          f"(LLM {'bloqueante' if args.blocking else 'asíncrono'}, {args.latency}s)")
+    print("=" * 60)
+    try:
+        baseline, under_load, responses, elapsed = asyncio.run(run_load(base, args.concurrency, args.latency))
+        print("  " + summary("Sin carga  ", baseline))
+        print("  " + summary("Con carga  ", under_load))
+        failed = [r.status_code for r in responses if r.status_code != 200]
+        print(f"  {len(responses) - len(failed)}/{len(responses)} /relsearch correctas en {elapsed:.2f}s "
+              f"(máx. {svc.llm.max_in_flight} simultáneas en el LLM)")
+
+        flat = percentile(under_load, 95) <= percentile(baseline, 95) + 0.05
+        print(f"  {'✅' if flat else '❌'} Latencia de /health {'estable' if flat else 'degradada'} durante la carga")
+        ok = not failed
+        if not args.blocking:
+            ok &= flat and asyncio.run(check_timeout_and_disconnect(base, svc, args.latency))
+    finally:
+        server.should_exit = True
+    print("=" * 60)
+    print("✅ Prueba superada" if ok else "❌ Prueba fallida")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Validación de la ejecución compartida de preguntas idénticas (rag/client/askpipeline.py)
+Con un pipeline simulado que cuenta las llamadas al LLM y las filas guardadas
+comprueba que:
+- N preguntas idénticas simultáneas (con otros espacios) hacen una sola
+  llamada al LLM y un solo guardado, y todas reciben la misma respuesta,
+- quien se une a mitad de una respuesta en streaming recibe también los
+  deltas anteriores,
+- la misma pregunta en otro idioma no se comparte,
+- la respuesta se reutiliza durante el TTL y después se vuelve a calcular,
+- los errores no se conservan,
+- el pipeline sigue mientras quede alguien esperando y se cancela cuando
+  se van todos,
+- el embedding de la pregunta se pide una sola vez aunque lleguen varias a la vez.
+
+Uso:
+    python tests/validate_ask_single_flight.py [--askers 50] [--latency 0.3]
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import sys
+
+# Añadir el directorio raíz del proyecto y rag/client/ al path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+sys.path.insert(0, os.path.join(project_root, 'rag', 'client'))
+
+from askpipeline import AskSingleFlight, QuestionEmbedding, QuestionEmbeddingCache
+
+QUESTION = "¿Qué se dijo sobre el telescopio James Webb?"
+
+
+class FakePipeline:
+    """Pipeline simulado: deltas del LLM, guardado con id y errores a demanda."""
+
+    def __init__(self, latency: float, deltas: int = 5):
+        self.latency = latency
+        self.deltas = deltas
+        self.llm_calls = 0
+        self.saved = 0
+        self.cancelled = 0
+        self.fail = False
+
+    def __call__(self, question: str):
+        async def events(flight):
+            self.llm_calls += 1
+            try:
+                for i in range(self.deltas):
+                    await asyncio.sleep(self.latency / self.deltas)
+                    yield "delta", {"lang": "es", "text": f"parte {i} "}
+            except asyncio.CancelledError:
+                self.cancelled += 1
+                raise
+            if self.fail:
+                yield "error", {"status": 502, "detail": "Error al realizar búsqueda: 500"}
+                return
+            self.saved += 1
+            flight.meta["query_id"] = self.saved
+            yield "result", {"success": True, "response": {"es": f"Respuesta a {question}"}, "query_id": self.saved}
+        return events
+
+
+async def collect(flight) -> list:
+    return [event async for event in flight.follow()]
+
+
+async def check_concurrent(askers: int, latency: float) -> bool:
+    print(f"✓ Probando {askers} preguntas idénticas simultáneas...")
+    flights = AskSingleFlight(ttl_seconds=30)
+    pipeline = FakePipeline(latency)
+    variants = [QUESTION, f"  {QUESTION} ", QUESTION.replace(" ", "  ")]
+    joined = [flights.join(variants[i % len(variants)], "es", pipeline(QUESTION)) for i in range(askers)]
+    results = await asyncio.gather(*(collect(flight) for flight, _ in joined))
+    roles = [role for _, role in joined]
+    same = all(events == results[0] for events in results) and results[0][-1][0] == "result"
+    ok = pipeline.llm_calls == 1 and pipeline.saved == 1 and same and roles.count("started") == 1
+    print(f"  {'✅' if ok else '❌'} {pipeline.llm_calls} llamada al LLM y {pipeline.saved} guardado para {askers} "
+          f"preguntas; todas con la misma respuesta ({len(results[0]) - 1} deltas)")
+
+    other = flights.join(QUESTION, "en", pipeline(QUESTION))
+    await collect(other[0])
+    by_language = other[1] == "started" and pipeline.llm_calls == 2
+    print(f"  {'✅' if by_language else '❌'} Misma pregunta en inglés: ejecución propia")
+    print(f"  Estadísticas: {flights.stats()}")
+    return ok and by_language
+
+
+async def check_late_stream_joiner(latency: float) -> bool:
+    print("✓ Probando quien se une a mitad de una respuesta en streaming...")
+    flights = AskSingleFlight(ttl_seconds=30)
+    pipeline = FakePipeline(latency, deltas=10)
+    leader, _ = flights.join(QUESTION, "es", pipeline(QUESTION))
+    first = asyncio.ensure_future(collect(leader))
+    await asyncio.sleep(latency / 2)
+    produced = len(leader.events)
+    late, role = flights.join(QUESTION, "es", pipeline(QUESTION))
+    late_events = await collect(late)
+    ok = role == "joined" and 0 < produced < 10 and late_events == await first and pipeline.llm_calls == 1
+    print(f"  {'✅' if ok else '❌'} Unida tras {produced} deltas: recibe los {len(late_events) - 1} deltas y la respuesta")
+    return ok
+
+
+async def check_ttl_and_errors(latency: float) -> bool:
+    print("✓ Probando el TTL de las respuestas y los errores...")
+    clock = [0.0]
+    flights = AskSingleFlight(ttl_seconds=30, clock=lambda: clock[0])
+    pipeline = FakePipeline(latency / 10)
+    await collect(flights.join(QUESTION, "es", pipeline(QUESTION))[0])
+
+    clock[0] = 10
+    flight, role = flights.join(QUESTION, "es", pipeline(QUESTION))
+    reused_events = await collect(flight)
+    reused = role == "reused" and pipeline.llm_calls == 1 and [e for e, _ in reused_events] == ["result"]
+    clock[0] = 41
+    role_after_ttl = flights.join(QUESTION, "es", pipeline(QUESTION))
+    await collect(role_after_ttl[0])
+    expired = role_after_ttl[1] == "started" and pipeline.llm_calls == 2
+    print(f"  {'✅' if reused else '❌'} A los 10 s: respuesta reutilizada sin llamar al LLM")
+    print(f"  {'✅' if expired else '❌'} Pasado el TTL: se vuelve a calcular")
+
+    failing = FakePipeline(latency / 10)
+    failing.fail = True
+    error_events = await collect(flights.join("Otra pregunta", "es", failing("Otra pregunta"))[0])
+    failing.fail = False
+    retry, role = flights.join("Otra pregunta", "es", failing("Otra pregunta"))
+    await collect(retry)
+    errors = error_events[-1][0] == "error" and role == "started" and failing.llm_calls == 2
+    print(f"  {'✅' if errors else '❌'} Un error no se conserva: la siguiente pregunta vuelve a intentarlo")
+    return reused and expired and errors
+
+
+async def check_cancellation(latency: float) -> bool:
+    print("✓ Probando la cancelación cuando los clientes se van...")
+    flights = AskSingleFlight(ttl_seconds=30)
+    pipeline = FakePipeline(latency)
+
+    # Uno de dos se va: el pipeline sigue para el otro
+    flight, _ = flights.join(QUESTION, "es", pipeline(QUESTION))
+    leaving = asyncio.ensure_future(collect(flight))
+    staying = asyncio.ensure_future(collect(flights.join(QUESTION, "es", pipeline(QUESTION))[0]))
+    await asyncio.sleep(latency / 3)
+    leaving.cancel()
+    events = await staying
+    kept = events[-1][0] == "result" and pipeline.cancelled == 0
+
+    # Se van todos: se cancela
+    flight, _ = flights.join("Pregunta abandonada", "es", pipeline("Pregunta abandonada"))
+    waiters = [asyncio.ensure_future(collect(flight)) for _ in range(3)]
+    await asyncio.sleep(latency / 3)
+    for waiter in waiters:
+        waiter.cancel()
+    await asyncio.sleep(0.05)
+    cancelled = (pipeline.cancelled == 1 and flight.done and flights.stats()["cancelled"] == 1
+                 and flights.join("Pregunta abandonada", "es", pipeline("Pregunta abandonada"))[1] == "started")
+    print(f"  {'✅' if kept else '❌'} Uno de dos clientes se desconecta: el otro recibe la respuesta")
+    print(f"  {'✅' if cancelled else '❌'} Se desconectan todos: pipeline cancelado y no se conserva")
+    return kept and cancelled
+
+
+async def check_embedding_fetch(askers: int, latency: float) -> bool:
+    print("✓ Probando el embedding de preguntas simultáneas...")
+    calls = []
+
+    async def fetch(question):
+        calls.append(question)
+        await asyncio.sleep(latency / 3)
+        return [1.0, 0.0], "modelo", 3, 7
+
+    cache = QuestionEmbeddingCache()
+    vectors = await asyncio.gather(*(QuestionEmbedding(QUESTION, fetch, cache).get() for _ in range(askers)))
+    ok = len(calls) == 1 and all(v == [1.0, 0.0] for v in vectors) and cache.stats()["coalesced"] == askers - 1
+    print(f"  {'✅' if ok else '❌'} {len(calls)} petición al context server para {askers} preguntas")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--askers", type=int, default=50, help="Preguntas idénticas simultáneas")
+    parser.add_argument("--latency", type=float, default=0.3, help="Latencia simulada del LLM (s)")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    print("=" * 60)
+    print("Validación de la ejecución compartida de preguntas")
+    print("=" * 60)
+    results = [
+        asyncio.run(check_concurrent(args.askers, args.latency)),
+        asyncio.run(check_late_stream_joiner(args.latency)),
+        asyncio.run(check_ttl_and_errors(args.latency)),
+        asyncio.run(check_cancellation(args.latency)),
+        asyncio.run(check_embedding_fetch(args.askers, args.latency)),
+    ]
+    print("=" * 60)
+    if all(results):
+        print("✅ Todas las pruebas pasaron")
+        return 0
+    print("❌ Algunas pruebas fallaron")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
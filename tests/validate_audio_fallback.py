@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+Validación y benchmark del AudioFallbackMiddleware (rag/client/middleware_audio_fallback.py)
+Comprueba que el script se inserta en el mismo sitio que con el HTML completo
+aunque '</body>' llegue partido entre bloques, que Content-Length se corrige,
+que no se tocan las respuestas que no son HTML, las de Range, las 206 ni las
+comprimidas, que un HEAD anuncia la misma longitud que el GET, y mide sobre una transcripción de 5 MB el tiempo
+hasta el primer byte (TTFB) y el pico de memoria frente al middleware anterior,
+que acumulaba la respuesta completa.
+
+Uso:
+    python tests/validate_audio_fallback.py [--size-mb 5]
+"""
+
+import argparse
+import asyncio
+import hashlib
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Añadir el directorio raíz del proyecto y rag/client/ al path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+sys.path.insert(0, os.path.join(project_root, 'rag', 'client'))
+
+import httpx
+from fastapi import FastAPI
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.responses import FileResponse, StreamingResponse
+
+from load_context_server import free_port, start_server
+from middleware_audio_fallback import FALLBACK_SCRIPT, AudioFallbackMiddleware
+
+SCRIPT = FALLBACK_SCRIPT.decode()
+
+
+class BufferedFallbackMiddleware(BaseHTTPMiddleware):
+    """El middleware anterior (acumula el cuerpo completo), como referencia del benchmark."""
+
+    async def dispatch(self, request, call_next):
+        response = await call_next(request)
+        if 'text/html' not in response.headers.get('content-type', '').lower():
+            return response
+        body = b""
+        async for chunk in response.body_iterator:
+            body += chunk
+        html = body.decode('utf-8').replace('</body>', SCRIPT + '</body>')
+        headers = dict(response.headers)
+        headers.pop('content-length', None)
+        return StreamingResponse(iter([html.encode('utf-8')]), status_code=response.status_code,
+                                 headers=headers, media_type=response.media_type)
+
+
+def run_asgi(chunks: list, headers: list, status: int = 200, method: str = "GET",
+             request_headers: list = None, pathsend: str = None) -> tuple:
+    """Pasa una respuesta por el middleware sin servidor. Devuelve (status, cabeceras, cuerpo)."""
+
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        if pathsend:
+            await send({"type": "http.response.pathsend", "path": pathsend})
+            return
+        for i, chunk in enumerate(chunks):
+            await send({"type": "http.response.body", "body": chunk, "more_body": i < len(chunks) - 1})
+
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    scope = {"type": "http", "method": method, "path": "/", "headers": request_headers or [],
+             "extensions": {"http.response.pathsend": {}} if pathsend else {}}
+    asyncio.run(AudioFallbackMiddleware(app)(scope, receive, send))
+    start = sent[0]
+    body = b"".join(m.get("body", b"") for m in sent[1:])
+    return start["status"], dict(start["headers"]), body
+
+
+def html_headers(length: int) -> list:
+    return [(b"content-type", b"text/html; charset=utf-8"), (b"content-length", str(length).encode())]
+
+
+def split(data: bytes, size: int) -> list:
+    return [data[i:i + size] for i in range(0, len(data), size)] or [b""]
+
+
+def test_boundaries() -> bool:
+    print("✓ Probando la inserción con '</body>' partido entre bloques...")
+    docs = {
+        "</body>": ("<html><head></head><body><p>Transcripción ñ</p>\n</body>\n</html>",
+                    lambda d: d.replace("</body>", SCRIPT + "</body>")),
+        "</BODY>": ("<HTML><BODY><P>Antiguo</P></BODY></HTML>",
+                    lambda d: d.replace("</BODY>", SCRIPT + "</BODY>")),
+        "solo </html>": ("<html><p>Sin body</p></html>", lambda d: d.replace("</html>", SCRIPT + "</html>")),
+        "</body> tras </html>": ("<html><p>Mal formado</p></html></body>",
+                                 lambda d: d.replace("</body>", SCRIPT + "</body>")),
+        "sin cierre": ("<p>Fragmento</p>", lambda d: d + SCRIPT),
+    }
+    ok = True
+    for name, (doc, expected) in docs.items():
+        data = doc.encode()
+        want = expected(doc).encode()
+        results = [run_asgi(split(data, size), html_headers(len(data))) for size in range(1, 17)]
+        result = all(body == want and int(headers[b"content-length"]) == len(body)
+                     for _, headers, body in results)
+        ok &= result
+        print(f"  {'✅' if result else '❌'} {name}: bloques de 1 a 16 bytes, Content-Length corregido")
+
+    # Sin Content-Length (chunked) la respuesta sigue sin él
+    _, headers, body = run_asgi([b"<body>", b"</bo", b"dy>"], [(b"content-type", b"text/html")])
+    chunked = b"content-length" not in headers and body == b"<body>" + FALLBACK_SCRIPT + b"</body>"
+    ok &= chunked
+    print(f"  {'✅' if chunked else '❌'} Respuesta sin Content-Length: se mantiene en chunked")
+    return ok
+
+
+def test_skipped(workdir: str) -> bool:
+    print("✓ Probando las respuestas que no se modifican...")
+    page = b"<html><body>x</body></html>"
+    cases = {
+        "CSS": run_asgi([b"body{}"], [(b"content-type", b"text/css"), (b"content-length", b"6")]),
+        "petición Range": run_asgi([page], html_headers(len(page)), request_headers=[(b"range", b"bytes=0-9")]),
+        "206": run_asgi([page], html_headers(len(page)), status=206),
+        "gzip": run_asgi([page], html_headers(len(page)) + [(b"content-encoding", b"gzip")]),
+    }
+    ok = True
+    for name, (_, headers, body) in cases.items():
+        untouched = FALLBACK_SCRIPT not in body and headers.get(b"content-length") == str(len(body)).encode()
+        ok &= untouched
+        print(f"  {'✅' if untouched else '❌'} {name}: sin cambios")
+
+    _, headers, body = run_asgi([b""], html_headers(len(page)), method="HEAD")
+    head = body == b"" and int(headers[b"content-length"]) == len(page) + len(FALLBACK_SCRIPT)
+    print(f"  {'✅' if head else '❌'} HEAD: sin cuerpo, Content-Length igual que el del GET")
+
+    path = os.path.join(workdir, "pathsend.html")
+    with open(path, "wb") as f:
+        f.write(page)
+    _, headers, body = run_asgi([], html_headers(len(page)), pathsend=path)
+    pathsend = body == page.replace(b"</body>", FALLBACK_SCRIPT + b"</body>")
+    print(f"  {'✅' if pathsend else '❌'} http.response.pathsend: archivo leído por bloques e inyectado")
+    return ok and head and pathsend
+
+
+def synthetic_transcript(size: int) -> bytes:
+    paragraph = ('<p><span class="time" id="time-00-00-00">[00:00:00]</span><br>'
+                 '<span class="high">palabra</span> ' * 20 + '</p>\n').encode()
+    body = paragraph * (size // len(paragraph))
+    return b"<html><body>\n" + body + b"</body></html>"
+
+
+def build_app(middleware, html: bytes, path: str) -> FastAPI:
+    app = FastAPI()
+    app.add_middleware(middleware)
+
+    @app.get("/s3")
+    async def from_storage():
+        # Bloques de 64 KB que llegan poco a poco, como desde el proxy de S3
+        async def chunks():
+            for i in range(0, len(html), 64 * 1024):
+                await asyncio.sleep(0.002)
+                yield html[i:i + 64 * 1024]
+        return StreamingResponse(chunks(), media_type="text/html; charset=utf-8",
+                                 headers={"content-length": str(len(html))})
+
+    @app.get("/local")
+    async def from_disk():
+        return FileResponse(path, media_type="text/html; charset=utf-8")
+
+    return app
+
+
+def measure(url: str) -> tuple:
+    """(TTFB en ms, total en ms, pico de memoria en MB, sha256 del cuerpo)"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    ttfb = None
+    # El cliente no guarda el cuerpo: el pico es el de los dos lados del servidor
+    digest = hashlib.sha256()
+    with httpx.stream("GET", url, timeout=60) as response:
+        for chunk in response.iter_raw():
+            if ttfb is None:
+                ttfb = time.perf_counter() - start
+            digest.update(chunk)
+    total = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return ttfb * 1000, total * 1000, peak / 1e6, digest.hexdigest()
+
+
+def test_benchmark(workdir: str, size_mb: float) -> bool:
+    html = synthetic_transcript(int(size_mb * 1e6))
+    path = os.path.join(workdir, "transcript.html")
+    with open(path, "wb") as f:
+        f.write(html)
+    print(f"✓ Benchmark con una transcripción de {len(html) / 1e6:.1f} MB...")
+    expected = hashlib.sha256(html.replace(b"</body>", FALLBACK_SCRIPT + b"</body>")).hexdigest()
+    servers, results = [], {}
+    try:
+        for name, middleware in (("anterior", BufferedFallbackMiddleware), ("streaming", AudioFallbackMiddleware)):
+            port = free_port()
+            servers.append(start_server(build_app(middleware, html, path), port))
+            for route in ("s3", "local"):
+                measure(f"http://127.0.0.1:{port}/{route}")  # calentamiento
+                results[(name, route)] = measure(f"http://127.0.0.1:{port}/{route}")
+    finally:
+        for server in servers:
+            server.should_exit = True
+
+    print(f"  {'':22}{'TTFB':>10}{'total':>10}{'pico memoria':>15}")
+    ok = True
+    for route in ("s3", "local"):
+        old, new = results[("anterior", route)], results[("streaming", route)]
+        for name, (ttfb, total, peak, _) in (("anterior", old), ("streaming", new)):
+            print(f"  {route + ' / ' + name:22}{ttfb:>8.1f}ms{total:>8.1f}ms{peak:>12.1f} MB")
+        same = old[3] == new[3] == expected
+        better = new[0] < old[0] / 2 and new[2] < old[2] / 4
+        ok &= same and better
+        print(f"  {'✅' if same else '❌'} Mismo HTML resultante; "
+              f"{'✅' if better else '❌'} TTFB x{old[0] / max(new[0], 0.01):.0f} menor, "
+              f"memoria x{old[2] / max(new[2], 0.01):.0f} menor")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=float, default=5, help="Tamaño de la transcripción del benchmark")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    print("=" * 60)
+    print("Validación del middleware de fallback de audios")
+    print("=" * 60)
+    with tempfile.TemporaryDirectory() as workdir:
+        results = [
+            test_boundaries(),
+            test_skipped(workdir),
+            test_benchmark(workdir, args.size_mb),
+        ]
+    print("=" * 60)
+    if all(results):
+        print("✅ Todas las pruebas pasaron")
+        return 0
+    print("❌ Algunas pruebas fallaron")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Validación del backfill de embeddings (db/backfill_embeddings.py)
+Usa el embedder local determinista: comprueba lotes por presupuesto de tokens,
+checkpoint tras una interrupción, reanudación y recálculo de embeddings obsoletos.
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+# Añadir el directorio raíz del proyecto (y db/ para sttcastdb) al path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+sys.path.insert(0, os.path.join(project_root, 'db'))
+
+import numpy as np
+
+from sttcastdb import SttcastDB
+from backfill_embeddings import FakeEmbedder, estimate_tokens, iter_batches, row_to_segment, run_backfill
+
+N_EPISODES = 5
+N_INTS = 300
+
+
+class FailingEmbedder(FakeEmbedder):
+    """Embedder que falla en la llamada número `fail_on` (simula una interrupción)."""
+
+    def __init__(self, dim: int, fail_on: int):
+        super().__init__(dim)
+        self.fail_on = fail_on
+
+    async def embed(self, segments):
+        if self.calls + 1 == self.fail_on:
+            self.calls += 1
+            raise RuntimeError("fallo simulado")
+        return await super().embed(segments)
+
+
+def make_db(path: str) -> SttcastDB:
+    db = SttcastDB(path, create_if_not_exists=True)
+    for e in range(N_EPISODES):
+        ints = [{"tag": f"Speaker {i % 3}", "start": float(i), "end": float(i + 1),
+                 "content": f"intervención {i} del episodio {e} " * (1 + i % 7)}
+                for i in range(N_INTS)]
+        db.add_episode(f"ep{e:03d}", datetime(2024, 1, 1) + timedelta(days=e), f"ep{e:03d}.mp3", ints)
+    return db
+
+
+def pending(db: SttcastDB) -> int:
+    return db.conn.execute("SELECT COUNT(*) FROM speakerintervention WHERE embedding IS NULL").fetchone()[0]
+
+
+def test_token_budget(db: SttcastDB) -> bool:
+    print("✓ Probando agrupación por presupuesto de tokens...")
+    rows = list(db.iter_ints_to_embed(page_size=100))
+    batches = list(iter_batches(rows, token_budget=2000, max_items=50))
+    sizes = [sum(estimate_tokens(s) for s in segs) for _, segs in batches]
+    flat_ids = [i for ids, _ in batches for i in ids]
+    ok = (flat_ids == [r["id"] for r in rows]
+          and all(t <= 2000 or len(segs) == 1 for t, (_, segs) in zip(sizes, batches))
+          and all(len(segs) <= 50 for _, segs in batches))
+    print(f"  {'✅' if ok else '❌'} {len(rows)} segmentos en {len(batches)} lotes (máx. {max(sizes)} tokens)")
+    return ok
+
+
+def test_interrupt_and_resume(db: SttcastDB) -> bool:
+    print("✓ Probando interrupción y reanudación...")
+    try:
+        asyncio.run(run_backfill(db, FailingEmbedder(32, fail_on=5), "fake-32",
+                                 token_budget=3000, concurrency=3, page_size=128))
+        print("  ❌ La interrupción simulada no se propagó")
+        return False
+    except RuntimeError:
+        pass
+
+    checkpoint = db.get_checkpoint("embeddings:fake-32")
+    below = db.conn.execute(
+        "SELECT COUNT(*) FROM speakerintervention WHERE id <= ? AND embedding IS NULL", (checkpoint,)
+    ).fetchone()[0]
+    if checkpoint == 0 or below != 0 or pending(db) == 0:
+        print(f"  ❌ Checkpoint inconsistente: {checkpoint} (pendientes por debajo: {below})")
+        return False
+    print(f"  ✅ Checkpoint en el id {checkpoint}, {pending(db)} intervenciones pendientes")
+
+    embedder = FakeEmbedder(32)
+    stats = asyncio.run(run_backfill(db, embedder, "fake-32", token_budget=3000, concurrency=3, page_size=128))
+    total = N_EPISODES * N_INTS
+    if pending(db) != 0 or stats["checkpoint"] != total:
+        print(f"  ❌ Quedan {pending(db)} pendientes tras reanudar ({stats})")
+        return False
+
+    # Los vectores guardados son los del embedder determinista, normalizados
+    row = db.conn.execute(
+        "SELECT si.id, si.embedding FROM speakerintervention si ORDER BY si.id DESC LIMIT 1"
+    ).fetchone()
+    seg_row = next(db.iter_ints_to_embed(after_id=row["id"] - 1, model="otro"))
+    expected = np.array(embedder.vector_for(row_to_segment(seg_row)), dtype=np.float32)
+    expected /= np.linalg.norm(expected)
+    if not np.allclose(np.frombuffer(row["embedding"], dtype=np.float32), expected, atol=1e-6):
+        print("  ❌ El embedding guardado no coincide con el esperado")
+        return False
+
+    again = asyncio.run(run_backfill(db, FakeEmbedder(32), "fake-32"))
+    if again["segments"] != 0:
+        print(f"  ❌ Una segunda ejecución volvió a procesar {again['segments']} segmentos")
+        return False
+    print(f"  ✅ Reanudado: {stats['segments']} segmentos en {stats['batches']} lotes; nada pendiente después")
+    return True
+
+
+def test_reembed_stale(db: SttcastDB) -> bool:
+    print("✓ Probando recálculo de embeddings de otro modelo...")
+    stats = asyncio.run(run_backfill(db, FakeEmbedder(16), "fake-16", reembed_stale=True, concurrency=2))
+    models = db.conn.execute("SELECT DISTINCT embedding_model FROM speakerintervention").fetchall()
+    ok = stats["segments"] == N_EPISODES * N_INTS and [m[0] for m in models] == ["fake-16"]
+    print(f"  {'✅' if ok else '❌'} {stats['segments']} embeddings recalculados, modelos: {[m[0] for m in models]}")
+    return ok
+
+
+def main():
+    logging.disable(logging.INFO)
+    print("=" * 60)
+    print("Validación del backfill de embeddings")
+    print("=" * 60)
+    with tempfile.TemporaryDirectory() as workdir:
+        db = make_db(os.path.join(workdir, "backfill.db"))
+        results = [test_token_budget(db), test_interrupt_and_resume(db), test_reembed_stale(db)]
+        db.close()
+    print("=" * 60)
+    if all(results):
+        print("✅ Todas las pruebas pasaron")
+        return 0
+    print("❌ Algunas pruebas fallaron")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
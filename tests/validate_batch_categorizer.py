@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Validación y benchmark de la categorización en lote (rag/client/categorizer.py)
+Con embeddings sintéticos (cada consulta cerca de una o dos categorías)
+comprueba que:
+- el producto de matrices asigna lo mismo que comparar consulta a consulta,
+- se respetan top-k y el umbral, ordenadas por similitud,
+- las consultas sin categoría por encima del umbral quedan como de baja
+  confianza (las únicas que irían al LLM),
+- los vectores sin normalizar o nulos no rompen el cálculo,
+y mide el tiempo con 10k consultas frente al bucle consulta a consulta.
+
+Uso:
+    python tests/validate_batch_categorizer.py [--queries 10000] [--categories 40] [--dim 1536]
+"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+
+# Añadir el directorio raíz del proyecto y rag/client/ al path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+sys.path.insert(0, os.path.join(project_root, 'rag', 'client'))
+
+import numpy as np
+
+from categorizer import match_categories, normalize_rows
+
+
+def synthetic(n_queries: int, n_categories: int, dim: int, seed: int = 0):
+    """Categorías aleatorias y consultas mezcla de 1-2 categorías más ruido (un 10 % solo ruido)."""
+    rng = np.random.default_rng(seed)
+    categories = normalize_rows(rng.standard_normal((n_categories, dim)))
+    first = rng.integers(0, n_categories, n_queries)
+    second = rng.integers(0, n_categories, n_queries)
+    mix = np.where(rng.random(n_queries) < 0.5, 0.0, 0.6)[:, None]
+    queries = categories[first] + mix * categories[second] + 0.8 * normalize_rows(rng.standard_normal((n_queries, dim)))
+    queries[rng.random(n_queries) < 0.1] = rng.standard_normal((1, dim))
+    # Escalas distintas: el emparejamiento no debe depender de la norma
+    queries *= rng.uniform(0.5, 3.0, (n_queries, 1))
+    return list(range(1, n_queries + 1)), queries.astype(np.float32), list(range(101, 101 + n_categories)), categories
+
+
+def per_query(query_ids, queries, category_ids, categories, top_k, threshold):
+    """Referencia: una consulta cada vez, como el flujo anterior."""
+    assignments, low = [], []
+    cats = normalize_rows(categories)
+    for query_id, vector in zip(query_ids, queries):
+        norm = np.linalg.norm(vector)
+        scores = cats @ (vector / norm) if norm else np.zeros(len(category_ids), dtype=np.float32)
+        ranked = sorted(zip(category_ids, scores), key=lambda item: -item[1])[:top_k]
+        if ranked[0][1] < threshold:
+            low.append((query_id, float(ranked[0][1])))
+            continue
+        assignments += [(query_id, c, float(s)) for c, s in ranked if s >= threshold]
+    return assignments, low
+
+
+def same(a, b) -> bool:
+    return len(a) == len(b) and all(x[:-1] == y[:-1] and abs(x[-1] - y[-1]) < 1e-4 for x, y in zip(a, b))
+
+
+def check_correctness(dim: int) -> bool:
+    print("✓ Probando las asignaciones frente al cálculo consulta a consulta...")
+    ok = True
+    for top_k, threshold in ((1, 0.5), (2, 0.5), (3, 0.3), (50, 0.0)):
+        data = synthetic(2000, 12, dim, seed=top_k)
+        matches = match_categories(*data, top_k=top_k, threshold=threshold)
+        ref_assignments, ref_low = per_query(*data, top_k, threshold)
+        result = same(matches.assignments, ref_assignments) and same(matches.low_confidence, ref_low)
+        ok &= result
+        print(f"  {'✅' if result else '❌'} top_k={top_k} umbral={threshold}: {len(matches.assignments)} asignaciones, "
+              f"{matches.categorized} consultas, {len(matches.low_confidence)} de baja confianza")
+
+    query_ids, queries, category_ids, categories = synthetic(500, 8, dim)
+    matches = match_categories(query_ids, queries, category_ids, categories, top_k=2, threshold=0.5)
+    by_query = {}
+    for query_id, category_id, similarity in matches.assignments:
+        by_query.setdefault(query_id, []).append(similarity)
+    rules = (all(len(s) <= 2 and min(s) >= 0.5 and s == sorted(s, reverse=True) for s in by_query.values())
+             and all(similarity < 0.5 and query_id not in by_query for query_id, similarity in matches.low_confidence)
+             and len(by_query) + len(matches.low_confidence) == len(query_ids))
+    print(f"  {'✅' if rules else '❌'} Como mucho top-k por consulta, todas >= umbral y en orden; "
+          f"el resto, de baja confianza")
+
+    queries[0] = 0
+    edge = match_categories(query_ids[:3], queries[:3], category_ids, categories, top_k=2, threshold=0.5)
+    empty = match_categories(query_ids[:3], queries[:3], [], np.empty((0, dim)), top_k=2, threshold=0.5)
+    edges = ((1, 0.0) in edge.low_confidence and not empty.assignments
+             and [q for q, _ in empty.low_confidence] == query_ids[:3])
+    print(f"  {'✅' if edges else '❌'} Vector nulo y sin categorías: baja confianza, sin errores")
+    return ok and rules and edges
+
+
+def check_benchmark(n_queries: int, n_categories: int, dim: int) -> bool:
+    print(f"✓ Benchmark con {n_queries} consultas, {n_categories} categorías y dimensión {dim}...")
+    data = synthetic(n_queries, n_categories, dim)
+    start = time.perf_counter()
+    matches = match_categories(*data, top_k=2, threshold=0.5)
+    batch = time.perf_counter() - start
+    sample = min(n_queries, 1000)
+    start = time.perf_counter()
+    per_query(data[0][:sample], data[1][:sample], data[2], data[3], 2, 0.5)
+    loop = (time.perf_counter() - start) * n_queries / sample
+    ok = batch < 5.0 and batch < loop
+    print(f"  Lote: {batch:.3f}s; consulta a consulta: {loop:.2f}s (estimado con {sample})")
+    print(f"  {'✅' if ok else '❌'} {matches.categorized} categorizadas, {len(matches.low_confidence)} para el LLM, "
+          f"x{loop / batch:.0f} más rápido")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--queries", type=int, default=10000, help="Consultas del benchmark")
+    parser.add_argument("--categories", type=int, default=40, help="Categorías del benchmark")
+    parser.add_argument("--dim", type=int, default=1536, help="Dimensión de los embeddings")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    print("=" * 60)
+    print("Validación de la categorización en lote")
+    print("=" * 60)
+    results = [
+        check_correctness(args.dim),
+        check_benchmark(args.queries, args.categories, args.dim),
+    ]
+    print("=" * 60)
+    if all(results):
+        print("✅ Todas las pruebas pasaron")
+        return 0
+    print("❌ Algunas pruebas fallaron")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Validación de la capa de lotes de embeddings del RAG server (rag/embedder.py)
+Usa el embedder local determinista: comprueba la división por tokens, el orden
+de los resultados, la caché persistente, la deduplicación, los reintentos y que
+tokenizar y consultar la caché de un lote grande no bloquea el event loop.
+
+Uso:
+    python tests/validate_batch_embedder.py
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+
+# Añadir rag/ al path (el servicio importa el módulo como `embedder`)
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(project_root, 'rag'))
+
+import numpy as np
+
+from embedder import BatchEmbedder, EmbeddingCache, FakeEmbeddingClient, count_tokens
+
+MODEL = "fake-model"
+
+
+class FlakyClient(FakeEmbeddingClient):
+    """Cliente que falla las primeras `failures` llamadas (429 simulado)."""
+
+    def __init__(self, dim: int, failures: int, status_code: int = 429):
+        super().__init__(dim)
+        self.failures = failures
+        self.status_code = status_code
+
+    async def embed(self, texts, model, dimensions=None):
+        if self.failures > 0:
+            self.failures -= 1
+            error = RuntimeError(f"error simulado {self.status_code}")
+            error.status_code = self.status_code
+            raise error
+        return await super().embed(texts, model, dimensions)
+
+
+def make_texts(n: int) -> list:
+    return [f"Intervención {i}: " + "palabra " * (20 + i % 50) for i in range(n)]
+
+
+def test_batching_and_order() -> bool:
+    print("✓ Probando división por tokens y orden de resultados...")
+    texts = make_texts(300)
+    client = FakeEmbeddingClient(dim=32, latency=0.05)
+    embedder = BatchEmbedder(client, max_batch_tokens=2000, concurrency=4)
+    start = time.perf_counter()
+    result = asyncio.run(embedder.embed(texts, MODEL))
+    elapsed = time.perf_counter() - start
+
+    expected = asyncio.run(FakeEmbeddingClient(dim=32).embed(texts, MODEL))[0]
+    ordered = all(np.allclose(v, e) for v, e in zip(result.vectors, expected))
+    batches = embedder.make_batches(texts)
+    within = all(sum(count_tokens(texts[i]) for i in b) <= 2000 for b in batches)
+    # Con 4 lotes simultáneos tarda bastante menos que en serie
+    serial = len(batches) * 0.05
+    ok = ordered and within and client.calls == len(batches) and elapsed < serial * 0.6
+    print(f"  {'✅' if ok else '❌'} {len(texts)} textos en {client.calls} lotes "
+          f"({elapsed:.2f}s, en serie serían {serial:.2f}s)")
+    return ok
+
+
+def test_persistent_cache(workdir: str) -> bool:
+    print("✓ Probando caché persistente y deduplicación...")
+    path = os.path.join(workdir, "cache.db")
+    texts = make_texts(100)
+    client = FakeEmbeddingClient(dim=16)
+    cache = EmbeddingCache(path)
+    first = asyncio.run(BatchEmbedder(client, cache=cache).embed(texts + texts[:10], MODEL))
+    cache.close()
+    deduped = client.texts_embedded == 100 and first.cached == 0
+
+    # Otro proceso (nueva conexión): solo se calculan los textos cambiados
+    client = FakeEmbeddingClient(dim=16)
+    cache = EmbeddingCache(path)
+    changed = texts[:95] + [t + " (editado)" for t in texts[95:]]
+    second = asyncio.run(BatchEmbedder(client, cache=cache).embed(changed, MODEL))
+    same = all(np.allclose(a, b) for a, b in zip(first.vectors[:95], second.vectors[:95]))
+    reused = client.texts_embedded == 5 and second.cached == 95 and same
+
+    # Otro modelo no comparte entradas de caché
+    other = asyncio.run(BatchEmbedder(client, cache=cache).embed(texts[:3], "otro-modelo"))
+    isolated = other.cached == 0
+    cache.close()
+
+    ok = deduped and reused and isolated
+    print(f"  {'✅' if ok else '❌'} 110 entradas -> 100 calculadas; "
+          f"segunda ejecución: {second.cached} de caché, {client.texts_embedded - 3} recalculadas")
+    return ok
+
+
+def test_retries() -> bool:
+    print("✓ Probando reintentos con backoff...")
+    client = FlakyClient(dim=8, failures=2)
+    embedder = BatchEmbedder(client, retries=3, backoff_base=0.01)
+    result = asyncio.run(embedder.embed(make_texts(5), MODEL))
+    recovered = len(result.vectors) == 5 and embedder.stats["retries"] == 2
+
+    client = FlakyClient(dim=8, failures=1, status_code=400)
+    embedder = BatchEmbedder(client, retries=3, backoff_base=0.01)
+    try:
+        asyncio.run(embedder.embed(make_texts(5), MODEL))
+        not_retried = False
+    except RuntimeError:
+        not_retried = embedder.stats["retries"] == 0
+
+    ok = recovered and not_retried
+    print(f"  {'✅' if ok else '❌'} 429 reintentado hasta recuperar; 400 propagado sin reintentos")
+    return ok
+
+
+def test_event_loop(workdir: str) -> bool:
+    print("✓ Probando que un lote grande no bloquea el event loop...")
+    texts = make_texts(20000)
+    cache = EmbeddingCache(os.path.join(workdir, "loop.db"))
+    embedder = BatchEmbedder(FakeEmbeddingClient(dim=8), cache=cache, max_batch_items=2048)
+    # Primera pasada: llena la caché (el cliente simulado calcula en el propio event loop)
+    asyncio.run(embedder.embed(texts, MODEL))
+    start = time.perf_counter()
+    embedder._prepare(texts, MODEL, None)
+    blocking = time.perf_counter() - start
+
+    async def run():
+        gaps = []
+        done = asyncio.Event()
+
+        async def ticker():
+            last = time.perf_counter()
+            while not done.is_set():
+                await asyncio.sleep(0.001)
+                now = time.perf_counter()
+                gaps.append(now - last)
+                last = now
+
+        task = asyncio.create_task(ticker())
+        result = await embedder.embed(texts, MODEL)
+        done.set()
+        await task
+        return max(gaps), result.cached
+
+    max_gap, cached = asyncio.run(run())
+    cache.close()
+    ok = cached == len(texts) and max_gap < max(0.05, blocking / 3)
+    print(f"  {'✅' if ok else '❌'} Tokenizar y consultar la caché: {blocking * 1000:.0f} ms; "
+          f"pausa máxima del event loop {max_gap * 1000:.0f} ms")
+    return ok
+
+
+def main():
+    logging.disable(logging.WARNING)
+    print("=" * 60)
+    print("Validación de la capa de lotes de embeddings")
+    print("=" * 60)
+    with tempfile.TemporaryDirectory() as workdir:
+        results = [test_batching_and_order(), test_persistent_cache(workdir), test_retries(),
+                   test_event_loop(workdir)]
+    print("=" * 60)
+    if all(results):
+        print("✅ Todas las pruebas pasaron")
+        return 0
+    print("❌ Algunas pruebas fallaron")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
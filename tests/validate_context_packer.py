@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+Validación del empaquetado de contexto de /getcontext (db/contextpacker.py)
+Con fragmentos sintéticos agrupados por temas (con casi duplicados e
+intervenciones consecutivas del mismo hablante) comprueba que el contexto
+empaquetado usa como mucho la mitad de tokens y cubre al menos los mismos
+temas relevantes que recortar por relevancia con el mismo presupuesto.
+También comprueba /getcontext de extremo a extremo.
+
+Uso:
+    python tests/validate_context_packer.py
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+# Añadir el directorio raíz del proyecto y db/ al path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+sys.path.insert(0, os.path.join(project_root, 'db'))
+
+import faiss
+import httpx
+import numpy as np
+
+from api.apihmac import create_auth_headers, serialize_body
+from contextpacker import fragment_tokens, pack_context
+from load_context_server import free_port, start_server
+
+CONTEXT_KEY = "packer-test-context-key"
+DIM = 64
+TOPICS = 20
+PER_TOPIC = 5
+
+
+def make_corpus(seed: int = 0):
+    """
+    TOPICS temas con PER_TOPIC intervenciones cada uno: dos de ellas son casi
+    idénticas y otras dos son consecutivas del mismo hablante. La pregunta es
+    más cercana a los primeros temas.
+    """
+    rng = np.random.default_rng(seed)
+    topics = rng.standard_normal((TOPICS, DIM)).astype(np.float32)
+    topics /= np.linalg.norm(topics, axis=1, keepdims=True)
+    query = sum(topics[t] * (0.85 ** t) for t in range(TOPICS))
+
+    fragments, vectors, topic_of = [], [], []
+    for t in range(TOPICS):
+        for j in range(PER_TOPIC):
+            noise = 0.05 if j < 2 else 0.45
+            vec = topics[t] + noise * rng.standard_normal(DIM).astype(np.float32) / np.sqrt(DIM) * 4
+            fragments.append({
+                "id": len(fragments) + 1,
+                "tag": f"Speaker {0 if j in (2, 3) else j}",
+                "epname": f"ep{t:03d}",
+                "epdate": "2024-01-01",
+                "start": float(j * 30 if j != 3 else 2 * 30 + 20),
+                "end": float(j * 30 + 20),
+                "content": f"Tema {t}, intervención {j}. " + "Se comenta el asunto con bastante detalle. " * 12,
+            })
+            vectors.append(vec)
+            topic_of.append(t)
+    vectors = np.array(vectors, dtype=np.float32)
+    relevance = vectors @ (query / np.linalg.norm(query))
+    order = np.argsort(-relevance)
+    # Orden de recuperación de FAISS: más relevante primero
+    return [fragments[i] for i in order], vectors[order], query, [topic_of[i] for i in order]
+
+
+def topics_covered(fragments: list) -> set:
+    return {int(f["epname"][2:]) for f in fragments}
+
+
+def test_packing() -> bool:
+    print("✓ Probando MMR, duplicados, uniones y presupuesto...")
+    fragments, vectors, query, _ = make_corpus()
+    tokens_in = sum(fragment_tokens(f) for f in fragments)
+    budget = tokens_in // 2
+
+    start = time.perf_counter()
+    packed, stats = pack_context(fragments, vectors, query, budget)
+    elapsed = (time.perf_counter() - start) * 1000
+
+    # Referencia: recortar la lista de FAISS por relevancia con el mismo presupuesto
+    baseline, used = [], 0
+    for f in fragments:
+        if used + fragment_tokens(f) > budget:
+            break
+        baseline.append(f)
+        used += fragment_tokens(f)
+
+    top = set(range(8))
+    within = stats["tokens_out"] <= budget and stats["tokens_saved"] >= tokens_in * 0.5
+    coverage = top <= topics_covered(packed) and len(topics_covered(packed)) >= len(topics_covered(baseline))
+    cleaned = stats["duplicates"] > 0 and stats["merged"] > 0
+    ok = within and coverage and cleaned
+    print(f"  {'✅' if within else '❌'} {stats['tokens_in']} -> {stats['tokens_out']} tokens "
+          f"({stats['tokens_saved'] / stats['tokens_in']:.0%} ahorrado) en {elapsed:.1f} ms")
+    print(f"  {'✅' if coverage else '❌'} Temas cubiertos: {len(topics_covered(packed))} empaquetando, "
+          f"{len(topics_covered(baseline))} recortando por relevancia")
+    print(f"  {'✅' if cleaned else '❌'} {stats['duplicates']} casi duplicados descartados, "
+          f"{stats['merged']} intervenciones unidas")
+    return ok
+
+
+def test_merge_keeps_speakers_apart() -> bool:
+    print("✓ Probando que solo se unen intervenciones consecutivas del mismo hablante...")
+    base = {"epname": "ep001", "epdate": "2024-01-01", "content": "texto"}
+    fragments = [
+        {**base, "id": 1, "tag": "Speaker 0", "start": 0.0, "end": 10.0},
+        {**base, "id": 2, "tag": "Speaker 0", "start": 10.5, "end": 20.0},
+        {**base, "id": 3, "tag": "Speaker 1", "start": 20.2, "end": 30.0},
+        {**base, "id": 4, "tag": "Speaker 0", "start": 45.0, "end": 50.0},
+    ]
+    packed, stats = pack_context(fragments, None, None, 0)
+    ok = [f["id"] for f in packed] == [1, 3, 4] and packed[0]["end"] == 20.0 and stats["merged"] == 1
+    print(f"  {'✅' if ok else '❌'} 4 intervenciones -> {len(packed)} fragmentos")
+    return ok
+
+
+def setup_context_app(workdir: str, fragments: list, vectors: np.ndarray, budget: int):
+    """Prepara app.state del context server sin pasar por el lifespan (.env, logs)."""
+    import context_server
+    from sttcastdb import SttcastDB
+
+    db = SttcastDB(os.path.join(workdir, "packer.db"), create_if_not_exists=True)
+    by_episode = {}
+    for f, v in zip(fragments, vectors):
+        by_episode.setdefault(f["epname"], []).append((f, v))
+    index = faiss.IndexIDMap2(faiss.IndexFlatL2(DIM))
+    for epname, items in sorted(by_episode.items()):
+        items.sort(key=lambda fv: fv[0]["start"])
+        db.add_episode(epname, datetime(2024, 1, 1), f"{epname}.mp3",
+                       [{"tag": f["tag"], "start": f["start"], "end": f["end"], "content": f["content"]}
+                        for f, _ in items])
+        rows = sorted(db.get_ints(epname=epname), key=lambda r: r["start"])
+        vecs = np.array([v for _, v in items], dtype=np.float32)
+        faiss.normalize_L2(vecs)
+        ids = [r["id"] for r in rows]
+        db.update_embeddings(((i, v.tobytes(), 10, 10) for i, v in zip(ids, vecs)), model="stub")
+        index.add_with_ids(vecs, np.array(ids, dtype=np.int64))
+
+    app = context_server.app
+    app.state.db = db
+    app.state.index = index
+    app.state.index_lock = threading.Lock()
+    app.state.db_write_lock = threading.Lock()
+    app.state.embedding_space = {"model": "stub", "dim": DIM, "dimensions": None}
+    app.state.migration = None
+    app.state.index_generation = 0
+    app.state.corpus_generation = 0
+    app.state.context_token_budget = budget
+    app.state.context_mmr_lambda = 0.7
+    app.state.context_dedup_threshold = 0.95
+    app.state.context_merge_gap = 1.0
+    context_server.CONTEXT_SERVER_API_KEY = CONTEXT_KEY
+    return app
+
+
+async def post_getcontext(base: str, payload: dict) -> dict:
+    headers = create_auth_headers(CONTEXT_KEY, "POST", "/getcontext", payload, "packer_test")
+    async with httpx.AsyncClient(timeout=60) as client:
+        r = await client.post(f"{base}/getcontext", content=serialize_body(payload).encode('utf-8'),
+                              headers=headers)
+    r.raise_for_status()
+    return r.json()
+
+
+def test_endpoint() -> bool:
+    print("✓ Probando /getcontext con empaquetado...")
+    fragments, vectors, query, _ = make_corpus(seed=1)
+    budget = sum(fragment_tokens(f) for f in fragments) // 2
+    with tempfile.TemporaryDirectory() as workdir:
+        app = setup_context_app(workdir, fragments, vectors, budget)
+        port = free_port()
+        server = start_server(app, port)
+        base = f"http://127.0.0.1:{port}"
+        payload = {"query": "pregunta", "n_fragments": 100, "query_embedding": query.tolist()}
+        try:
+            packed = asyncio.run(post_getcontext(base, payload))
+            raw = asyncio.run(post_getcontext(base, {**payload, "token_budget": 0}))
+        finally:
+            server.should_exit = True
+        app.state.db.close()
+
+    stats = packed.get("packing") or {}
+    raw_tokens = sum(fragment_tokens(f) for f in raw["context"])
+    # Sin empaquetar, el contexto llega en el orden de FAISS (más relevante primero)
+    vec_of = {f["content"]: v / np.linalg.norm(v) for f, v in zip(fragments, vectors)}
+    scores = [float(vec_of[f["content"]] @ query) for f in raw["context"]]
+    ordered = all(a >= b - 1e-5 for a, b in zip(scores, scores[1:]))
+    ok = (stats.get("tokens_out", budget + 1) <= budget and raw.get("packing") is None
+          and len(raw["context"]) == TOPICS * PER_TOPIC and ordered)
+    print(f"  {'✅' if ok else '❌'} {len(raw['context'])} fragmentos ({raw_tokens} tokens) -> "
+          f"{len(packed['context'])} ({stats.get('tokens_out')} tokens); token_budget=0 lo desactiva")
+    return ok
+
+
+def main():
+    logging.disable(logging.WARNING)
+    print("=" * 60)
+    print("Validación del empaquetado de contexto")
+    print("=" * 60)
+    results = [test_packing(), test_merge_keeps_speakers_apart(), test_endpoint()]
+    print("=" * 60)
+    if all(results):
+        print("✅ Todas las pruebas pasaron")
+        return 0
+    print("❌ Algunas pruebas fallaron")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+"""
+Validación de la migración de modelo de embeddings en el context server
+Lanza un RAG server simulado con dos modelos (64 y 16 dimensiones), migra el
+índice al modelo pequeño mientras se hacen consultas y se añade un episodio, y
+comprueba que las consultas no fallan y que el cambio de índice es completo.
+Antes cancela una primera migración a medias y comprueba que los embeddings
+de la BD siguen siendo todos del modelo activo y que la siguiente la reanuda.
+Al final cambia el índice activo mientras /addsegments espera sus embeddings y
+comprueba que se recalculan con el modelo del índice nuevo.
+
+Uso:
+    python tests/validate_embedding_migration.py
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+# Añadir el directorio raíz del proyecto (y db/ para sttcastdb) al path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+sys.path.insert(0, os.path.join(project_root, 'db'))
+
+import faiss
+import httpx
+import numpy as np
+from fastapi import FastAPI, HTTPException, Request, Response
+from starlette.requests import ClientDisconnect
+
+from api.apiclient import SignedAsyncClient
+from api.apihmac import create_auth_headers, serialize_body, validate_hmac_auth
+from load_context_server import free_port, start_server
+
+RAG_KEY = "migration-rag-key"
+CONTEXT_KEY = "migration-context-key"
+OLD_MODEL, OLD_DIM = "stub-large", 64
+NEW_MODEL, NEW_DIM = "stub-small", 16
+
+
+def fake_embedding(text: str, dim: int) -> list:
+    seed = int.from_bytes(hashlib.sha256(f"{dim}|{text}".encode()).digest()[:4], 'little')
+    return np.random.default_rng(seed).standard_normal(dim).astype(np.float32).tolist()
+
+
+def build_stub_rag(latency: float, embed_hooks: list = None) -> FastAPI:
+    """
+    RAG server simulado: modelo por defecto de 64 dimensiones y otro permitido de 16.
+    Cada petición a /getembeddings consume y ejecuta la primera función de `embed_hooks`.
+    """
+    stub = FastAPI()
+    embed_hooks = embed_hooks if embed_hooks is not None else []
+
+    def dim_for(model, dimensions) -> int:
+        model = model or OLD_MODEL
+        if model not in (OLD_MODEL, NEW_MODEL):
+            raise HTTPException(status_code=400, detail=f"Modelo de embeddings no permitido: {model}")
+        return dimensions or (OLD_DIM if model == OLD_MODEL else NEW_DIM)
+
+    @stub.post("/getembeddings")
+    async def getembeddings(request: Request):
+        try:
+            body_bytes = await request.body()
+        except ClientDisconnect:
+            # Lote en vuelo de la migración cancelada
+            return Response(status_code=499)
+        validate_hmac_auth(request, RAG_KEY, body_bytes)
+        body = json.loads(body_bytes)
+        if isinstance(body, list):
+            body = {"segments": body}
+        dim = dim_for(body.get("model"), body.get("dimensions"))
+        await asyncio.sleep(latency)
+        if embed_hooks:
+            embed_hooks.pop(0)()
+        return {"embeddings": [fake_embedding(s["content"], dim) for s in body["segments"]],
+                "tokens_prompt": 10, "tokens_total": 10, "model": body.get("model") or OLD_MODEL}
+
+    @stub.post("/getoneembedding")
+    async def getoneembedding(request: Request):
+        body_bytes = await request.body()
+        validate_hmac_auth(request, RAG_KEY, body_bytes)
+        body = json.loads(body_bytes)
+        dim = dim_for(body.get("model"), body.get("dimensions"))
+        return {"embedding": fake_embedding(body["query"], dim), "model": body.get("model") or OLD_MODEL}
+
+    return stub
+
+
+def setup_context_app(workdir: str, rag_url: str):
+    """Prepara app.state del context server con un índice del modelo antiguo."""
+    import context_server
+    from sttcastdb import SttcastDB
+    from embeddingcache import QueryEmbeddingCache
+
+    db = SttcastDB(os.path.join(workdir, "migration.db"), create_if_not_exists=True)
+    index = faiss.IndexIDMap2(faiss.IndexFlatL2(OLD_DIM))
+    for e in range(6):
+        ints = [{"tag": f"Speaker {i % 3}", "start": float(i), "end": float(i + 1),
+                 "content": f"episodio {e} intervención {i}"} for i in range(200)]
+        db.add_episode(f"ep{e:03d}", datetime(2024, 1, 1) + timedelta(days=e), f"ep{e:03d}.mp3", ints)
+    rows = db.get_ints(with_embeddings=False)
+    vectors = np.array([fake_embedding(r["content"], OLD_DIM) for r in rows], dtype=np.float32)
+    faiss.normalize_L2(vectors)
+    ids = [r["id"] for r in rows]
+    db.update_embeddings(((i, v.tobytes(), 10, 10) for i, v in zip(ids, vectors)), model=OLD_MODEL)
+    index.add_with_ids(vectors, np.array(ids, dtype=np.int64))
+
+    app = context_server.app
+    app.state.db = db
+    app.state.index = index
+    app.state.index_file = os.path.join(workdir, "migration.faiss")
+    app.state.index_lock = threading.Lock()
+    app.state.db_write_lock = threading.Lock()
+    app.state.rag_client = SignedAsyncClient(rag_url, RAG_KEY, client_id='context_server')
+    app.state.embedding_cache = QueryEmbeddingCache(model=OLD_MODEL)
+    app.state.default_embedding_model = OLD_MODEL
+    app.state.embedding_space = {"model": OLD_MODEL, "dim": OLD_DIM, "dimensions": None}
+    app.state.migration = None
+    app.state.index_generation = 0
+    app.state.corpus_generation = 0
+    app.state.context_token_budget = 0
+    context_server.CONTEXT_SERVER_API_KEY = CONTEXT_KEY
+    return app
+
+
+async def post(client: httpx.AsyncClient, base: str, path: str, payload) -> httpx.Response:
+    headers = create_auth_headers(CONTEXT_KEY, "POST", path, payload, "migration_test")
+    return await client.post(f"{base}{path}", content=serialize_body(payload).encode('utf-8'), headers=headers)
+
+
+async def run_checks(base: str, app) -> bool:
+    ok = True
+    async with httpx.AsyncClient(timeout=60) as client:
+        r = await post(client, base, "/getcontext", {"query": "episodio 1 intervención 3", "n_fragments": 3})
+        print(f"  {'✅' if r.status_code == 200 else '❌'} /getcontext antes de migrar "
+              f"(modelo {r.json().get('embedding_model')}, dim {len(r.json().get('query_embedding', []))})")
+        ok &= r.status_code == 200 and len(r.json()["query_embedding"]) == OLD_DIM
+
+        # Migración cancelada a medias: la BD no debe quedar con vectores de dos modelos
+        r = await post(client, base, "/admin/embedding_migration/start", {"model": NEW_MODEL, "token_budget": 2000})
+        ok &= r.status_code == 200
+        status = {}
+        for _ in range(500):
+            status = (await post(client, base, "/admin/embedding_migration/status", {})).json()
+            if status["staged"]:
+                break
+            await asyncio.sleep(0.01)
+        r = await post(client, base, "/admin/embedding_migration/cancel", {})
+        await asyncio.sleep(0.2)
+        status = (await post(client, base, "/admin/embedding_migration/status", {})).json()
+        staged = sum(m["n"] for m in status["staged"])
+        untouched = (r.status_code == 200 and status["migration"]["status"] == "cancelled" and staged > 0
+                     and [m["embedding_model"] for m in status["stored"]] == [OLD_MODEL]
+                     and status["active"]["model"] == OLD_MODEL)
+        print(f"  {'✅' if untouched else '❌'} Migración cancelada: {staged} vectores preparados aparte, "
+              f"BD con {status['stored']}")
+        ok &= untouched
+
+        r = await post(client, base, "/admin/embedding_migration/start", {"model": NEW_MODEL, "token_budget": 2000})
+        print(f"  {'✅' if r.status_code == 200 else '❌'} Migración lanzada: {r.json()}")
+        ok &= r.status_code == 200
+
+        # Episodio nuevo durante la migración: debe acabar en los dos índices
+        segments = [{"tag": "Speaker 9", "start": float(i), "end": float(i + 1), "content": f"nuevo {i}"}
+                    for i in range(50)]
+        r = await post(client, base, "/addsegments", {"epname": "ep999", "epdate": "2024-02-01T00:00:00",
+                                                       "epfile": "ep999.mp3", "segments": segments})
+        ok &= r.status_code == 200
+        generations = (app.state.index_generation, app.state.corpus_generation)
+        print(f"  {'✅' if generations == (0, 1) else '❌'} Episodio añadido: sube la generación del corpus "
+              f"y no la del índice (índice {generations[0]}, corpus {generations[1]})")
+        ok &= generations == (0, 1)
+
+        # Consultas durante la migración: ninguna debe fallar
+        failures, dims = 0, set()
+        deadline = time.time() + 60
+        while time.time() < deadline:
+            r = await post(client, base, "/getcontext", {"query": "episodio 2", "n_fragments": 5})
+            if r.status_code != 200:
+                failures += 1
+            else:
+                dims.add(len(r.json()["query_embedding"]))
+            status = (await post(client, base, "/admin/embedding_migration/status", {})).json()
+            if status["migration"]["status"] not in ("pending", "running"):
+                break
+            await asyncio.sleep(0.02)
+        print(f"  {'✅' if failures == 0 else '❌'} Consultas durante la migración sin errores "
+              f"(dimensiones vistas: {sorted(dims)})")
+        ok &= failures == 0
+
+        print(f"  Estado final: {status['migration']['status']}, pasadas: {status['migration']['passes']}, "
+              f"reanudados: {status['migration']['seeded']}, almacenados: {status['stored']}")
+        status = (await post(client, base, "/admin/embedding_migration/status", {})).json()
+        promoted = ([m["embedding_model"] for m in status["stored"]] == [NEW_MODEL] and not status["staged"]
+                    and status["migration"]["seeded"] > 0)
+        print(f"  {'✅' if promoted else '❌'} Tras el cambio, la BD tiene solo {NEW_MODEL} y nada preparado")
+        ok &= status["migration"]["status"] == "done" and promoted
+
+        r = await post(client, base, "/getcontext", {"query": "nuevo 7", "n_fragments": 1})
+        body = r.json()
+        switched = (r.status_code == 200 and body["embedding_model"] == NEW_MODEL
+                    and len(body["query_embedding"]) == NEW_DIM and body["index_generation"] == 1
+                    and body["corpus_generation"] == 2)
+        print(f"  {'✅' if switched else '❌'} /getcontext tras el cambio usa {body.get('embedding_model')} "
+              f"(dim {len(body.get('query_embedding', []))}, generación {body.get('index_generation')}, "
+              f"corpus {body.get('corpus_generation')})")
+        ok &= switched
+
+        # Con un query_embedding del modelo antiguo, el servidor lo recalcula en lugar de fallar
+        r = await post(client, base, "/getcontext", {"query": "nuevo 7", "n_fragments": 1,
+                                                     "query_embedding": fake_embedding("nuevo 7", OLD_DIM)})
+        print(f"  {'✅' if r.status_code == 200 else '❌'} query_embedding del modelo antiguo recalculado")
+        ok &= r.status_code == 200
+
+    total = app.state.db.conn.execute("SELECT COUNT(*) FROM speakerintervention").fetchone()[0]
+    complete = app.state.index.d == NEW_DIM and app.state.index.ntotal == total
+    print(f"  {'✅' if complete else '❌'} Índice activo: d={app.state.index.d}, "
+          f"{app.state.index.ntotal} vectores de {total} intervenciones")
+    meta_file = f"{app.state.index_file}.meta.json"
+    with open(meta_file) as f:
+        meta = json.load(f)
+    on_disk = faiss.read_index(app.state.index_file)
+    persisted = (meta["model"] == NEW_MODEL and meta["dim"] == NEW_DIM and meta["generation"] == 1
+                 and meta["corpus_generation"] == 2 and on_disk.d == NEW_DIM)
+    print(f"  {'✅' if persisted else '❌'} Índice y metadatos guardados en disco: {meta}")
+    return ok and complete and persisted
+
+
+async def check_switch_during_addsegments(base: str, app, embed_hooks: list) -> bool:
+    """Cambio de índice mientras /addsegments espera sus embeddings: se recalculan con el modelo nuevo."""
+    print("✓ Probando un cambio de índice durante /addsegments...")
+    from embeddingindex import bump_index_generation
+
+    def switch_back():
+        # Como EmbeddingMigration.try_switch: índice y espacio nuevos bajo index_lock
+        with app.state.index_lock:
+            app.state.index = faiss.IndexIDMap2(faiss.IndexFlatL2(OLD_DIM))
+            app.state.embedding_space = {"model": OLD_MODEL, "dim": OLD_DIM, "dimensions": None}
+            bump_index_generation(app.state)
+
+    embed_hooks.append(switch_back)
+    segments = [{"tag": "Speaker 8", "start": float(i), "end": float(i + 1), "content": f"cambio {i}"}
+                for i in range(20)]
+    async with httpx.AsyncClient(timeout=60) as client:
+        r = await post(client, base, "/addsegments", {"epname": "ep998", "epdate": "2024-02-02T00:00:00",
+                                                       "epfile": "ep998.mp3", "segments": segments})
+    rows = app.state.db.get_ints(with_embeddings=True, epname="ep998")
+    models = {row["embedding_model"] for row in app.state.db.conn.execute(
+        "SELECT embedding_model FROM speakerintervention WHERE id IN (%s)" % ",".join("?" * len(rows)),
+        [row["id"] for row in rows])}
+    ok = (r.status_code == 200 and not embed_hooks and app.state.index.d == OLD_DIM
+          and app.state.index.ntotal == len(segments) and len(rows) == len(segments) and models == {OLD_MODEL})
+    print(f"  {'✅' if ok else '❌'} Embeddings recalculados con {OLD_MODEL}: {app.state.index.ntotal} vectores "
+          f"de dim {app.state.index.d} en el índice nuevo, modelos en la BD {sorted(models)} ({r.status_code})")
+    return ok
+
+
+def main():
+    logging.disable(logging.INFO)
+    print("=" * 60)
+    print(f"Migración de embeddings {OLD_MODEL} ({OLD_DIM}) -> {NEW_MODEL} ({NEW_DIM})")
+    print("=" * 60)
+    with tempfile.TemporaryDirectory() as workdir:
+        rag_port, ctx_port = free_port(), free_port()
+        embed_hooks = []
+        rag_server = start_server(build_stub_rag(latency=0.05, embed_hooks=embed_hooks), rag_port)
+        app = setup_context_app(workdir, f"http://127.0.0.1:{rag_port}")
+        ctx_server = start_server(app, ctx_port)
+        try:
+            ok = asyncio.run(run_checks(f"http://127.0.0.1:{ctx_port}", app))
+            ok &= asyncio.run(check_switch_during_addsegments(f"http://127.0.0.1:{ctx_port}", app, embed_hooks))
+        finally:
+            ctx_server.should_exit = True
+            rag_server.should_exit = True
+            app.state.db.close()
+    print("=" * 60)
+    print("✅ Migración validada" if ok else "❌ La migración no se completó correctamente")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
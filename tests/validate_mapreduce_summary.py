@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""
+Validación de los resúmenes map-reduce del RAG server (rag/mapreduce.py + /summarize)
+Con la transcripción real de summaries/debug_block_cm250912.json comprueba que
+las ventanas respetan el presupuesto de tokens y se cortan entre
+intervenciones sin perder texto, y con un backend de LLM simulado que:
+- las ventanas se resumen en paralelo y se reducen en una llamada final,
+- cambiar el prompt de reducción solo repite esa llamada (caché de ventanas),
+- cambiar el prompt de las ventanas invalida la caché,
+- hay un nivel intermedio cuando los resúmenes parciales no caben en un prompt,
+- las transcripciones cortas siguen usando un solo prompt en modo auto.
+
+Uso:
+    python tests/validate_mapreduce_summary.py [--latency 0.3] [--window-tokens 3000]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+# Añadir el directorio raíz del proyecto y rag/ al path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+sys.path.insert(0, os.path.join(project_root, 'rag'))
+
+import httpx
+
+from api.apihmac import create_auth_headers, serialize_body
+from embedder import count_tokens
+from llmbackend import EndpointLimits, MockLLMBackend
+from load_context_server import free_port, start_server
+from mapreduce import SummaryCache, build_windows, normalize_transcript
+
+RAG_KEY = "mapreduce-test-rag-key"
+CONCURRENCY = 4
+SAMPLE = os.path.join(project_root, "summaries", "debug_block_cm250912.json")
+
+
+class RecordingMockBackend(MockLLMBackend):
+    """Guarda los prompts recibidos."""
+
+    def __init__(self, latency: float):
+        super().__init__(latency=latency)
+        self.prompts = []
+
+    async def chat(self, messages, model, json_mode=False, timeout=None):
+        self.prompts.append(messages[-1]["content"])
+        return await super().chat(messages, model, json_mode, timeout)
+
+
+def setup_service(backend, cache_path: str, window_tokens: int):
+    """Configura los globales que el servicio fija en __main__."""
+    import sttcast_rag_service as svc
+    svc.RAG_SERVER_API_KEY = RAG_KEY
+    svc.OPENAI_GPT_MODEL = "mock-model"
+    svc.OPENAI_SUMMARIES_MODEL = "mock-model"
+    svc.OPENAI_EMBEDDING_MODEL = "mock-embedding"
+    svc.llm = backend
+    svc.llm_limits = EndpointLimits(concurrency={"summarize": CONCURRENCY}, timeouts={"summarize": 60})
+    svc.summary_mode = "mapreduce"
+    svc.summary_single_max_tokens = 60000
+    svc.summary_window_tokens = window_tokens
+    svc.summary_cache = SummaryCache(cache_path)
+    return svc
+
+
+def load_sample() -> dict:
+    with open(SAMPLE, encoding="utf-8") as f:
+        return json.load(f)[0]
+
+
+def transcript_text(html: str) -> str:
+    import sttcast_rag_service as svc
+    return svc.sanitize_transcript_content(svc.extract_text_from_html(html))
+
+
+async def post_summarize(url: str, episodes: list) -> list:
+    headers = create_auth_headers(RAG_KEY, "POST", url, episodes, "mapreduce_test")
+    async with httpx.AsyncClient(timeout=120) as client:
+        r = await client.post(url, content=serialize_body(episodes).encode('utf-8'), headers=headers)
+    r.raise_for_status()
+    return r.json()
+
+
+def summarize(url: str, backend, episodes: list) -> tuple:
+    """Devuelve (respuesta, llamadas nuevas al LLM, segundos)."""
+    calls = backend.calls
+    start = time.perf_counter()
+    result = asyncio.run(post_summarize(url, episodes))
+    return result, backend.calls - calls, time.perf_counter() - start
+
+
+def test_windows(text: str, window_tokens: int) -> bool:
+    print("✓ Probando la división en ventanas...")
+    start = time.perf_counter()
+    windows = build_windows(text, window_tokens)
+    elapsed = (time.perf_counter() - start) * 1000
+    normalized = normalize_transcript(text)
+
+    within = all(count_tokens(w["text"]) <= window_tokens for w in windows)
+    # La primera ventana empieza con la cabecera del episodio
+    boundaries = all(w["text"].startswith("[") for w in windows[1:])
+    lossless = " ".join(w["text"] for w in windows).split() == normalized.split()
+    ok = within and boundaries and lossless and len(windows) > 1
+    print(f"  {'✅' if within else '❌'} {count_tokens(text)} tokens ({count_tokens(normalized)} normalizados) -> "
+          f"{len(windows)} ventanas de hasta {max(w['tokens'] for w in windows)} tokens en {elapsed:.0f} ms")
+    print(f"  {'✅' if boundaries else '❌'} Las ventanas empiezan en una intervención o marca de tiempo")
+    print(f"  {'✅' if lossless else '❌'} Ninguna palabra perdida ni duplicada")
+    return ok
+
+
+def test_map_reduce(url, backend, episode, windows: int, latency: float) -> bool:
+    print("✓ Probando map-reduce concurrente...")
+    backend.max_in_flight = 0
+    result, calls, elapsed = summarize(url, backend, [episode])
+    summary = json.loads(result[0]["summary"])
+    sequential = (windows + 1) * latency
+    parallel = backend.max_in_flight == CONCURRENCY and elapsed < sequential * 0.7
+    ok = calls == windows + 1 and parallel and "es" in summary and "en" in summary
+    print(f"  {'✅' if calls == windows + 1 else '❌'} {calls} llamadas al LLM ({windows} ventanas + reducción), "
+          f"{result[0]['tokens_prompt']} tokens de entrada")
+    print(f"  {'✅' if parallel else '❌'} {elapsed:.2f}s (secuencial: {sequential:.2f}s), "
+          f"{backend.max_in_flight} ventanas a la vez")
+    return ok
+
+
+def test_reduce_tweak(svc, url, backend, episode, windows: int) -> bool:
+    print("✓ Probando que cambiar el prompt de reducción no repite las ventanas...")
+    first, _, _ = summarize(url, backend, [episode])
+    original = svc.build_reduce_prompt
+    svc.build_reduce_prompt = lambda parts: original(parts) + "\nUsa un tono divulgativo.\n"
+    try:
+        tweaked, calls, elapsed = summarize(url, backend, [episode])
+    finally:
+        svc.build_reduce_prompt = original
+    ok = calls == 1 and tweaked[0]["summary"] != first[0]["summary"]
+    print(f"  {'✅' if ok else '❌'} {calls} llamada al LLM en {elapsed:.2f}s; tokens de entrada "
+          f"{first[0]['tokens_prompt']} -> {tweaked[0]['tokens_prompt']}")
+    return ok
+
+
+def test_map_tweak(svc, url, backend, episode, windows: int) -> bool:
+    print("✓ Probando que cambiar el prompt de las ventanas invalida la caché...")
+    original = svc.build_window_prompt
+    svc.build_window_prompt = lambda window, i, n: original(window, i, n) + "\nSé breve.\n"
+    try:
+        _, calls, _ = summarize(url, backend, [episode])
+    finally:
+        svc.build_window_prompt = original
+    ok = calls == windows + 1
+    print(f"  {'✅' if ok else '❌'} {calls} llamadas al LLM")
+    return ok
+
+
+def test_hierarchical(svc, url, backend, episode, windows: int) -> bool:
+    print("✓ Probando un nivel intermedio de combinación...")
+    svc.summary_mode = "auto"
+    svc.summary_single_max_tokens = 400
+    backend.prompts.clear()
+    try:
+        result, calls, _ = summarize(url, backend, [episode])
+    finally:
+        svc.summary_mode = "mapreduce"
+        svc.summary_single_max_tokens = 60000
+    combines = sum(1 for p in backend.prompts if "Combínalos en un único resumen" in p)
+    reduce_prompt = backend.prompts[-1]
+    ok = (combines >= 1 and calls == combines + 1 and "### RESÚMENES PARCIALES ###" in reduce_prompt
+          and json.loads(result[0]["summary"]).get("es"))
+    print(f"  {'✅' if ok else '❌'} {windows} ventanas en caché, {combines} combinaciones intermedias "
+          f"y la reducción final ({calls} llamadas)")
+    return ok
+
+
+def test_auto_short(svc, url, backend) -> bool:
+    print("✓ Probando que en modo auto una transcripción corta usa un solo prompt...")
+    svc.summary_mode = "auto"
+    text = "[00:00:00.00 - 00:00:10.00]\n[Speaker 0]: Hablamos del telescopio James Webb."
+    backend.prompts.clear()
+    try:
+        _, calls, _ = summarize(url, backend, [{"ep_id": "corto", "transcription": text,
+                                                "transcription_format": "text"}])
+    finally:
+        svc.summary_mode = "mapreduce"
+    ok = calls == 1 and backend.prompts[0] == svc.build_summary_prompt(svc.sanitize_transcript_content(text))
+    print(f"  {'✅' if ok else '❌'} {calls} llamada con el prompt completo")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency", type=float, default=0.3)
+    parser.add_argument("--window-tokens", type=int, default=3000)
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    sample = load_sample()
+    backend = RecordingMockBackend(latency=args.latency)
+    with tempfile.TemporaryDirectory() as workdir:
+        svc = setup_service(backend, os.path.join(workdir, "summary_cache.db"), args.window_tokens)
+        text = transcript_text(sample["transcription"])
+        windows = len(build_windows(text, args.window_tokens))
+        episode = {"ep_id": sample["ep_id"], "transcription": text, "transcription_format": "text"}
+
+        port = free_port()
+        server = start_server(svc.app, port)
+        url = f"http://127.0.0.1:{port}/summarize"
+        print("=" * 60)
+        print("Validación de los resúmenes map-reduce")
+        print("=" * 60)
+        try:
+            results = [
+                test_windows(text, args.window_tokens),
+                test_map_reduce(url, backend, episode, windows, args.latency),
+                test_reduce_tweak(svc, url, backend, episode, windows),
+                test_map_tweak(svc, url, backend, episode, windows),
+                test_hierarchical(svc, url, backend, episode, windows),
+                test_auto_short(svc, url, backend),
+            ]
+        finally:
+            server.should_exit = True
+            svc.summary_cache.close()
+    print("=" * 60)
+    if all(results):
+        print("✅ Todas las pruebas pasaron")
+        return 0
+    print("❌ Algunas pruebas fallaron")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
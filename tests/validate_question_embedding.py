@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Validación del embedding único por pregunta en /api/ask (rag/client/askpipeline.py)
+Levanta el context server con un RAG server simulado que cuenta las peticiones
+de embedding y recorre las etapas de una pregunta como client_rag (consultas
+similares, caché de respuestas, /getcontext y guardado) comprobando que:
+- el embedding se pide una sola vez por pregunta y /getcontext no lo recalcula,
+- la misma pregunta (con otros espacios) no vuelve a pedirlo, y la caché no
+  arrastra la generación del corpus (la respuesta a la caché debe preguntarla),
+- una generación del índice nueva o el TTL invalidan la caché,
+- los tiempos por etapa quedan en una línea del log.
+
+Uso:
+    python tests/validate_question_embedding.py [--latency 0.2]
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+
+# Añadir el directorio raíz del proyecto, db/ y rag/client/ al path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+sys.path.insert(0, os.path.join(project_root, 'db'))
+sys.path.insert(0, os.path.join(project_root, 'rag', 'client'))
+
+from fastapi import FastAPI, Request
+
+from api.apiclient import SignedAsyncClient
+from api.apihmac import validate_hmac_auth
+from askpipeline import QuestionEmbedding, QuestionEmbeddingCache, StageTimer
+from load_context_server import CONTEXT_KEY, RAG_KEY, fake_embedding, free_port, setup_context_app, start_server
+
+
+class CountingRag:
+    """RAG server simulado que cuenta las peticiones de embedding."""
+
+    def __init__(self, latency: float):
+        self.calls = 0
+        self.app = FastAPI()
+
+        @self.app.post("/getoneembedding")
+        async def getoneembedding(request: Request):
+            body_bytes = await request.body()
+            validate_hmac_auth(request, RAG_KEY, body_bytes)
+            self.calls += 1
+            await asyncio.sleep(latency)
+            return {"embedding": fake_embedding((await request.json())["query"])}
+
+
+class ContextClient:
+    """Las dos llamadas de client_rag al context server, contando las peticiones."""
+
+    def __init__(self, base_url: str):
+        self.client = SignedAsyncClient(base_url, CONTEXT_KEY, "question_embedding_test")
+        self.requests = 0
+
+    async def fetch_embedding(self, question: str):
+        self.requests += 1
+        data = (await self.client.post_json("/getcontext", {"query": question, "n_fragments": 1,
+                                                            "only_embedding": True})).json()
+        return (data["query_embedding"], data["embedding_model"], data["index_generation"],
+                data["corpus_generation"])
+
+    async def context(self, question_embedding: QuestionEmbedding) -> dict:
+        self.requests += 1
+        response = await self.client.post_json("/getcontext", {"query": question_embedding.question,
+                                                               "n_fragments": 5,
+                                                               "query_embedding": await question_embedding.get()})
+        return response.json()
+
+
+async def ask(client: ContextClient, cache: QuestionEmbeddingCache, question: str) -> tuple:
+    """Etapas de /api/ask que usan el embedding (la BD y el LLM no intervienen aquí)."""
+    timer = StageTimer("/api/ask")
+    handle = QuestionEmbedding(question, client.fetch_embedding, cache, timer)
+    uses = [await handle.get()]
+    with timer.stage("similares"):
+        await asyncio.sleep(0)
+    uses.append(await handle.get())
+    with timer.stage("caché"):
+        await asyncio.sleep(0)
+    with timer.stage("contexto"):
+        context = await client.context(handle)
+    uses.append(await handle.get())
+    with timer.stage("guardado"):
+        uses.append(handle.embedding)
+    cache.observe_generation(context["index_generation"])
+    return handle, timer, uses, context
+
+
+async def run_checks(client: ContextClient, rag: CountingRag, app) -> list:
+    results = []
+    cache = QuestionEmbeddingCache(max_items=100, ttl_seconds=300)
+
+    print("✓ Probando una pregunta completa...")
+    handle, timer, uses, context = await ask(client, cache, "¿Qué se dijo del telescopio James Webb?")
+    ok = (rag.calls == 1 and handle.fetches == 1 and client.requests == 2
+          and all(u == uses[0] for u in uses) and "context" in context
+          and handle.corpus_generation == app.state.corpus_generation)
+    print(f"  {'✅' if ok else '❌'} {rag.calls} embedding calculado, {client.requests} peticiones al context "
+          f"server (embedding + contexto), el mismo vector en las {len(uses)} etapas")
+    print(f"  Tiempos: {timer.summary()}")
+    results.append(ok and "embedding=" in timer.summary() and "contexto=" in timer.summary())
+
+    print("✓ Probando la misma pregunta con otros espacios...")
+    requests_before = client.requests
+    handle, timer, _, _ = await ask(client, cache, "  ¿Qué se dijo del   telescopio James Webb? ")
+    ok = (handle.cached and handle.fetches == 0 and client.requests == requests_before + 1 and rag.calls == 1
+          and handle.corpus_generation is None)
+    print(f"  {'✅' if ok else '❌'} Embedding de la caché de client_rag: solo la petición de contexto "
+          f"({timer.stages['embedding'] * 1000:.2f} ms en la etapa de embedding)")
+    results.append(ok)
+
+    print("✓ Probando la invalidación por generación del índice y por TTL...")
+    app.state.index_generation += 1
+    # El siguiente contacto con el context server revela la generación nueva
+    await ask(client, cache, "otra pregunta")
+    handle, _, _, _ = await ask(client, cache, "¿Qué se dijo del telescopio James Webb?")
+    by_generation = not handle.cached and handle.index_generation == app.state.index_generation
+
+    clock = [0.0]
+    short = QuestionEmbeddingCache(max_items=2, ttl_seconds=10, clock=lambda: clock[0])
+    short.put("a", [1.0], "stub", 1)
+    fresh = short.get("a") is not None
+    clock[0] = 11
+    expired = short.get("a") is None
+    for q in ("b", "c", "d"):
+        short.put(q, [1.0], "stub", 1)
+    bounded = short.stats()["size"] == 2 and short.get("b") is None
+    ok = by_generation and fresh and expired and bounded
+    print(f"  {'✅' if by_generation else '❌'} Generación {app.state.index_generation}: embedding pedido de nuevo")
+    print(f"  {'✅' if fresh and expired else '❌'} TTL respetado; {'✅' if bounded else '❌'} LRU acotada")
+    results.append(ok)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency", type=float, default=0.2, help="Latencia del RAG simulado (s)")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    print("=" * 60)
+    print("Validación del embedding único por pregunta")
+    print("=" * 60)
+    with tempfile.TemporaryDirectory() as workdir:
+        rag = CountingRag(args.latency)
+        rag_port, ctx_port = free_port(), free_port()
+        rag_server = start_server(rag.app, rag_port)
+        app = setup_context_app(workdir, f"http://127.0.0.1:{rag_port}")
+        app.state.context_token_budget = 0
+        ctx_server = start_server(app, ctx_port)
+        client = ContextClient(f"http://127.0.0.1:{ctx_port}")
+        try:
+            results = asyncio.run(run_checks(client, rag, app))
+        finally:
+            ctx_server.should_exit = True
+            rag_server.should_exit = True
+            app.state.db.close()
+    print("=" * 60)
+    if all(results):
+        print("✅ Todas las pruebas pasaron")
+        return 0
+    print("❌ Algunas pruebas fallaron")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+Validación de /relsearch/stream (server-sent events) con un backend de LLM simulado
+Comprueba el parser JSON incremental (trozos arbitrarios, comas colgantes y
+salida truncada) y que el endpoint envía el texto de la respuesta antes de que
+termine el modelo, con las referencias en el evento final. Con el endpoint
+saturado, un stream que no consigue hueco en el plazo recibe un 504, y el hueco
+de un cliente que se desconecta a mitad se libera para el siguiente. Un
+rechazo del modelo termina en un error 400 sin texto enviado, y una salida que
+no es JSON, en la respuesta por defecto (como /relsearch).
+
+Uso:
+    python tests/validate_relsearch_stream.py [--latency 2.0]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+# Añadir el directorio raíz del proyecto y rag/ al path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+sys.path.insert(0, os.path.join(project_root, 'rag'))
+
+from api.apiclient import SignedAsyncClient
+from jsonstream import IncrementalJSONParser, parse_partial_json
+from llmbackend import EndpointLimits, LLMResponse, MockLLMBackend
+from load_context_server import free_port, start_server
+
+RAG_KEY = "stream-test-rag-key"
+
+SAMPLE = {
+    "search": {"es": "<p>El \"telescopio\" James Webb á \\ 🔭</p>", "en": "<p>The James Webb telescope</p>"},
+    "refs": [{"label": "ep001", "file": "ep001", "time": 12.5, "tag": "Speaker 0"}],
+    "flags": [True, False, None, -3, 1.5e3],
+}
+
+
+def test_parser() -> bool:
+    print("✓ Probando el parser JSON incremental...")
+    text = "```json\n" + json.dumps(SAMPLE, ensure_ascii=True) + "\n```"
+    rng = random.Random(7)
+    roundtrip = True
+    streamed_ok = True
+    for _ in range(200):
+        parser = IncrementalJSONParser()
+        streamed = {}
+        pos = 0
+        while pos < len(text):
+            step = rng.randint(1, 9)
+            for path, delta in parser.feed(text[pos:pos + step]):
+                streamed[path] = streamed.get(path, "") + delta
+            pos += step
+        roundtrip &= parser.complete and parser.close() == SAMPLE
+        streamed_ok &= streamed.get(("search", "es")) == SAMPLE["search"]["es"]
+
+    tolerant = parse_partial_json('{"a": [1, 2,], "b": {"c": "x",},}') == {"a": [1, 2], "b": {"c": "x"}}
+    truncated = parse_partial_json('{"search": {"es": "<p>Hola, mun') == {"search": {"es": "<p>Hola, mun"}}
+    ok = roundtrip and streamed_ok and tolerant and truncated
+    print(f"  {'✅' if ok else '❌'} 200 troceados aleatorios reconstruidos; comas colgantes y truncado tolerados")
+    return ok
+
+
+class ScriptedLLM(MockLLMBackend):
+    """Backend simulado que responde siempre con el texto indicado."""
+
+    def __init__(self, content: str, latency: float = 0.0):
+        super().__init__(latency=latency)
+        self.content = content
+
+    def respond(self, messages, model) -> LLMResponse:
+        return LLMResponse(self.content, prompt_tokens=10, completion_tokens=10, finish_reason="stop", model=model)
+
+
+def setup_service(latency: float, concurrency: int = 4, timeout: float = 60, llm=None):
+    """Configura los globales que el servicio fija en __main__."""
+    import sttcast_rag_service as svc
+    svc.RAG_SERVER_API_KEY = RAG_KEY
+    svc.OPENAI_GPT_MODEL = "mock-model"
+    svc.llm = llm or MockLLMBackend(latency=latency)
+    svc.llm_limits = EndpointLimits(concurrency={"relsearch": concurrency}, timeouts={"relsearch": timeout})
+    return svc
+
+
+def stream_payload() -> dict:
+    return {
+        "query": "¿Qué se dijo sobre el telescopio James Webb?",
+        "embeddings": [{"tag": "Speaker 0", "epname": "ep001", "epdate": "2024-01-01",
+                        "start": 10.0, "end": 20.0, "content": "Hablamos del telescopio James Webb"}],
+        "requester": "127.0.0.1",
+    }
+
+
+async def run_stream(base: str) -> tuple:
+    payload = stream_payload()
+    client = SignedAsyncClient(base, RAG_KEY, "stream_test")
+    first_delta, events = None, []
+    started = time.perf_counter()
+    try:
+        async for event, data in client.stream_events("/relsearch/stream", payload):
+            if event == "delta" and first_delta is None:
+                first_delta = time.perf_counter() - started
+            events.append((event, data))
+    finally:
+        await client.aclose()
+    return first_delta, time.perf_counter() - started, events
+
+
+def test_endpoint(latency: float) -> bool:
+    print("✓ Probando /relsearch/stream...")
+    svc = setup_service(latency)
+    port = free_port()
+    server = start_server(svc.app, port)
+    try:
+        first_delta, total, events = asyncio.run(run_stream(f"http://127.0.0.1:{port}"))
+    finally:
+        server.should_exit = True
+
+    deltas = [d for e, d in events if e == "delta"]
+    done = [d for e, d in events if e == "done"]
+    if not done:
+        print(f"  ❌ Falta el evento final: {events[-1:]}")
+        return False
+    streamed = {lang: "".join(d["text"] for d in deltas if d["lang"] == lang) for lang in ("es", "en")}
+    same_text = all(streamed[lang] == done[0]["search"][lang] for lang in ("es", "en"))
+    last = events[-1][0] == "done" and "refs" in done[0]
+    early = first_delta is not None and first_delta < total * 0.5
+
+    ok = same_text and last and early
+    print(f"  {'✅' if early else '❌'} Primer trozo a los {first_delta or 0:.2f}s de {total:.2f}s totales")
+    print(f"  {'✅' if same_text and last else '❌'} {len(deltas)} trozos reconstruyen la respuesta; "
+          f"referencias en el evento final")
+    return ok
+
+
+def test_refusal_and_invalid_json() -> bool:
+    print("✓ Probando un rechazo del modelo y una salida que no es JSON...")
+    refusal = json.dumps({"search": {"es": "Error: Consulta no válida. " + "No puedo responder. " * 5,
+                                     "en": "Error: Invalid query. " + "I cannot answer. " * 5},
+                          "refs": []}, ensure_ascii=False)
+    results = {}
+    for name, content in (("refusal", refusal), ("invalid", "La respuesta no es JSON: " + "texto " * 20)):
+        svc = setup_service(0.2, llm=ScriptedLLM(content, latency=0.2))
+        port = free_port()
+        server = start_server(svc.app, port)
+        try:
+            results[name] = asyncio.run(run_stream(f"http://127.0.0.1:{port}"))[2]
+        finally:
+            server.should_exit = True
+
+    events = results["refusal"]
+    refused = ([e for e, _ in events] == ["error"] and events[0][1]["status"] == 400)
+    print(f"  {'✅' if refused else '❌'} Rechazo: error 400 sin ningún trozo de texto enviado "
+          f"({[e for e, _ in events]})")
+    events = results["invalid"]
+    done = [d for e, d in events if e == "done"]
+    default = bool(done) and done[0]["search"]["es"].startswith("Error al procesar la respuesta")
+    print(f"  {'✅' if default else '❌'} Salida no JSON: respuesta por defecto en el evento final "
+          f"({[e for e, _ in events]})")
+    return refused and default
+
+
+async def run_saturation(base: str, svc) -> dict:
+    client = SignedAsyncClient(base, RAG_KEY, "stream_test", timeout=30)
+    result = {}
+
+    async def consume(name: str):
+        started = time.perf_counter()
+        try:
+            async for event, _ in client.stream_events("/relsearch/stream", stream_payload()):
+                if event == "delta":
+                    result.setdefault(f"{name}_delta", time.perf_counter() - started)
+                result[f"{name}_last"] = event
+        except Exception as e:
+            result[f"{name}_error"] = (getattr(getattr(e, "response", None), "status_code", None),
+                                       time.perf_counter() - started)
+
+    try:
+        # Hueco ocupado (sin esperar, así el semáforo no queda ligado a este event loop):
+        # B no lo consigue en el plazo y recibe un 504
+        release = await svc.llm_limits.acquire("relsearch")
+        await consume("b")
+        release()
+        # A se desconecta a mitad del stream: su hueco debe quedar libre para C
+        first = asyncio.create_task(consume("a"))
+        await asyncio.sleep(0.5)
+        result["active_during_stream"] = svc.llm_limits.stats()["relsearch"]["active"]
+        first.cancel()
+        await asyncio.gather(first, return_exceptions=True)
+        await asyncio.sleep(0.6)
+        result["active_after_disconnect"] = svc.llm_limits.stats()["relsearch"]["active"]
+        await consume("c")
+    finally:
+        await client.aclose()
+    result["stats"] = svc.llm_limits.stats()["relsearch"]
+    return result
+
+
+def test_saturation() -> bool:
+    print("✓ Probando /relsearch/stream con el endpoint saturado...")
+    svc = setup_service(latency=1.0, concurrency=1, timeout=1.5)
+    port = free_port()
+    server = start_server(svc.app, port)
+    try:
+        result = asyncio.run(run_saturation(f"http://127.0.0.1:{port}", svc))
+    finally:
+        server.should_exit = True
+
+    status, waited = result.get("b_error", (None, 0))
+    bounded = status == 504 and waited < 2.5
+    freed = (result["active_during_stream"] == 1 and result["active_after_disconnect"] == 0
+             and result["stats"]["cancelled"] >= 1)
+    reused = "c_delta" in result and result.get("c_last") == "done"
+    print(f"  {'✅' if bounded else '❌'} Sin hueco libre: {status} a los {waited:.2f}s (plazo 1.5s)")
+    print(f"  {'✅' if freed and reused else '❌'} Cliente desconectado a mitad: hueco liberado "
+          f"(activos {result['active_after_disconnect']}) y usado por el siguiente stream")
+    return bounded and freed and reused
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency", type=float, default=2.0, help="Latencia simulada del LLM (s)")
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    print("=" * 60)
+    print("Validación de /relsearch/stream")
+    print("=" * 60)
+    results = [test_parser(), test_endpoint(args.latency), test_refusal_and_invalid_json(), test_saturation()]
+    print("=" * 60)
+    if all(results):
+        print("✅ Todas las pruebas pasaron")
+        return 0
+    print("❌ Algunas pruebas fallaron")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+Validación del pipeline de resúmenes (summaries/get_rag_summaries.py + /summarize)
+Levanta el RAG server con un backend de LLM simulado y comprueba que:
+- los episodios se resumen en paralelo (cliente y bloques del servicio),
+- se envía el texto extraído en lugar del HTML completo,
+- una segunda ejecución no vuelve a resumir los episodios sin cambios,
+- un episodio que falla de forma transitoria se reintenta,
+- las respuestas 200 mal formadas se anotan como episodios fallidos sin
+  interrumpir a los demás.
+
+Uso:
+    python tests/validate_summaries_pipeline.py [--episodes 8] [--latency 0.5]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+# Añadir el directorio raíz del proyecto, rag/ y summaries/ al path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+sys.path.insert(0, os.path.join(project_root, 'rag'))
+sys.path.insert(0, os.path.join(project_root, 'summaries'))
+
+import httpx
+
+from api.apihmac import create_auth_headers, serialize_body
+from llmbackend import EndpointLimits, MockLLMBackend
+from load_context_server import free_port, start_server
+
+RAG_KEY = "summaries-test-rag-key"
+CONCURRENCY = 4
+
+
+class RecordingMockBackend(MockLLMBackend):
+    """Guarda los prompts y falla la primera llamada de los episodios indicados."""
+
+    def __init__(self, latency: float, fail_once: tuple = ()):
+        super().__init__(latency=latency)
+        self.prompts = []
+        self.fail_once = set(fail_once)
+
+    async def chat(self, messages, model, json_mode=False, timeout=None):
+        prompt = messages[-1]["content"]
+        self.prompts.append(prompt)
+        for marker in list(self.fail_once):
+            if marker in prompt:
+                self.fail_once.discard(marker)
+                raise RuntimeError(f"Fallo simulado del LLM para {marker}")
+        return await super().chat(messages, model, json_mode, timeout)
+
+
+def setup_service(backend: MockLLMBackend):
+    """Configura los globales que el servicio fija en __main__."""
+    import sttcast_rag_service as svc
+    svc.RAG_SERVER_API_KEY = RAG_KEY
+    svc.OPENAI_GPT_MODEL = "mock-model"
+    svc.OPENAI_SUMMARIES_MODEL = "mock-model"
+    svc.OPENAI_EMBEDDING_MODEL = "mock-embedding"
+    svc.llm = backend
+    svc.llm_limits = EndpointLimits(concurrency={"summarize": CONCURRENCY}, timeouts={"summarize": 60})
+    return svc
+
+
+def transcription_html(ep_id: str, version: int = 1) -> str:
+    """Transcripción con la estructura de sttcast (marcas de tiempo, hablantes y resumen de hablantes)."""
+    paragraphs = "\n".join(
+        f'<p><span class="time">[{i * 30}s]</span> [<span class="speaker-{i % 2}">Speaker {i % 2}</span>]: '
+        f'Marcador {ep_id} v{version}. Se habla del telescopio y de la intervención {i}. '
+        f'<audio controls preload="none"><source src="{ep_id}.mp3#t={i * 30}"></audio></p>'
+        for i in range(40)
+    )
+    return (f'<html><head><style>.time {{ color: grey; }}</style></head><body>'
+            f'<span id="speaker-summary"><table><tr><td>RESUMEN-HABLANTES</td></tr></table></span>'
+            f'{paragraphs}</body></html>')
+
+
+def write_transcriptions(input_dir: str, episodes: int):
+    for i in range(episodes):
+        ep_id = f"ep{i:03d}"
+        with open(os.path.join(input_dir, f"{ep_id}_whisper_audio_es.html"), "w", encoding="utf-8") as f:
+            f.write(transcription_html(ep_id))
+
+
+def run_client(input_dir: str, output_dir: str, url: str, **kwargs) -> tuple:
+    from get_rag_summaries import summarize_directory
+    start = time.perf_counter()
+    results = asyncio.run(summarize_directory(input_dir, output_dir, url, RAG_KEY, concurrency=CONCURRENCY,
+                                              backoff_base=0.05, **kwargs))
+    return results, time.perf_counter() - start
+
+
+def test_concurrent_plain_text(input_dir, output_dir, url, backend, episodes, latency) -> bool:
+    print("✓ Probando resúmenes concurrentes con texto plano...")
+    from get_rag_summaries import load_transcriptions
+    html_bytes = sum(os.path.getsize(os.path.join(input_dir, f)) for f in os.listdir(input_dir))
+    text_bytes = sum(len(ep["transcription"].encode("utf-8")) for ep in load_transcriptions(input_dir))
+
+    results, elapsed = run_client(input_dir, output_dir, url)
+    sequential = episodes * latency
+    saved = all(os.path.exists(os.path.join(output_dir, f"ep{i:03d}_summary.json")) for i in range(episodes))
+    concurrent = backend.max_in_flight > 1 and elapsed < sequential * 0.6
+    plain = (len(backend.prompts) == episodes
+             and not any("<audio" in p or "RESUMEN-HABLANTES" in p for p in backend.prompts)
+             and all("Marcador ep" in p and "Speaker 0" in p for p in backend.prompts))
+    ok = saved and concurrent and plain and results["summarized"] == episodes
+    print(f"  {'✅' if concurrent else '❌'} {episodes} episodios en {elapsed:.2f}s "
+          f"(secuencial: {sequential:.2f}s), {backend.max_in_flight} llamadas al LLM a la vez")
+    print(f"  {'✅' if plain else '❌'} Enviado texto plano: {text_bytes} bytes frente a {html_bytes} de HTML "
+          f"({1 - text_bytes / html_bytes:.0%} menos)")
+    print(f"  {'✅' if saved else '❌'} Resúmenes y manifiesto guardados")
+    return ok
+
+
+def test_skip_unchanged(input_dir, output_dir, url, backend) -> bool:
+    print("✓ Probando que no se repiten los episodios sin cambios...")
+    calls = backend.calls
+    results, _ = run_client(input_dir, output_dir, url)
+    new_calls = backend.calls - calls
+    unchanged = new_calls == 0 and results["summarized"] == 0
+
+    with open(os.path.join(input_dir, "ep001_whisper_audio_es.html"), "w", encoding="utf-8") as f:
+        f.write(transcription_html("ep001", version=2))
+    results_changed, _ = run_client(input_dir, output_dir, url)
+    changed = backend.calls == calls + 1 and results_changed["summarized"] == 1
+
+    results_forced, _ = run_client(input_dir, output_dir, url, force=True)
+    forced = results_forced["summarized"] == results["skipped"]
+    ok = unchanged and changed and forced
+    print(f"  {'✅' if unchanged else '❌'} Segunda ejecución: {results['skipped']} omitidos, "
+          f"{new_calls} llamadas nuevas al LLM")
+    print(f"  {'✅' if changed else '❌'} Transcripción modificada: {results_changed['summarized']} resumido")
+    print(f"  {'✅' if forced else '❌'} --force: {results_forced['summarized']} resumidos")
+    return ok
+
+
+def test_retry(input_dir, output_dir, url, backend) -> bool:
+    print("✓ Probando reintentos por episodio...")
+    backend.fail_once = {"Marcador ep002 ", "Marcador ep005 "}
+    results, _ = run_client(input_dir, output_dir, url, force=True, retries=2)
+    with open(os.path.join(output_dir, "summaries_manifest.json"), encoding="utf-8") as f:
+        manifest = json.load(f)
+    ok = not results["failed"] and not backend.fail_once and {"ep002", "ep005"} <= set(manifest)
+    print(f"  {'✅' if ok else '❌'} 2 fallos transitorios del LLM, {len(results['failed'])} episodios fallidos")
+    return ok
+
+
+def build_malformed_service() -> "FastAPI":
+    """Servicio /summarize simulado con respuestas 200 mal formadas para algunos episodios."""
+    from fastapi import FastAPI, Request, Response
+
+    stub = FastAPI()
+
+    @stub.post("/summarize")
+    async def summarize(request: Request):
+        item = json.loads(await request.body())[0]
+        ep_id = item["ep_id"]
+        if ep_id == "ep000":
+            return []                                          # IndexError
+        if ep_id == "ep001":
+            return Response(content="no es JSON", media_type="application/json")  # ValueError
+        if ep_id == "ep002":
+            return [{"ep_id": ep_id}]                          # KeyError: falta summary
+        await asyncio.sleep(0.2)
+        return [{"ep_id": ep_id, "summary": json.dumps({"es": "Resumen", "en": "Summary"}),
+                 "tokens_prompt": 1, "tokens_completion": 1, "tokens_total": 2, "estimated_cost_usd": 0}]
+
+    return stub
+
+
+def test_malformed_responses() -> bool:
+    print("✓ Probando respuestas 200 mal formadas...")
+    port = free_port()
+    server = start_server(build_malformed_service(), port)
+    try:
+        with tempfile.TemporaryDirectory() as input_dir, tempfile.TemporaryDirectory() as output_dir:
+            write_transcriptions(input_dir, 5)
+            results, _ = run_client(input_dir, output_dir, f"http://127.0.0.1:{port}/summarize", retries=0)
+            with open(os.path.join(output_dir, "summaries_manifest.json"), encoding="utf-8") as f:
+                manifest = json.load(f)
+    finally:
+        server.should_exit = True
+    ok = (sorted(results["failed"]) == ["ep000", "ep001", "ep002"] and results["summarized"] == 2
+          and set(manifest) == {"ep003", "ep004"})
+    print(f"  {'✅' if ok else '❌'} {len(results['failed'])} respuestas mal formadas anotadas como fallidas; "
+          f"{results['summarized']} episodios resumidos igualmente")
+    return ok
+
+
+async def post_block(url: str, block: list) -> list:
+    headers = create_auth_headers(RAG_KEY, "POST", url, block, "summaries_test")
+    async with httpx.AsyncClient(timeout=60) as client:
+        r = await client.post(url, content=serialize_body(block).encode('utf-8'), headers=headers)
+    r.raise_for_status()
+    return r.json()
+
+
+def test_service_block(url, backend, latency) -> bool:
+    print("✓ Probando un bloque HTML de varios episodios en el servicio...")
+    block = [{"ep_id": f"blk{i}", "transcription": transcription_html(f"blk{i}")} for i in range(CONCURRENCY)]
+    backend.max_in_flight = 0
+    start = time.perf_counter()
+    summaries = asyncio.run(post_block(url, block))
+    elapsed = time.perf_counter() - start
+    ok = ([s["ep_id"] for s in summaries] == [b["ep_id"] for b in block]
+          and backend.max_in_flight == CONCURRENCY and elapsed < latency * CONCURRENCY * 0.6)
+    print(f"  {'✅' if ok else '❌'} {len(block)} episodios en {elapsed:.2f}s, en el orden enviado")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--episodes", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.5)
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    backend = RecordingMockBackend(latency=args.latency)
+    svc = setup_service(backend)
+    port = free_port()
+    server = start_server(svc.app, port)
+    url = f"http://127.0.0.1:{port}/summarize"
+
+    print("=" * 60)
+    print("Validación del pipeline de resúmenes")
+    print("=" * 60)
+    try:
+        with tempfile.TemporaryDirectory() as input_dir, tempfile.TemporaryDirectory() as output_dir:
+            write_transcriptions(input_dir, args.episodes)
+            results = [
+                test_concurrent_plain_text(input_dir, output_dir, url, backend, args.episodes, args.latency),
+                test_skip_unchanged(input_dir, output_dir, url, backend),
+                test_retry(input_dir, output_dir, url, backend),
+                test_service_block(url, backend, args.latency),
+                test_malformed_responses(),
+            ]
+    finally:
+        server.should_exit = True
+    print("=" * 60)
+    if all(results):
+        print("✅ Todas las pruebas pasaron")
+        return 0
+    print("❌ Algunas pruebas fallaron")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+Validación del índice de anclas de tiempo de las transcripciones
+(tools/timeanchors.py y rag/client/findtime.py)
+Con una transcripción sintética de varias horas comprueba que:
+- find_nearest_time_id devuelve lo mismo que el recorrido anterior con BeautifulSoup,
+- la búsqueda con el índice en memoria tarda microsegundos,
+- el sidecar <html>.anchors.json se reutiliza y se reconstruye al cambiar el HTML,
+- una transcripción remota se revalida con If-None-Match (304) y se vuelve a
+  descargar solo cuando cambia su ETag.
+
+Uso:
+    python tests/validate_time_anchors.py [--hours 3]
+"""
+
+import argparse
+import hashlib
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+# Añadir el directorio raíz del proyecto y rag/client/ al path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+sys.path.insert(0, os.path.join(project_root, 'rag', 'client'))
+
+from bs4 import BeautifulSoup
+from fastapi import FastAPI, Request, Response
+
+from findtime import TimeAnchorCache, find_nearest_time_id
+from load_context_server import free_port, start_server
+from tools.timeanchors import sidecar_path
+
+WORDS = "podcast ciencia telescopio universo galaxia estrella planeta agujero negro luz".split()
+
+
+def anchor_id(secs: int) -> str:
+    return f"time-{secs // 3600:02d}-{(secs % 3600) // 60:02d}-{secs % 60:02d}"
+
+
+def synthetic_transcript(hours: float, seed: int, offset: int = 0) -> str:
+    """HTML con el formato de sttcast: un párrafo con <span class="time"> cada 10-40 s."""
+    rng = random.Random(seed)
+    parts = ['<html><body><h2 class="title">Episodio de prueba</h2>']
+    secs = offset
+    while secs < hours * 3600:
+        words = " ".join(f'<span class="{rng.choice(["low", "medium", "high"])}">{rng.choice(WORDS)}</span>'
+                         if rng.random() < 0.3 else rng.choice(WORDS) for _ in range(60))
+        parts.append(f'<p><span class="time" id="{anchor_id(secs)}">[{secs}]</span><br>'
+                     f'<span class="speaker-0">Hablante</span><span>{words}</span></p>')
+        # Alguna ancla repetida, como las de párrafos que empiezan en el mismo segundo
+        secs += 0 if rng.random() < 0.02 else rng.randint(10, 40)
+    parts.append('</body></html>')
+    return "\n".join(parts)
+
+
+def bs4_nearest(spans: list, target_seconds: float):
+    """El recorrido de find_nearest_time_id antes del índice, sobre los spans ya parseados."""
+    best_id, best_secs = None, -1
+    for span in spans:
+        sid = span.get("id", "")
+        try:
+            hh, mm, ss = map(int, sid.replace("time-", "").split("-"))
+        except Exception:
+            continue
+        secs = hh * 3600 + mm * 60 + ss
+        if secs <= target_seconds and secs > best_secs:
+            best_secs, best_id = secs, sid
+    return best_id
+
+
+def bs4_spans(html: str) -> list:
+    return BeautifulSoup(html, "html.parser").find_all("span", class_="time")
+
+
+def test_equivalence(path: str, html: str, hours: float) -> bool:
+    print("✓ Probando que el índice da los mismos ids que BeautifulSoup...")
+    rng = random.Random(5)
+    targets = [0, 0.5, 9.99, hours * 3600 + 100] + [rng.uniform(0, hours * 3600) for _ in range(200)]
+    spans = bs4_spans(html)
+    expected = [bs4_nearest(spans, t) for t in targets]
+    got = [find_nearest_time_id(path, t) for t in targets]
+    mismatches = sum(a != b for a, b in zip(got, expected))
+    ok = mismatches == 0 and expected[0] is not None
+    print(f"  {'✅' if ok else '❌'} {len(targets)} tiempos, {mismatches} diferencias "
+          f"(incluidos los extremos de la transcripción)")
+    return ok
+
+
+def test_lookup_speed(path: str, html: str) -> bool:
+    print("✓ Probando el tiempo de búsqueda...")
+    start = time.perf_counter()
+    bs4_nearest(bs4_spans(html), 3600)
+    bs4_ms = (time.perf_counter() - start) * 1000
+
+    find_nearest_time_id(path, 3600)
+    n = 2000
+    start = time.perf_counter()
+    for i in range(n):
+        find_nearest_time_id(path, (i * 7) % 10000)
+    lookup_us = (time.perf_counter() - start) / n * 1e6
+    # Incluye el os.stat que valida el índice contra el mtime del HTML
+    ok = lookup_us < 1000
+    print(f"  {'✅' if ok else '❌'} Índice en memoria: {lookup_us:.1f} µs por búsqueda "
+          f"(parsear con BeautifulSoup: {bs4_ms:.0f} ms por referencia)")
+    return ok
+
+
+def test_sidecar(path: str, hours: float) -> bool:
+    print("✓ Probando el sidecar y su invalidación por mtime...")
+    cache = TimeAnchorCache()
+    before = cache.local_index(path)
+    from_sidecar = os.path.exists(sidecar_path(path)) and cache.stats()["sidecar"] == 1
+    cache.local_index(path)
+    from_memory = cache.stats()["memory"] == 1
+
+    # Nueva versión de la transcripción (anclas desplazadas 5 s)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(synthetic_transcript(hours, seed=1, offset=5))
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000))
+    after = cache.local_index(path)
+    rebuilt = cache.stats()["parsed"] == 1 and after.seconds[0] == 5 and before.seconds[0] == 0
+    reread = TimeAnchorCache()
+    reread.local_index(path)
+    refreshed = reread.stats()["sidecar"] == 1
+
+    ok = from_sidecar and from_memory and rebuilt and refreshed
+    print(f"  {'✅' if from_sidecar and from_memory else '❌'} Índice leído del sidecar "
+          f"({os.path.getsize(sidecar_path(path))} bytes) y después de memoria")
+    print(f"  {'✅' if rebuilt and refreshed else '❌'} HTML modificado: índice reconstruido y sidecar reescrito")
+    return ok
+
+
+def build_transcript_server(state: dict) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/transcripts/{name}")
+    async def transcript(name: str, request: Request):
+        state["requests"] += 1
+        etag = '"' + hashlib.sha256(state["html"].encode()).hexdigest()[:16] + '"'
+        if request.headers.get("if-none-match") == etag:
+            state["not_modified"] += 1
+            return Response(status_code=304, headers={"ETag": etag})
+        return Response(state["html"], media_type="text/html", headers={"ETag": etag})
+
+    return app
+
+
+def test_remote(hours: float) -> bool:
+    print("✓ Probando la revalidación de transcripciones remotas...")
+    state = {"html": synthetic_transcript(hours, seed=2), "requests": 0, "not_modified": 0}
+    port = free_port()
+    server = start_server(build_transcript_server(state), port)
+    url = f"http://127.0.0.1:{port}/transcripts/ep001_whisper_audio_es.html"
+    clock = [0.0]
+    cache = TimeAnchorCache(revalidate_seconds=60, clock=lambda: clock[0])
+    try:
+        # Diez referencias del mismo episodio en una respuesta
+        ids = [cache.remote_index(url).nearest(600 + i) for i in range(10)]
+        single = state["requests"] == 1 and all(ids)
+
+        clock[0] = 61
+        cache.remote_index(url)
+        revalidated = state["requests"] == 2 and state["not_modified"] == 1
+
+        state["html"] = synthetic_transcript(hours, seed=2, offset=3)
+        clock[0] = 122
+        changed = cache.remote_index(url).seconds[0] == 3 and cache.stats()["downloaded"] == 2
+    finally:
+        server.should_exit = True
+
+    ok = single and revalidated and changed
+    print(f"  {'✅' if single else '❌'} 10 referencias del mismo episodio: 1 descarga")
+    print(f"  {'✅' if revalidated else '❌'} Pasado el intervalo: petición condicional respondida con 304")
+    print(f"  {'✅' if changed else '❌'} ETag nuevo: transcripción descargada e índice reconstruido")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hours", type=float, default=3, help="Duración de la transcripción sintética")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    print("=" * 60)
+    print("Validación del índice de anclas de tiempo")
+    print("=" * 60)
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, "ep001_whisper_audio_es.html")
+        html = synthetic_transcript(args.hours, seed=1)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(html)
+        print(f"Transcripción sintética de {args.hours:g} h: {len(html) / 1e6:.1f} MB")
+        results = [
+            test_equivalence(path, html, args.hours),
+            test_lookup_speed(path, html),
+            test_sidecar(path, args.hours),
+            test_remote(args.hours),
+        ]
+    print("=" * 60)
+    if all(results):
+        print("✅ Todas las pruebas pasaron")
+        return 0
+    print("❌ Algunas pruebas fallaron")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""
+Validación de la caché en disco de transcripciones remotas (rag/client/transcriptcache.py)
+Con un servidor HTTP local que hace de S3 (ETag, latencia configurable y
+caídas simuladas) comprueba que:
+- 50 peticiones simultáneas de un episodio nuevo provocan una sola descarga,
+- las siguientes se sirven del disco, y pasado el intervalo de revalidación se
+  sirve la copia mientras se revalida en segundo plano (304 o contenido nuevo),
+- con S3 caído se sigue sirviendo la copia local,
+- el tamaño queda acotado (LRU) y el índice sobrevive a un reinicio,
+- una entrada fijada mientras se sirve no se borra al expulsarla ni al
+  renovarla (se borra al soltarla), y una respuesta en curso envía el archivo
+  completo aunque otra petición lo expulse a mitad,
+- el proxy de /transcripts sirve el HTML desde la caché con el ETag de S3.
+
+Uso:
+    python tests/validate_transcript_cache.py [--latency 0.2] [--viewers 50]
+"""
+
+import argparse
+import asyncio
+import hashlib
+import logging
+import os
+import sys
+import tempfile
+import time
+
+# Añadir el directorio raíz del proyecto y rag/client/ al path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+sys.path.insert(0, os.path.join(project_root, 'rag', 'client'))
+
+import httpx
+from fastapi import FastAPI, Request, Response
+
+from load_context_server import free_port, start_server
+from transcriptcache import TranscriptDiskCache
+from starlette.requests import Request as StarletteRequest
+
+from transcriptproxy import TranscriptProxy
+
+EPISODE = "ep100_whisper_audio_es.html"
+
+
+class S3Stub:
+    """Storage simulado: cuenta descargas y peticiones condicionales."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.objects = {}
+        self.down = False
+        self.downloads = 0
+        self.not_modified = 0
+        self.app = FastAPI()
+
+        @self.app.get("/{name}")
+        async def get_object(name: str, request: Request):
+            await asyncio.sleep(self.latency)
+            if self.down:
+                return Response(status_code=503)
+            if name not in self.objects:
+                return Response(status_code=404)
+            body = self.objects[name]
+            etag = '"' + hashlib.md5(body).hexdigest() + '"'
+            if request.headers.get("if-none-match") == etag:
+                self.not_modified += 1
+                return Response(status_code=304, headers={"ETag": etag})
+            self.downloads += 1
+            return Response(body, media_type="text/html", headers={"ETag": etag})
+
+
+def html(episode: int, version: int = 1, size: int = 20_000) -> bytes:
+    return (f"<html><body><h2>Episodio {episode} v{version}</h2>".encode() + b"x" * size + b"</body></html>")
+
+
+def read(entry) -> bytes:
+    with open(entry.path, "rb") as f:
+        return f.read()
+
+
+async def check_single_flight(base: str, workdir: str, s3: S3Stub, viewers: int) -> bool:
+    print(f"✓ Probando {viewers} lectores simultáneos de un episodio nuevo...")
+    s3.objects[EPISODE] = html(100)
+    async with httpx.AsyncClient() as client:
+        cache = TranscriptDiskCache(os.path.join(workdir, "c1"), base, client)
+        entries = await asyncio.gather(*(cache.get(EPISODE) for _ in range(viewers)))
+        same = all(read(e) == s3.objects[EPISODE] for e in entries)
+        start = time.perf_counter()
+        again = await cache.get(EPISODE)
+        hit_ms = (time.perf_counter() - start) * 1000
+        stats = cache.stats()
+    ok = (s3.downloads == 1 and stats["coalesced"] == viewers - 1 and same
+          and again is not None and stats["hits"] == 1 and hit_ms < s3.latency * 1000 / 2)
+    print(f"  {'✅' if s3.downloads == 1 and same else '❌'} {s3.downloads} descarga para {viewers} "
+          f"peticiones ({stats['coalesced']} esperaron a la misma)")
+    print(f"  {'✅' if stats['hits'] == 1 else '❌'} Siguiente lectura desde disco en {hit_ms:.2f} ms "
+          f"(S3: {s3.latency * 1000:.0f} ms)")
+    return ok
+
+
+async def check_revalidation(base: str, workdir: str, s3: S3Stub) -> bool:
+    print("✓ Probando la revalidación en segundo plano y la caída de S3...")
+    s3.objects[EPISODE] = html(100)
+    clock = [1000.0]
+    async with httpx.AsyncClient() as client:
+        cache = TranscriptDiskCache(os.path.join(workdir, "c2"), base, client,
+                                    revalidate_seconds=60, clock=lambda: clock[0])
+        await cache.get(EPISODE)
+
+        # Caducada sin cambios: se sirve al momento y un 304 la renueva
+        clock[0] += 61
+        start = time.perf_counter()
+        stale = await cache.get(EPISODE)
+        stale_ms = (time.perf_counter() - start) * 1000
+        await asyncio.sleep(s3.latency * 3)
+        revalidated = (stale is not None and stale_ms < s3.latency * 1000 / 2 and s3.not_modified == 1
+                       and cache.stats()["revalidated"] == 1 and stale.validated_at == clock[0])
+
+        # Contenido nuevo en S3: la copia vieja se sirve una vez más y se sustituye
+        s3.objects[EPISODE] = html(100, version=2)
+        clock[0] += 61
+        old = read(await cache.get(EPISODE))
+        await asyncio.sleep(s3.latency * 3)
+        new = read(await cache.get(EPISODE))
+        refreshed = old == html(100) and new == html(100, version=2) and cache.stats()["refreshed"] == 1
+
+        # S3 caído: la copia local sigue sirviéndose; lo que no está en la caché falla
+        s3.down = True
+        clock[0] += 61
+        during_outage = read(await cache.get(EPISODE)) == html(100, version=2)
+        await asyncio.sleep(s3.latency * 3)
+        try:
+            await cache.get("ep999_whisper_audio_es.html")
+            uncached_fails = False
+        except httpx.HTTPError:
+            uncached_fails = True
+        s3.down = False
+        stats = cache.stats()
+    resilient = during_outage and uncached_fails and stats["errors"] == 2
+    print(f"  {'✅' if revalidated else '❌'} Copia caducada servida en {stale_ms:.2f} ms y renovada con 304")
+    print(f"  {'✅' if refreshed else '❌'} ETag distinto: copia sustituida tras servir la anterior")
+    print(f"  {'✅' if resilient else '❌'} S3 caído: copia local servida; sin copia, error ({stats['errors']} errores)")
+    print(f"  Estadísticas: {stats}")
+    return revalidated and refreshed and resilient
+
+
+async def check_lru(base: str, workdir: str, s3: S3Stub) -> bool:
+    print("✓ Probando el límite de tamaño y el reinicio...")
+    cache_dir = os.path.join(workdir, "c3")
+    names = [f"ep{i:03d}_whisper_audio_es.html" for i in range(6)]
+    for i, name in enumerate(names):
+        s3.objects[name] = html(i)
+    entry_size = len(html(0))
+    async with httpx.AsyncClient() as client:
+        cache = TranscriptDiskCache(cache_dir, base, client, max_bytes=entry_size * 3)
+        for name in names[:3]:
+            await cache.get(name)
+        await cache.get(names[0])          # el 0 pasa a ser el más reciente
+        for name in names[3:5]:
+            await cache.get(name)          # expulsan el 1 y el 2
+        kept = list(cache._entries)
+        files = [f for f in os.listdir(cache_dir) if f.endswith(".html")]
+        bounded = (cache.total_bytes <= cache.max_bytes and kept == [names[0], names[3], names[4]]
+                   and len(files) == 3 and cache.stats()["evictions"] == 2)
+
+        restarted = TranscriptDiskCache(cache_dir, base, client, max_bytes=entry_size * 3)
+        downloads = s3.downloads
+        await restarted.get(names[4])
+        persisted = (list(restarted._entries)[-1] == names[4] and set(restarted._entries) == set(kept)
+                     and s3.downloads == downloads)
+    print(f"  {'✅' if bounded else '❌'} {cache.total_bytes} bytes de {cache.max_bytes}: "
+          f"expulsados los menos usados ({cache.stats()['evictions']})")
+    print(f"  {'✅' if persisted else '❌'} Tras reiniciar: {len(restarted._entries)} entradas sin volver a descargar")
+    return bounded and persisted
+
+
+async def check_pinning(base: str, workdir: str, s3: S3Stub) -> bool:
+    print("✓ Probando las entradas fijadas mientras se sirven...")
+    names = [f"ep2{i:02d}_whisper_audio_es.html" for i in range(3)]
+    for i, name in enumerate(names):
+        s3.objects[name] = html(200 + i, size=1_000_000)
+    entry_size = len(s3.objects[names[0]])
+    clock = [1000.0]
+    async with httpx.AsyncClient() as client:
+        cache = TranscriptDiskCache(os.path.join(workdir, "c5"), base, client, max_bytes=entry_size,
+                                    revalidate_seconds=60, clock=lambda: clock[0])
+
+        # Expulsión: el archivo fijado sigue en disco hasta soltarlo
+        pinned = await cache.get(names[0], pin=True)
+        await cache.get(names[1])
+        kept_while_pinned = names[0] not in cache._entries and os.path.exists(pinned.path)
+        await cache.release(pinned)
+        evicted = kept_while_pinned and not os.path.exists(pinned.path) and cache.stats()["pinned"] == 0
+
+        # Renovación: la copia nueva va a otro archivo y la fijada no se toca
+        pinned = await cache.get(names[1], pin=True)
+        s3.objects[names[1]] = html(201, version=2, size=1_000_000)
+        clock[0] += 61
+        await cache.get(names[1])
+        await asyncio.sleep(s3.latency * 3)
+        current = cache._entries[names[1]]
+        untouched = read(pinned) == html(201, size=1_000_000) and current.path != pinned.path
+        await cache.release(pinned)
+        refreshed = (untouched and not os.path.exists(pinned.path)
+                     and read(current) == html(201, version=2, size=1_000_000))
+
+        # Respuesta en curso: otra petición expulsa la entrada tras el primer bloque
+        proxy = TranscriptProxy(base, None, client, cache=cache)
+        scope = {"type": "http", "method": "GET", "path": f"/transcripts/{names[1]}", "headers": []}
+        response = await proxy._from_cache(names[1], StarletteRequest(scope))
+        served_path = cache._entries[names[1]].path
+        body, evicted_midway = [], []
+
+        async def receive():
+            await asyncio.sleep(3600)
+
+        async def send(message):
+            if message["type"] == "http.response.body":
+                body.append(message.get("body", b""))
+                if len(body) == 1:
+                    await cache.get(names[2])
+                    evicted_midway.append(names[1] not in cache._entries and os.path.exists(served_path))
+
+        await response(scope, receive, send)
+        streamed = (b"".join(body) == html(201, version=2, size=1_000_000) and evicted_midway == [True]
+                    and not os.path.exists(served_path) and cache.stats()["pinned"] == 0)
+    print(f"  {'✅' if evicted else '❌'} Expulsada mientras se servía: el archivo se borra al soltarla")
+    print(f"  {'✅' if refreshed else '❌'} Renovada mientras se servía: copia nueva en otro archivo, "
+          f"la anterior intacta hasta soltarla")
+    print(f"  {'✅' if streamed else '❌'} Respuesta de {entry_size} bytes completa aunque se expulsó a mitad de envío")
+    return evicted and refreshed and streamed
+
+
+def check_proxy(base: str, workdir: str, s3: S3Stub) -> bool:
+    print("✓ Probando /transcripts con la caché...")
+    s3.objects[EPISODE] = html(100)
+    client = httpx.AsyncClient()
+    cache = TranscriptDiskCache(os.path.join(workdir, "c4"), base, client)
+    proxy = TranscriptProxy(base, None, client, cache=cache)
+    app = FastAPI()
+
+    @app.get("/transcripts/{file_path:path}")
+    async def get_transcript(file_path: str, request: Request):
+        return await proxy.serve(file_path, request)
+
+    port = free_port()
+    server = start_server(app, port)
+    try:
+        downloads = s3.downloads
+        url = f"http://127.0.0.1:{port}/transcripts/{EPISODE}"
+        first, second = httpx.get(url, timeout=10), httpx.get(url, timeout=10)
+        etag = '"' + hashlib.md5(html(100)).hexdigest() + '"'
+        conditional = httpx.get(url, headers={"If-None-Match": etag}, timeout=10)
+        missing = httpx.get(f"http://127.0.0.1:{port}/transcripts/no_existe.html", timeout=10)
+    finally:
+        server.should_exit = True
+    ok = (first.content == second.content == html(100) and s3.downloads == downloads + 1
+          and second.headers.get("etag") == etag and conditional.status_code == 304
+          and missing.status_code == 404 and proxy.stats()["cache"]["hits"] == 2)
+    print(f"  {'✅' if ok else '❌'} Dos visitas, {s3.downloads - downloads} descarga; ETag de S3 y 304 "
+          f"desde la copia local; 404 para lo que S3 no tiene")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency", type=float, default=0.2, help="Latencia del S3 simulado (s)")
+    parser.add_argument("--viewers", type=int, default=50, help="Peticiones simultáneas del episodio nuevo")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    print("=" * 60)
+    print("Validación de la caché de transcripciones")
+    print("=" * 60)
+    s3 = S3Stub(args.latency)
+    port = free_port()
+    server = start_server(s3.app, port)
+    base = f"http://127.0.0.1:{port}"
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            results = [
+                asyncio.run(check_single_flight(base, workdir, s3, args.viewers)),
+                asyncio.run(check_revalidation(base, workdir, s3)),
+                asyncio.run(check_lru(base, workdir, s3)),
+                asyncio.run(check_pinning(base, workdir, s3)),
+                check_proxy(base, workdir, s3),
+            ]
+    finally:
+        server.should_exit = True
+    print("=" * 60)
+    if all(results):
+        print("✅ Todas las pruebas pasaron")
+        return 0
+    print("❌ Algunas pruebas fallaron")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
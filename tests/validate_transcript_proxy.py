@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Validación del proxy de /transcripts (rag/client/transcriptproxy.py)
+Levanta un servidor HTTP local que hace de S3 (Range, ETag, Last-Modified) y
+el proxy delante, y comprueba que:
+- una descarga completa se retransmite por bloques con la memoria acotada,
+- Range, If-None-Match e If-Modified-Since llegan al storage y sus 206/304 se
+  devuelven tal cual,
+- si el cliente se desconecta se cierra la descarga del storage,
+- los archivos que solo están en local se sirven con FileResponse (Range y 304),
+  también con el storage caído, y el path traversal se rechaza.
+
+Uso:
+    python tests/validate_transcript_proxy.py [--size-mb 16]
+"""
+
+import argparse
+import hashlib
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Añadir el directorio raíz del proyecto y rag/client/ al path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+sys.path.insert(0, os.path.join(project_root, 'rag', 'client'))
+
+import httpx
+from email.utils import formatdate
+from fastapi import FastAPI, Request, Response
+from starlette.responses import FileResponse
+
+from load_context_server import free_port, start_server
+from transcriptproxy import TranscriptProxy
+
+AUDIO = "ep001_whisper_audio.mp3"
+HTML = "ep001_whisper_audio_es.html"
+LOCAL_ONLY = "ep002_whisper_audio_es.html"
+
+
+def build_s3_stub(root: str, seen: list) -> FastAPI:
+    """Storage mínimo con el comportamiento de S3 para GET: Range, ETag y Last-Modified."""
+    app = FastAPI()
+
+    @app.get("/{name}")
+    async def get_object(name: str, request: Request):
+        seen.append(dict(request.headers))
+        path = os.path.join(root, name)
+        if not os.path.isfile(path):
+            return Response(status_code=404)
+        st = os.stat(path)
+        etag = '"' + hashlib.md5(f"{name}-{st.st_size}".encode()).hexdigest() + '"'
+        last_modified = formatdate(st.st_mtime, usegmt=True)
+        if request.headers.get("if-none-match") == etag or request.headers.get("if-modified-since") == last_modified:
+            return Response(status_code=304, headers={"ETag": etag, "Last-Modified": last_modified})
+        return FileResponse(path, headers={"ETag": etag, "Last-Modified": last_modified},
+                            media_type="application/octet-stream")
+
+    return app
+
+
+def build_proxy_app(proxy: TranscriptProxy) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/transcripts/{file_path:path}")
+    async def get_transcript(file_path: str, request: Request):
+        return await proxy.serve(file_path, request)
+
+    return app
+
+
+def test_streaming(base: str, audio: bytes) -> bool:
+    print("✓ Probando una descarga completa en streaming...")
+    digest = hashlib.sha256()
+    tracemalloc.start()
+    with httpx.stream("GET", f"{base}/transcripts/{AUDIO}", timeout=30) as response:
+        for chunk in response.iter_bytes():
+            digest.update(chunk)
+        headers = response.headers
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    ok = (response.status_code == 200 and digest.digest() == hashlib.sha256(audio).digest()
+          and headers.get("content-length") == str(len(audio)) and headers.get("content-type") == "audio/mpeg"
+          and peak < len(audio) / 4)
+    print(f"  {'✅' if ok else '❌'} {len(audio) / 2**20:.0f} MB íntegros con Content-Length; "
+          f"pico de memoria (proxy, storage y cliente) {peak / 1e6:.1f} MB")
+    return ok
+
+
+def test_range_and_conditional(base: str, audio: bytes, seen: list) -> bool:
+    print("✓ Probando Range, If-None-Match e If-Modified-Since...")
+    url = f"{base}/transcripts/{AUDIO}"
+    start, end = 5_000_000, 5_999_999
+    partial = httpx.get(url, headers={"Range": f"bytes={start}-{end}"}, timeout=10)
+    ranged = (partial.status_code == 206 and partial.content == audio[start:end + 1]
+              and partial.headers["content-range"] == f"bytes {start}-{end}/{len(audio)}"
+              and seen[-1].get("range") == f"bytes={start}-{end}")
+
+    etag, last_modified = partial.headers["etag"], partial.headers["last-modified"]
+    by_etag = httpx.get(url, headers={"If-None-Match": etag}, timeout=10)
+    by_date = httpx.get(url, headers={"If-Modified-Since": last_modified}, timeout=10)
+    conditional = (by_etag.status_code == 304 and not by_etag.content and by_etag.headers.get("etag") == etag
+                   and by_date.status_code == 304 and seen[-1].get("if-modified-since") == last_modified)
+
+    html = httpx.get(f"{base}/transcripts/{HTML}", timeout=10)
+    html_ok = html.status_code == 200 and html.headers["content-type"] == "text/html; charset=utf-8"
+    ok = ranged and conditional and html_ok
+    print(f"  {'✅' if ranged else '❌'} Range reenviado: 206 con {len(partial.content)} bytes y Content-Range")
+    print(f"  {'✅' if conditional else '❌'} Peticiones condicionales: 304 del storage sin cuerpo")
+    print(f"  {'✅' if html_ok else '❌'} HTML con Content-Type text/html; charset=utf-8")
+    return ok
+
+
+def test_disconnect(base: str, proxy: TranscriptProxy) -> bool:
+    print("✓ Probando la desconexión del cliente a mitad de descarga...")
+    with httpx.stream("GET", f"{base}/transcripts/{AUDIO}", timeout=10) as response:
+        first = next(response.iter_bytes())
+        during = proxy.active_streams
+    deadline = time.monotonic() + 5
+    while proxy.active_streams and time.monotonic() < deadline:
+        time.sleep(0.05)
+    ok = bool(first) and during == 1 and proxy.active_streams == 0
+    print(f"  {'✅' if ok else '❌'} Descarga del storage cerrada ({during} activa durante, "
+          f"{proxy.active_streams} después)")
+    return ok
+
+
+def test_local(base: str, down_base: str, local: bytes) -> bool:
+    print("✓ Probando los archivos locales...")
+    url = f"{base}/transcripts/{LOCAL_ONLY}"
+    full = httpx.get(url, timeout=10)
+    partial = httpx.get(url, headers={"Range": "bytes=10-19"}, timeout=10)
+    cached = httpx.get(url, headers={"If-None-Match": full.headers.get("etag", "")}, timeout=10)
+    served = (full.status_code == 200 and full.content == local and partial.status_code == 206
+              and partial.content == local[10:20] and cached.status_code == 304)
+
+    fallback = httpx.get(f"{down_base}/transcripts/{LOCAL_ONLY}", timeout=10)
+    missing = httpx.get(f"{down_base}/transcripts/no_existe.html", timeout=10)
+    traversal = httpx.get(f"{base}/transcripts/..%2Fsecreto.txt", timeout=10)
+    resilient = fallback.status_code == 200 and missing.status_code == 502 and traversal.status_code == 404
+    ok = served and resilient
+    print(f"  {'✅' if served else '❌'} Solo en local: 200, 206 para Range y 304 con su ETag")
+    print(f"  {'✅' if resilient else '❌'} Storage caído: copia local servida ({fallback.status_code}), "
+          f"{missing.status_code} si no la hay; path traversal: {traversal.status_code}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=int, default=16, help="Tamaño del audio simulado (MB)")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    print("=" * 60)
+    print("Validación del proxy de transcripciones")
+    print("=" * 60)
+    with tempfile.TemporaryDirectory() as workdir:
+        s3_dir, local_dir = os.path.join(workdir, "s3"), os.path.join(workdir, "local")
+        os.makedirs(s3_dir)
+        os.makedirs(local_dir)
+        audio = os.urandom(args.size_mb * 1024 * 1024)
+        local = b"<html><body><p>Solo en local</p></body></html>"
+        with open(os.path.join(s3_dir, AUDIO), "wb") as f:
+            f.write(audio)
+        with open(os.path.join(s3_dir, HTML), "wb") as f:
+            f.write(b"<html><body><p>Transcripcion</p></body></html>")
+        with open(os.path.join(local_dir, LOCAL_ONLY), "wb") as f:
+            f.write(local)
+        with open(os.path.join(workdir, "secreto.txt"), "w") as f:
+            f.write("no")
+
+        seen = []
+        s3_port, proxy_port, down_port = free_port(), free_port(), free_port()
+        s3 = start_server(build_s3_stub(s3_dir, seen), s3_port)
+        proxy = TranscriptProxy(f"http://127.0.0.1:{s3_port}", local_dir)
+        # Storage caído: nada escucha en el puerto
+        down_proxy = TranscriptProxy(f"http://127.0.0.1:{free_port()}", local_dir)
+        servers = [s3, start_server(build_proxy_app(proxy), proxy_port),
+                   start_server(build_proxy_app(down_proxy), down_port)]
+        base, down_base = f"http://127.0.0.1:{proxy_port}", f"http://127.0.0.1:{down_port}"
+        try:
+            results = [
+                test_streaming(base, audio),
+                test_range_and_conditional(base, audio, seen),
+                test_disconnect(base, proxy),
+                test_local(base, down_base, local),
+            ]
+        finally:
+            for server in servers:
+                server.should_exit = True
+    print("=" * 60)
+    if all(results):
+        print("✅ Todas las pruebas pasaron")
+        return 0
+    print("❌ Algunas pruebas fallaron")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
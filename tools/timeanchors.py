@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Índice de anclas de tiempo de una transcripción HTML.
+
+Cada párrafo de una transcripción empieza con <span class="time" id="time-HH-MM-SS">
+(los ids los pone insert_summaries.py). Para enlazar una referencia del RAG con
+su párrafo basta la lista ordenada de segundos de esas anclas y sus ids: la
+búsqueda es un bisect en lugar de parsear el HTML completo.
+
+El índice se guarda junto a la transcripción en <transcripción>.anchors.json
+con el mtime y el tamaño del HTML del que se sacó; si el HTML cambia, el
+sidecar deja de valer y se reconstruye.
+
+Uso (precalcular los sidecars de un directorio al publicar):
+    python tools/timeanchors.py /path/to/transcriptions
+"""
+
+import argparse
+import bisect
+import glob
+import json
+import logging
+import os
+import re
+import sys
+from typing import List, Optional, Tuple
+
+SIDECAR_SUFFIX = ".anchors.json"
+SIDECAR_VERSION = 1
+
+_SPAN_TAG = re.compile(r'<span\b([^>]*)>', re.IGNORECASE)
+_ATTR = re.compile(r'([\w-]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+_TIME_ID = re.compile(r'time-(\d+)-(\d+)-(\d+)')
+
+
+class TimeAnchorIndex:
+    """Segundos de las anclas de una transcripción (ordenados) y sus ids."""
+
+    def __init__(self, seconds: List[int], ids: List[str]):
+        self.seconds = seconds
+        self.ids = ids
+
+    @classmethod
+    def from_anchors(cls, anchors: List[Tuple[int, str]]) -> "TimeAnchorIndex":
+        """
+        Construye el índice a partir de (segundos, id) en orden de documento.
+        Si varias anclas tienen los mismos segundos se queda la primera.
+        """
+        seconds, ids = [], []
+        # sorted es estable: a igualdad de segundos se mantiene el orden del documento
+        for secs, anchor_id in sorted(anchors, key=lambda a: a[0]):
+            if seconds and seconds[-1] == secs:
+                continue
+            seconds.append(secs)
+            ids.append(anchor_id)
+        return cls(seconds, ids)
+
+    @classmethod
+    def from_html(cls, html: str) -> "TimeAnchorIndex":
+        return cls.from_anchors(extract_anchors(html))
+
+    def nearest(self, target_seconds: float) -> Optional[str]:
+        """Id del ancla más cercana anterior (o igual) a target_seconds, o None."""
+        pos = bisect.bisect_right(self.seconds, target_seconds) - 1
+        return self.ids[pos] if pos >= 0 else None
+
+    def __len__(self) -> int:
+        return len(self.seconds)
+
+    def to_dict(self) -> dict:
+        return {"seconds": self.seconds, "ids": self.ids}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "TimeAnchorIndex":
+        return cls(list(data["seconds"]), list(data["ids"]))
+
+
+def extract_anchors(html: str) -> List[Tuple[int, str]]:
+    """Devuelve (segundos, id) de cada <span class="time" id="time-HH-MM-SS"> en orden de documento."""
+    anchors = []
+    for m in _SPAN_TAG.finditer(html):
+        attrs_text = m.group(1)
+        # La inmensa mayoría de spans (confianza, hablantes) no tienen ancla
+        if 'time' not in attrs_text:
+            continue
+        attrs = {name.lower(): dq or sq for name, dq, sq in _ATTR.findall(attrs_text)}
+        if "time" not in attrs.get("class", "").split():
+            continue
+        sid = attrs.get("id", "")
+        tm = _TIME_ID.fullmatch(sid)
+        if not tm:
+            if sid:
+                logging.debug(f"Id de ancla de tiempo no válido: {sid}")
+            continue
+        hh, mm, ss = map(int, tm.groups())
+        anchors.append((hh * 3600 + mm * 60 + ss, sid))
+    return anchors
+
+
+def sidecar_path(html_path: str) -> str:
+    return html_path + SIDECAR_SUFFIX
+
+
+def file_validators(html_path: str) -> dict:
+    st = os.stat(html_path)
+    return {"mtime_ns": st.st_mtime_ns, "size": st.st_size}
+
+
+def load_sidecar(html_path: str, validators: dict) -> Optional[TimeAnchorIndex]:
+    """Lee el sidecar de una transcripción si existe y corresponde a la versión actual del HTML."""
+    try:
+        with open(sidecar_path(html_path), encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logging.warning(f"Sidecar de anclas ilegible para {html_path}: {e}")
+        return None
+    if data.get("version") != SIDECAR_VERSION or data.get("source") != validators:
+        logging.debug(f"Sidecar de anclas desactualizado para {html_path}")
+        return None
+    return TimeAnchorIndex.from_dict(data)
+
+
+def write_sidecar(html_path: str, index: TimeAnchorIndex, validators: dict) -> bool:
+    """
+    Guarda el sidecar junto a la transcripción (escritura atómica).
+    Es una optimización: si el directorio no admite escritura se registra y se sigue.
+    """
+    path = sidecar_path(html_path)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"version": SIDECAR_VERSION, "source": validators, **index.to_dict()}, f,
+                      separators=(",", ":"))
+        os.replace(tmp, path)
+        return True
+    except OSError as e:
+        logging.warning(f"No se pudo guardar el sidecar de anclas {path}: {e}")
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        return False
+
+
+def build_sidecar(html_path: str) -> TimeAnchorIndex:
+    """Parsea una transcripción local y escribe su sidecar."""
+    validators = file_validators(html_path)
+    with open(html_path, encoding="utf-8") as f:
+        index = TimeAnchorIndex.from_html(f.read())
+    write_sidecar(html_path, index, validators)
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Precalcula los índices de anclas de tiempo (<html>.anchors.json) de las transcripciones."
+    )
+    parser.add_argument("transcript_dir", help="Directorio de las transcripciones HTML")
+    parser.add_argument("--pattern", default="*.html", help="Patrón de los ficheros (por defecto *.html)")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.transcript_dir):
+        logging.error(f"El directorio de transcripciones {args.transcript_dir} no existe")
+        return 1
+    built = 0
+    for html_path in sorted(glob.glob(os.path.join(args.transcript_dir, args.pattern))):
+        index = build_sidecar(html_path)
+        logging.info(f"{os.path.basename(html_path)}: {len(index)} anclas")
+        built += 1
+    logging.info(f"Sidecars de anclas generados: {built}")
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    sys.exit(main())